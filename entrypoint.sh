@@ -7,14 +7,20 @@ redis-server --daemonize yes
 celery --app=service:celery beat --loglevel=INFO &
 celery --app=service:celery worker --loglevel=INFO &
 
-# Run the gunicorn server
+# Run the gunicorn server. Threaded workers are used so that clients long polling the status of a
+# task don't block other requests. The API holds at most GUNICORN_THREADS - 1 status requests at
+# once (in each worker), so a thread is always free for other requests.
+export GUNICORN_WORKERS=${GUNICORN_WORKERS:-1}
+export GUNICORN_THREADS=${GUNICORN_THREADS:-8}
+GUNICORN_ARGS="--worker-class gthread --workers $GUNICORN_WORKERS --threads $GUNICORN_THREADS"
+
 CERT_FILE=service.crt
 KEY_FILE=service.key
 if [ -f "$CERT_FILE" ]; then
     echo "SSL Certificates Found. Will serve over HTTPS."
-    exec gunicorn -b :8000  --certfile=service.crt --keyfile=service.key --timeout 300 --graceful-timeout 60 --access-logfile - --error-logfile - service:app
+    exec gunicorn -b :8000 $GUNICORN_ARGS --certfile=service.crt --keyfile=service.key --timeout 300 --graceful-timeout 60 --access-logfile - --error-logfile - service:app
 else
     echo "WARNING: No SSL certificates found. Generate them with 'manage ssl'."
     echo "Running without SSL, not suitable for production use."
-    exec gunicorn -b :8000  --timeout 300 --graceful-timeout 60 --access-logfile - --error-logfile - service:app
+    exec gunicorn -b :8000 $GUNICORN_ARGS --timeout 300 --graceful-timeout 60 --access-logfile - --error-logfile - service:app
 fi
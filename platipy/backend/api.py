@@ -16,6 +16,7 @@ import datetime
 import json
 import os
 import tempfile
+import threading
 import time
 import uuid
 import werkzeug
@@ -32,7 +33,7 @@ from platipy.backend import app, api
 from platipy.dicom.communication import DicomConnector
 
 from .models import db, AlchemyEncoder, APIKey, Dataset, DataObject, DicomLocation
-from .tasks import run_task, retrieve_task
+from .tasks import run_task, retrieve_task, get_fan_out_status
 
 
 class CustomConfig(object):
@@ -58,42 +59,115 @@ class Resource(flask_restful.Resource):
     method_decorators = [authenticate]  # applies to all inherited resources
 
 
-class TaskStatus(Resource):
-    def get(self, task_id):
-        """Get the status of a task given the ID"""
-        task = run_task.AsyncResult(task_id)
-        if task.state == "PENDING":
-            response = {
-                "state": task.state,
-                "current": 0,
-                "total": 1,
-                "status": "Pending...",
-            }
-        elif task.state != "FAILURE":
-
-            if task.info:
-                response = {
-                    "state": task.state,
-                    "current": task.info.get("current", 0),
-                    "total": task.info.get("total", 1),
-                    "status": task.info.get("status", ""),
-                }
-                if "result" in task.info:
-                    response["result"] = task.info["result"]
-                if "series" in task.info:
-                    response["series"] = task.info["series"]
-            else:
-                response = {"state": task.state}
+# The longest time (in seconds) a status request waits for the task to change. This must stay well
+# below the gunicorn worker timeout (see entrypoint.sh).
+TASK_STATUS_MAX_WAIT = 30
+TASK_STATUS_CHECK_INTERVAL = 0.5
 
-        else:
-            # something went wrong in the background job
+# Each waiting status request occupies a server thread, so only this many wait at once (in each
+# worker process), and further requests respond straight away. Defaults to all but one of the
+# gunicorn threads, so that other requests are always served (and none wait with a single thread).
+TASK_STATUS_MAX_WAITING = int(
+    os.environ.get(
+        "TASK_STATUS_MAX_WAITING", max(int(os.environ.get("GUNICORN_THREADS", 1)) - 1, 0)
+    )
+)
+task_status_waiting = threading.BoundedSemaphore(max(TASK_STATUS_MAX_WAITING, 1))
+
+
+def get_task_status(task_id):
+    """Get the status of a task given the ID"""
+    task = run_task.AsyncResult(task_id)
+    if task.state == "PENDING":
+        response = {
+            "state": task.state,
+            "current": 0,
+            "total": 1,
+            "status": "Pending...",
+        }
+    elif task.state != "FAILURE":
+
+        if task.info and "group_id" in task.info:
+            # The algorithm was split across workers
+            response = get_fan_out_status(task.info)
+        elif task.info:
             response = {
                 "state": task.state,
-                "current": 1,
-                "total": 1,
-                "status": str(task.info),  # this is the exception raised
+                "current": task.info.get("current", 0),
+                "total": task.info.get("total", 1),
+                "status": task.info.get("status", ""),
             }
-        return response
+            if "result" in task.info:
+                response["result"] = task.info["result"]
+            if "series" in task.info:
+                response["series"] = task.info["series"]
+        else:
+            response = {"state": task.state}
+
+    else:
+        # something went wrong in the background job
+        response = {
+            "state": task.state,
+            "current": 1,
+            "total": 1,
+            "status": str(task.info),  # this is the exception raised
+        }
+    return response
+
+
+class TaskStatus(Resource):
+
+    parser = reqparse.RequestParser()
+    parser.add_argument(
+        "wait",
+        type=float,
+        default=0,
+        location="args",
+        help="Seconds to wait for the status to differ from the one given",
+    )
+    parser.add_argument("state", location="args", help="The last state seen by the client")
+    parser.add_argument("current", type=int, location="args", help="The last progress seen")
+    parser.add_argument("status", location="args", help="The last status message seen")
+
+    def get(self, task_id):
+        """Get the status of a task given the ID.
+
+        If wait is given, the request is held (long polling) until the state, current progress or
+        status message of the task differs from those given, or until wait seconds have passed.
+        This saves clients from repeatedly polling while nothing is happening. If
+        TASK_STATUS_MAX_WAITING requests are already waiting, the request responds straight away.
+        """
+
+        args = self.parser.parse_args()
+        wait = min(max(args["wait"], 0), TASK_STATUS_MAX_WAIT)
+
+        waiting = (
+            wait > 0
+            and TASK_STATUS_MAX_WAITING > 0
+            and task_status_waiting.acquire(blocking=False)
+        )
+        if not waiting:
+            wait = 0
+
+        deadline = time.monotonic() + wait
+
+        try:
+            while True:
+                response = get_task_status(task_id)
+
+                unchanged = (
+                    response.get("state") == args["state"]
+                    and response.get("current") == args["current"]
+                    and response.get("status") == args["status"]
+                )
+
+                if not unchanged or time.monotonic() >= deadline:
+                    return response
+
+                time.sleep(TASK_STATUS_CHECK_INTERVAL)
+        finally:
+            if waiting:
+                task_status_waiting.release()
 
 
 class DicomLocationEndpoint(Resource):
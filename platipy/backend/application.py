@@ -14,20 +14,28 @@
 
 import json
 import os
+import tempfile
 
 from flask import Flask
 from loguru import logger
 import pydicom
 
-from pymedphys._dicom.connect.listen import DicomListener
+from platipy.dicom.communication import DicomConnector
+
+ALGORITHM_PARTITIONS = (None, "object", "parent")
 
 
 class Algorithm:
-    def __init__(self, name, function, default_settings):
+    def __init__(self, name, function, default_settings, partition=None):
         self.name = name
         self.function = function
         self.default_settings = default_settings
 
+        # How the input data objects of a dataset may be split across workers: None (all data
+        # objects are passed in a single call), "object" (each data object is processed
+        # independently) or "parent" (data objects sharing a parent are processed together)
+        self.partition = partition
+
     def settings_to_json(self):
         return json.dumps(self.default_settings, indent=4)
 
@@ -45,9 +53,13 @@ class FlaskApp(Flask):
 
     api = None  # Holds reference to api for extensibility
 
-    def register(self, name, default_settings=None):
+    def register(self, name, default_settings=None, partition=None):
+
+        if partition not in ALGORITHM_PARTITIONS:
+            raise ValueError(f"partition must be one of {ALGORITHM_PARTITIONS}")
+
         def decorator(f):
-            self.algorithms.update({name: Algorithm(name, f, default_settings)})
+            self.algorithms.update({name: Algorithm(name, f, default_settings, partition)})
             return f
 
         return decorator
@@ -102,8 +114,9 @@ class FlaskApp(Flask):
                 f = os.path.join(dicom_path, f)
 
                 try:
-                    d = pydicom.read_file(f)
+                    d = pydicom.read_file(f, stop_before_pixels=True)
                     series_uid = d.SeriesInstanceUID
+                    break
                 except Exception as e:
                     logger.debug("No Series UID in: {0}".format(f))
                     logger.debug(e)
@@ -130,11 +143,16 @@ class FlaskApp(Flask):
                 db.session.commit()
 
         try:
-            dicom_listener = DicomListener(
-                port=listen_port, ae_title=listen_ae_title, on_released_callback=series_recieved
+            dicom_listener = DicomConnector(port=listen_port, output_directory=tempfile.mkdtemp())
+
+            # A series is processed once it is complete, i.e. when no more of its instances have
+            # been received for a few seconds, or the association sending it is released
+            dicom_listener.listen(
+                series_recieved,
+                ae_title=listen_ae_title,
+                series_complete_callback=series_recieved,
+                block=False,
             )
 
-            dicom_listener.start()
-
         except Exception as e:
             logger.error("Listener Error: " + str(e))
@@ -15,13 +15,13 @@
 import time
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 
 import requests
 
 from loguru import logger
 
-
 API_DICOM_LOCATION = "{0}/api/dicomlocation"
 API_DATASET = "{0}/api/dataset"
 API_DATASET_READY = "{0}/api/dataset/ready"
@@ -30,11 +30,13 @@ API_TRIGGER = "{0}/api/trigger"
 API_ALGORITHM = "{0}/api/algorithm"
 API_DOWNLOAD_OBJECT = "{0}/api/dataobject/download"
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 class PlatiPyClient:
     """Client to help iteract with the framework implemented within PlatiPy."""
 
-    def __init__(self, host, port, api_key, algorithm_name, verify=None):
+    def __init__(self, host, port, api_key, algorithm_name, verify=None, max_workers=4):
         """Initialize an instance of the client. Will test to ensure that the host it reachable
 
         Arguments:
@@ -42,6 +44,13 @@ class PlatiPyClient:
             port {int} -- Port number server is using to running service
             api_key {str} -- The API Key created for this app on the server
             algorithm_name {str} -- The name fo the algorithm to use within the service
+
+        Keyword Arguments:
+            verify {str} -- Path to the certificate to verify the server with. Runs without SSL if
+                            not set (default: {None})
+            max_workers {int} -- The number of output objects downloaded concurrently, which is
+                                 also the number of connections kept open to the server
+                                 (default: {4})
         """
 
         protocol = "https"
@@ -61,12 +70,17 @@ class PlatiPyClient:
 
         self.api_key = api_key
         self.algorithm_name = algorithm_name
+        self.max_workers = max_workers
 
-        res = requests.get(
-            API_ALGORITHM.format(self.base_url),
-            headers={"API_KEY": self.api_key},
-            verify=self.verify,
-        )
+        # A session re-uses connections to the server between requests
+        self.session = requests.Session()
+        self.session.headers["API_KEY"] = self.api_key
+        self.session.verify = self.verify
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(max_workers, 1))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        res = self.session.get(API_ALGORITHM.format(self.base_url))
         logger.debug(res.status_code)
 
     def get_dicom_location(self, name):
@@ -79,11 +93,7 @@ class PlatiPyClient:
             dict -- The dicom location dictionary object, or None if it doesn't exist
         """
 
-        res = requests.get(
-            API_DICOM_LOCATION.format(self.base_url),
-            headers={"API_KEY": self.api_key},
-            verify=self.verify,
-        )
+        res = self.session.get(API_DICOM_LOCATION.format(self.base_url))
         logger.debug(res.status_code)
 
         for location in res.json():
@@ -118,12 +128,7 @@ class PlatiPyClient:
         if ae_title:
             params["ae_title"] = ae_title
 
-        res = requests.post(
-            API_DICOM_LOCATION.format(self.base_url),
-            headers={"API_KEY": self.api_key},
-            data=params,
-            verify=self.verify,
-        )
+        res = self.session.post(API_DICOM_LOCATION.format(self.base_url), data=params)
         logger.debug(res.status_code)
 
         if res.status_code >= 200 and res.status_code < 300:
@@ -150,10 +155,8 @@ class PlatiPyClient:
         if isinstance(dataset, dict):
             params["dataset"] = dataset["id"]
 
-        res = requests.get(
-            "{0}/{1}".format(API_DATASET.format(self.base_url), params["dataset"]),
-            headers={"API_KEY": self.api_key},
-            verify=self.verify,
+        res = self.session.get(
+            "{0}/{1}".format(API_DATASET.format(self.base_url), params["dataset"])
         )
         logger.debug(res.status_code)
 
@@ -180,10 +183,8 @@ class PlatiPyClient:
         if isinstance(dataset, dict):
             params["dataset"] = dataset["id"]
 
-        res = requests.get(
-            "{0}/{1}".format(API_DATASET_READY.format(self.base_url), params["dataset"]),
-            headers={"API_KEY": self.api_key},
-            verify=self.verify,
+        res = self.session.get(
+            "{0}/{1}".format(API_DATASET_READY.format(self.base_url), params["dataset"])
         )
         logger.debug(res.status_code)
 
@@ -229,12 +230,7 @@ class PlatiPyClient:
         if timeout:
             params["timeout"] = timeout
 
-        res = requests.post(
-            API_DATASET.format(self.base_url),
-            headers={"API_KEY": self.api_key},
-            data=params,
-            verify=self.verify,
-        )
+        res = self.session.post(API_DATASET.format(self.base_url), data=params)
         logger.debug(res.status_code)
 
         if res.status_code >= 200 and res.status_code < 300:
@@ -298,12 +294,7 @@ class PlatiPyClient:
             params["seriesUID"] = series_uid
             params["dicom_retrieve"] = dicom_retrieve
 
-            res = requests.post(
-                API_DATA_OBJECT.format(self.base_url),
-                headers={"API_KEY": self.api_key},
-                data=params,
-                verify=self.verify,
-            )
+            res = self.session.post(API_DATA_OBJECT.format(self.base_url), data=params)
             logger.debug(res.status_code)
 
             if res.status_code >= 200:
@@ -319,12 +310,10 @@ class PlatiPyClient:
 
             with open(file_path, "rb") as file_handle:
 
-                res = requests.post(
+                res = self.session.post(
                     API_DATA_OBJECT.format(self.base_url),
-                    headers={"API_KEY": self.api_key},
                     data=params,
                     files={"file_data": file_handle},
-                    verify=self.verify,
                 )
                 logger.debug(res.status_code)
 
@@ -342,11 +331,7 @@ class PlatiPyClient:
         """
 
         algorithm = None
-        res = requests.get(
-            API_ALGORITHM.format(self.base_url),
-            headers={"API_KEY": self.api_key},
-            verify=self.verify,
-        )
+        res = self.session.get(API_ALGORITHM.format(self.base_url))
         logger.debug(res.status_code)
         if res.status_code == 200:
             for algorithm in res.json():
@@ -359,12 +344,20 @@ class PlatiPyClient:
                     logger.error("No default_settings provided by algorithm")
         return None
 
-    def run_algorithm(self, dataset, config=None):
+    def run_algorithm(self, dataset, config=None, poll_interval=1, poll_wait=20):
         """Runs the algorithm on the dataset specified
 
         Arguments:
             dataset {dict/int} -- The dataset on which to run the algorithm
 
+        Keyword Arguments:
+            config {dict} -- The algorithm settings (default: {None})
+            poll_interval {float} -- The minimum time between status requests (default: {1})
+            poll_wait {float} -- How long the server should hold each status request until the
+                                 status changes (long polling). The server responds straight
+                                 away if it has no thread to spare, and poll_interval applies.
+                                 Set to 0 to poll every poll_interval (default: {20})
+
         Yields:
             dict -- Status of the run
         """
@@ -385,20 +378,20 @@ class PlatiPyClient:
 
             params["config"] = json.dumps(config)
 
-        res = requests.post(
-            API_TRIGGER.format(self.base_url),
-            headers={"API_KEY": self.api_key},
-            data=params,
-            verify=self.verify,
-        )
+        res = self.session.post(API_TRIGGER.format(self.base_url), data=params)
         logger.debug(res.status_code)
 
         if res.status_code == 200:
-            # Poll the URL given to determine the progress of the task
+            # Poll the URL given to determine the progress of the task. If poll_wait is given, the
+            # server holds each request until the status differs from the last one seen (or
+            # poll_wait passes).
             poll_url = "{0}{1}".format(self.base_url, res.json()["poll"])
+            poll_params = {"wait": poll_wait}
 
             while True:
-                res = requests.get(poll_url, headers={"API_KEY": self.api_key}, verify=self.verify)
+                poll_start = time.monotonic()
+
+                res = self.session.get(poll_url, params=poll_params)
                 status = res.json()
 
                 if (
@@ -410,13 +403,57 @@ class PlatiPyClient:
 
                 yield status
 
-                time.sleep(1)
+                poll_params = {
+                    "wait": poll_wait,
+                    "state": status.get("state"),
+                    "current": status.get("current"),
+                    "status": status.get("status"),
+                }
+
+                # Servers which don't support waiting respond straight away
+                time.sleep(max(poll_interval - (time.monotonic() - poll_start), 0))
         else:
             logger.error(res.json())
 
         logger.info("Algorithm Processing Complete")
 
-    def download_output_objects(self, dataset, output_path="."):
+    def download_output_object(self, data_object, output_path="."):
+        """Downloads an output object to the output path. The file is streamed to disk in chunks.
+
+        Arguments:
+            data_object {dict/int} -- The data object to download
+
+        Keyword Arguments:
+            output_path {str} -- The directory in which the object should be downloaded
+                                 (default: {"."})
+
+        Returns:
+            str -- The path of the downloaded file, or None if something went wrong
+        """
+
+        data_object_id = data_object
+        if isinstance(data_object, dict):
+            data_object_id = data_object["id"]
+
+        url = API_DOWNLOAD_OBJECT.format(self.base_url)
+        with self.session.get("{0}/{1}".format(url, data_object_id), stream=True) as res:
+            logger.debug(res.status_code)
+
+            if res.status_code != 200:
+                logger.error(res.json())
+                return None
+
+            filename = res.headers["Content-Disposition"].split("filename=")[1]
+
+            output_file = os.path.join(output_path, filename)
+            logger.info("Downloading to: {0}".format(output_file))
+            with open(output_file, "wb") as file_handle:
+                for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    file_handle.write(chunk)
+
+        return output_file
+
+    def download_output_objects(self, dataset, output_path=".", max_workers=None):
         """Downloads the output objects from the dataset specified to the output path
 
         Arguments:
@@ -425,24 +462,32 @@ class PlatiPyClient:
         Keyword Arguments:
             output_path {str} -- The directory in which the objects should be downloaded
                                  (default: {"."})
+            max_workers {int} -- The number of objects downloaded concurrently. Uses the
+                                 max_workers of the client if not set (default: {None})
+
+        Returns:
+            list -- The paths of the downloaded files (None for those which couldn't be
+                    downloaded)
         """
 
+        if max_workers is None:
+            max_workers = self.max_workers
+
         if not os.path.exists(output_path):
             logger.info("Creating directory")
             os.makedirs(output_path)
 
         dataset = self.get_dataset(dataset)
-        if dataset:
-            for data_obj in dataset["output_data_objects"]:
-                url = API_DOWNLOAD_OBJECT.format(self.base_url)
-                res = requests.get(
-                    "{0}/{1}".format(url, data_obj["id"]),
-                    headers={"API_KEY": self.api_key},
-                    verify=self.verify,
+        if not dataset:
+            return []
+
+        data_objects = dataset["output_data_objects"]
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            return list(
+                executor.map(
+                    lambda data_obj: self.download_output_object(
+                        data_obj, output_path=output_path
+                    ),
+                    data_objects,
                 )
-                logger.debug(res.status_code)
-                filename = res.headers["Content-Disposition"].split("filename=")[1]
-
-                output_file = os.path.join(output_path, filename)
-                logger.info("Downloading to: {0}".format(output_file))
-                open(output_file, "wb").write(res.content)
+            )
@@ -31,7 +31,9 @@ body_settings_defaults = {
 }
 
 
-@app.register("Primitive Body Segmentation", default_settings=body_settings_defaults)
+@app.register(
+    "Primitive Body Segmentation", default_settings=body_settings_defaults, partition="object"
+)
 def primitive_body_segmentation(data_objects, working_dir, settings):
 
     logger.info("Running Primitive Body Segmentation")
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from celery import chord
+from celery.result import GroupResult
 from celery.schedules import crontab
 
 from loguru import logger
@@ -21,6 +23,7 @@ import os
 import datetime
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 from platipy.backend import celery, db, app
@@ -135,37 +138,47 @@ def move_task(task, endpoint, seriesUIDs, host, port, ae_title):
     total = len(seriesUIDs)
     count = 0
 
-    dicom_connector = DicomConnector(host=host, port=port, ae_title=ae_title)
-
-    task.update_state(
-        state="PROGRESS",
-        meta={"current": count, "total": total, "status": "Verifying dicom location"},
-    )
-
-    dicom_verify = dicom_connector.verify()
-
-    if dicom_verify == None:
-        return {
-            "current": 100,
-            "total": 100,
-            "status": "Unable to connect to dicom location",
-        }
-
-    for suid in seriesUIDs:
+    with DicomConnector(host=host, port=port, ae_title=ae_title) as dicom_connector:
 
         task.update_state(
             state="PROGRESS",
             meta={
                 "current": count,
                 "total": total,
-                "status": "Moving series for UID: {0}".format(suid),
+                "status": "Verifying dicom location",
             },
         )
 
-        logger.info("Moving Series with UID: {0}".format(suid))
-        dicom_connector.move_series(suid)
-
-        count = count + 1
+        dicom_verify = dicom_connector.verify()
+
+        if not dicom_verify:
+            return {
+                "current": 100,
+                "total": 100,
+                "status": "Unable to connect to dicom location",
+            }
+
+        # Series are moved concurrently, over the associations kept open by the connector
+        with ThreadPoolExecutor(
+            max_workers=dicom_connector.max_associations
+        ) as executor:
+            futures = {}
+            for suid in seriesUIDs:
+                logger.info("Moving Series with UID: {0}".format(suid))
+                futures[executor.submit(dicom_connector.move_series, suid)] = suid
+
+            for future in as_completed(futures):
+                future.result()
+                count = count + 1
+
+                task.update_state(
+                    state="PROGRESS",
+                    meta={
+                        "current": count,
+                        "total": total,
+                        "status": "Moved series for UID: {0}".format(futures[future]),
+                    },
+                )
 
     task.update_state(
         state="SUCCESS",
@@ -173,10 +186,201 @@ def move_task(task, endpoint, seriesUIDs, host, port, ae_title):
     )
 
 
+def partition_data_objects(data_objects, partition):
+    """Splits the input data objects of a dataset into groups which can be processed separately
+
+    Args:
+        data_objects (list): The input DataObjects of the dataset
+        partition (str): "object" to process each data object separately, or "parent" to keep
+            data objects sharing the same (top level) parent together
+
+    Returns:
+        list: Lists of DataObjects, in the order they first appear in data_objects
+    """
+
+    partitions = {}
+    for do in data_objects:
+
+        key = do.id
+        if partition == "parent":
+            root = do
+            while root.parent is not None:
+                root = root.parent
+            key = root.id
+
+        partitions.setdefault(key, []).append(do)
+
+    return list(partitions.values())
+
+
+def run_algorithm(algorithm, config, input_objects):
+    """Runs an algorithm on some input DataObjects in a new working directory"""
+
+    if config is None:
+        return algorithm.function(input_objects, tempfile.mkdtemp())
+
+    return algorithm.function(input_objects, tempfile.mkdtemp(), config)
+
+
+def save_output_data_objects(ds, output_data_objects):
+    """Saves the output DataObjects of an algorithm, and sends DICOM objects to the Dataset's
+    Dicom To location"""
+
+    dicom_objects = []
+    for do in output_data_objects:
+        do.dataset_id = ds.id
+        db.session.add(do)
+        db.session.commit()
+
+        if do.type == "DICOM":
+            dicom_objects.append(do)
+
+    if len(dicom_objects) == 0:
+        return
+
+    if not ds.to_dicom_location:
+        logger.warning(
+            "DICOM Data Object output but not Dicom To location defined in Dataset"
+        )
+        return
+
+    logger.info("Sending to Dicom To Location")
+    with DicomConnector(
+        host=ds.to_dicom_location.host,
+        port=ds.to_dicom_location.port,
+        ae_title=ds.to_dicom_location.ae_title,
+    ) as dicom_connector:
+        dicom_verify = dicom_connector.verify()
+
+        if not dicom_verify:
+            logger.error(
+                "Unable to connect to Dicom Location: {0} {1} {2}".format(
+                    ds.to_dicom_location.host,
+                    ds.to_dicom_location.port,
+                    ds.to_dicom_location.ae_title,
+                )
+            )
+            return
+
+        # All objects are sent at once, spread over several associations
+        send_results = dicom_connector.send_dcm_files([do.path for do in dicom_objects])
+
+    for do, send_result in zip(dicom_objects, send_results):
+        if send_result:
+            do.is_sent = True
+            db.session.add(do)
+    db.session.commit()
+
+
+@celery.task(bind=True)
+def run_partition_task(task, algorithm_name, config, dataset_id, data_object_ids):
+    """
+    Runs an algorithm on part of the input data objects of a dataset, see run_task
+    """
+
+    # Commit to refresh session
+    db.session.commit()
+
+    algorithm = app.algorithms[algorithm_name]
+
+    ds = Dataset.query.filter_by(id=dataset_id).first()
+    input_objects = [DataObject.query.filter_by(id=i).first() for i in data_object_ids]
+
+    logger.info(
+        "Running algorithm {0} on data objects: {1}".format(
+            algorithm_name, data_object_ids
+        )
+    )
+
+    output_data_objects = run_algorithm(algorithm, config, input_objects)
+
+    if not output_data_objects:
+        logger.warning(
+            "Algorithm ({0}) did not return any output objects for data objects: {1}".format(
+                algorithm_name, data_object_ids
+            )
+        )
+        return []
+
+    save_output_data_objects(ds, output_data_objects)
+
+    return [do.id for do in output_data_objects]
+
+
+@celery.task(bind=True)
+def collect_partitions_task(task, output_data_object_ids, algorithm_name, start):
+    """
+    Gathers the output data objects once all partitions of a dataset have been processed
+    """
+
+    output_data_object_ids = [i for ids in output_data_object_ids for i in ids]
+
+    logger.info("Dataset processing complete, took: " + str(time.time() - start))
+    logger.info("Number of data objects generated: " + str(len(output_data_object_ids)))
+
+    return {
+        "status": "Running Algorithm Complete: {0}".format(algorithm_name),
+        "output_data_objects": output_data_object_ids,
+    }
+
+
+def get_fan_out_status(info):
+    """Determines the aggregate status of a run_task which was split across workers
+
+    Args:
+        info (dict): The result of the run_task
+
+    Returns:
+        dict: The state, progress (in data objects processed) and status of the task
+    """
+
+    collect_result = celery.AsyncResult(info["collect_id"])
+
+    # The group may no longer be stored once the results expire
+    group_result = GroupResult.restore(info["group_id"], app=celery)
+    partition_results = group_result.results if group_result else []
+
+    total = sum(info["partition_sizes"])
+    current = sum(
+        size
+        for size, result in zip(info["partition_sizes"], partition_results)
+        if result.successful()
+    )
+
+    failed_results = [r for r in partition_results + [collect_result] if r.failed()]
+    if len(failed_results) > 0:
+        return {
+            "state": "FAILURE",
+            "current": current,
+            "total": total,
+            "status": str(failed_results[0].info),
+        }
+
+    if collect_result.successful():
+        return {
+            "state": "SUCCESS",
+            "current": total,
+            "total": total,
+            **collect_result.info,
+        }
+
+    return {
+        "state": "RUNNING",
+        "current": current,
+        "total": total,
+        "status": info["status"],
+    }
+
+
 @celery.task(bind=True)
 def run_task(task, algorithm_name, config, dataset_id):
+    """
+    Runs an algorithm on the input data objects of a dataset.
 
-    task_id = task.request.id
+    If the algorithm was registered with a partition, the data objects are split into groups
+    which are processed by separate run_partition_tasks (across all available workers). In this
+    case the task returns once these are queued, see get_fan_out_status for the progress.
+    """
 
     start = time.time()
 
@@ -203,56 +407,40 @@ def run_task(task, algorithm_name, config, dataset_id):
 
     task.update_state(state="RUNNING", meta=state_details)
 
-    if config is None:
-        output_data_objects = algorithm.function(input_objects, tempfile.mkdtemp())
-    else:
-        output_data_objects = algorithm.function(
-            input_objects, tempfile.mkdtemp(), config
-        )
+    partitions = [input_objects]
+    if algorithm.partition:
+        partitions = partition_data_objects(input_objects, algorithm.partition)
 
-    if not output_data_objects:
-        logger.warning(
-            "Algorithm ({0}) did not return any output objects".format(algorithm_name)
-        )
+    if len(partitions) > 1:
+        logger.info("Splitting dataset into {0} partitions".format(len(partitions)))
 
-    # Save the data objects
-    for do in output_data_objects:
-        do.dataset_id = ds.id
-        db.session.add(do)
-        db.session.commit()
+        collect_result = chord(
+            run_partition_task.s(
+                algorithm_name, config, dataset_id, [do.id for do in partition]
+            )
+            for partition in partitions
+        )(collect_partitions_task.s(algorithm_name, start))
 
-        if do.type == "DICOM":
-            if ds.to_dicom_location:
+        # Save the group so that its progress can be restored when polling the status
+        collect_result.parent.save()
 
-                logger.info("Sending to Dicom To Location")
-                dicom_connector = DicomConnector(
-                    host=do.dataset.to_dicom_location.host,
-                    port=do.dataset.to_dicom_location.port,
-                    ae_title=do.dataset.to_dicom_location.ae_title,
-                )
-                dicom_verify = dicom_connector.verify()
-
-                if not dicom_verify:
-                    logger.error(
-                        "Unable to connect to Dicom Location: {0} {1} {2}".format(
-                            do.dataset.to_dicom_location.host,
-                            do.dataset.to_dicom_location.port,
-                            do.dataset.to_dicom_location.ae_title,
-                        )
-                    )
-                    continue
+        return {
+            **state_details,
+            "group_id": collect_result.parent.id,
+            "collect_id": collect_result.id,
+            "partition_sizes": [len(partition) for partition in partitions],
+        }
 
-                send_result = dicom_connector.send_dcm(do.path)
+    output_data_objects = run_algorithm(algorithm, config, input_objects)
 
-                if send_result:
-                    do.is_sent = True
-                    db.session.add(do)
-                    db.session.commit()
+    if not output_data_objects:
+        logger.warning(
+            "Algorithm ({0}) did not return any output objects".format(algorithm_name)
+        )
+        output_data_objects = []
 
-            else:
-                logger.warning(
-                    "DICOM Data Object output but not Dicom To location defined in Dataset"
-                )
+    # Save the data objects
+    save_output_data_objects(ds, output_data_objects)
 
     end = time.time()
     time_taken = end - start
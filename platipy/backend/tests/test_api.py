@@ -0,0 +1,73 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import os
+import tempfile
+import threading
+
+import pytest
+
+pytest.importorskip("celery")
+pytest.importorskip("flask_sqlalchemy")
+pytest.importorskip("flask_restful")
+
+# The backend writes its log and database to the WORK directory when imported
+os.environ.setdefault("WORK", tempfile.mkdtemp())
+
+from platipy.backend import api  # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def task_status(monkeypatch):
+    """Serves a task which is RUNNING for its first 3 status checks and SUCCESS after"""
+
+    checks = []
+
+    def get_task_status(task_id):
+        checks.append(task_id)
+        return {"state": "RUNNING" if len(checks) <= 3 else "SUCCESS"}
+
+    monkeypatch.setattr(api, "get_task_status", get_task_status)
+    monkeypatch.setattr(api, "TASK_STATUS_CHECK_INTERVAL", 0.01)
+    monkeypatch.setattr(api, "TASK_STATUS_MAX_WAITING", 1)
+    monkeypatch.setattr(api, "task_status_waiting", threading.BoundedSemaphore(1))
+
+    def get(**args):
+        with api.app.test_request_context(query_string=args):
+            return api.TaskStatus().get("task")
+
+    return get, checks
+
+
+def test_task_status_long_poll(task_status):
+
+    get, checks = task_status
+
+    assert get(wait=5, state="RUNNING") == {"state": "SUCCESS"}
+    assert len(checks) == 4
+
+
+def test_task_status_no_thread_to_wait(task_status):
+
+    get, checks = task_status
+
+    # Once the waiting requests use up their threads, other requests respond straight away
+    assert api.task_status_waiting.acquire(blocking=False)
+    assert get(wait=5, state="RUNNING") == {"state": "RUNNING"}
+    assert len(checks) == 1
+
+    api.task_status_waiting.release()
+    assert get(wait=5, state="RUNNING") == {"state": "SUCCESS"}
@@ -0,0 +1,177 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip("celery")
+pytest.importorskip("flask_sqlalchemy")
+pytest.importorskip("flask_restful")
+
+# The backend writes its log and database to the WORK directory when imported
+os.environ.setdefault("WORK", tempfile.mkdtemp())
+
+from platipy.backend import tasks  # pylint: disable=wrong-import-position
+
+
+class MockDataObject:
+    """A DataObject with only the fields used to partition a dataset"""
+
+    def __init__(self, do_id, parent=None):
+        self.id = do_id
+        self.parent = parent
+
+
+class MockResult:
+    """An AsyncResult in the given state"""
+
+    def __init__(self, state, info=None):
+        self.state = state
+        self.info = info
+
+    def successful(self):
+        return self.state == "SUCCESS"
+
+    def failed(self):
+        return self.state == "FAILURE"
+
+
+class MockGroupResult:
+    """A GroupResult of the given results"""
+
+    def __init__(self, results):
+        self.results = results
+
+
+def test_partition_data_objects():
+
+    patient_a = MockDataObject(1)
+    patient_b = MockDataObject(2)
+    series_a = MockDataObject(3, parent=patient_a)
+    series_b = MockDataObject(4, parent=patient_b)
+    structures_a = MockDataObject(5, parent=series_a)
+
+    data_objects = [series_b, series_a, structures_a, patient_b]
+
+    assert tasks.partition_data_objects(data_objects, "object") == [
+        [series_b],
+        [series_a],
+        [structures_a],
+        [patient_b],
+    ]
+
+    # Data objects are grouped by their top level parent, in the order they first appear
+    assert tasks.partition_data_objects(data_objects, "parent") == [
+        [series_b, patient_b],
+        [series_a, structures_a],
+    ]
+
+
+@pytest.fixture
+def fan_out(monkeypatch):
+    """Stores the results of a run_task split into partitions of 2, 3 and 1 data objects"""
+
+    results = {}
+    groups = {}
+
+    monkeypatch.setattr(tasks.celery, "AsyncResult", lambda task_id: results[task_id])
+    monkeypatch.setattr(
+        tasks.GroupResult, "restore", lambda group_id, app=None: groups.get(group_id)
+    )
+
+    info = {
+        "status": "Running Algorithm: test",
+        "group_id": "group",
+        "collect_id": "collect",
+        "partition_sizes": [2, 3, 1],
+    }
+
+    return info, results, groups
+
+
+def test_get_fan_out_status_running(fan_out):
+
+    info, results, groups = fan_out
+    groups["group"] = MockGroupResult(
+        [MockResult("SUCCESS", [7]), MockResult("STARTED"), MockResult("SUCCESS", [8])]
+    )
+    results["collect"] = MockResult("PENDING")
+
+    assert tasks.get_fan_out_status(info) == {
+        "state": "RUNNING",
+        "current": 3,
+        "total": 6,
+        "status": "Running Algorithm: test",
+    }
+
+
+def test_get_fan_out_status_success(fan_out):
+
+    info, results, groups = fan_out
+    groups["group"] = MockGroupResult([MockResult("SUCCESS", [i]) for i in range(3)])
+    results["collect"] = MockResult(
+        "SUCCESS", {"status": "Complete", "output_data_objects": [0, 1, 2]}
+    )
+
+    assert tasks.get_fan_out_status(info) == {
+        "state": "SUCCESS",
+        "current": 6,
+        "total": 6,
+        "status": "Complete",
+        "output_data_objects": [0, 1, 2],
+    }
+
+
+def test_get_fan_out_status_failure(fan_out):
+
+    info, results, groups = fan_out
+    groups["group"] = MockGroupResult(
+        [
+            MockResult("SUCCESS", [7]),
+            MockResult("FAILURE", ValueError("Algorithm failed")),
+            MockResult("STARTED"),
+        ]
+    )
+    results["collect"] = MockResult("PENDING")
+
+    assert tasks.get_fan_out_status(info) == {
+        "state": "FAILURE",
+        "current": 2,
+        "total": 6,
+        "status": "Algorithm failed",
+    }
+
+
+def test_get_fan_out_status_expired_group(fan_out):
+
+    info, results, _ = fan_out
+
+    # Once the group has expired, the progress of the partitions is unknown
+    results["collect"] = MockResult("PENDING")
+    assert tasks.get_fan_out_status(info) == {
+        "state": "RUNNING",
+        "current": 0,
+        "total": 6,
+        "status": "Running Algorithm: test",
+    }
+
+    results["collect"] = MockResult(
+        "SUCCESS", {"status": "Complete", "output_data_objects": [0, 1, 2]}
+    )
+    assert tasks.get_fan_out_status(info)["state"] == "SUCCESS"
+    assert tasks.get_fan_out_status(info)["current"] == 6
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import click
+
+from loguru import logger
+
+from platipy.imaging.projects.multiatlas.library import build_atlas_library
+
+logger.remove()
+logger.add(sys.stderr, level="DEBUG")
+
+
+@click.command()
+@click.option(
+    "--input_dir",
+    "-i",
+    required=True,
+    type=click.Path(exists=True),
+    help="Directory containing the NIfTI atlases.",
+)
+@click.option(
+    "--output_dir",
+    "-o",
+    required=True,
+    type=click.Path(),
+    help="Directory to write the atlas library to.",
+)
+@click.option(
+    "--atlas_id",
+    "-a",
+    multiple=True,
+    help="ID of an atlas to include. Can be given multiple times. By default all atlases found "
+    "in the input directory are included.",
+)
+@click.option(
+    "--structure",
+    "-s",
+    multiple=True,
+    help="Name of a structure to include. Can be given multiple times. By default all structures "
+    "found for each atlas are included.",
+)
+@click.option(
+    "--image_format",
+    default="Case_{0}/Images/Case_{0}_CROP.nii.gz",
+    show_default=True,
+    help="Path format of the atlas images, relative to the input directory. {0} is the atlas ID.",
+)
+@click.option(
+    "--label_format",
+    default="Case_{0}/Structures/Case_{0}_{1}_CROP.nii.gz",
+    show_default=True,
+    help="Path format of the atlas structures, relative to the input directory. {0} is the atlas "
+    "ID and {1} the structure name.",
+)
+@click.option(
+    "--crop_expansion_mm",
+    nargs=3,
+    type=float,
+    default=None,
+    help="Crop each atlas to its structures, expanded by this margin (in mm).",
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of worker processes used to convert the atlases.",
+)
+def click_command(
+    input_dir,
+    output_dir,
+    atlas_id,
+    structure,
+    image_format,
+    label_format,
+    crop_expansion_mm,
+    workers,
+):
+    """
+    Build a memory-mapped atlas library from a directory of NIfTI atlases.
+
+    Atlas images and structures are stored uncompressed, so they can be loaded quickly by the
+    segmentation algorithms. Set "atlas_library_path" in the atlas settings to use the library.
+    """
+
+    atlas_library = build_atlas_library(
+        input_dir,
+        output_dir,
+        atlas_id_list=list(atlas_id) if atlas_id else None,
+        atlas_structure_list=list(structure) if structure else None,
+        atlas_image_format=image_format,
+        atlas_label_format=label_format,
+        crop_atlas_expansion_mm=crop_expansion_mm,
+        executor="process" if workers > 1 else "serial",
+        max_workers=workers,
+    )
+
+    logger.info(f"Atlas library written to {output_dir}: {atlas_library.atlas_id_list}")
+
+
+if __name__ == "__main__":
+    click_command()  # pylint: disable=no-value-for-parameter
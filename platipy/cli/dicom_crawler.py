@@ -96,6 +96,35 @@ logger.add(sys.stderr, level="DEBUG")
     show_default=True,
     help="Use less verbose descriptions for DICOM images.",
 )
+@click.option(
+    "--index_executor",
+    type=click.Choice(["serial", "thread", "process"]),
+    default="serial",
+    show_default=True,
+    help="How DICOM headers are read when indexing the input directory.",
+)
+@click.option(
+    "--index_workers",
+    type=int,
+    default=None,
+    help="Maximum number of workers used to index the input directory.",
+)
+@click.option(
+    "--index_file",
+    type=click.Path(),
+    default=None,
+    help="SQLite file used to index the input directory between runs. When given, only new or "
+    "modified DICOM files are read, and only data which changed since the last run is converted.",
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of worker processes used to convert the data. Each patient (or other value of "
+    "the sort_by field) is converted by a single worker.",
+)
 @click.option(
     "--verbose",
     "-v",
@@ -114,6 +143,10 @@ def click_command(
     overwrite,
     file_suffix,
     short_description,
+    index_executor,
+    index_workers,
+    index_file,
+    workers,
     verbose,
 ):
     """
@@ -159,6 +192,10 @@ def click_command(
         overwrite_existing_files=overwrite,
         write_to_disk=True,
         verbose=verbose,
+        index_executor=index_executor,
+        index_workers=index_workers,
+        index_path=index_file,
+        workers=workers,
     )
 
     logger.info("########################")
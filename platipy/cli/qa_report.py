@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import click
+
+import matplotlib
+
+from loguru import logger
+
+# Figures are only written to disk, so don't use an interactive backend
+matplotlib.use("Agg")
+
+# pylint: disable=wrong-import-position
+from platipy.imaging.visualisation.batch import QA_FIGURE_FORMATS, render_qa_batch
+
+logger.remove()
+logger.add(sys.stderr, level="DEBUG")
+
+
+@click.command()
+@click.option(
+    "--manifest",
+    "-m",
+    required=True,
+    type=click.Path(exists=True),
+    help="JSON manifest listing the image and contours (and optionally the contours to compare "
+    "to) of each case.",
+)
+@click.option(
+    "--output_dir",
+    "-o",
+    required=True,
+    type=click.Path(),
+    help="Directory to write the figures to.",
+)
+@click.option(
+    "--format",
+    "-f",
+    "file_format",
+    type=click.Choice(QA_FIGURE_FORMATS),
+    default="png",
+    show_default=True,
+    help="Format of the figures.",
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of worker processes used to render the figures.",
+)
+def click_command(manifest, output_dir, file_format, workers):
+    """
+    Render QA figures of the contours of many cases.
+
+    The manifest is a JSON list of cases, or a dict with the list of "cases" and a "template" of
+    figure settings shared by all cases. Each case has an "id", an "image", "contours" (a dict of
+    name: path, or a directory of NIfTI files) and optionally "comparison" contours, in which case
+    a comparison figure with a table of metrics is rendered.
+    """
+
+    results = render_qa_batch(
+        manifest,
+        output_dir,
+        file_format=file_format,
+        executor="process" if workers > 1 else "serial",
+        max_workers=workers,
+    )
+
+    failed_cases = [case_id for case_id, path in results.items() if path is None]
+    if len(failed_cases) > 0:
+        logger.error(f"Could not render: {failed_cases}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    click_command()  # pylint: disable=no-value-for-parameter
@@ -25,6 +25,8 @@ from platipy.cli import (
     rtstruct_to_nifti,
     nifti_to_series,
     tcia_download,
+    atlas_library,
+    qa_report,
 )
 
 tools = {
@@ -34,6 +36,8 @@ tools = {
     "rtstruct_to_nifti": rtstruct_to_nifti.click_command,
     "nifti_to_series": nifti_to_series.click_command,
     "tcia-download": tcia_download.click_command,
+    "atlas_library": atlas_library.click_command,
+    "qa_report": qa_report.click_command,
 }
 
 # If backend tools are installed, then provide manage tools
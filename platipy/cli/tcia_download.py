@@ -64,7 +64,14 @@ logger.add(sys.stderr, level="DEBUG")
 @click.option(
     "--output", "-o", required=False, type=click.Path(), help="Path to directory to store output"
 )
-def click_command(collection, patients, modalities, nifti, output):
+@click.option(
+    "--workers",
+    "-w",
+    default=4,
+    type=int,
+    help="Number of series to download concurrently",
+)
+def click_command(collection, patients, modalities, nifti, output, workers):
     """
     This tool allows you to download data directly from The Cancer Imaging Archive (TCIA).
 
@@ -119,6 +126,7 @@ def click_command(collection, patients, modalities, nifti, output):
         modalities=modalities,
         nifti=nifti,
         output_directory=output,
+        max_workers=workers,
     )
 
 
@@ -1 +1,2 @@
 from .connector import DicomConnector
+from .writer import DicomStoreWriter
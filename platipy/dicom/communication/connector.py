@@ -14,9 +14,11 @@
 
 import os
 import tempfile
+import threading
+import contextlib
 import pydicom
 
-from pydicom.dataset import Dataset, FileDataset
+from pydicom.dataset import Dataset
 
 from pydicom.uid import ImplicitVRLittleEndian
 from pynetdicom import (
@@ -25,22 +27,58 @@ from pynetdicom import (
     VerificationPresentationContexts,
     StoragePresentationContexts,
     QueryRetrievePresentationContexts,
-    PYNETDICOM_IMPLEMENTATION_UID,
-    PYNETDICOM_IMPLEMENTATION_VERSION,
 )
 from pynetdicom.sop_class import (
-    VerificationSOPClass,
     PatientRootQueryRetrieveInformationModelFind,
     PatientRootQueryRetrieveInformationModelGet,
-    PatientRootQueryRetrieveInformationModelMove
+    PatientRootQueryRetrieveInformationModelMove,
 )
 from pynetdicom.pdu_primitives import SCP_SCU_RoleSelectionNegotiation
 
+try:
+    from pynetdicom.sop_class import Verification
+except ImportError:
+    # pynetdicom < 2.0
+    from pynetdicom.sop_class import VerificationSOPClass as Verification
+
 from loguru import logger
 
+from platipy.dicom.communication.writer import DicomStoreWriter
+from platipy.imaging.utils.parallel import parallel_map
+
 
 class DicomConnector:
-    def __init__(self, host="127.0.0.1", port=0, ae_title="", output_directory=tempfile.mkdtemp()):
+    """Connects to a remote DICOM application entity (AE) to query, retrieve and send data.
+
+    When used as a context manager, associations with the remote AE are kept open and re-used by
+    subsequent operations, and released on exit. Otherwise, each operation opens (and releases) its
+    own association. At most max_associations are open at once, which also limits the number of
+    series or files transferred concurrently.
+
+    Args:
+        host (str, optional): The host of the remote AE. Defaults to "127.0.0.1".
+        port (int, optional): The port of the remote AE. Defaults to 0.
+        ae_title (str, optional): The AE Title of the remote AE. Defaults to "".
+        output_directory (str, optional): The directory to which received series are written.
+            Defaults to a new temporary directory.
+        max_write_workers (int, optional): The number of threads writing received instances.
+            Defaults to 4.
+        max_write_queue_size (int, optional): The maximum number of received instances waiting to
+            be written. Defaults to 256.
+        max_associations (int, optional): The maximum number of associations open with the
+            remote AE at once (including idle associations kept for re-use). Defaults to 4.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        ae_title="",
+        output_directory=tempfile.mkdtemp(),
+        max_write_workers=4,
+        max_write_queue_size=256,
+        max_associations=4,
+    ):
         self.host = host
         self.port = port
         self.ae_title = ae_title if ae_title else ""
@@ -58,53 +96,216 @@ class DicomConnector:
         self.current_dir = None
         self.recieved_callback = None
 
-    def verify(self):
-        # Verify Connection
+        # Received instances are written by a DicomStoreWriter, created when first needed
+        self.max_write_workers = max_write_workers
+        self.max_write_queue_size = max_write_queue_size
+        self.series_complete_callback = None
+        self.series_complete_timeout = 5.0
+        self.report_recompleted_series = False
+        self.writer = None
+
+        # Idle associations (for each type of association) which can be re-used. Idle
+        # associations are still open, so they count towards max_associations.
+        self.max_associations = max_associations
+        self.keep_associations = False
+        self._idle_associations = {}
+        self._open_associations = 0
+        self._association_condition = threading.Condition()
+
+    def __enter__(self):
+
+        self.keep_associations = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.keep_associations = False
+        self.release_associations()
+
+    def get_writer(self):
+        """Gets the DicomStoreWriter used to write received instances, creating it if needed"""
+
+        if self.writer is None:
+            self.writer = DicomStoreWriter(
+                output_directory=self.output_directory,
+                max_workers=self.max_write_workers,
+                max_queue_size=self.max_write_queue_size,
+                series_complete_callback=self.series_complete_callback,
+                series_complete_timeout=self.series_complete_timeout,
+                report_recompleted_series=self.report_recompleted_series,
+            )
+
+        return self.writer
+
+    def _associate(self, association_type):
+        """Requests a new association with the remote AE
+
+        Args:
+            association_type (str): The presentation contexts to request: "verification",
+                "query_retrieve", "get" (query/retrieve, acting as storage SCP for the retrieved
+                instances) or "storage".
+
+        Returns:
+            pynetdicom.association.Association: The association.
+        """
 
         ae = AE()
-        ae.requested_contexts = VerificationPresentationContexts
+        kwargs = {}
+
+        if association_type == "verification":
+            ae.requested_contexts = VerificationPresentationContexts
+
+        elif association_type == "query_retrieve":
+            ae.requested_contexts = QueryRetrievePresentationContexts
+
+        elif association_type == "get":
+            # Specify which SOP Classes are supported as an SCU
+            for context in QueryRetrievePresentationContexts:
+                ae.add_requested_context(context.abstract_syntax, ImplicitVRLittleEndian)
+            for context in StoragePresentationContexts[:115]:
+                ae.add_requested_context(context.abstract_syntax, ImplicitVRLittleEndian)
+
+            # Add SCP/SCU Role Selection Negotiation to the extended negotiation
+            # We want to act as a Storage SCP
+            ext_neg = []
+            for context in StoragePresentationContexts:
+                role = SCP_SCU_RoleSelectionNegotiation()
+                role.sop_class_uid = context.abstract_syntax
+                role.scp_role = True
+                role.scu_role = False
+                ext_neg.append(role)
+
+            kwargs["ext_neg"] = ext_neg
+            kwargs["evt_handlers"] = [(evt.EVT_C_STORE, self.on_c_store)]
+
+        elif association_type == "storage":
+            for context in StoragePresentationContexts:
+                ae.add_requested_context(context.abstract_syntax, [ImplicitVRLittleEndian])
 
-        # Associate with a peer DICOM AE
-        if len(self.ae_title) > 0:
-            assoc = ae.associate(self.host, self.port, ae_title=self.ae_title)
         else:
-            assoc = ae.associate(self.host, self.port)
+            raise ValueError(f"Unknown association type: {association_type}")
 
-        result = None
+        if len(self.ae_title) > 0:
+            kwargs["ae_title"] = self.ae_title
+
+        assoc = ae.associate(self.host, self.port, **kwargs)
 
         if assoc.is_established:
-            status = assoc.send_c_echo()
+            logger.info("Association accepted by the peer")
 
-            if status:
-                result = status.Status
+        return assoc
 
-            # Release the association
-            assoc.release()
+    @contextlib.contextmanager
+    def association(self, association_type):
+        """Provides an association with the remote AE, re-using an idle association if possible.
 
-        return not result is None
+        At most max_associations associations (in use or idle) are open at once. If none is
+        available, an idle association of another type is released to make room, otherwise this
+        blocks until an association is returned.
 
-    def do_find(self, dataset, query_model=PatientRootQueryRetrieveInformationModelFind):
+        Args:
+            association_type (str): The type of association, see _associate.
 
-        ae = AE()
+        Yields:
+            pynetdicom.association.Association: The association. Check that it is established
+            before use.
+        """
 
-        ae.requested_contexts = QueryRetrievePresentationContexts
+        assoc = None
+        released_assoc = None
 
-        if len(self.ae_title) > 0:
-            assoc = ae.associate(self.host, self.port, ae_title=self.ae_title)
-        else:
-            assoc = ae.associate(self.host, self.port)
+        with self._association_condition:
+            while True:
+                idle_associations = self._idle_associations.setdefault(association_type, [])
+                if len(idle_associations) > 0:
+                    assoc = idle_associations.pop()
 
-        results = []
-        if assoc.is_established:
-            logger.info("Association accepted by the peer")
+                    # The remote AE may have closed the association while it was idle
+                    if assoc.is_established:
+                        break
+
+                    assoc = None
+                    self._open_associations -= 1
+                    continue
+
+                if self._open_associations < self.max_associations:
+                    self._open_associations += 1
+                    break
 
-            responses = assoc.send_c_find(dataset, query_model=query_model)
+                # Make room by releasing an idle association of another type (taking its place)
+                other_idle_associations = [
+                    associations
+                    for associations in self._idle_associations.values()
+                    if len(associations) > 0
+                ]
+                if len(other_idle_associations) > 0:
+                    released_assoc = other_idle_associations[0].pop()
+                    break
 
-            for _, ds in responses:
-                results.append(ds)
+                self._association_condition.wait()
 
-            # Release the association
-            assoc.release()
+        try:
+            if released_assoc is not None and released_assoc.is_established:
+                released_assoc.release()
+
+            if assoc is None:
+                assoc = self._associate(association_type)
+
+            yield assoc
+
+        finally:
+            keep_assoc = assoc is not None and assoc.is_established and self.keep_associations
+
+            if assoc is not None and assoc.is_established and not keep_assoc:
+                assoc.release()
+
+            with self._association_condition:
+                if keep_assoc:
+                    self._idle_associations[association_type].append(assoc)
+                else:
+                    self._open_associations -= 1
+                self._association_condition.notify_all()
+
+    def release_associations(self):
+        """Releases all idle associations with the remote AE"""
+
+        with self._association_condition:
+            idle_associations = [
+                assoc
+                for associations in self._idle_associations.values()
+                for assoc in associations
+            ]
+            self._idle_associations = {}
+            self._open_associations -= len(idle_associations)
+            self._association_condition.notify_all()
+
+        for assoc in idle_associations:
+            if assoc.is_established:
+                assoc.release()
+
+    def verify(self):
+        # Verify Connection
+
+        result = None
+
+        with self.association("verification") as assoc:
+            if assoc.is_established:
+                status = assoc.send_c_echo()
+
+                if status:
+                    result = status.Status
+
+        return not result is None
+
+    def do_find(self, dataset, query_model=PatientRootQueryRetrieveInformationModelFind):
+
+        results = []
+        with self.association("query_retrieve") as assoc:
+            if assoc.is_established:
+                responses = assoc.send_c_find(dataset, query_model=query_model)
+
+                for _, ds in responses:
+                    results.append(ds)
 
         logger.info("Got " + str(len(results)) + " results")
 
@@ -138,29 +339,37 @@ class DicomConnector:
         move_aet="PYNETDICOM",
         query_model=PatientRootQueryRetrieveInformationModelMove,
     ):
+        """Triggers a C-MOVE of one or more series to an AE.
+
+        Args:
+            seriesInstanceUID (str | list): The SeriesInstanceUID, or a list of them. Series are
+                moved concurrently, using up to max_associations associations.
+            move_aet (str, optional): The AE Title to move the series to. Defaults to "PYNETDICOM".
+            query_model (optional): The query model. Defaults to
+                PatientRootQueryRetrieveInformationModelMove.
+        """
 
-        ae = AE()
-        ae.requested_contexts = QueryRetrievePresentationContexts
-
-        if len(self.ae_title) > 0:
-            assoc = ae.associate(self.host, self.port, ae_title=self.ae_title)
-        else:
-            assoc = ae.associate(self.host, self.port)
-
-        if assoc.is_established:
-            logger.info("Association accepted by the peer")
-
-            dataset = Dataset()
-            dataset.SeriesInstanceUID = seriesInstanceUID
-            dataset.QueryRetrieveLevel = "SERIES"
+        if not isinstance(seriesInstanceUID, str):
+            parallel_map(
+                self.move_series,
+                seriesInstanceUID,
+                executor="thread",
+                max_workers=self.max_associations,
+                move_aet=move_aet,
+                query_model=query_model,
+            )
+            return
 
-            responses = assoc.send_c_move(dataset, move_aet, query_model=query_model)
+        with self.association("query_retrieve") as assoc:
+            if assoc.is_established:
+                dataset = Dataset()
+                dataset.SeriesInstanceUID = seriesInstanceUID
+                dataset.QueryRetrieveLevel = "SERIES"
 
-            for (_, _) in responses:
-                pass
+                responses = assoc.send_c_move(dataset, move_aet, query_model=query_model)
 
-            # Release the association
-            assoc.release()
+                for _, _ in responses:
+                    pass
 
         logger.info("Finished")
 
@@ -170,62 +379,66 @@ class DicomConnector:
         recieved_callback=None,
         query_model=PatientRootQueryRetrieveInformationModelGet,
     ):
+        """Retrieves one or more series using C-GET.
+
+        Args:
+            series_instance_uid (str | list): The SeriesInstanceUID, or a list of them. Series are
+                retrieved concurrently, using up to max_associations associations.
+            recieved_callback (function, optional): Defaults to None.
+            query_model (optional): The query model. Defaults to
+                PatientRootQueryRetrieveInformationModelGet.
+
+        Returns:
+            str | list: The directory containing each retrieved series (None if nothing was
+            retrieved, or if some instances couldn't be written).
+        """
 
         self.recieved_callback = recieved_callback
 
-        ae = AE()
-
-        # Specify which SOP Classes are supported as an SCU
-        for context in QueryRetrievePresentationContexts:
-            ae.add_requested_context(context.abstract_syntax, ImplicitVRLittleEndian)
-        for context in StoragePresentationContexts[:115]:
-            ae.add_requested_context(context.abstract_syntax, ImplicitVRLittleEndian)
-
-        # Add SCP/SCU Role Selection Negotiation to the extended negotiation
-        # We want to act as a Storage SCP
-        ext_neg = []
-        for context in StoragePresentationContexts:
-            role = SCP_SCU_RoleSelectionNegotiation()
-            role.sop_class_uid = context.abstract_syntax
-            role.scp_role = True
-            role.scu_role = False
-            ext_neg.append(role)
-
-        handlers = [(evt.EVT_C_STORE, self.on_c_store)]
-
-        if len(self.ae_title) > 0:
-            assoc = ae.associate(
-                self.host,
-                self.port,
-                ae_title=self.ae_title,
-                ext_neg=ext_neg,
-                evt_handlers=handlers,
+        if not isinstance(series_instance_uid, str):
+            return parallel_map(
+                self.download_series,
+                series_instance_uid,
+                executor="thread",
+                max_workers=self.max_associations,
+                recieved_callback=recieved_callback,
+                query_model=query_model,
             )
-        else:
-            assoc = ae.associate(self.host, self.port, ext_neg=ext_neg, evt_handlers=handlers)
 
-        if assoc.is_established:
-            logger.info("Association accepted by the peer")
+        with self.association("get") as assoc:
+            if assoc.is_established:
+                dataset = Dataset()
+                dataset.SeriesInstanceUID = series_instance_uid
+                dataset.QueryRetrieveLevel = "SERIES"
 
-            dataset = Dataset()
-            dataset.SeriesInstanceUID = series_instance_uid
-            dataset.QueryRetrieveLevel = "SERIES"
+                responses = assoc.send_c_get(dataset, query_model=query_model)
 
-            responses = assoc.send_c_get(dataset, query_model=query_model)
+                for _, _ in responses:
+                    pass
 
-            for (_, _) in responses:
-                pass
+        logger.info("Finished")
 
-            # Release the association
-            assoc.release()
+        # Several series may be retrieved at once, so the current_dir can't be used here
+        series_dir = self.get_writer().get_series_directory(series_instance_uid, create=False)
+        if not os.path.isdir(series_dir):
+            return None
 
-        logger.info("Finished")
+        self.writer.flush(series_dir)
 
-        return self.current_dir
+        failed_writes = self.writer.get_failed_writes(series_dir)
+        if len(failed_writes) > 0:
+            logger.error(
+                "Series incomplete, {0} instances could not be written: {1}".format(
+                    len(failed_writes), series_dir
+                )
+            )
+            return None
+
+        return series_dir
 
     def on_c_store(self, event):
 
-        dataset = event.dataset
+        file_meta = event.file_meta
 
         mode_prefix = "UN"
         mode_prefixes = {
@@ -249,59 +462,30 @@ class DicomConnector:
         }
 
         try:
-            mode_prefix = mode_prefixes[dataset.SOPClassUID.name]
+            mode_prefix = mode_prefixes[file_meta.MediaStorageSOPClassUID.name]
         except KeyError:
             mode_prefix = "UN"
 
-        suid = dataset.SeriesInstanceUID
-        series_dir = suid
-        if self.output_directory is not None:
-            series_dir = os.path.join(self.output_directory, suid)
-
-        filename = "{0!s}.{1!s}".format(mode_prefix, dataset.SOPInstanceUID)
-
-        if not os.path.exists(series_dir):
-            os.mkdir(series_dir)
-
-        filename = os.path.join(series_dir, filename)
-
-        if os.path.exists(filename):
-            logger.debug("DICOM file already exists, overwriting")
-
-        context = event.context
-        meta = Dataset()
-        meta.MediaStorageSOPClassUID = dataset.SOPClassUID
-        meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
-        meta.ImplementationClassUID = PYNETDICOM_IMPLEMENTATION_UID
-        meta.TransferSyntaxUID = context.transfer_syntax
-
-        # The following is not mandatory, set for convenience
-        meta.ImplementationVersionName = PYNETDICOM_IMPLEMENTATION_VERSION
-        file_ds = FileDataset(filename, {}, file_meta=meta, preamble=b"\0" * 128)
-        file_ds.update(dataset)
-        file_ds.is_little_endian = context.transfer_syntax.is_little_endian
-        file_ds.is_implicit_VR = context.transfer_syntax.is_implicit_VR
+        filename = "{0!s}.{1!s}".format(mode_prefix, file_meta.MediaStorageSOPInstanceUID)
 
         status_ds = Dataset()
         status_ds.Status = 0x0000
 
+        writer = self.get_writer()
+
         try:
-            # We use `write_like_original=False` to ensure that a compliant
-            #   File Meta Information Header is written
-            file_ds.save_as(filename, write_like_original=False)
-            status_ds.Status = 0x0000  # Success
-        except IOError:
-            logger.warning("Could not write file to specified directory:")
-            logger.warning("    {0!s}".format(os.path.dirname(filename)))
-            logger.warning("Directory may not exist or you may not have write " "permission")
+            series_dir = writer.get_series_directory(event.dataset.SeriesInstanceUID)
+        except OSError as exception:
+            logger.warning("Could not create series directory in:")
+            logger.warning("    {0!s}".format(self.output_directory))
+            logger.warning(exception)
             # Failed - Out of Resources - IOError
             status_ds.Status = 0xA700
-        except Exception as exception:
-            logger.warning("Could not write file to specified directory:")
-            logger.warning("    {0!s}".format(os.path.dirname(filename)))
-            logger.warning(exception)
-            # Failed - Out of Resources - Miscellaneous error
-            status_ds.Status = 0xA701
+            return status_ds
+
+        # The data set is written as it was received (without decoding and encoding it again) by
+        # the writer threads, so the next instance can be received while this one is written
+        writer.put(series_dir, filename, file_meta, event.request.DataSet.getvalue())
 
         self.current_dir = series_dir
 
@@ -317,30 +501,64 @@ class DicomConnector:
         if isinstance(dcm_file, str):
             dcm_files = [dcm_file]
 
-        transfer_syntax = [ImplicitVRLittleEndian]
+        statuses = self.send_dcm_files(dcm_files, max_workers=1)
 
-        ae = AE()
+        status = ""
+        if len(statuses) > 0 and statuses[-1] is not None:
+            status = statuses[-1]
 
-        for context in StoragePresentationContexts:
-            ae.add_requested_context(context.abstract_syntax, transfer_syntax)
+        return status
 
-        if len(self.ae_title) > 0:
-            assoc = ae.associate(self.host, self.port, ae_title=self.ae_title)
-        else:
-            assoc = ae.associate(self.host, self.port)
+    def send_dcm_files(self, dcm_files, max_workers=None):
+        """Sends DICOM files to the remote AE using C-STORE.
 
-        status = ""
-        if assoc.is_established:
-            logger.debug("Sending file: {0!s}".format(dcm_file))
+        The files are split between up to max_workers associations, which send concurrently. Each
+        association sends many files.
 
-            for dcm_file in dcm_files:
-                dataset = pydicom.read_file(dcm_file)
-                status = assoc.send_c_store(dataset)
+        Args:
+            dcm_files (list): The paths of the DICOM files to send.
+            max_workers (int, optional): The maximum number of concurrent associations. Defaults
+                to None, in which case max_associations is used.
 
-            # Release the association
-            assoc.release()
+        Returns:
+            list: The status (pydicom.Dataset) of the C-STORE of each file, or None if it couldn't
+            be sent.
+        """
 
-        return status
+        if max_workers is None:
+            max_workers = self.max_associations
+
+        number_of_chunks = max(min(max_workers, self.max_associations, len(dcm_files)), 1)
+        chunks = [dcm_files[i::number_of_chunks] for i in range(number_of_chunks)]
+
+        chunk_statuses = parallel_map(
+            self._send_dcm_chunk,
+            chunks,
+            executor="thread" if number_of_chunks > 1 else "serial",
+            max_workers=number_of_chunks,
+        )
+
+        # Put the statuses back into the order of the files
+        statuses = [None] * len(dcm_files)
+        for chunk_index, chunk_status in enumerate(chunk_statuses):
+            statuses[chunk_index::number_of_chunks] = chunk_status
+
+        return statuses
+
+    def _send_dcm_chunk(self, dcm_files):
+        """Sends DICOM files over a single association"""
+
+        statuses = [None] * len(dcm_files)
+
+        with self.association("storage") as assoc:
+            if assoc.is_established:
+                for file_index, dcm_file in enumerate(dcm_files):
+                    logger.debug("Sending file: {0!s}".format(dcm_file))
+
+                    dataset = pydicom.read_file(dcm_file)
+                    statuses[file_index] = assoc.send_c_store(dataset)
+
+        return statuses
 
     def on_c_echo(self, event):
         """Respond to a C-ECHO service request.
@@ -369,17 +587,67 @@ class DicomConnector:
     def on_association_released(self, event):
 
         if self.recieved_callback and self.current_dir:
+            writer = self.get_writer()
+            writer.flush(self.current_dir)
+
+            # Don't pass on a series with instances missing
+            failed_writes = writer.get_failed_writes(self.current_dir)
+            if len(failed_writes) > 0:
+                logger.error(
+                    "Series incomplete, {0} instances could not be written: {1}".format(
+                        len(failed_writes), self.current_dir
+                    )
+                )
+                return
+
             self.recieved_callback(self.current_dir)
 
-    def listen(self, recieved_callback, ae_title="PYNETDICOM"):
+    def listen(
+        self,
+        recieved_callback,
+        ae_title="PYNETDICOM",
+        series_complete_callback=None,
+        series_complete_timeout=5.0,
+        block=True,
+        report_recompleted_series=False,
+    ):
+        """Listens for incoming DICOM (C-STORE) requests.
+
+        Args:
+            recieved_callback (function): Called with the path of the series directory once an
+                association sending a series is released. Neither callback is called for a
+                series with instances which couldn't be written.
+            ae_title (str, optional): The AE Title to listen with. Defaults to "PYNETDICOM".
+            series_complete_callback (function, optional): Called with the path of the series
+                directory once no more instances of the series are received for
+                series_complete_timeout seconds, even if the association isn't released.
+                Defaults to None.
+            series_complete_timeout (float, optional): The time (in seconds) after which a series
+                is considered complete. Defaults to 5.
+            block (bool, optional): Whether to block while listening. Defaults to True.
+            report_recompleted_series (bool, optional): Whether to run the series complete
+                callback again if more instances of a series are received after it was reported
+                as complete. Defaults to False.
+
+        Returns:
+            pynetdicom.transport.ThreadedAssociationServer: The server, if block is False.
+        """
 
         self.recieved_callback = recieved_callback
+        self.series_complete_callback = series_complete_callback
+        self.series_complete_timeout = series_complete_timeout
+        self.report_recompleted_series = report_recompleted_series
+
+        # The writer is created again, so that it uses the series complete callback
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
 
         # Initialise the Application Entity and specify the listen port
         ae = AE(ae_title=ae_title)
 
         # Add the supported presentation context
-        ae.add_supported_context(VerificationSOPClass)
+        ae.add_supported_context(Verification)
         for context in StoragePresentationContexts:
             ae.add_supported_context(context.abstract_syntax)
 
@@ -392,4 +660,4 @@ class DicomConnector:
         ]
 
         # Start listening for incoming association requests
-        ae.start_server(("", self.port), evt_handlers=handlers)
+        return ae.start_server(("", self.port), block=block, evt_handlers=handlers)
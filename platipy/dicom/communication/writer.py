@@ -0,0 +1,288 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import queue
+import threading
+
+from pydicom.filewriter import write_file_meta_info
+
+from loguru import logger
+
+
+class DicomStoreWriter:
+    """Writes DICOM instances received by a Storage SCP to disk using background threads.
+
+    Instances are passed as their encoded data set (as received, so they don't need to be decoded
+    and encoded again) and written by a pool of threads, so that the SCP can respond to the next
+    C-STORE request without waiting for the disk. The queue of instances is bounded, so a fast
+    sender is slowed down rather than filling up memory.
+
+    Optionally, a callback is run once no instances of a series have been received for some time
+    (and all of its instances have been written), so that it can be processed without waiting for
+    the association to be released. Each series is reported as complete once: instances of a
+    series received after it was reported (e.g. sent again, or after a long pause) are written,
+    but the series is only reported again if report_recompleted_series is set.
+
+    The sender has already been told an instance was stored by the time it is written, so an
+    instance which can't be written is recorded (see get_failed_writes), and a series with failed
+    writes isn't reported as complete unless the failed instances are received (and written)
+    again.
+
+    Args:
+        output_directory (str, optional): The directory in which a directory is created for each
+            series. Defaults to None, in which case the series directories are created in the
+            current working directory.
+        max_workers (int, optional): The number of writer threads. Defaults to 4.
+        max_queue_size (int, optional): The maximum number of instances waiting to be written.
+            Defaults to 256.
+        series_complete_callback (function, optional): Called with the path of the series
+            directory once a series is complete. Defaults to None.
+        series_complete_timeout (float, optional): The time (in seconds) after receiving the last
+            instance of a series after which the series is considered complete. Defaults to 5.
+        report_recompleted_series (bool, optional): Whether to run the series complete callback
+            again for a series which was already reported as complete, once the instances
+            received since are written. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        output_directory=None,
+        max_workers=4,
+        max_queue_size=256,
+        series_complete_callback=None,
+        series_complete_timeout=5.0,
+        report_recompleted_series=False,
+    ):
+
+        self.output_directory = output_directory
+        self.series_complete_callback = series_complete_callback
+        self.series_complete_timeout = series_complete_timeout
+        self.report_recompleted_series = report_recompleted_series
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._condition = threading.Condition()
+        self._closed = False
+
+        # For each series directory: the number of instances not yet written, and the time the
+        # last instance was received. Series already reported as complete are kept, so that they
+        # aren't reported again.
+        self._pending = {}
+        self._last_received = {}
+        self._completed = set()
+
+        # For each series directory: the file names of the instances which couldn't be written
+        self._failed = {}
+
+        self._workers = [
+            threading.Thread(target=self._write_worker, daemon=True) for _ in range(max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+        self._monitor = None
+        if series_complete_callback is not None:
+            self._monitor = threading.Thread(target=self._monitor_series, daemon=True)
+            self._monitor.start()
+
+    def get_series_directory(self, series_instance_uid, create=True):
+        """Gets the directory to which the instances of a series are written, creating it if
+        needed.
+
+        Args:
+            series_instance_uid (str): The SeriesInstanceUID.
+            create (bool, optional): Whether to create the directory. Defaults to True.
+
+        Returns:
+            str: The path of the series directory.
+        """
+
+        series_dir = str(series_instance_uid)
+        if self.output_directory is not None:
+            series_dir = os.path.join(self.output_directory, series_dir)
+
+        if not create:
+            return series_dir
+
+        # Only the first instance of each series needs to check the directory exists
+        with self._condition:
+            if series_dir not in self._pending:
+                os.makedirs(series_dir, exist_ok=True)
+                self._pending[series_dir] = 0
+
+        return series_dir
+
+    def put(self, series_dir, filename, file_meta, encoded_dataset):
+        """Queues an instance to be written. Blocks if the queue is full.
+
+        Args:
+            series_dir (str): The series directory, see get_series_directory.
+            filename (str): The file name of the instance.
+            file_meta (pydicom.dataset.FileMetaDataset): The File Meta Information of the instance.
+            encoded_dataset (bytes): The encoded data set, in the transfer syntax given in the
+                file_meta.
+        """
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("DicomStoreWriter is closed")
+
+            self._pending[series_dir] = self._pending.get(series_dir, 0) + 1
+            self._last_received[series_dir] = time.monotonic()
+
+        self._queue.put((series_dir, filename, file_meta, encoded_dataset))
+
+    def get_failed_writes(self, series_dir):
+        """Gets the instances of a series which couldn't be written.
+
+        Args:
+            series_dir (str): The series directory, see get_series_directory.
+
+        Returns:
+            list: The file names of the instances which couldn't be written (empty if all
+            instances received so far were written).
+        """
+
+        with self._condition:
+            return sorted(self._failed.get(series_dir, []))
+
+    def flush(self, series_dir=None):
+        """Waits until all queued instances have been written.
+
+        Args:
+            series_dir (str, optional): If given, only waits for the instances of this series.
+                Defaults to None.
+        """
+
+        with self._condition:
+            self._condition.wait_for(
+                lambda: (
+                    sum(self._pending.values()) == 0
+                    if series_dir is None
+                    else self._pending.get(series_dir, 0) == 0
+                )
+            )
+
+    def close(self):
+        """Writes all queued instances and stops the writer threads"""
+
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+        if self._monitor is not None:
+            self._monitor.join()
+
+    def _write_worker(self):
+        """Writes instances from the queue until a None is received"""
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            series_dir, filename, file_meta, encoded_dataset = item
+            file_path = os.path.join(series_dir, filename)
+
+            written = False
+            try:
+                with open(file_path, "wb") as file_obj:
+                    file_obj.write(b"\0" * 128)
+                    file_obj.write(b"DICM")
+                    write_file_meta_info(file_obj, file_meta)
+                    file_obj.write(encoded_dataset)
+                written = True
+            except Exception as exception:  # pylint: disable=broad-except
+                logger.error("Could not write file to specified directory:")
+                logger.error("    {0!s}".format(file_path))
+                logger.error(exception)
+
+            with self._condition:
+                # An instance received again (and written) is no longer missing
+                if written:
+                    self._failed.get(series_dir, set()).discard(filename)
+                else:
+                    self._failed.setdefault(series_dir, set()).add(filename)
+
+                self._pending[series_dir] -= 1
+                self._condition.notify_all()
+
+    def _monitor_series(self):
+        """Runs the series complete callback for series which have been idle long enough"""
+
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                complete_series = [
+                    series_dir
+                    for series_dir, last_received in self._last_received.items()
+                    if self._pending[series_dir] == 0
+                    and (self._closed or now - last_received >= self.series_complete_timeout)
+                ]
+                for series_dir in complete_series:
+                    del self._last_received[series_dir]
+
+                failed_writes = {
+                    series_dir: len(self._failed[series_dir])
+                    for series_dir in complete_series
+                    if len(self._failed.get(series_dir, [])) > 0
+                }
+
+                if len(complete_series) == 0:
+                    if self._closed and len(self._last_received) == 0:
+                        return
+
+                    # Series still being written are checked again when a write completes
+                    next_check = min(
+                        [
+                            last_received + self.series_complete_timeout - now
+                            for series_dir, last_received in self._last_received.items()
+                            if self._pending[series_dir] == 0
+                        ],
+                        default=self.series_complete_timeout,
+                    )
+                    self._condition.wait(timeout=max(next_check, 0.01))
+                    continue
+
+            for series_dir in complete_series:
+                if series_dir in failed_writes:
+                    logger.error(
+                        "Series incomplete, {0} instances could not be written: {1}".format(
+                            failed_writes[series_dir], series_dir
+                        )
+                    )
+                    continue
+
+                if series_dir in self._completed:
+                    if not self.report_recompleted_series:
+                        logger.debug("Series already complete: {0}".format(series_dir))
+                        continue
+                    logger.info("Series complete again: {0}".format(series_dir))
+                else:
+                    self._completed.add(series_dir)
+                    logger.info("Series complete: {0}".format(series_dir))
+
+                try:
+                    self.series_complete_callback(series_dir)
+                except Exception as exception:  # pylint: disable=broad-except
+                    logger.error("Series complete callback failed for: {0}".format(series_dir))
+                    logger.error(exception)
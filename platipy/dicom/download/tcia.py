@@ -13,9 +13,12 @@
 # limitations under the License.
 
 import json
+import shutil
+import tempfile
+import threading
 import zipfile
-import os
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
@@ -36,6 +39,13 @@ download_series_endpoint = f"{API_URL}/query/getImage"
 sop_uids_endpoint = f"{API_URL}/query/getSOPInstanceUIDs"
 download_image_endpoint = f"{API_URL}/query/getSingleImage"
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Series zip files smaller than this are extracted from memory, larger ones are spooled to disk
+SPOOL_MAX_SIZE = 256 * 1024 * 1024
+
+MANIFEST_FILE = "tcia_manifest.json"
+
 
 def get_collections():
     """Get a list of collections available in the TCIA database
@@ -118,11 +128,137 @@ def get_hn_data(number_of_patients=1):
     )
 
 
+class FetchManifest:
+    """Records which series have been downloaded (and which patients converted) by fetch_data,
+    so that an interrupted fetch can be resumed.
+
+    Args:
+        manifest_path (pathlib.Path): The path of the manifest file.
+    """
+
+    def __init__(self, manifest_path):
+
+        self.manifest_path = manifest_path
+        self._lock = threading.Lock()
+
+        self.manifest = {"series": {}, "nifti": {}}
+        if manifest_path.exists():
+            with open(manifest_path, "r") as file_obj:
+                self.manifest = json.load(file_obj)
+
+    def is_downloaded(self, series_uid, target_directory):
+        """Checks whether a series was completely downloaded to the target directory"""
+
+        with self._lock:
+            return series_uid in self.manifest["series"] and target_directory.exists()
+
+    def set_downloaded(self, series_uid, patient_id, modality, number_of_files):
+        """Records that a series has been downloaded"""
+
+        with self._lock:
+            self.manifest["series"][series_uid] = {
+                "PatientID": patient_id,
+                "Modality": modality,
+                "NumberOfFiles": number_of_files,
+            }
+            self._write()
+
+    def get_converted(self, patient_id):
+        """Gets the Nifti conversion results for a patient, or None if it wasn't converted"""
+
+        with self._lock:
+            nifti_results = self.manifest["nifti"].get(patient_id)
+
+        if nifti_results is None:
+            return None
+
+        # Paths are stored as strings in the manifest
+        return {field: [Path(path) for path in paths] for field, paths in nifti_results.items()}
+
+    def set_converted(self, patient_id, nifti_results):
+        """Records the Nifti conversion results for a patient"""
+
+        with self._lock:
+            self.manifest["nifti"][patient_id] = nifti_results
+            self._write()
+
+    def clear_converted(self, patient_id):
+        """Forgets the Nifti conversion of a patient (e.g. since new series were downloaded)"""
+
+        with self._lock:
+            if self.manifest["nifti"].pop(patient_id, None) is not None:
+                self._write()
+
+    def _write(self):
+
+        # Write to a temporary file first, so an interruption doesn't corrupt the manifest
+        temp_path = self.manifest_path.with_suffix(".tmp")
+        with open(temp_path, "w") as file_obj:
+            json.dump(self.manifest, file_obj, indent=2, default=str)
+        temp_path.replace(self.manifest_path)
+
+
+def download_series(series_uid, target_directory, session=None):
+    """Downloads a series from TCIA and extracts it to the target directory.
+
+    The series is extracted to a temporary directory which is only renamed to the target directory
+    once complete, so an interrupted download never leaves a partial series behind.
+
+    Args:
+        series_uid (str): The SeriesInstanceUID of the series to download.
+        target_directory (pathlib.Path): The directory in which to extract the series.
+        session (requests.Session, optional): The session to download with. Defaults to None.
+
+    Returns:
+        int: The number of files in the series.
+    """
+
+    if session is None:
+        session = requests
+
+    partial_directory = target_directory.with_name(f"{target_directory.name}.partial")
+    if partial_directory.exists():
+        shutil.rmtree(partial_directory)
+
+    with session.get(
+        download_series_endpoint, stream=True, params={"SeriesInstanceUID": series_uid}
+    ) as response:
+        response.raise_for_status()
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as zip_obj:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                zip_obj.write(chunk)
+
+            zip_obj.seek(0)
+            with zipfile.ZipFile(zip_obj, "r") as zip_ref:
+                zip_ref.extractall(partial_directory)
+                number_of_files = len(zip_ref.namelist())
+
+    partial_directory.replace(target_directory)
+
+    return number_of_files
+
+
 def fetch_data(
-    collection, patient_ids=None, modalities=None, nifti=True, output_directory="./tcia"
+    collection,
+    patient_ids=None,
+    modalities=None,
+    nifti=True,
+    output_directory="./tcia",
+    max_workers=4,
 ):
     """Fetches data from TCIA from the dataset specified
 
+    Series are downloaded concurrently, and each patient's data is converted to Nifti while the
+    following patients are downloaded. A manifest of downloaded series (and converted patients) is
+    kept in the collection's output directory, so an interrupted fetch can be resumed by running
+    it again.
+
+    A series which can't be downloaded (or a patient which can't be converted) is logged and
+    skipped, and the remaining patients are still fetched. The patients with failed series aren't
+    converted to Nifti, and the failed series are listed once the fetch is complete. Running the
+    fetch again retries them.
+
     Args:
         collection (str): The TCIA collection to fetch from
         patient_ids (list, optional): The patient IDs to fetch. If not set all patients are
@@ -132,9 +268,12 @@ def fetch_data(
         nifti (bool, optional): Whether or not to convert the fetched DICOM to Nifti. Defaults to
                                 True
         output_directory (str): The directory in which to place fetched data
+        max_workers (int, optional): The number of series to download concurrently. Defaults to
+                                     4.
 
     Returns:
-        dict: The patients and directories where their data was fetched
+        dict: The patients and directories where their data was fetched. Series which failed to
+        download aren't included.
     """
 
     result = {}
@@ -165,63 +304,133 @@ def fetch_data(
     if not patient_ids:
         patient_ids = get_patients_in_collection(collection)
 
-    for pid in patient_ids:
+    manifest = FetchManifest(output_directory.joinpath(MANIFEST_FILE))
 
-        patient_directory = output_directory.joinpath(pid)
-        dicom_directory = patient_directory.joinpath("DICOM")
-        nifti_directory = patient_directory.joinpath("NIFTI")
-        result[pid] = {}
-        result[pid]["DICOM"] = {}
+    def fetch_series(series_uid, target_directory, pid, modality):
+        logger.debug(f"Downloading Series: {series_uid}")
+        try:
+            number_of_files = download_series(series_uid, target_directory, session=session)
+        except Exception as exception:  # pylint: disable=broad-except
+            logger.error(f"Could not download Series: {series_uid} (Patient: {pid})")
+            logger.exception(exception)
+            return False
 
-        logger.debug(f"Fetching data for Patient: {pid}")
+        manifest.set_downloaded(series_uid, pid, modality, number_of_files)
+        return True
 
-        for modality in modalities:
-            res = requests.get(
-                series_endpoint,
-                params={"Collection": collection, "PatientID": pid, "Modality": modality},
+    def convert_patient(pid, dicom_directory, nifti_directory):
+        logger.info(f"Converting data for {pid} to Nifti")
+        try:
+            nifti_results = process_dicom_directory(
+                dicom_directory, output_directory=nifti_directory
             )
-            series = json.loads(res.text)
+        except Exception as exception:  # pylint: disable=broad-except
+            logger.error(f"Could not convert data for {pid} to Nifti")
+            logger.exception(exception)
+            return None
 
-            if not modality in result[pid]:
-                result[pid]["DICOM"][modality] = {}
+        if nifti_results is None or pid not in nifti_results:
+            logger.warning(f"No data converted to Nifti for {pid}")
+            return None
 
-            for obj in series:
+        manifest.set_converted(pid, nifti_results[pid])
+        return nifti_results[pid]
 
-                series_uid = obj["SeriesInstanceUID"]
+    with requests.Session() as session, ThreadPoolExecutor(
+        max_workers=max_workers
+    ) as download_executor, ThreadPoolExecutor(max_workers=1) as convert_executor:
 
-                target_directory = dicom_directory.joinpath(series_uid)
-                result[pid]["DICOM"][modality][series_uid] = target_directory
-                if target_directory.exists():
-                    logger.warning(
-                        f"Series directory exists: {target_directory}, won't fetch data"
-                    )
-                    continue
+        download_futures = {}
+        for pid in patient_ids:
 
-                logger.debug(f"Downloading Series: {series_uid}")
+            dicom_directory = output_directory.joinpath(pid, "DICOM")
+            result[pid] = {}
+            result[pid]["DICOM"] = {}
+            download_futures[pid] = []
 
-                target_directory.mkdir(parents=True)
+            logger.debug(f"Fetching data for Patient: {pid}")
 
-                save_path = target_directory.joinpath(f"{pid}.zip")
-
-                response = requests.get(
-                    download_series_endpoint,
-                    stream=True,
-                    params={"SeriesInstanceUID": obj["SeriesInstanceUID"]},
+            for modality in modalities:
+                res = session.get(
+                    series_endpoint,
+                    params={"Collection": collection, "PatientID": pid, "Modality": modality},
                 )
-                with open(save_path, "wb") as file_obj:
-                    for chunk in response.iter_content():
-                        file_obj.write(chunk)
+                series = json.loads(res.text)
 
-                with zipfile.ZipFile(save_path, "r") as zip_ref:
-                    zip_ref.extractall(target_directory)
+                result[pid]["DICOM"][modality] = {}
 
-                os.remove(save_path)
+                for obj in series:
+
+                    series_uid = obj["SeriesInstanceUID"]
+
+                    target_directory = dicom_directory.joinpath(series_uid)
+                    result[pid]["DICOM"][modality][series_uid] = target_directory
+                    if manifest.is_downloaded(series_uid, target_directory):
+                        logger.debug(f"Series already downloaded: {series_uid}")
+                        continue
+
+                    if target_directory.exists():
+                        logger.warning(
+                            f"Series directory exists: {target_directory}, won't fetch data"
+                        )
+                        continue
+
+                    dicom_directory.mkdir(parents=True, exist_ok=True)
+                    download_futures[pid].append(
+                        (
+                            modality,
+                            series_uid,
+                            download_executor.submit(
+                                fetch_series, series_uid, target_directory, pid, modality
+                            ),
+                        )
+                    )
 
-        if nifti:
-            logger.info(f"Converting data for {pid} to Nifti")
-            nifti_results = process_dicom_directory(
-                dicom_directory, output_directory=nifti_directory
+        # Patients are converted in order, as soon as all of their series are downloaded
+        failed_series = {}
+        convert_futures = {}
+        for pid in patient_ids:
+
+            for modality, series_uid, future in download_futures[pid]:
+                if not future.result():
+                    del result[pid]["DICOM"][modality][series_uid]
+                    failed_series.setdefault(pid, []).append(series_uid)
+
+            if not nifti:
+                continue
+
+            if pid in failed_series:
+                logger.warning(f"Not converting data for {pid} to Nifti, some series failed")
+                result[pid]["NIFTI"] = None
+                continue
+
+            if len(download_futures[pid]) > 0:
+                manifest.clear_converted(pid)
+
+            nifti_results = manifest.get_converted(pid)
+            if nifti_results is not None:
+                logger.debug(f"Data for {pid} already converted to Nifti")
+                result[pid]["NIFTI"] = nifti_results
+                continue
+
+            patient_directory = output_directory.joinpath(pid)
+            convert_futures[pid] = convert_executor.submit(
+                convert_patient,
+                pid,
+                patient_directory.joinpath("DICOM"),
+                patient_directory.joinpath("NIFTI"),
             )
-            result[pid]["NIFTI"] = nifti_results[pid]
+
+        for pid, future in convert_futures.items():
+            result[pid]["NIFTI"] = future.result()
+
+    if len(failed_series) > 0:
+        logger.error(
+            f"Failed to download {sum(len(uids) for uids in failed_series.values())} series, "
+            "fetch the data again to retry:"
+        )
+        for pid, series_uids in failed_series.items():
+            for series_uid in series_uids:
+                logger.error(f"    Patient: {pid}, Series: {series_uid}")
 
     return result
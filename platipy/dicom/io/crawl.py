@@ -13,19 +13,24 @@
 # limitations under the License.
 
 
+import os
 import re
-import sys
+import time
+import functools
 
 import pathlib
 import pydicom
 import numpy as np
 import SimpleITK as sitk
 
-from skimage.draw import polygon
 from loguru import logger
 
 from datetime import datetime
 
+from platipy.dicom.io.index import DicomIndex
+from platipy.dicom.io.rtstruct_to_nifti import rasterise_contour_sequence
+from platipy.imaging.utils.parallel import get_executor, parallel_map
+
 
 def flatten(itr):
     if type(itr) in (str, bytes, sitk.Image):
@@ -249,7 +254,9 @@ def fix_missing_data(contour_data_list):
     return contour_data
 
 
-def transform_point_set_from_dicom_struct(image, dicom_struct, spacing_override=False):
+def transform_point_set_from_dicom_struct(
+    image, dicom_struct, spacing_override=False, executor="serial", max_workers=None
+):
     """
     This function is used to generate a binary mask from a set of vertices.
     This allows us to convert from DICOM-RTStruct format to any imaging format.
@@ -260,6 +267,9 @@ def transform_point_set_from_dicom_struct(image, dicom_struct, spacing_override=
         dicom_struct ([pydicom.Dataset]): The DICOM-RTStruct file
         spacing_override (bool | tuple, optional): Overwrite the spacing.
             Set with (axial_spacing, coronal_spacing, sagittal spacing). Defaults to False.
+        executor (str, optional): The type of executor used to convert the structures, one of
+            "serial", "thread" or "process". Defaults to "serial".
+        max_workers (int, optional): The maximum number of workers. Defaults to None.
 
     Returns:
         list, list : final_struct_name_sequence, structure_list
@@ -279,11 +289,10 @@ def transform_point_set_from_dicom_struct(image, dicom_struct, spacing_override=
         "_".join(i.ROIName.split()) for i in dicom_struct.StructureSetROISequence
     ]
 
-    structure_list = []
+    contour_sequence_list = []
     final_struct_name_sequence = []
 
     for structIndex, structure_name in enumerate(struct_name_sequence):
-        image_blank = np.zeros(image.GetSize()[::-1], dtype=np.uint8)
         logger.info(
             "    Converting structure {0} with name: {1}".format(structIndex, structure_name)
         )
@@ -307,65 +316,84 @@ def transform_point_set_from_dicom_struct(image, dicom_struct, spacing_override=
             logger.warning("    This is not a closed planar structure, skipping.")
             continue
 
-        for sl in range(len(struct_point_sequence[structIndex].ContourSequence)):
-
-            contour_data = fix_missing_data(
-                struct_point_sequence[structIndex].ContourSequence[sl].ContourData
-            )
+        contour_sequence_list.append(struct_point_sequence[structIndex].ContourSequence)
 
-            struct_slice_contour_data = np.array(contour_data, dtype=np.double)
-            vertexArr_physical = struct_slice_contour_data.reshape(
-                struct_slice_contour_data.shape[0] // 3, 3
-            )
+        structure_name_clean = re.sub(r"[^\w]", "_", structure_name).upper()
+        while "__" in structure_name_clean:
+            structure_name_clean = structure_name_clean.replace("__", "_")
+        final_struct_name_sequence.append(structure_name_clean)
 
-            point_arr = np.array(
-                [image.TransformPhysicalPointToIndex(i) for i in vertexArr_physical]
-            ).T
+    structure_list = parallel_map(
+        rasterise_contour_sequence,
+        contour_sequence_list,
+        executor=executor,
+        max_workers=max_workers,
+        dicom_image=image,
+    )
 
-            [xVertexArr_image, yVertexArr_image] = point_arr[[0, 1]]
-            zIndex = point_arr[2][0]
+    return final_struct_name_sequence, structure_list
 
-            if np.any(point_arr[2] != zIndex):
-                logger.error("    Axial slice index varies in contour. Quitting now.")
-                logger.error("    Structure:   {0}".format(structure_name))
-                logger.error("    Slice index: {0}".format(zIndex))
-                quit()
 
-            if zIndex >= image.GetSize()[2]:
-                logger.warning("    Slice index greater than image size. Skipping slice.")
-                logger.warning("    Structure:   {0}".format(structure_name))
-                logger.warning("    Slice index: {0}".format(zIndex))
-                continue
+def read_dicom_file_index(dicom_file, parent_sorting_field="PatientName", header_only=True):
+    """Reads the fields used to index a DICOM file.
 
-            sliceArr = np.zeros(image.GetSize()[:2], dtype=np.uint8)
-            filledIndicesX, filledIndicesY = polygon(
-                xVertexArr_image, yVertexArr_image, shape=sliceArr.shape
-            )
-            sliceArr[filledIndicesX, filledIndicesY] = 1
-            image_blank[zIndex] += sliceArr.T
+    Args:
+        dicom_file (str): The path to the DICOM file.
+        parent_sorting_field (str, optional): The DICOM tag used to sort at the highest level.
+            Defaults to "PatientName".
+        header_only (bool, optional): Only read the tags needed for indexing, skipping the rest
+            of the header and the pixel data. Defaults to True.
 
-        struct_image = sitk.GetImageFromArray(1 * (image_blank > 0))
-        struct_image.CopyInformation(image)
-        structure_list.append(sitk.Cast(struct_image, sitk.sitkUInt8))
-        structure_name_clean = re.sub(r"[^\w]", "_", structure_name).upper()
-        while "__" in structure_name_clean:
-            structure_name_clean = structure_name_clean.replace("__", "_")
-        final_struct_name_sequence.append(structure_name_clean)
+    Returns:
+        tuple: The parent sorting field data and the series instance UID.
+    """
 
-    return final_struct_name_sequence, structure_list
+    if header_only:
+        dicom_object = pydicom.dcmread(
+            dicom_file,
+            force=True,
+            stop_before_pixels=True,
+            specific_tags=[parent_sorting_field, "SeriesInstanceUID"],
+        )
+    else:
+        dicom_object = pydicom.read_file(dicom_file, force=True)
 
+    return dicom_object[parent_sorting_field].value, dicom_object.SeriesInstanceUID
 
-def process_dicom_file_list(dicom_file_list, parent_sorting_field="PatientName", verbose=False):
 
+def process_dicom_file_list(
+    dicom_file_list,
+    parent_sorting_field="PatientName",
+    verbose=False,
+    header_only=True,
+    executor="serial",
+    max_workers=None,
+    dicom_index=None,
+):
     """
     Organise the DICOM files by the series UID
+
+    Args:
+        dicom_file_list (list): The DICOM files (pathlib.Path) to organise.
+        parent_sorting_field (str, optional): The DICOM tag used to sort at the highest level.
+            Defaults to "PatientName".
+        verbose (bool, optional): Print more information while running. Defaults to False.
+        header_only (bool, optional): Only read the tags needed for indexing (not the pixel
+            data). Defaults to True.
+        executor (str, optional): The type of executor used to read the files, one of "serial",
+            "thread" or "process". Defaults to "serial".
+        max_workers (int, optional): The maximum number of workers. Defaults to None.
+        dicom_index (platipy.dicom.io.index.DicomIndex, optional): A persistent index. If given,
+            only files which are new or have changed since they were indexed are read. Defaults
+            to None.
+
+    Returns:
+        dict: The DICOM files, as {parent_data: {series_uid: [list_of_DICOM_files]}}
     """
     dicom_series_dict_parent = {}
 
-    for i, dicom_file in enumerate(sorted(dicom_file_list)):
-        if verbose is True:
-            logger.debug(f"  Sorting file {i}")
-
+    file_list = []
+    for dicom_file in sorted(dicom_file_list):
         dicom_file = dicom_file.as_posix()
 
         if "dicomdir" in dicom_file.lower():
@@ -374,15 +402,63 @@ def process_dicom_file_list(dicom_file_list, parent_sorting_field="PatientName",
             )
             continue
 
-        dicom_object = pydicom.read_file(dicom_file, force=True)
+        file_list.append(dicom_file)
+
+    if dicom_index is not None:
+        dicom_index.remove_missing_files(file_list)
+        files_to_read = dicom_index.get_changed_files(
+            file_list, parent_sorting_field=parent_sorting_field
+        )
+        logger.info(
+            f"DICOM index: {len(file_list) - len(files_to_read)} files unchanged, "
+            f"{len(files_to_read)} files to read"
+        )
+    else:
+        files_to_read = file_list
+
+    read_index = functools.partial(
+        read_dicom_file_index, parent_sorting_field=parent_sorting_field, header_only=header_only
+    )
+
+    time_start = time.perf_counter()
 
-        parent_sorting_field_data = dicom_object[parent_sorting_field].value
+    pool = get_executor(executor=executor, max_workers=max_workers)
+    if pool is None:
+        file_index_list = map(read_index, files_to_read)
+    else:
+        # Send the files to worker processes in batches, rather than one at a time
+        number_of_workers = max_workers or os.cpu_count() or 1
+        chunksize = max(1, min(256, len(files_to_read) // (4 * number_of_workers)))
+        file_index_list = pool.map(read_index, files_to_read, chunksize=chunksize)
+
+    try:
+        file_index_list = [
+            (dicom_file, parent_sorting_field_data, series_uid)
+            for dicom_file, (parent_sorting_field_data, series_uid) in zip(
+                files_to_read, file_index_list
+            )
+        ]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    time_elapsed = time.perf_counter() - time_start
+    logger.info(
+        f"Indexed {len(files_to_read)} DICOM files in {time_elapsed:.1f} s "
+        f"({len(files_to_read) / max(time_elapsed, 1e-6):.1f} files/second)"
+    )
+
+    if dicom_index is not None:
+        dicom_index.add_files(file_index_list, parent_sorting_field=parent_sorting_field)
+        return dicom_index.get_series_dict(file_list)
+
+    for i, (dicom_file, parent_sorting_field_data, series_uid) in enumerate(file_index_list):
+        if verbose is True:
+            logger.debug(f"  Sorting file {i}")
 
         if parent_sorting_field_data not in dicom_series_dict_parent.keys():
             dicom_series_dict_parent[parent_sorting_field_data] = {}
 
-        series_uid = dicom_object.SeriesInstanceUID
-
         if series_uid not in dicom_series_dict_parent[parent_sorting_field_data].keys():
             dicom_series_dict_parent[parent_sorting_field_data][series_uid] = [dicom_file]
 
@@ -831,8 +907,9 @@ def write_output_data_to_disk(
     return files_written
 
 
-def process_dicom_directory(
-    dicom_directory,
+def process_dicom_parent_data(
+    parent_data,
+    dicom_series_dict,
     parent_sorting_field="PatientName",
     output_image_name_format="{parent_sorting_data}_{study_uid_index}_{Modality}_{image_desc}_{SeriesNumber}",
     output_structure_name_format="{parent_sorting_data}_{study_uid_index}_{Modality}_{structure_name}",
@@ -842,296 +919,404 @@ def process_dicom_directory(
     output_file_suffix=".nii.gz",
     overwrite_existing_files=False,
     write_to_disk=True,
-    verbose=False,
     initial_sop_class_name_default="UNKNOWN",
 ):
+    """
+    Convert (and optionally write) all the DICOM series sharing the same parent data (e.g. all
+    the series for a single patient).
 
-    # Check dicom_directory type
-    if isinstance(dicom_directory, str) or isinstance(dicom_directory, pathlib.Path):
-        # Get all the DICOM files in the given directory
-        root_path = pathlib.Path(dicom_directory)
-        # Find files ending with .dcm, .dc3
-        dicom_file_list = [
-            p
-            for p in root_path.glob("**/*")
-            if p.name.lower().endswith(".dcm") or p.name.lower().endswith(".dc3")
-        ]
+    The series are converted together, in order, so that the study UID indices and the suffixes
+    added to duplicate names are consistent.
 
-    elif hasattr(dicom_directory, "__iter__"):
-        dicom_file_list = []
-        for dicom_dir in dicom_directory:
-            # Get all the DICOM files in each directory
-            root_path = pathlib.Path(dicom_dir)
-            # Find files ending with .dcm, .dc3
-            dicom_file_list += [
-                p
-                for p in root_path.glob("**/*")
-                if p.name.lower().endswith(".dcm") or p.name.lower().endswith(".dc3")
-            ]
+    Returns:
+        dict: The files written to disk for each field (if write_to_disk is True), otherwise the
+            converted SimpleITK images for each field.
+    """
 
-    if len(dicom_file_list) == 0:
-        logger.info("No DICOM files found in input directory. Exiting now.")
-        return
+    logger.info(f"Processing data for {parent_sorting_field} = {parent_data}.")
+    logger.info(f"  Number of DICOM series = {len(dicom_series_dict.keys())}")
+
+    # Set up the output data
+    # This stores the SimpleITK images and file names
+    output_data_dict = {}
+
+    # Set up the study UID dict
+    # This helps match structure sets to relevant images
+    # And paired images to each other (e.g. PET/CT)
+    study_uid_dict = {}
+
+    # Give some user feedback
+    logger.debug(f"  Output image name format: {output_image_name_format}")
+    logger.debug(f"  Output structure name format: {output_structure_name_format}")
+    logger.debug(f"  Output dose name format: {output_dose_name_format}")
+
+    # For each unique series UID, process the DICOM files
+    for series_uid in dicom_series_dict.keys():
+
+        # This function returns four values
+        # 1. dicom_type: This is IMAGES, STRUCTURES, DOSES, etc
+        # 2. dicom_file_metadata: Some special metadata extracted from the DICOM header
+        # 3. initial_dicom: The first DICOM in the series. For doses and structures there is
+        #    (usually) only one DICOM anyway
+        # 4. dicom_file_data: The actual SimpleITK image data
+
+        for (
+            dicom_type,
+            dicom_file_metadata,
+            initial_dicom,
+            dicom_file_data,
+        ) in process_dicom_series(
+            dicom_series_dict=dicom_series_dict,
+            series_uid=series_uid,
+            parent_sorting_field=parent_sorting_field,
+            return_extra=return_extra,
+            initial_sop_class_name_default=initial_sop_class_name_default,
+        ):
 
-    # Process the DICOM files
-    # This returns a dictionary (of dictionaries):
-    #   {parent_data (e.g. PatientName): {series_UID_1: [list_of_DICOM_files],
-    #                                    {series_UID_2: [list_of_DICOM_files], ...
-    #   parent_data_2                  : {series_UID_1: [list_of_DICOM_files],
-    #                                    {series_UID_2: [list_of_DICOM_files], ...
-    #   ...     }
-    dicom_series_dict_parent = process_dicom_file_list(
-        dicom_file_list, parent_sorting_field=parent_sorting_field, verbose=verbose
-    )
+            # Step 1
+            # Check the parent sorting field is consistent
+            # This would usually be the PatientName, PatientID, or similar
+            # Occasionally these will both be blank
 
-    if dicom_series_dict_parent is None:
-        logger.info("No valid DICOM files found. Ending.")
-        return None
+            parent_sorting_data = dicom_file_metadata["parent_sorting_data"]
 
-    output = {}
+            if "parent_sorting_data" not in output_data_dict.keys():
+                output_data_dict["parent_sorting_data"] = parent_sorting_data
 
-    for parent_data, dicom_series_dict in dicom_series_dict_parent.items():
-        logger.info(f"Processing data for {parent_sorting_field} = {parent_data}.")
-        logger.info(f"  Number of DICOM series = {len(dicom_series_dict.keys())}")
-
-        # Set up the output data
-        # This stores the SimpleITK images and file names
-        output_data_dict = {}
-
-        # Set up the study UID dict
-        # This helps match structure sets to relevant images
-        # And paired images to each other (e.g. PET/CT)
-        study_uid_dict = {}
-
-        # Give some user feedback
-        logger.debug(f"  Output image name format: {output_image_name_format}")
-        logger.debug(f"  Output structure name format: {output_structure_name_format}")
-        logger.debug(f"  Output dose name format: {output_dose_name_format}")
-
-        # For each unique series UID, process the DICOM files
-        for series_uid in dicom_series_dict.keys():
-
-            # This function returns four values
-            # 1. dicom_type: This is IMAGES, STRUCTURES, DOSES, etc
-            # 2. dicom_file_metadata: Some special metadata extracted from the DICOM header
-            # 3. initial_dicom: The first DICOM in the series. For doses and structures there is
-            #    (usually) only one DICOM anyway
-            # 4. dicom_file_data: The actual SimpleITK image data
-
-            for (
-                dicom_type,
-                dicom_file_metadata,
-                initial_dicom,
-                dicom_file_data,
-            ) in process_dicom_series(
-                dicom_series_dict=dicom_series_dict,
-                series_uid=series_uid,
-                parent_sorting_field=parent_sorting_field,
-                return_extra=return_extra,
-                initial_sop_class_name_default=initial_sop_class_name_default,
-            ):
+            else:
+                if parent_sorting_data != output_data_dict["parent_sorting_data"]:
+                    # This runs in a worker process, so raise rather than exit, and let the
+                    # calling process report it
+                    logger.error(
+                        f"A conflict was found for the parent sorting field "
+                        f"({parent_sorting_field}): {output_data_dict['parent_sorting_data']} "
+                        f"and {parent_sorting_data} (series {series_uid})"
+                    )
+                    raise ValueError(
+                        f"Conflicting values of the parent sorting field ({parent_sorting_field}) "
+                        f"for {parent_data}: {output_data_dict['parent_sorting_data']} and "
+                        f"{parent_sorting_data}"
+                    )
+                else:
+                    logger.info(
+                        f"  Parent sorting field ({parent_sorting_field}) match found: "
+                        f"{parent_sorting_data}"
+                    )
 
-                # Step 1
-                # Check the parent sorting field is consistent
-                # This would usually be the PatientName, PatientID, or similar
-                # Occasionally these will both be blank
+            # Step 2
+            # Get the study UID
+            # Used for indexing DICOM series
 
-                parent_sorting_data = dicom_file_metadata["parent_sorting_data"]
+            study_uid = dicom_file_metadata["study_uid"]
 
-                if "parent_sorting_data" not in output_data_dict.keys():
-                    output_data_dict["parent_sorting_data"] = parent_sorting_data
+            if study_uid not in study_uid_dict.keys():
+                try:
+                    study_uid_index = max(study_uid_dict.values()) + 1
+                except AttributeError:
+                    study_uid_index = 0  # Study UID dict might not exist
+                except ValueError:
+                    study_uid_index = 0  # Study UID dict might be empty
 
-                else:
-                    if parent_sorting_data != output_data_dict["parent_sorting_data"]:
-                        logger.error(
-                            f"A conflict was found for the parent sorting field "
-                            f"({parent_sorting_field}): {parent_sorting_data}"
-                        )
-                        logger.error("Quitting now.")
-                        print(dicom_series_dict_parent.keys())
-                        sys.exit()
-                    else:
-                        logger.info(
-                            f"  Parent sorting field ({parent_sorting_field}) match found: "
-                            f"{parent_sorting_data}"
-                        )
+                logger.info(f"  Setting study instance UID index: {study_uid_index}")
 
-                # Step 2
-                # Get the study UID
-                # Used for indexing DICOM series
+                study_uid_dict[study_uid] = study_uid_index
 
-                study_uid = dicom_file_metadata["study_uid"]
+            else:
+                logger.info(
+                    f"  Study instance UID index already exists: {study_uid_dict[study_uid]}"
+                )
 
-                if study_uid not in study_uid_dict.keys():
-                    try:
-                        study_uid_index = max(study_uid_dict.values()) + 1
-                    except AttributeError:
-                        study_uid_index = 0  # Study UID dict might not exist
-                    except ValueError:
-                        study_uid_index = 0  # Study UID dict might be empty
+            # Step 3
+            # Generate names for output files
 
-                    logger.info(f"  Setting study instance UID index: {study_uid_index}")
+            # Special names
+            # ! This can be defined once at the start of the function
+            special_name_fields = [
+                "parent_sorting_data",
+                "study_uid_index",
+                "image_desc",
+                "structure_name",
+            ]
 
-                    study_uid_dict[study_uid] = study_uid_index
+            # Get the image description (other special names are already defined above)
+            image_desc = get_dicom_info_from_description(initial_dicom, return_extra=return_extra)
 
-                else:
-                    logger.info(
-                        f"  Study instance UID index already exists: {study_uid_dict[study_uid]}"
-                    )
+            # Get all the fields from the user-given name format
+            if dicom_type == "IMAGES":
+                all_naming_fields = [
+                    i[i.find("{") + 1 :] for i in output_image_name_format.split("}") if len(i) > 0
+                ]
+            elif dicom_type == "STRUCTURES":
+                all_naming_fields = [
+                    i[i.find("{") + 1 :]
+                    for i in output_structure_name_format.split("}")
+                    if len(i) > 0
+                ]
+            elif dicom_type == "DOSES":
+                all_naming_fields = [
+                    i[i.find("{") + 1 :] for i in output_dose_name_format.split("}") if len(i) > 0
+                ]
 
-                # Step 3
-                # Generate names for output files
+            # Now exclude those that aren't derived from the DICOM header
+            dicom_header_tags = [i for i in all_naming_fields if i not in special_name_fields]
 
-                # Special names
-                # ! This can be defined once at the start of the function
-                special_name_fields = [
-                    "parent_sorting_data",
-                    "study_uid_index",
-                    "image_desc",
-                    "structure_name",
-                ]
+            naming_info_dict = {}
+            for dicom_field in dicom_header_tags:
+                try:
+                    dicom_field_value = initial_dicom[dicom_field].value
+                except (AttributeError, KeyError):
+                    logger.warning(
+                        f"  Could not find DICOM header {dicom_field}. Setting as 0 to "
+                        f"preserve naming convention."
+                    )
+                    dicom_field_value = 0
+                naming_info_dict[dicom_field] = dicom_field_value
 
-                # Get the image description (other special names are already defined above)
-                image_desc = get_dicom_info_from_description(
-                    initial_dicom, return_extra=return_extra
+            if dicom_type == "IMAGES":
+
+                output_name = output_image_name_format.format(
+                    parent_sorting_data=parent_sorting_data,
+                    study_uid_index=study_uid_dict[study_uid],
+                    image_desc=image_desc,
+                    **naming_info_dict,
                 )
 
-                # Get all the fields from the user-given name format
-                if dicom_type == "IMAGES":
-                    all_naming_fields = [
-                        i[i.find("{") + 1 :]
-                        for i in output_image_name_format.split("}")
-                        if len(i) > 0
-                    ]
-                elif dicom_type == "STRUCTURES":
-                    all_naming_fields = [
-                        i[i.find("{") + 1 :]
-                        for i in output_structure_name_format.split("}")
-                        if len(i) > 0
-                    ]
-                elif dicom_type == "DOSES":
-                    all_naming_fields = [
-                        i[i.find("{") + 1 :]
-                        for i in output_dose_name_format.split("}")
-                        if len(i) > 0
-                    ]
-
-                # Now exclude those that aren't derived from the DICOM header
-                dicom_header_tags = [i for i in all_naming_fields if i not in special_name_fields]
-
-                naming_info_dict = {}
-                for dicom_field in dicom_header_tags:
-                    try:
-                        dicom_field_value = initial_dicom[dicom_field].value
-                    except (AttributeError, KeyError):
-                        logger.warning(
-                            f"  Could not find DICOM header {dicom_field}. Setting as 0 to "
-                            f"preserve naming convention."
-                        )
-                        dicom_field_value = 0
-                    naming_info_dict[dicom_field] = dicom_field_value
+                if "IMAGES" not in output_data_dict.keys():
+                    # Make a new entry
+                    output_data_dict["IMAGES"] = {output_name: dicom_file_data}
+
+                else:
+                    # First check if there is another image of the same name
+
+                    if output_name not in output_data_dict["IMAGES"].keys():
+                        output_data_dict["IMAGES"][output_name] = dicom_file_data
+
+                    else:
+                        logger.info("      An image with this name exists, appending.")
 
-                if dicom_type == "IMAGES":
+                        if hasattr(output_data_dict["IMAGES"][output_name], "__iter__"):
+                            output_data_dict["IMAGES"][output_name] = list(
+                                [output_data_dict["IMAGES"][output_name]]
+                            )
+
+                        output_data_dict["IMAGES"][output_name].append(dicom_file_data)
+
+            elif dicom_type == "STRUCTURES":
+
+                for structure_name, structure_image in zip(
+                    dicom_file_metadata["structure_name_list"], dicom_file_data
+                ):
 
-                    output_name = output_image_name_format.format(
+                    output_name = output_structure_name_format.format(
                         parent_sorting_data=parent_sorting_data,
                         study_uid_index=study_uid_dict[study_uid],
                         image_desc=image_desc,
+                        structure_name=structure_name,
                         **naming_info_dict,
                     )
 
-                    if "IMAGES" not in output_data_dict.keys():
+                    if "STRUCTURES" not in output_data_dict.keys():
                         # Make a new entry
-                        output_data_dict["IMAGES"] = {output_name: dicom_file_data}
+                        output_data_dict["STRUCTURES"] = {output_name: structure_image}
 
                     else:
-                        # First check if there is another image of the same name
+                        # First check if there is another structure of the same name
 
-                        if output_name not in output_data_dict["IMAGES"].keys():
-                            output_data_dict["IMAGES"][output_name] = dicom_file_data
+                        if output_name not in output_data_dict["STRUCTURES"].keys():
+                            output_data_dict["STRUCTURES"][output_name] = structure_image
 
                         else:
-                            logger.info("      An image with this name exists, appending.")
-
-                            if hasattr(output_data_dict["IMAGES"][output_name], "__iter__"):
-                                output_data_dict["IMAGES"][output_name] = list(
-                                    [output_data_dict["IMAGES"][output_name]]
+                            logger.info("      A structure with this name exists, appending.")
+                            if hasattr(output_data_dict["STRUCTURES"][output_name], "__iter__"):
+                                output_data_dict["STRUCTURES"][output_name] = list(
+                                    [output_data_dict["STRUCTURES"][output_name]]
                                 )
 
-                            output_data_dict["IMAGES"][output_name].append(dicom_file_data)
+                            output_data_dict["STRUCTURES"][output_name].append(structure_image)
 
-                elif dicom_type == "STRUCTURES":
+            elif dicom_type == "DOSES":
 
-                    for structure_name, structure_image in zip(
-                        dicom_file_metadata["structure_name_list"], dicom_file_data
-                    ):
+                output_name = output_dose_name_format.format(
+                    parent_sorting_data=parent_sorting_data,
+                    study_uid_index=study_uid_dict[study_uid],
+                    **naming_info_dict,
+                )
 
-                        output_name = output_structure_name_format.format(
-                            parent_sorting_data=parent_sorting_data,
-                            study_uid_index=study_uid_dict[study_uid],
-                            image_desc=image_desc,
-                            structure_name=structure_name,
-                            **naming_info_dict,
-                        )
+                if "DOSES" not in output_data_dict.keys():
+                    # Make a new entry
+                    output_data_dict["DOSES"] = {output_name: dicom_file_data}
 
-                        if "STRUCTURES" not in output_data_dict.keys():
-                            # Make a new entry
-                            output_data_dict["STRUCTURES"] = {output_name: structure_image}
+                else:
+                    # First check if there is another image of the same name
 
-                        else:
-                            # First check if there is another structure of the same name
+                    if output_name not in output_data_dict["DOSES"].keys():
+                        output_data_dict["DOSES"][output_name] = dicom_file_data
 
-                            if output_name not in output_data_dict["STRUCTURES"].keys():
-                                output_data_dict["STRUCTURES"][output_name] = structure_image
+                    else:
+                        logger.info("      An image with this name exists, appending.")
 
-                            else:
-                                logger.info("      A structure with this name exists, appending.")
-                                if hasattr(
-                                    output_data_dict["STRUCTURES"][output_name], "__iter__"
-                                ):
-                                    output_data_dict["STRUCTURES"][output_name] = list(
-                                        [output_data_dict["STRUCTURES"][output_name]]
-                                    )
+                        if isinstance(output_data_dict["DOSES"][output_name], sitk.Image):
+                            output_data_dict["DOSES"][output_name] = list(
+                                [output_data_dict["DOSES"][output_name]]
+                            )
 
-                                output_data_dict["STRUCTURES"][output_name].append(structure_image)
+                        output_data_dict["DOSES"][output_name].append(dicom_file_data)
 
-                elif dicom_type == "DOSES":
+    if write_to_disk:
+        return write_output_data_to_disk(
+            output_data_dict=output_data_dict,
+            output_directory=output_directory,
+            output_file_suffix=output_file_suffix,
+            overwrite_existing_files=overwrite_existing_files,
+        )
 
-                    output_name = output_dose_name_format.format(
-                        parent_sorting_data=parent_sorting_data,
-                        study_uid_index=study_uid_dict[study_uid],
-                        **naming_info_dict,
-                    )
+    return output_data_dict
 
-                    if "DOSES" not in output_data_dict.keys():
-                        # Make a new entry
-                        output_data_dict["DOSES"] = {output_name: dicom_file_data}
 
-                    else:
-                        # First check if there is another image of the same name
+def process_dicom_directory(
+    dicom_directory,
+    parent_sorting_field="PatientName",
+    output_image_name_format="{parent_sorting_data}_{study_uid_index}_{Modality}_{image_desc}_{SeriesNumber}",
+    output_structure_name_format="{parent_sorting_data}_{study_uid_index}_{Modality}_{structure_name}",
+    output_dose_name_format="{parent_sorting_data}_{study_uid_index}_{DoseSummationType}",
+    return_extra=True,
+    output_directory="./",
+    output_file_suffix=".nii.gz",
+    overwrite_existing_files=False,
+    write_to_disk=True,
+    verbose=False,
+    initial_sop_class_name_default="UNKNOWN",
+    index_executor="serial",
+    index_workers=None,
+    index_path=None,
+    workers=1,
+):
+
+    # Check dicom_directory type
+    if isinstance(dicom_directory, str) or isinstance(dicom_directory, pathlib.Path):
+        # Get all the DICOM files in the given directory
+        root_path = pathlib.Path(dicom_directory)
+        # Find files ending with .dcm, .dc3
+        dicom_file_list = [
+            p
+            for p in root_path.glob("**/*")
+            if p.name.lower().endswith(".dcm") or p.name.lower().endswith(".dc3")
+        ]
 
-                        if output_name not in output_data_dict["DOSES"].keys():
-                            output_data_dict["DOSES"][output_name] = dicom_file_data
+    elif hasattr(dicom_directory, "__iter__"):
+        dicom_file_list = []
+        for dicom_dir in dicom_directory:
+            # Get all the DICOM files in each directory
+            root_path = pathlib.Path(dicom_dir)
+            # Find files ending with .dcm, .dc3
+            dicom_file_list += [
+                p
+                for p in root_path.glob("**/*")
+                if p.name.lower().endswith(".dcm") or p.name.lower().endswith(".dc3")
+            ]
 
-                        else:
-                            logger.info("      An image with this name exists, appending.")
+    if len(dicom_file_list) == 0:
+        logger.info("No DICOM files found in input directory. Exiting now.")
+        return
 
-                            if isinstance(output_data_dict["DOSES"][output_name], sitk.Image):
-                                output_data_dict["DOSES"][output_name] = list(
-                                    [output_data_dict["DOSES"][output_name]]
-                                )
+    dicom_index = None
+    if index_path is not None:
+        dicom_index = DicomIndex(index_path)
 
-                            output_data_dict["DOSES"][output_name].append(dicom_file_data)
+    # Process the DICOM files
+    # This returns a dictionary (of dictionaries):
+    #   {parent_data (e.g. PatientName): {series_UID_1: [list_of_DICOM_files],
+    #                                    {series_UID_2: [list_of_DICOM_files], ...
+    #   parent_data_2                  : {series_UID_1: [list_of_DICOM_files],
+    #                                    {series_UID_2: [list_of_DICOM_files], ...
+    #   ...     }
+    dicom_series_dict_parent = process_dicom_file_list(
+        dicom_file_list,
+        parent_sorting_field=parent_sorting_field,
+        verbose=verbose,
+        executor=index_executor,
+        max_workers=index_workers,
+        dicom_index=dicom_index,
+    )
+
+    if dicom_series_dict_parent is None:
+        logger.info("No valid DICOM files found. Ending.")
+        return None
+
+    output = {}
+    conversion_list = []
 
-        if write_to_disk:
-            output[str(parent_data)] = write_output_data_to_disk(
-                output_data_dict=output_data_dict,
-                output_directory=output_directory,
+    for parent_data, dicom_series_dict in dicom_series_dict_parent.items():
+
+        # When using an index, only convert data where some of the files (or the output
+        # settings) have changed since the last conversion. All series for this parent are
+        # converted together, so the study UID indices (used for naming) are consistent.
+        conversion_signature = None
+        if dicom_index is not None and write_to_disk:
+            conversion_signature = dicom_index.compute_signature(
+                dicom_series_dict,
+                parent_sorting_field=parent_sorting_field,
+                output_image_name_format=output_image_name_format,
+                output_structure_name_format=output_structure_name_format,
+                output_dose_name_format=output_dose_name_format,
+                return_extra=return_extra,
+                output_directory=str(pathlib.Path(output_directory).resolve()),
                 output_file_suffix=output_file_suffix,
-                overwrite_existing_files=overwrite_existing_files,
+                initial_sop_class_name_default=initial_sop_class_name_default,
             )
-        else:
-            output[str(parent_data)] = output_data_dict
+
+            if dicom_index.is_converted(parent_data, conversion_signature):
+                logger.info(
+                    f"No changes for {parent_sorting_field} = {parent_data} since the last "
+                    "conversion. Skipping."
+                )
+                continue
+
+        conversion_list.append((parent_data, dicom_series_dict, conversion_signature))
+
+    convert_parent_data = functools.partial(
+        process_dicom_parent_data,
+        parent_sorting_field=parent_sorting_field,
+        output_image_name_format=output_image_name_format,
+        output_structure_name_format=output_structure_name_format,
+        output_dose_name_format=output_dose_name_format,
+        return_extra=return_extra,
+        output_directory=output_directory,
+        output_file_suffix=output_file_suffix,
+        overwrite_existing_files=overwrite_existing_files,
+        write_to_disk=write_to_disk,
+        initial_sop_class_name_default=initial_sop_class_name_default,
+    )
+
+    pool = get_executor(executor="process" if workers > 1 else "serial", max_workers=workers)
+    if pool is None:
+        conversion_results = (
+            convert_parent_data(parent_data, dicom_series_dict)
+            for parent_data, dicom_series_dict, _ in conversion_list
+        )
+    else:
+        conversion_results = pool.map(
+            convert_parent_data,
+            [parent_data for parent_data, _, _ in conversion_list],
+            [dicom_series_dict for _, dicom_series_dict, _ in conversion_list],
+        )
+
+    conversion_results = iter(conversion_results)
+    try:
+        for parent_data, _, conversion_signature in conversion_list:
+            try:
+                parent_output = next(conversion_results)
+            except Exception:
+                logger.error(f"Could not convert data for {parent_sorting_field} = {parent_data}")
+                raise
+
+            output[str(parent_data)] = parent_output
+
+            if conversion_signature is not None:
+                dicom_index.set_converted(parent_data, conversion_signature)
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
     """
     TO DO!
@@ -0,0 +1,225 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import hashlib
+import sqlite3
+import contextlib
+from pathlib import Path
+
+from loguru import logger
+
+
+class DicomIndex:
+    """A persistent index of DICOM files, used to incrementally crawl a directory.
+
+    For each file the index records the modification time and size, along with the tags used to
+    sort it (the parent sorting field and SeriesInstanceUID). When crawling again, only files
+    which are new or have changed need to be read. The index also records which parent groups
+    (e.g. patients) have been converted, so these can be skipped if none of their files changed.
+
+    Args:
+        index_path (str | pathlib.Path): The path of the SQLite index file. This is created if it
+            doesn't exist.
+    """
+
+    def __init__(self, index_path):
+
+        self.index_path = Path(index_path)
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime INTEGER, "
+                "size INTEGER, parent_sorting_field TEXT, parent_data TEXT, series_uid TEXT)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS converted "
+                "(parent_data TEXT PRIMARY KEY, signature TEXT)"
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Connects to the index, committing any changes and closing the connection on exit"""
+
+        connection = sqlite3.connect(str(self.index_path), timeout=60)
+
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _file_stat(dicom_file):
+        """Returns the modification time (in ns) and size of a file"""
+
+        stat = Path(dicom_file).stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def get_changed_files(self, dicom_file_list, parent_sorting_field="PatientName"):
+        """Finds the files which are not yet indexed, or have changed since they were indexed.
+
+        Args:
+            dicom_file_list (list): The paths (str) of the DICOM files.
+            parent_sorting_field (str, optional): The DICOM tag used to sort at the highest level.
+                Files indexed with a different field are treated as changed. Defaults to
+                "PatientName".
+
+        Returns:
+            list: The files which need to be read.
+        """
+
+        with self._connect() as connection:
+            indexed_files = {
+                path: (mtime, size, field)
+                for path, mtime, size, field in connection.execute(
+                    "SELECT path, mtime, size, parent_sorting_field FROM files"
+                )
+            }
+
+        return [
+            dicom_file
+            for dicom_file in dicom_file_list
+            if indexed_files.get(dicom_file)
+            != (*self._file_stat(dicom_file), parent_sorting_field)
+        ]
+
+    def add_files(self, file_index_list, parent_sorting_field="PatientName"):
+        """Adds (or updates) files in the index.
+
+        Args:
+            file_index_list (list): Tuples of (path, parent_data, series_uid) for each file.
+            parent_sorting_field (str, optional): The DICOM tag used to sort at the highest level.
+                Defaults to "PatientName".
+        """
+
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        dicom_file,
+                        *self._file_stat(dicom_file),
+                        parent_sorting_field,
+                        str(parent_data),
+                        str(series_uid),
+                    )
+                    for dicom_file, parent_data, series_uid in file_index_list
+                ],
+            )
+
+    def remove_missing_files(self, dicom_file_list):
+        """Removes files from the index which are no longer present.
+
+        Args:
+            dicom_file_list (list): The paths (str) of the DICOM files which are present.
+
+        Returns:
+            int: The number of files removed from the index.
+        """
+
+        dicom_file_set = set(dicom_file_list)
+
+        with self._connect() as connection:
+            missing_files = [
+                (path,)
+                for (path,) in connection.execute("SELECT path FROM files")
+                if path not in dicom_file_set
+            ]
+            connection.executemany("DELETE FROM files WHERE path = ?", missing_files)
+
+        if len(missing_files) > 0:
+            logger.info(f"Removed {len(missing_files)} missing files from the DICOM index")
+
+        return len(missing_files)
+
+    def get_series_dict(self, dicom_file_list):
+        """Organises the indexed files by parent data and series UID.
+
+        Args:
+            dicom_file_list (list): The paths (str) of the DICOM files to include.
+
+        Returns:
+            dict: The DICOM files, as {parent_data: {series_uid: [list_of_DICOM_files]}}
+        """
+
+        with self._connect() as connection:
+            indexed_files = {
+                path: (parent_data, series_uid)
+                for path, parent_data, series_uid in connection.execute(
+                    "SELECT path, parent_data, series_uid FROM files"
+                )
+            }
+
+        dicom_series_dict_parent = {}
+        for dicom_file in sorted(dicom_file_list):
+            parent_data, series_uid = indexed_files[dicom_file]
+            dicom_series_dict_parent.setdefault(parent_data, {}).setdefault(series_uid, [])
+            dicom_series_dict_parent[parent_data][series_uid].append(dicom_file)
+
+        return dicom_series_dict_parent
+
+    def compute_signature(self, dicom_series_dict, **settings):
+        """Computes a signature of a group of series, which changes if any of the files change.
+
+        Args:
+            dicom_series_dict (dict): The DICOM files, as {series_uid: [list_of_DICOM_files]}
+            settings: Any settings which change the converted output (e.g. naming formats).
+
+        Returns:
+            str: The signature.
+        """
+
+        signature = hashlib.sha256()
+
+        for series_uid in sorted(dicom_series_dict.keys()):
+            signature.update(series_uid.encode())
+            for dicom_file in sorted(dicom_series_dict[series_uid]):
+                signature.update(repr((dicom_file, *self._file_stat(dicom_file))).encode())
+
+        signature.update(json.dumps(settings, sort_keys=True, default=str).encode())
+
+        return signature.hexdigest()
+
+    def is_converted(self, parent_data, signature):
+        """Checks whether a parent group was converted with the same files and settings.
+
+        Args:
+            parent_data (str): The parent sorting data (e.g. the PatientName).
+            signature (str): The signature, see compute_signature.
+
+        Returns:
+            bool: True if it was already converted.
+        """
+
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT signature FROM converted WHERE parent_data = ?", (str(parent_data),)
+            ).fetchone()
+
+        return row is not None and row[0] == signature
+
+    def set_converted(self, parent_data, signature):
+        """Records that a parent group has been converted.
+
+        Args:
+            parent_data (str): The parent sorting data (e.g. the PatientName).
+            signature (str): The signature, see compute_signature.
+        """
+
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO converted VALUES (?, ?)", (str(parent_data), signature)
+            )
@@ -19,7 +19,9 @@ import numpy as np
 import SimpleITK as sitk
 
 from loguru import logger
-from skimage.draw import polygon
+
+from platipy.imaging.label.utils import vectorised_transform_physical_point_to_index
+from platipy.imaging.utils.parallel import parallel_map
 
 
 def read_dicom_image(dicom_path):
@@ -99,13 +101,201 @@ def fix_missing_data(contour_data):
     return contour_data
 
 
-def transform_point_set_from_dicom_struct(dicom_image, dicom_struct, spacing_override=None):
+def _polygon_edge_crossings(edge_arr, lower_inclusive=True):
+    """Finds where the polygon edges cross each row (of pixel centres)
+
+    Args:
+        edge_arr (np.ndarray): The edges, as (N, 5) integer array with columns (polygon index,
+            start row, start column, end row, end column).
+        lower_inclusive (bool, optional): Select edges with min(row) <= r < max(row) if True,
+            otherwise edges with min(row) < r <= max(row). Defaults to True.
+
+    Returns:
+        tuple: The polygon index and row of each crossing, along with the crossing column as a
+            rational number (base + numerator / denominator).
+    """
+
+    polygon_index, r_0, c_0, r_1, c_1 = edge_arr.T
+
+    number_of_rows = np.abs(r_1 - r_0)
+    edge_index = np.repeat(np.arange(len(edge_arr)), number_of_rows)
+    row_offset = np.arange(number_of_rows.sum()) - np.repeat(
+        np.cumsum(number_of_rows) - number_of_rows, number_of_rows
+    )
+
+    rows = np.minimum(r_0, r_1)[edge_index] + row_offset + (0 if lower_inclusive else 1)
+
+    numerator = (c_1 - c_0)[edge_index] * (rows - r_0[edge_index])
+    denominator = (r_1 - r_0)[edge_index]
+    numerator = np.where(denominator < 0, -numerator, numerator)
+    denominator = np.abs(denominator)
+
+    return polygon_index[edge_index], rows, c_0[edge_index], numerator, denominator
+
+
+def fill_polygons(vertex_arr, polygon_lengths, shape):
+    """Fills a set of polygons, each lying in a single slice of a volume
+
+    Pixels inside a polygon, or on its boundary, are filled (exactly as with
+    skimage.draw.polygon), and overlapping polygons are combined. All polygons are filled at
+    once, using the crossings of the polygon edges with each row of pixels.
+
+    Args:
+        vertex_arr (np.ndarray): The (integer) vertices of all the polygons, as an (N, 3) array
+            of (slice, row, column) indices.
+        polygon_lengths (list): The number of vertices in each polygon.
+        shape (tuple): The shape of the volume.
+
+    Returns:
+        np.ndarray: The filled volume (boolean).
+    """
+
+    vertex_arr = np.asarray(vertex_arr, dtype=np.int64)
+    polygon_lengths = np.asarray(polygon_lengths, dtype=np.int64)
+
+    # Each vertex is joined to the previous vertex in the same polygon
+    polygon_index = np.repeat(np.arange(len(polygon_lengths)), polygon_lengths)
+    polygon_start = np.cumsum(polygon_lengths) - polygon_lengths
+    previous_vertex = np.arange(len(vertex_arr)) - 1
+    previous_vertex[polygon_start] = polygon_start + polygon_lengths - 1
+
+    edge_arr = np.stack(
+        [
+            polygon_index,
+            vertex_arr[:, 1],
+            vertex_arr[:, 2],
+            vertex_arr[previous_vertex, 1],
+            vertex_arr[previous_vertex, 2],
+        ],
+        axis=1,
+    )
+    slice_index = vertex_arr[polygon_start, 0]
+
+    # Count the edges crossing a ray to the right (or left) of each pixel. A pixel is inside (or
+    # on the boundary of) the polygon if either count is odd. Since the crossings on each row come
+    # in pairs, the pixels with an odd count are those between the first and second crossing,
+    # third and fourth crossing, etc.
+    difference_arr = np.zeros((shape[0], shape[1], shape[2] + 1), dtype=np.int32)
+
+    for lower_inclusive in (True, False):
+        polygon_crossing, rows, base, numerator, denominator = _polygon_edge_crossings(
+            edge_arr, lower_inclusive=lower_inclusive
+        )
+
+        if lower_inclusive:
+            # Right crossings, the first pixel with the crossing at or to its right
+            columns = base - ((-numerator) // denominator)
+        else:
+            # Left crossings, the first pixel with the crossing strictly to its left
+            columns = base + numerator // denominator + 1
+
+        order = np.lexsort((columns, rows, polygon_crossing))
+        polygon_crossing, rows, columns = polygon_crossing[order], rows[order], columns[order]
+
+        slices = slice_index[polygon_crossing[0::2]]
+        rows = rows[0::2]
+        valid = (rows >= 0) & (rows < shape[1])
+
+        np.add.at(
+            difference_arr,
+            (slices[valid], rows[valid], np.clip(columns[0::2][valid], 0, shape[2])),
+            1,
+        )
+        np.add.at(
+            difference_arr,
+            (slices[valid], rows[valid], np.clip(columns[1::2][valid], 0, shape[2])),
+            -1,
+        )
+
+    filled_arr = np.cumsum(difference_arr[:, :, :-1], axis=2) > 0
+
+    # The vertices are always on the boundary
+    in_bounds = np.all((vertex_arr >= 0) & (vertex_arr < shape), axis=1)
+    filled_arr[tuple(vertex_arr[in_bounds].T)] = True
+
+    return filled_arr
+
+
+def rasterise_contour_sequence(contour_sequence, dicom_image):
+    """Converts the (closed planar) contours of a single structure into a mask
+
+    All vertices are transformed to image indices at once, and the contours are filled together
+    within the bounding box of the structure.
+
+    Args:
+        contour_sequence (pydicom.Sequence): The ContourSequence of the structure
+        dicom_image (sitk.Image): The reference image
+
+    Returns:
+        sitk.Image: The binary mask of the structure
+    """
+
+    vertex_arr_list = [
+        np.array(fix_missing_data(contour.ContourData), dtype=np.double).reshape(-1, 3)
+        for contour in contour_sequence
+    ]
+
+    # Transform every vertex of every contour in one go
+    index_arr = vectorised_transform_physical_point_to_index(
+        dicom_image, np.concatenate(vertex_arr_list), rotate=False
+    )
+    # Round half up, as in SimpleITK's TransformPhysicalPointToIndex
+    index_arr = np.floor(index_arr + 0.5).astype(int)
+    contour_index_list = np.split(index_arr, np.cumsum([len(v) for v in vertex_arr_list])[:-1])
+
+    image_size = dicom_image.GetSize()
+    valid_contour_index_list = []
+    for contour_index in contour_index_list:
+        z_index = contour_index[0, 2]
+
+        if np.any(contour_index[:, 2] != z_index):
+            logger.error("Axial slice index varies in contour. Quitting now.")
+            logger.error("Slice index: {0}".format(z_index))
+            quit()
+
+        if z_index < 0 or z_index >= image_size[2]:
+            logger.debug("Warning: Slice index outside of image. Skipping slice.")
+            logger.debug("Slice index: {0}".format(z_index))
+            continue
+
+        valid_contour_index_list.append(contour_index)
+
+    mask_arr = np.zeros(image_size[::-1], dtype=np.uint8)
+
+    if len(valid_contour_index_list) > 0:
+        # The bounding box (in x, y, z) of the contours, limited to the image
+        all_index_arr = np.concatenate(valid_contour_index_list)
+        box_lower = np.clip(all_index_arr.min(axis=0), 0, np.array(image_size) - 1)
+        box_upper = np.clip(all_index_arr.max(axis=0), 0, np.array(image_size) - 1) + 1
+
+        box_arr = fill_polygons(
+            (all_index_arr - box_lower)[:, ::-1],
+            [len(contour_index) for contour_index in valid_contour_index_list],
+            tuple((box_upper - box_lower)[::-1]),
+        )
+
+        mask_arr[
+            box_lower[2] : box_upper[2], box_lower[1] : box_upper[1], box_lower[0] : box_upper[0]
+        ] = box_arr
+
+    mask = sitk.GetImageFromArray(mask_arr)
+    mask.CopyInformation(dicom_image)
+
+    return mask
+
+
+def transform_point_set_from_dicom_struct(
+    dicom_image, dicom_struct, spacing_override=None, executor="serial", max_workers=None
+):
     """Converts a set of points from a DICOM RTSTRUCT into a mask array
 
     Args:
         dicom_image (sitk.Image): The reference image
         dicom_struct (pydicom.Dataset): The DICOM RTSTRUCT
         spacing_override (list): The spacing to override. Defaults to None
+        executor (str, optional): The type of executor used to convert the structures, one of
+            "serial", "thread" or "process". Defaults to "serial".
+        max_workers (int, optional): The maximum number of workers. Defaults to None.
 
     Returns:
         tuple: Returns a list of masks and a list of structure names
@@ -126,11 +316,10 @@ def transform_point_set_from_dicom_struct(dicom_image, dicom_struct, spacing_ove
         "_".join(i.ROIName.split()) for i in dicom_struct.StructureSetROISequence
     ]
 
-    struct_list = []
+    contour_sequence_list = []
     final_struct_name_sequence = []
 
     for struct_index, struct_name in enumerate(struct_name_sequence):
-        image_blank = np.zeros(dicom_image.GetSize()[::-1], dtype=np.uint8)
         logger.debug("Converting structure {0} with name: {1}".format(struct_index, struct_name))
 
         if not hasattr(struct_point_sequence[struct_index], "ContourSequence"):
@@ -141,10 +330,6 @@ def transform_point_set_from_dicom_struct(dicom_image, dicom_struct, spacing_ove
             logger.debug("Contour sequence empty for this structure, skipping.")
             continue
 
-        if len(struct_point_sequence[struct_index].ContourSequence) == 0:
-            logger.debug("Contour sequence empty for this structure, skipping.")
-            continue
-
         if (
             not struct_point_sequence[struct_index].ContourSequence[0].ContourGeometricType
             == "CLOSED_PLANAR"
@@ -152,49 +337,17 @@ def transform_point_set_from_dicom_struct(dicom_image, dicom_struct, spacing_ove
             logger.debug("This is not a closed planar structure, skipping.")
             continue
 
-        for sl in range(len(struct_point_sequence[struct_index].ContourSequence)):
-
-            contour_data = fix_missing_data(
-                struct_point_sequence[struct_index].ContourSequence[sl].ContourData
-            )
-
-            struct_slice_contour_data = np.array(contour_data, dtype=np.double)
-            vertex_arr_physical = struct_slice_contour_data.reshape(
-                struct_slice_contour_data.shape[0] // 3, 3
-            )
-
-            point_arr = np.array(
-                [dicom_image.TransformPhysicalPointToIndex(i) for i in vertex_arr_physical]
-            ).T
-
-            [x_vertex_arr_image, y_vertex_arr_image] = point_arr[[0, 1]]
-            z_index = point_arr[2][0]
-            if np.any(point_arr[2] != z_index):
-                logger.debug("Error: axial slice index varies in contour. Quitting now.")
-                logger.debug("Structure:   {0}".format(struct_name))
-                logger.debug("Slice index: {0}".format(z_index))
-                quit()
-
-            if z_index >= dicom_image.GetSize()[2]:
-                logger.debug("Warning: Slice index greater than image size. Skipping slice.")
-                logger.debug("Structure:   {0}".format(struct_name))
-                logger.debug("Slice index: {0}".format(z_index))
-                continue
-
-            slice_arr = np.zeros(image_blank.shape[-2:], dtype=np.uint8)
-
-            filled_indices_x, filled_indices_y = polygon(
-                x_vertex_arr_image, y_vertex_arr_image, shape=slice_arr.shape
-            )
-            slice_arr[filled_indices_y, filled_indices_x] = 1
-
-            image_blank[z_index] += slice_arr
-
-        struct_image = sitk.GetImageFromArray(1 * (image_blank > 0))
-        struct_image.CopyInformation(dicom_image)
-        struct_list.append(sitk.Cast(struct_image, sitk.sitkUInt8))
+        contour_sequence_list.append(struct_point_sequence[struct_index].ContourSequence)
         final_struct_name_sequence.append(struct_name)
 
+    struct_list = parallel_map(
+        rasterise_contour_sequence,
+        contour_sequence_list,
+        executor=executor,
+        max_workers=max_workers,
+        dicom_image=dicom_image,
+    )
+
     return struct_list, final_struct_name_sequence
 
 
@@ -0,0 +1,326 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import threading
+
+import pytest
+
+import pydicom
+import numpy as np
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_dataset
+from pydicom.uid import ImplicitVRLittleEndian, CTImageStorage, generate_uid
+from pynetdicom import AE, evt, StoragePresentationContexts, VerificationPresentationContexts
+
+from platipy.dicom.communication import DicomConnector, DicomStoreWriter
+
+
+def generate_ct_slice(series_uid, slice_index):
+    """Generates a minimal CT slice"""
+
+    ds = Dataset()
+    ds.PatientName = "TEST"
+    ds.PatientID = "TEST"
+    ds.Modality = "CT"
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = generate_uid()
+    ds.StudyInstanceUID = "1.2.3.4"
+    ds.SeriesInstanceUID = series_uid
+    ds.InstanceNumber = slice_index
+    ds.Rows = 8
+    ds.Columns = 8
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelData = np.full((8, 8), slice_index, dtype=np.int16).tobytes()
+
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    ds.is_little_endian = True
+    ds.is_implicit_VR = True
+
+    return ds
+
+
+def put_dataset(writer, ds):
+    """Encodes a data set and queues it to be written"""
+
+    encoded_dataset = DicomBytesIO()
+    encoded_dataset.is_little_endian = True
+    encoded_dataset.is_implicit_VR = True
+    write_dataset(encoded_dataset, ds)
+
+    series_dir = writer.get_series_directory(ds.SeriesInstanceUID)
+    writer.put(series_dir, f"CT.{ds.SOPInstanceUID}", ds.file_meta, encoded_dataset.getvalue())
+
+
+def test_dicom_store_writer(tmp_path):
+
+    # The timeout is long enough that series are only completed by closing the writer
+    completed_series = []
+    writer = DicomStoreWriter(
+        tmp_path,
+        max_workers=2,
+        max_queue_size=4,
+        series_complete_callback=completed_series.append,
+        series_complete_timeout=60,
+    )
+
+    series_uids = [generate_uid(), generate_uid()]
+    datasets = [generate_ct_slice(series_uids[i % 2], i) for i in range(30)]
+
+    for ds in datasets:
+        put_dataset(writer, ds)
+
+    writer.flush()
+
+    for ds in datasets:
+        written_ds = pydicom.dcmread(
+            tmp_path.joinpath(ds.SeriesInstanceUID, f"CT.{ds.SOPInstanceUID}")
+        )
+        assert written_ds.SOPInstanceUID == ds.SOPInstanceUID
+        assert np.array_equal(written_ds.pixel_array, ds.pixel_array)
+
+    writer.close()
+
+    # Each series is reported as complete once
+    assert sorted(completed_series) == sorted(str(tmp_path.joinpath(s)) for s in series_uids)
+
+
+@pytest.mark.parametrize("report_recompleted_series", [False, True])
+def test_dicom_store_writer_recompleted_series(tmp_path, report_recompleted_series):
+
+    completed_series = []
+    completed = threading.Event()
+    writer = DicomStoreWriter(
+        tmp_path,
+        series_complete_callback=lambda series_dir: (
+            completed_series.append(series_dir),
+            completed.set(),
+        ),
+        series_complete_timeout=0.1,
+        report_recompleted_series=report_recompleted_series,
+    )
+
+    series_uid = generate_uid()
+    put_dataset(writer, generate_ct_slice(series_uid, 0))
+    assert completed.wait(timeout=30)
+
+    # An instance of the series received after it was reported as complete
+    put_dataset(writer, generate_ct_slice(series_uid, 1))
+    writer.close()
+
+    assert len(list(tmp_path.joinpath(series_uid).iterdir())) == 2
+    expected_series = [str(tmp_path.joinpath(series_uid))]
+    assert completed_series == expected_series * (2 if report_recompleted_series else 1)
+
+
+def test_dicom_store_writer_failed_write(tmp_path):
+
+    completed_series = []
+    writer = DicomStoreWriter(
+        tmp_path,
+        series_complete_callback=completed_series.append,
+        series_complete_timeout=60,
+    )
+
+    series_uid = generate_uid()
+    datasets = [generate_ct_slice(series_uid, i) for i in range(3)]
+
+    # A directory in place of the file makes the write fail
+    failed_filename = f"CT.{datasets[1].SOPInstanceUID}"
+    tmp_path.joinpath(series_uid, failed_filename).mkdir(parents=True)
+
+    for ds in datasets:
+        put_dataset(writer, ds)
+
+    writer.flush()
+    series_dir = writer.get_series_directory(series_uid)
+    assert writer.get_failed_writes(series_dir) == [failed_filename]
+
+    writer.close()
+
+    # The incomplete series isn't reported as complete
+    assert completed_series == []
+
+
+def test_dicom_connector_listen(tmp_path):
+
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        port = sock.getsockname()[1]
+
+    received = threading.Event()
+    completed = threading.Event()
+    received_series = []
+
+    listener = DicomConnector(port=port, output_directory=str(tmp_path.joinpath("listener")))
+    tmp_path.joinpath("listener").mkdir()
+    server = listener.listen(
+        lambda series_dir: (received_series.append(series_dir), received.set()),
+        series_complete_callback=lambda series_dir: completed.set(),
+        series_complete_timeout=0.2,
+        block=False,
+    )
+
+    try:
+        series_uid = generate_uid()
+        dicom_files = []
+        for slice_index in range(10):
+            dicom_file = tmp_path.joinpath(f"{slice_index}.dcm")
+            generate_ct_slice(series_uid, slice_index).save_as(
+                str(dicom_file), write_like_original=False
+            )
+            dicom_files.append(str(dicom_file))
+
+        sender = DicomConnector(port=port)
+        sender.send_dcm(dicom_files)
+
+        assert received.wait(10)
+        assert completed.wait(10)
+    finally:
+        server.shutdown()
+        listener.writer.close()
+
+    assert received_series == [str(tmp_path.joinpath("listener", series_uid))]
+
+    # All instances have been written by the time the callback is run
+    for dicom_file in dicom_files:
+        ds = pydicom.dcmread(dicom_file)
+        written_ds = pydicom.dcmread(
+            tmp_path.joinpath("listener", series_uid, f"CT.{ds.SOPInstanceUID}")
+        )
+        assert written_ds.InstanceNumber == ds.InstanceNumber
+        assert np.array_equal(written_ds.pixel_array, ds.pixel_array)
+
+
+def test_dicom_connector_association_reuse(tmp_path):
+
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        port = sock.getsockname()[1]
+
+    listener = DicomConnector(port=port, output_directory=str(tmp_path.joinpath("listener")))
+    tmp_path.joinpath("listener").mkdir()
+    server = listener.listen(lambda series_dir: None, block=False)
+
+    try:
+        series_uids = [generate_uid() for _ in range(3)]
+        dicom_files = []
+        for series_uid in series_uids:
+            for slice_index in range(8):
+                dicom_file = tmp_path.joinpath(f"{series_uid}.{slice_index}.dcm")
+                generate_ct_slice(series_uid, slice_index).save_as(
+                    str(dicom_file), write_like_original=False
+                )
+                dicom_files.append(str(dicom_file))
+
+        sender = DicomConnector(port=port, max_associations=2)
+
+        association_types = []
+        associate = sender._associate  # pylint: disable=protected-access
+        sender._associate = lambda association_type: (  # pylint: disable=protected-access
+            association_types.append(association_type) or associate(association_type)
+        )
+
+        with sender:
+            assert sender.verify()
+            assert sender.verify()
+
+            statuses = sender.send_dcm_files(dicom_files[:12])
+            statuses += sender.send_dcm_files(dicom_files[12:])
+
+        # Idle associations are re-used, and released when leaving the with block
+        assert association_types.count("verification") == 1
+        assert association_types.count("storage") == 2
+        assert len(sender._idle_associations) == 0  # pylint: disable=protected-access
+
+        assert len(statuses) == len(dicom_files)
+        assert all(status.Status == 0x0000 for status in statuses)
+
+        # Without the with block, each operation uses a new association
+        assert sender.send_dcm(dicom_files[0]).Status == 0x0000
+        assert association_types.count("storage") == 3
+
+        listener.writer.flush()
+    finally:
+        server.shutdown()
+        listener.writer.close()
+
+    for series_uid in series_uids:
+        assert len(list(tmp_path.joinpath("listener", series_uid).glob("CT.*"))) == 8
+
+
+def test_dicom_connector_max_associations(tmp_path):
+
+    # An SCP which counts the associations open at once
+    open_associations = []
+    max_open_associations = []
+    lock = threading.Lock()
+
+    def on_accepted(event):
+        with lock:
+            open_associations.append(event.assoc)
+            max_open_associations.append(len(open_associations))
+
+    def on_closed(event):
+        with lock:
+            if event.assoc in open_associations:
+                open_associations.remove(event.assoc)
+
+    scp = AE()
+    scp.supported_contexts = VerificationPresentationContexts + StoragePresentationContexts
+    server = scp.start_server(
+        ("", 0),
+        block=False,
+        evt_handlers=[
+            (evt.EVT_ACCEPTED, on_accepted),
+            (evt.EVT_RELEASED, on_closed),
+            (evt.EVT_ABORTED, on_closed),
+            (evt.EVT_C_STORE, lambda event: 0x0000),
+        ],
+    )
+
+    try:
+        dicom_files = []
+        series_uid = generate_uid()
+        for slice_index in range(12):
+            dicom_file = tmp_path.joinpath(f"{slice_index}.dcm")
+            generate_ct_slice(series_uid, slice_index).save_as(
+                str(dicom_file), write_like_original=False
+            )
+            dicom_files.append(str(dicom_file))
+
+        sender = DicomConnector(port=server.server_address[1], max_associations=2)
+
+        # The idle verification association is released to make room for the second storage
+        # association
+        with sender:
+            assert sender.verify()
+            statuses = sender.send_dcm_files(dicom_files)
+            assert sender.verify()
+
+        assert all(status.Status == 0x0000 for status in statuses)
+        assert max(max_open_associations) == 2
+        assert len(max_open_associations) == 4
+    finally:
+        server.shutdown()
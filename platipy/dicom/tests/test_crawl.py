@@ -0,0 +1,226 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name
+
+import pytest
+import pydicom
+import numpy as np
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+
+from platipy.dicom.io import crawl
+from platipy.dicom.io.crawl import process_dicom_directory, process_dicom_file_list
+from platipy.dicom.io.index import DicomIndex
+
+
+def write_ct_slice(path, patient_name, series_uid, slice_index):
+    """Writes a minimal CT slice to disk"""
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CTImageStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.PatientName = patient_name
+    ds.PatientID = patient_name
+    ds.Modality = "CT"
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = series_uid
+    ds.InstanceNumber = slice_index
+    ds.StudyInstanceUID = "1.2.3." + str(sum(map(ord, patient_name)))
+    ds.SeriesNumber = 1
+    ds.SeriesDescription = "TEST"
+    ds.ImagePositionPatient = [0, 0, slice_index]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [1, 1]
+    ds.SliceThickness = 1
+    ds.Rows = 8
+    ds.Columns = 8
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelData = np.zeros((8, 8), dtype=np.int16).tobytes()
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ds.save_as(str(path), write_like_original=False)
+
+
+@pytest.fixture
+def dicom_directory(tmp_path):
+    """Generates a directory containing two patients, with two series each"""
+
+    series_uids = {}
+    for patient_name in ["PATIENT_A", "PATIENT_B"]:
+        series_uids[patient_name] = [generate_uid(), generate_uid()]
+
+        for series_uid in series_uids[patient_name]:
+            for slice_index in range(3):
+                write_ct_slice(
+                    tmp_path.joinpath(patient_name, series_uid, f"{slice_index}.dcm"),
+                    patient_name,
+                    series_uid,
+                    slice_index,
+                )
+
+    return tmp_path, series_uids
+
+
+@pytest.mark.parametrize(
+    "header_only,executor",
+    [(False, "serial"), (True, "serial"), (True, "thread"), (True, "process")],
+)
+def test_process_dicom_file_list(dicom_directory, header_only, executor):
+
+    root_path, series_uids = dicom_directory
+    dicom_file_list = list(root_path.glob("**/*.dcm"))
+
+    dicom_series_dict_parent = process_dicom_file_list(
+        dicom_file_list, header_only=header_only, executor=executor, max_workers=2
+    )
+
+    assert {str(p) for p in dicom_series_dict_parent.keys()} == set(series_uids.keys())
+
+    for patient_name, dicom_series_dict in dicom_series_dict_parent.items():
+        patient_name = str(patient_name)
+        assert set(dicom_series_dict.keys()) == set(series_uids[patient_name])
+
+        for series_uid, series_file_list in dicom_series_dict.items():
+            assert series_file_list == sorted(
+                p.as_posix() for p in root_path.joinpath(patient_name, series_uid).glob("*.dcm")
+            )
+            assert pydicom.dcmread(series_file_list[0]).SeriesInstanceUID == series_uid
+
+
+def test_process_dicom_file_list_index(dicom_directory, tmp_path_factory):
+
+    root_path, series_uids = dicom_directory
+    dicom_index = DicomIndex(tmp_path_factory.mktemp("index").joinpath("index.sqlite"))
+
+    dicom_file_list = list(root_path.glob("**/*.dcm"))
+    indexed_series_dict_parent = process_dicom_file_list(dicom_file_list, dicom_index=dicom_index)
+    assert indexed_series_dict_parent == {
+        str(k): v for k, v in process_dicom_file_list(dicom_file_list).items()
+    }
+
+    file_list = sorted(p.as_posix() for p in dicom_file_list)
+    assert dicom_index.get_changed_files(file_list) == []
+    assert dicom_index.get_changed_files(file_list, parent_sorting_field="PatientID") == file_list
+
+    # Move a slice to a new patient, and add a new series
+    moved_file = root_path.joinpath("PATIENT_A", series_uids["PATIENT_A"][0], "0.dcm")
+    write_ct_slice(moved_file, "PATIENT_C", series_uids["PATIENT_A"][0], 0)
+    new_series_uid = generate_uid()
+    new_file = root_path.joinpath("PATIENT_B", new_series_uid, "0.dcm")
+    write_ct_slice(new_file, "PATIENT_B", new_series_uid, 0)
+
+    dicom_file_list = list(root_path.glob("**/*.dcm"))
+    file_list = sorted(p.as_posix() for p in dicom_file_list)
+    assert dicom_index.get_changed_files(file_list) == sorted(
+        [moved_file.as_posix(), new_file.as_posix()]
+    )
+
+    dicom_series_dict_parent = process_dicom_file_list(dicom_file_list, dicom_index=dicom_index)
+    assert dicom_series_dict_parent["PATIENT_C"] == {
+        series_uids["PATIENT_A"][0]: [moved_file.as_posix()]
+    }
+    assert len(dicom_series_dict_parent["PATIENT_A"][series_uids["PATIENT_A"][0]]) == 2
+    assert dicom_series_dict_parent["PATIENT_B"][new_series_uid] == [new_file.as_posix()]
+    assert dicom_index.get_changed_files(file_list) == []
+
+
+def test_process_dicom_directory_incremental(dicom_directory, tmp_path_factory):
+
+    root_path, series_uids = dicom_directory
+    output_path = tmp_path_factory.mktemp("output")
+    index_path = output_path.joinpath("index.sqlite")
+
+    output = process_dicom_directory(
+        root_path, output_directory=output_path, index_path=index_path
+    )
+    assert set(output.keys()) == {"PATIENT_A", "PATIENT_B"}
+    assert len(output["PATIENT_A"]["IMAGES"]) == 2
+
+    # Nothing changed, so nothing is converted
+    output = process_dicom_directory(
+        root_path, output_directory=output_path, index_path=index_path
+    )
+    assert output == {}
+
+    # Only the patient with a new series is converted again
+    new_series_uid = generate_uid()
+    write_ct_slice(
+        root_path.joinpath("PATIENT_B", new_series_uid, "0.dcm"), "PATIENT_B", new_series_uid, 0
+    )
+
+    output = process_dicom_directory(
+        root_path, output_directory=output_path, index_path=index_path
+    )
+    assert set(output.keys()) == {"PATIENT_B"}
+
+
+def test_process_dicom_directory_workers(dicom_directory, tmp_path_factory):
+
+    root_path, _ = dicom_directory
+
+    output_serial = process_dicom_directory(
+        root_path, output_directory=tmp_path_factory.mktemp("serial"), workers=1
+    )
+    output_parallel = process_dicom_directory(
+        root_path, output_directory=tmp_path_factory.mktemp("parallel"), workers=2
+    )
+
+    assert list(output_serial.keys()) == list(output_parallel.keys())
+    for parent_data, parent_output in output_serial.items():
+        for field, file_list in parent_output.items():
+            assert [f.name for f in file_list] == [
+                f.name for f in output_parallel[parent_data][field]
+            ]
+            assert all(f.exists() for f in output_parallel[parent_data][field])
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_process_dicom_directory_parent_conflict(
+    dicom_directory, tmp_path_factory, monkeypatch, workers
+):
+
+    root_path, _ = dicom_directory
+
+    # Series of both patients are given as belonging to one patient
+    dicom_series_dict_parent = process_dicom_file_list(list(root_path.glob("**/*.dcm")))
+    merged_series_dict = {
+        series_uid: files
+        for dicom_series_dict in dicom_series_dict_parent.values()
+        for series_uid, files in dicom_series_dict.items()
+    }
+    monkeypatch.setattr(
+        crawl,
+        "process_dicom_file_list",
+        lambda *args, **kwargs: {"PATIENT_A": merged_series_dict},
+    )
+
+    with pytest.raises(ValueError):
+        process_dicom_directory(
+            root_path, output_directory=tmp_path_factory.mktemp("output"), workers=workers
+        )
@@ -0,0 +1,156 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name
+
+import pytest
+
+import numpy as np
+import SimpleITK as sitk
+
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from skimage.draw import polygon
+
+from platipy.dicom.io.crawl import transform_point_set_from_dicom_struct
+from platipy.dicom.io.rtstruct_to_nifti import fill_polygons, rasterise_contour_sequence
+
+
+def reference_rasterise(contour_sequence, image):
+    """Rasterises the contours one vertex and one slice at a time"""
+
+    mask_arr = np.zeros(image.GetSize()[::-1], dtype=np.uint8)
+
+    for contour in contour_sequence:
+        vertex_arr = np.array(contour.ContourData, dtype=np.double).reshape(-1, 3)
+        point_arr = np.array([image.TransformPhysicalPointToIndex(i) for i in vertex_arr]).T
+
+        z_index = point_arr[2][0]
+        if z_index < 0 or z_index >= image.GetSize()[2]:
+            continue
+
+        filled_y, filled_x = polygon(point_arr[1], point_arr[0], shape=mask_arr.shape[1:])
+        mask_arr[z_index, filled_y, filled_x] = 1
+
+    return mask_arr
+
+
+@pytest.fixture
+def structure_set():
+    """Generates an image and a structure set with some randomly shaped structures"""
+
+    image = sitk.Image(64, 60, 20, sitk.sitkInt16)
+    image.SetSpacing((0.9766, 0.9766, 2.5))
+    image.SetOrigin((-31.2, -29.7, -20.0))
+
+    rng = np.random.default_rng(42)
+
+    dicom_struct = Dataset()
+    dicom_struct.StructureSetROISequence = Sequence()
+    dicom_struct.ROIContourSequence = Sequence()
+
+    for roi_index in range(6):
+        roi = Dataset()
+        roi.ROIName = f"Structure {roi_index}"
+        dicom_struct.StructureSetROISequence.append(roi)
+
+        roi_contour = Dataset()
+        roi_contour.ContourSequence = Sequence()
+
+        center = rng.uniform(-25, 25, 2)
+        for slice_index in range(rng.integers(0, 10), rng.integers(12, 24)):
+            # Slices beyond the image are skipped
+            z = -20.0 + 2.5 * slice_index
+
+            for _ in range(rng.integers(1, 3)):
+                angle = np.sort(rng.uniform(0, 2 * np.pi, rng.integers(3, 40)))
+                radius = rng.uniform(1, 25, len(angle))
+                vertex_arr = np.stack(
+                    [
+                        center[0] + radius * np.cos(angle),
+                        center[1] + radius * np.sin(angle),
+                        np.full(len(angle), z),
+                    ],
+                    axis=1,
+                )
+
+                contour = Dataset()
+                contour.ContourGeometricType = "CLOSED_PLANAR"
+                contour.ContourData = np.round(vertex_arr, 4).ravel().tolist()
+                roi_contour.ContourSequence.append(contour)
+
+        dicom_struct.ROIContourSequence.append(roi_contour)
+
+    return image, dicom_struct
+
+
+def test_fill_polygons():
+
+    rng = np.random.default_rng(0)
+    shape = (4, 30, 32)
+
+    vertex_list = []
+    expected_arr = np.zeros(shape, dtype=bool)
+    for _ in range(50):
+        # Includes self-intersecting polygons and vertices outside the volume
+        number_of_vertices = rng.integers(3, 12)
+        vertex_arr = np.stack(
+            [
+                np.full(number_of_vertices, rng.integers(0, shape[0])),
+                rng.integers(-5, shape[1] + 5, number_of_vertices),
+                rng.integers(-5, shape[2] + 5, number_of_vertices),
+            ],
+            axis=1,
+        )
+        vertex_list.append(vertex_arr)
+
+        filled_r, filled_c = polygon(vertex_arr[:, 1], vertex_arr[:, 2], shape=shape[1:])
+        expected_arr[vertex_arr[0, 0], filled_r, filled_c] = True
+
+    filled_arr = fill_polygons(
+        np.concatenate(vertex_list), [len(vertex_arr) for vertex_arr in vertex_list], shape
+    )
+
+    assert np.array_equal(filled_arr, expected_arr)
+
+
+def test_rasterise_contour_sequence(structure_set):
+
+    image, dicom_struct = structure_set
+
+    for roi_contour in dicom_struct.ROIContourSequence:
+        mask = rasterise_contour_sequence(roi_contour.ContourSequence, image)
+
+        assert mask.GetSize() == image.GetSize()
+        assert mask.GetPixelID() == sitk.sitkUInt8
+        assert np.array_equal(
+            sitk.GetArrayFromImage(mask), reference_rasterise(roi_contour.ContourSequence, image)
+        )
+
+
+@pytest.mark.parametrize("executor", ["serial", "thread", "process"])
+def test_transform_point_set_from_dicom_struct(structure_set, executor):
+
+    image, dicom_struct = structure_set
+
+    structure_names, structure_list = transform_point_set_from_dicom_struct(
+        image, dicom_struct, executor=executor, max_workers=2
+    )
+
+    assert structure_names == [f"STRUCTURE_{i}" for i in range(6)]
+    for structure, roi_contour in zip(structure_list, dicom_struct.ROIContourSequence):
+        assert np.array_equal(
+            sitk.GetArrayFromImage(structure),
+            reference_rasterise(roi_contour.ContourSequence, image),
+        )
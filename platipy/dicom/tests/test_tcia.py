@@ -0,0 +1,185 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name
+
+import io
+import json
+import threading
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from pydicom.uid import generate_uid
+
+from platipy.dicom.download import tcia
+from platipy.dicom.tests.test_crawl import write_ct_slice
+
+
+@pytest.fixture
+def tcia_server(tmp_path, monkeypatch):
+    """Serves a small collection from a local stand-in for the TCIA API"""
+
+    series = {}
+    for patient_id in ["PAT1", "PAT2"]:
+        series_uid = generate_uid()
+
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, "w") as zip_ref:
+            for slice_index in range(4):
+                dicom_file = tmp_path.joinpath(f"{series_uid}.{slice_index}.dcm")
+                write_ct_slice(dicom_file, patient_id, series_uid, slice_index)
+                zip_ref.write(dicom_file, f"1-{slice_index}.dcm")
+
+        series[series_uid] = (patient_id, zip_buffer.getvalue())
+
+    image_requests = []
+
+    class TCIARequestHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            url = urlparse(self.path)
+            params = {key: value[0] for key, value in parse_qs(url.query).items()}
+
+            if url.path == "/getModalityValues":
+                body = json.dumps([{"Modality": "CT"}, {"Modality": "RTSTRUCT"}]).encode()
+            elif url.path == "/getSeries":
+                body = json.dumps(
+                    [
+                        {"SeriesInstanceUID": series_uid}
+                        for series_uid, (patient_id, _) in series.items()
+                        if patient_id == params["PatientID"] and params["Modality"] == "CT"
+                    ]
+                ).encode()
+            elif url.path == "/getImage":
+                image_requests.append(params["SeriesInstanceUID"])
+                body = series[params["SeriesInstanceUID"]][1]
+            else:
+                self.send_error(404)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TCIARequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(tcia, "modalities_endpoint", f"{url}/getModalityValues")
+    monkeypatch.setattr(tcia, "series_endpoint", f"{url}/getSeries")
+    monkeypatch.setattr(tcia, "download_series_endpoint", f"{url}/getImage")
+
+    yield series, image_requests
+
+    server.shutdown()
+
+
+def test_fetch_data(tmp_path, tcia_server):
+
+    series, image_requests = tcia_server
+    output_directory = tmp_path.joinpath("tcia")
+
+    result = tcia.fetch_data(
+        "TEST", patient_ids=["PAT1", "PAT2"], modalities=["CT"], output_directory=output_directory
+    )
+
+    assert sorted(image_requests) == sorted(series.keys())
+    for series_uid, (patient_id, _) in series.items():
+        series_directory = result[patient_id]["DICOM"]["CT"][series_uid]
+        assert len(list(series_directory.glob("*.dcm"))) == 4
+
+        nifti_files = result[patient_id]["NIFTI"]["IMAGES"]
+        assert len(nifti_files) == 1
+        assert Path(nifti_files[0]).exists()
+
+    # Fetching again resumes from the manifest, without downloading or converting anything
+    resumed_result = tcia.fetch_data(
+        "TEST", patient_ids=["PAT1", "PAT2"], modalities=["CT"], output_directory=output_directory
+    )
+
+    assert len(image_requests) == len(series)
+    for patient_id in ["PAT1", "PAT2"]:
+        assert resumed_result[patient_id]["DICOM"] == result[patient_id]["DICOM"]
+        assert resumed_result[patient_id]["NIFTI"] == result[patient_id]["NIFTI"]
+
+
+def test_fetch_data_interrupted(tmp_path, tcia_server):
+
+    series, image_requests = tcia_server
+    output_directory = tmp_path.joinpath("tcia")
+
+    # A series which was partially extracted when the fetch was interrupted is fetched again
+    series_uid = list(series.keys())[0]
+    partial_directory = output_directory.joinpath("TEST", "PAT1", "DICOM", f"{series_uid}.partial")
+    partial_directory.mkdir(parents=True)
+    partial_directory.joinpath("1-0.dcm").write_bytes(b"")
+
+    result = tcia.fetch_data(
+        "TEST",
+        patient_ids=["PAT1"],
+        modalities=["CT"],
+        nifti=False,
+        output_directory=output_directory,
+    )
+
+    assert image_requests == [series_uid]
+    assert not partial_directory.exists()
+    assert len(list(result["PAT1"]["DICOM"]["CT"][series_uid].glob("*.dcm"))) == 4
+    assert "NIFTI" not in result["PAT1"]
+
+
+def test_fetch_data_failed_series(tmp_path, tcia_server, monkeypatch):
+
+    series, image_requests = tcia_server
+    output_directory = tmp_path.joinpath("tcia")
+
+    failed_series_uid = next(uid for uid, (pid, _) in series.items() if pid == "PAT1")
+    download_series = tcia.download_series
+
+    def failing_download_series(series_uid, target_directory, session=None):
+        if series_uid == failed_series_uid:
+            raise ConnectionError("Connection reset")
+        return download_series(series_uid, target_directory, session=session)
+
+    monkeypatch.setattr(tcia, "download_series", failing_download_series)
+
+    # The other patient is still fetched and converted
+    result = tcia.fetch_data(
+        "TEST", patient_ids=["PAT1", "PAT2"], modalities=["CT"], output_directory=output_directory
+    )
+
+    assert result["PAT1"]["DICOM"]["CT"] == {}
+    assert result["PAT1"]["NIFTI"] is None
+    assert len(result["PAT2"]["DICOM"]["CT"]) == 1
+    assert len(result["PAT2"]["NIFTI"]["IMAGES"]) == 1
+
+    # Fetching again retries the failed series only
+    monkeypatch.setattr(tcia, "download_series", download_series)
+    result = tcia.fetch_data(
+        "TEST", patient_ids=["PAT1", "PAT2"], modalities=["CT"], output_directory=output_directory
+    )
+
+    assert image_requests.count(failed_series_uid) == 1
+    assert len(image_requests) == len(series)
+    assert len(result["PAT1"]["DICOM"]["CT"]) == 1
+    assert len(result["PAT1"]["NIFTI"]["IMAGES"]) == 1
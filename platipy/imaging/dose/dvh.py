@@ -16,6 +16,8 @@ import numpy as np
 import SimpleITK as sitk
 import pandas as pd
 
+from platipy.imaging.utils.crop import label_to_slices
+
 
 def calculate_dvh(dose_grid, label, bins=1001):
     """Calculates a dose-volume histogram
@@ -55,8 +57,34 @@ def calculate_dvh(dose_grid, label, bins=1001):
     return bins, values
 
 
-def calculate_dvh_for_labels(dose_grid, labels, bin_width=0.1, max_dose=None):
-    """Calculate the DVH for multiple labels
+def _digitize_uniform(values, bin_edges):
+    """Finds the bin of each value for uniformly spaced bin edges
+
+    Values are assigned to bins in the same way as np.histogram (the last bin includes its upper
+    edge), with -1 and len(bin_edges) - 1 given to values below and above the bin edges.
+    """
+
+    values = values.astype(np.float64)
+    number_of_bins = len(bin_edges) - 1
+    bin_width = (bin_edges[-1] - bin_edges[0]) / number_of_bins
+
+    bin_index = np.floor((values - bin_edges[0]) / bin_width).astype(np.int64)
+    bin_index = np.clip(bin_index, 0, number_of_bins - 1)
+
+    # Correct any values placed in the neighbouring bin due to rounding
+    bin_index[values < bin_edges[bin_index]] -= 1
+    move_up = (values >= bin_edges[bin_index + 1]) & (bin_index < number_of_bins - 1)
+    bin_index[move_up] += 1
+    bin_index[values > bin_edges[-1]] = number_of_bins
+
+    return bin_index
+
+
+def calculate_dvh_array(dose_grid, labels, bin_width=0.1, max_dose=None):
+    """Calculate the DVH for multiple labels at once
+
+    The dose grid is binned once (within the bounding box of all the labels), after which the
+    DVH, mean dose and volume of each label is found from the voxels within its bounding box.
 
     Args:
         dose_grid (SimpleITK.Image): Dose grid
@@ -67,51 +95,117 @@ def calculate_dvh_for_labels(dose_grid, labels, bin_width=0.1, max_dose=None):
             dose grid is used.Defaults to None.
 
     Returns:
-        pandas.DataFrame: The DVH for each structure along with the mean dose and size in cubic
-            centimetres as a data frame.
+        bins (numpy.ndarray): The points of the dose bins
+        values (numpy.ndarray): The DVH values, with shape (number of labels, number of bins)
+        mean_dose (numpy.ndarray): The mean dose within each label
+        volume_cc (numpy.ndarray): The volume of each label, in cubic centimetres
     """
 
-    dvh = []
-
-    label_keys = labels.keys()
+    label_keys = list(labels.keys())
+    reference_label = labels[label_keys[0]]
 
-    dose_grid = sitk.Resample(dose_grid, labels[list(label_keys)[0]])
-    dose_array = sitk.GetArrayFromImage(dose_grid)
+    dose_grid = sitk.Resample(dose_grid, reference_label)
+    dose_array = sitk.GetArrayViewFromImage(dose_grid)
 
     if not max_dose:
         max_dose = dose_array.max()
 
-    for k in label_keys:
+    bin_edges = np.arange(-bin_width / 2, max_dose + bin_width, bin_width)
+    number_of_bins = len(bin_edges) - 1
 
-        mask = labels[k]
-        mask_array = sitk.GetArrayFromImage(mask)
+    # Get mid-points of bins, removing rounding error
+    bins = np.round((bin_edges[1:] + bin_edges[:-1]) / 2.0, decimals=10)
 
-        # Compute cubic centimetre volume of structure
-        cc = mask_array.sum() * np.product([a / 10 for a in mask.GetSpacing()])
+    label_arrays = []
+    for k in label_keys:
+        mask = labels[k]
 
-        bins, values = calculate_dvh(
-            dose_grid, labels[k], bins=np.arange(-bin_width / 2, max_dose + bin_width, bin_width)
+        if (
+            mask.GetSize() != reference_label.GetSize()
+            or mask.GetOrigin() != reference_label.GetOrigin()
+            or mask.GetSpacing() != reference_label.GetSpacing()
+        ):
+            mask = sitk.Resample(mask, reference_label, sitk.Transform(), sitk.sitkNearestNeighbor)
+            label_arrays.append(sitk.GetArrayFromImage(mask))
+        else:
+            label_arrays.append(sitk.GetArrayViewFromImage(mask))
+
+    bounding_boxes = [label_to_slices(label_array) for label_array in label_arrays]
+
+    counts = np.zeros((len(label_keys), number_of_bins), dtype=np.int64)
+    mean_dose = np.full(len(label_keys), np.nan)
+    voxel_counts = np.zeros(len(label_keys), dtype=np.int64)
+
+    non_empty_boxes = [box for box in bounding_boxes if box is not None]
+    if len(non_empty_boxes) > 0:
+        # Bin the dose within the union of the bounding boxes (just once)
+        union_box = tuple(
+            slice(
+                min(box[axis].start for box in non_empty_boxes),
+                max(box[axis].stop for box in non_empty_boxes),
+            )
+            for axis in range(dose_array.ndim)
         )
+        union_offset = [axis_slice.start for axis_slice in union_box]
+        dose_bin_array = _digitize_uniform(dose_array[union_box], bin_edges)
 
-        # Remove rounding error
-        bins = np.round(
-            bins.astype(float),
-            decimals=10,
-        )
+        for label_index, (label_array, box) in enumerate(zip(label_arrays, bounding_boxes)):
+            if box is None:
+                continue
+
+            box_in_union = tuple(
+                slice(axis_slice.start - offset, axis_slice.stop - offset)
+                for axis_slice, offset in zip(box, union_offset)
+            )
 
-        mean_dose = dose_array[mask_array > 0].mean()
-        entry = {
-            **{
-                "label": k,
-                "cc": cc,
-                "mean": mean_dose,
-            },
-            **{d: c for d, c in zip(bins, values)},
-        }
+            label_mask = label_array[box] != 0
 
-        dvh.append(entry)
+            counts[label_index] = np.bincount(
+                dose_bin_array[box_in_union][label_mask] + 1, minlength=number_of_bins + 2
+            )[1:-1]
+            mean_dose[label_index] = dose_array[box][label_mask].mean()
+            voxel_counts[label_index] = label_mask.sum()
+
+    # Calculate the actual (cumulative) DVH values
+    values = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1].astype(float)
+    total_counts = values.max(axis=1, initial=0)
+    values[total_counts > 0] /= total_counts[total_counts > 0, None]
+
+    # Compute cubic centimetre volume of structure
+    volume_cc = voxel_counts * np.prod([a / 10 for a in reference_label.GetSpacing()])
+
+    return bins, values, mean_dose, volume_cc
+
+
+def calculate_dvh_for_labels(dose_grid, labels, bin_width=0.1, max_dose=None):
+    """Calculate the DVH for multiple labels
+
+    See calculate_dvh_array to get the DVH as an array (without building a data frame).
+
+    Args:
+        dose_grid (SimpleITK.Image): Dose grid
+        labels (dict): Dictionary of labels with the label name as key and SimpleITK.Image mask as
+            value.
+        bin_width (float, optional): The width of each bin of the DVH (Gy). Defaults to 0.1.
+        max_dose (float, optional): The maximum dose of the DVH. If not set then maximum dose from
+            dose grid is used.Defaults to None.
+
+    Returns:
+        pandas.DataFrame: The DVH for each structure along with the mean dose and size in cubic
+            centimetres as a data frame.
+    """
 
-    return pd.DataFrame(dvh)
+    bins, values, mean_dose, volume_cc = calculate_dvh_array(
+        dose_grid, labels, bin_width=bin_width, max_dose=max_dose
+    )
+
+    return pd.concat(
+        [
+            pd.DataFrame({"label": list(labels.keys()), "cc": volume_cc, "mean": mean_dose}),
+            pd.DataFrame(values, columns=bins),
+        ],
+        axis=1,
+    )
 
 
 def calculate_d_x(dvh, x, label=None):
@@ -13,10 +13,15 @@
 # limitations under the License.
 
 
+import itertools
+
 import numpy as np
+import pandas as pd
 import SimpleITK as sitk
 
-from platipy.imaging.utils.crop import label_to_roi, crop_to_roi
+from platipy.imaging.utils.crop import label_to_roi, crop_to_roi, label_to_slices
+from platipy.imaging.label.utils import generate_primes
+from platipy.imaging.utils.parallel import parallel_map
 
 
 def compute_volume(label):
@@ -55,7 +60,7 @@ def compute_surface_metrics(label_a, label_b, verbose=False):
     std_sd_list = []
     median_sd_list = []
     num_points = []
-    for (la, lb) in ((label_a, label_b), (label_b, label_a)):
+    for la, lb in ((label_a, label_b), (label_b, label_a)):
 
         label_intensity_stat = sitk.LabelIntensityStatisticsImageFilter()
         reference_distance_map = sitk.Abs(
@@ -248,7 +253,7 @@ def compute_metric_masd(label_a, label_b, auto_crop=True):
 
     mean_sd_list = []
     num_points = []
-    for (la, lb) in ((label_a, label_b), (label_b, label_a)):
+    for la, lb in ((label_a, label_b), (label_b, label_a)):
 
         label_intensity_stat = sitk.LabelIntensityStatisticsImageFilter()
         reference_distance_map = sitk.Abs(
@@ -293,3 +298,342 @@ def compute_metric_hd(label_a, label_b, auto_crop=True):
     hausdorff_distance_value = hausdorff_distance.GetHausdorffDistance()
 
     return hausdorff_distance_value
+
+
+def compute_comparison_metrics(label_a, label_b, tolerance_mm=2.0, percentile=95):
+    """Compute volume and surface metrics between two labels, sharing the work between metrics.
+
+    The labels are cropped to the bounding box of both labels once, and a distance map and
+    contour are computed once for each label. The metrics computed are:
+    DSC, volumeA, volumeB (in cubic centimetres), volumeOverlap, fractionOverlap,
+    truePositiveFraction, trueNegativeFraction, falsePositiveFraction, falseNegativeFraction,
+    hausdorffDistance, hausdorffDistance{percentile} (the maximum of the two directed percentile
+    surface distances), meanSurfaceDistance (MASD) and surfaceDSC (the fraction of surface voxels
+    within the tolerance of the other surface).
+
+    Args:
+        label_a (sitk.Image): A mask to compare
+        label_b (sitk.Image): Another mask to compare
+        tolerance_mm (float, optional): The tolerance used for the surface DSC. Defaults to 2.0.
+        percentile (float, optional): The percentile for the percentile Hausdorff distance.
+            Defaults to 95.
+
+    Returns:
+        dict: Dictionary object containing the metrics
+    """
+
+    arr_a = sitk.GetArrayViewFromImage(label_a) != 0
+    arr_b = sitk.GetArrayViewFromImage(label_b) != 0
+
+    volume_a = arr_a.sum()
+    volume_b = arr_b.sum()
+    true_pos = (arr_a & arr_b).sum()
+    true_neg = arr_a.size - (volume_a + volume_b - true_pos)
+    false_pos = volume_b - true_pos
+    false_neg = volume_a - true_pos
+
+    voxel_volume = np.prod(label_a.GetSpacing()) / 1000.0  # Conversion to cm^3
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = {
+            "DSC": float(2.0 * true_pos / (volume_a + volume_b)),
+            "volumeA": volume_a * voxel_volume,
+            "volumeB": volume_b * voxel_volume,
+            "volumeOverlap": true_pos * voxel_volume,
+            "fractionOverlap": float(true_pos / (volume_a + volume_b - true_pos)),
+            "truePositiveFraction": float(true_pos / (true_pos + false_neg)),
+            "trueNegativeFraction": float(true_neg / (true_neg + false_pos)),
+            "falsePositiveFraction": float(false_pos / (true_neg + false_pos)),
+            "falseNegativeFraction": float(false_neg / (true_pos + false_neg)),
+        }
+
+    surface_metrics = [
+        "hausdorffDistance",
+        f"hausdorffDistance{percentile}",
+        "meanSurfaceDistance",
+        "surfaceDSC",
+    ]
+
+    if volume_a == 0 or volume_b == 0:
+        result.update({metric: np.nan for metric in surface_metrics})
+        return result
+
+    # Crop to both labels (with a margin so the contours are the same as in the full image)
+    crop_box = label_to_slices(arr_a | arr_b, expansion=1)
+    crop_index = [int(axis_slice.start) for axis_slice in crop_box[::-1]]
+    crop_size = [int(axis_slice.stop - axis_slice.start) for axis_slice in crop_box[::-1]]
+
+    signed_distance_list = []
+    contour_list = []
+    for label in (label_a, label_b):
+        label = crop_to_roi(label, size=crop_size, index=crop_index)
+        label = sitk.Cast(label != 0, sitk.sitkUInt8)
+
+        signed_distance_list.append(
+            sitk.GetArrayFromImage(
+                sitk.SignedMaurerDistanceMap(label, squaredDistance=False, useImageSpacing=True)
+            )
+        )
+        contour_list.append(sitk.GetArrayFromImage(sitk.LabelContour(label)) != 0)
+
+    signed_distance_a, signed_distance_b = signed_distance_list
+    contour_a, contour_b = contour_list
+
+    # Distances from each surface to the other surface
+    surface_distance_b_to_a = np.abs(signed_distance_a[contour_b])
+    surface_distance_a_to_b = np.abs(signed_distance_b[contour_a])
+    surface_distances = np.concatenate([surface_distance_a_to_b, surface_distance_b_to_a])
+
+    # Distances from every voxel of one label to the other label (zero inside the other label)
+    hausdorff_distance = max(
+        np.maximum(signed_distance_a[arr_b[crop_box]], 0).max(),
+        np.maximum(signed_distance_b[arr_a[crop_box]], 0).max(),
+    )
+
+    result["hausdorffDistance"] = float(hausdorff_distance)
+    result[f"hausdorffDistance{percentile}"] = float(
+        max(
+            np.percentile(surface_distance_a_to_b, percentile),
+            np.percentile(surface_distance_b_to_a, percentile),
+        )
+    )
+    result["meanSurfaceDistance"] = float(surface_distances.mean())
+    result["surfaceDSC"] = float((surface_distances <= tolerance_mm).mean())
+
+    return result
+
+
+def _compute_comparison_metrics_for_pair(label_pair, **kwargs):
+    """Computes the comparison metrics for a (label_a, label_b) tuple"""
+    return compute_comparison_metrics(*label_pair, **kwargs)
+
+
+def compute_comparison_metrics_table(
+    label_sets, tolerance_mm=2.0, percentile=95, executor="serial", max_workers=None
+):
+    """Compare the labels of several observers (or algorithms), for each structure.
+
+    For each structure, every pair of label sets containing that structure is compared using
+    compute_comparison_metrics.
+
+    Args:
+        label_sets (dict): The label sets to compare, as a dictionary of dictionaries, e.g.
+            {observer: {structure_name: sitk.Image}}
+        tolerance_mm (float, optional): The tolerance used for the surface DSC. Defaults to 2.0.
+        percentile (float, optional): The percentile for the percentile Hausdorff distance.
+            Defaults to 95.
+        executor (str, optional): The type of executor used to compare the labels, one of
+            "serial", "thread" or "process". Defaults to "serial".
+        max_workers (int, optional): The maximum number of workers. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: Data frame with a row for each metric of each comparison, with columns
+            structure, observer_a, observer_b, metric and value.
+    """
+
+    comparison_list = []
+    for observer_a, observer_b in itertools.combinations(label_sets.keys(), 2):
+        for structure in label_sets[observer_a]:
+            if structure not in label_sets[observer_b]:
+                continue
+
+            comparison_list.append((structure, observer_a, observer_b))
+
+    metrics_list = parallel_map(
+        _compute_comparison_metrics_for_pair,
+        [
+            (label_sets[observer_a][structure], label_sets[observer_b][structure])
+            for structure, observer_a, observer_b in comparison_list
+        ],
+        executor=executor,
+        max_workers=max_workers,
+        tolerance_mm=tolerance_mm,
+        percentile=percentile,
+    )
+
+    return pd.DataFrame(
+        [
+            {
+                "structure": structure,
+                "observer_a": observer_a,
+                "observer_b": observer_b,
+                "metric": metric,
+                "value": value,
+            }
+            for (structure, observer_a, observer_b), metrics in zip(comparison_list, metrics_list)
+            for metric, value in metrics.items()
+        ],
+        columns=["structure", "observer_a", "observer_b", "metric", "value"],
+    )
+
+
+def _unique_inverse(arr):
+    """Finds the unique values of an integer array, and the index of each value in them.
+
+    Small non-negative values (e.g. label images) are counted with np.bincount, which avoids
+    sorting the array.
+    """
+
+    arr = arr.ravel()
+
+    if arr.dtype.kind == "f":
+        arr = arr.astype(np.int64)
+
+    if arr.size > 0 and arr.min() >= 0 and arr.max() < 2**16:
+        arr = arr.astype(np.intp)
+        values = np.flatnonzero(np.bincount(arr))
+        lookup = np.zeros(values[-1] + 1, dtype=np.intp)
+        lookup[values] = np.arange(len(values))
+        return values, lookup[arr]
+
+    return np.unique(arr, return_inverse=True)
+
+
+def compute_confusion_matrix(label_a, label_b):
+    """Counts the voxels for each combination of values in two label images, in a single pass.
+
+    For multi-label images (e.g. 0 for background and 1, 2, ... for structures) this is the
+    label confusion matrix. The images can also be encoded using prime_encode_structure_list or
+    binary_encode_structure_list, in which case each value is a combination of structures.
+
+    Args:
+        label_a (sitk.Image): A label image to compare
+        label_b (sitk.Image): Another label image to compare
+
+    Returns:
+        pandas.DataFrame: The number of voxels with each value of label_a (index) and each value
+            of label_b (columns).
+    """
+
+    # Values are kept in the type of the image, so 64 bit (unsigned) encodings aren't truncated
+    values_a, inverse_a = _unique_inverse(sitk.GetArrayViewFromImage(label_a))
+    values_b, inverse_b = _unique_inverse(sitk.GetArrayViewFromImage(label_b))
+
+    counts = np.bincount(
+        inverse_a * len(values_b) + inverse_b, minlength=len(values_a) * len(values_b)
+    ).reshape(len(values_a), len(values_b))
+
+    return pd.DataFrame(counts, index=values_a, columns=values_b)
+
+
+def _structure_membership(values, encoding, num_structures):
+    """Finds which structures each (encoded) label value belongs to.
+
+    Args:
+        values (np.ndarray): The label values.
+        encoding (str): The encoding, one of "label", "binary" or "prime".
+        num_structures (int): The number of structures.
+
+    Returns:
+        np.ndarray: Boolean array of shape (len(values), num_structures).
+    """
+
+    values = np.asarray(values)[:, None]
+
+    if encoding == "label":
+        return values.astype(np.int64) == np.arange(1, num_structures + 1)
+
+    # Encoded values are unsigned, and can use all 64 bits
+    values = values.astype(np.uint64)
+
+    if encoding == "binary":
+        bits = np.uint64(1) << np.arange(1, num_structures + 1, dtype=np.uint64)
+        return (values & bits) != 0
+
+    if encoding == "prime":
+        primes = np.array(list(itertools.islice(generate_primes(), num_structures)), np.uint64)
+        return (values % primes) == 0
+
+    raise ValueError(f"Unknown encoding: {encoding}, use one of 'label', 'binary' or 'prime'")
+
+
+def _count_structures(values, encoding):
+    """Finds the number of structures encoded in a set of label values"""
+
+    values = np.asarray(values)
+
+    if encoding == "label":
+        return int(values.max(initial=0))
+
+    # The highest bit which can be set depends on the type of the image (up to 63)
+    max_power = min(values.dtype.itemsize * 8 - 1, 63)
+    values = values.astype(np.uint64)
+
+    if encoding == "binary":
+        bits = [
+            power
+            for power in range(1, max_power + 1)
+            if (values & (np.uint64(1) << np.uint64(power))).any()
+        ]
+        return max(bits, default=0)
+
+    if encoding == "prime":
+        # As in prime_decode_image, stop at the first prime which isn't present
+        num_structures = 0
+        for prime in generate_primes():
+            if not ((values % np.uint64(prime)) == 0).any():
+                return num_structures
+            num_structures += 1
+
+    raise ValueError(f"Unknown encoding: {encoding}, use one of 'label', 'binary' or 'prime'")
+
+
+def compute_multi_label_volume_metrics(label_a, label_b, encoding="label", structure_names=None):
+    """Compute volume metrics between every structure of two multi-label (or encoded) images.
+
+    The metrics of all structures are derived from a single confusion matrix (see
+    compute_confusion_matrix), rather than comparing each structure in a separate pass. The
+    metrics computed are: DSC, volumeA, volumeB (in cubic centimetres), volumeOverlap,
+    fractionOverlap (Jaccard), truePositiveFraction, trueNegativeFraction, falsePositiveFraction
+    and falseNegativeFraction.
+
+    Args:
+        label_a (sitk.Image): A label image to compare
+        label_b (sitk.Image): Another label image to compare
+        encoding (str, optional): How the structures are encoded, "label" for a multi-label image
+            with values 1, 2, ... for each structure, "binary" for binary_encode_structure_list
+            or "prime" for prime_encode_structure_list. Defaults to "label".
+        structure_names (list, optional): The names of the structures, in the order they are
+            labelled or encoded. Defaults to None, in which case the structures are numbered
+            from 1 and the number of structures is found from the images.
+
+    Returns:
+        pandas.DataFrame: Data frame with a row for each structure and a column for each metric.
+    """
+
+    confusion_matrix = compute_confusion_matrix(label_a, label_b)
+    counts = confusion_matrix.values
+
+    if structure_names is None:
+        num_structures = max(
+            _count_structures(confusion_matrix.index, encoding),
+            _count_structures(confusion_matrix.columns, encoding),
+        )
+        structure_names = list(range(1, num_structures + 1))
+
+    membership_a = _structure_membership(confusion_matrix.index, encoding, len(structure_names))
+    membership_b = _structure_membership(confusion_matrix.columns, encoding, len(structure_names))
+
+    volume_a = membership_a.T @ counts.sum(axis=1)
+    volume_b = membership_b.T @ counts.sum(axis=0)
+    true_pos = np.einsum("is,ij,js->s", membership_a, counts, membership_b)
+    true_neg = counts.sum() - (volume_a + volume_b - true_pos)
+    false_pos = volume_b - true_pos
+    false_neg = volume_a - true_pos
+
+    voxel_volume = np.prod(label_a.GetSpacing()) / 1000.0  # Conversion to cm^3
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics = {
+            "DSC": 2.0 * true_pos / (volume_a + volume_b),
+            "volumeA": volume_a * voxel_volume,
+            "volumeB": volume_b * voxel_volume,
+            "volumeOverlap": true_pos * voxel_volume,
+            "fractionOverlap": true_pos / (volume_a + volume_b - true_pos),
+            "truePositiveFraction": true_pos / (true_pos + false_neg),
+            "trueNegativeFraction": true_neg / (true_neg + false_pos),
+            "falsePositiveFraction": false_pos / (true_neg + false_pos),
+            "falseNegativeFraction": false_neg / (true_pos + false_neg),
+        }
+
+    return pd.DataFrame(metrics, index=pd.Index(structure_names, name="structure"))
@@ -15,10 +15,12 @@
 import numpy as np
 import SimpleITK as sitk
 
-from functools import reduce
-from scipy.stats import pearsonr
-from skimage.util.shape import view_as_windows
 from platipy.imaging.registration.utils import smooth_and_resample
+from platipy.imaging.utils.crop import label_to_slices
+
+# The margin (in voxels) around the labels when combining them. This covers the largest kernel
+# used by sitk.DiscreteGaussian (the default maximum kernel width is 32 voxels).
+COMBINE_LABELS_CROP_MARGIN = 17
 
 
 def mutual_information(arr_a, arr_b, bins=64):
@@ -51,6 +53,98 @@ def mutual_information(arr_a, arr_b, bins=64):
     return mi
 
 
+def _box_sum(integral_image, lower_indices, upper_indices):
+    """Sums the values within boxes using an integral image (summed-area table).
+
+    Args:
+        integral_image (np.ndarray): The integral image, padded with a leading zero along each
+            axis (i.e. one larger than the original array in every dimension).
+        lower_indices (list): For each axis, a 1D array of the (inclusive) lower box index.
+        upper_indices (list): For each axis, a 1D array of the (exclusive) upper box index.
+
+    Returns:
+        np.ndarray: The sum within each box, with one entry per combination of box indices.
+    """
+
+    box_sum = 0
+    for corner in np.ndindex(*(2,) * integral_image.ndim):
+        # Inclusion-exclusion: the sign depends on the number of lower indices used
+        sign = (-1) ** (integral_image.ndim - sum(corner))
+        index = [
+            upper_indices[axis] if use_upper else lower_indices[axis]
+            for axis, use_upper in enumerate(corner)
+        ]
+        box_sum = box_sum + sign * integral_image[np.ix_(*index)]
+
+    return box_sum
+
+
+def local_correlation(arr_a, arr_b, window_shape):
+    """Computes the Pearson correlation coefficient between two arrays within a moving window
+
+    The window is centred on each voxel and clipped at the array boundaries, so patches at the
+    edges only include voxels inside the arrays. Running sums of a, b, a^2, b^2 and ab are
+    computed once using integral images, so the whole map is computed in a single pass.
+
+    Args:
+        arr_a (np.ndarray): The first image array.
+        arr_b (np.ndarray): The second image array, must have the same shape as arr_a.
+        window_shape (list | tuple): The size of the window (in voxels) along each axis.
+
+    Returns:
+        np.ndarray: The correlation coefficient for each voxel. Where the correlation is
+            undefined (e.g. constant patches) the value is set to 0.
+    """
+
+    # Subtracting the mean does not change the correlation but improves numerical precision
+    arr_a = np.asarray(arr_a, dtype=np.float64)
+    arr_b = np.asarray(arr_b, dtype=np.float64)
+    arr_a = arr_a - arr_a.mean()
+    arr_b = arr_b - arr_b.mean()
+
+    # Determine the extent of the (clipped) window for each voxel along each axis
+    lower_indices = []
+    upper_indices = []
+    for axis_length, window_length in zip(arr_a.shape, window_shape):
+        index = np.arange(axis_length)
+        lower_indices.append(np.clip(index - (window_length - 1) // 2, 0, axis_length))
+        upper_indices.append(np.clip(index + window_length // 2 + 1, 0, axis_length))
+
+    # The number of voxels in each patch
+    n_voxels = 1
+    for axis, (lower, upper) in enumerate(zip(lower_indices, upper_indices)):
+        shape = [1] * arr_a.ndim
+        shape[axis] = -1
+        n_voxels = n_voxels * (upper - lower).reshape(shape)
+
+    def patch_sums(arr):
+        integral_image = np.pad(arr, [(1, 0)] * arr.ndim)
+        for axis in range(arr.ndim):
+            integral_image = np.cumsum(integral_image, axis=axis)
+        return _box_sum(integral_image, lower_indices, upper_indices)
+
+    sum_a = patch_sums(arr_a)
+    sum_b = patch_sums(arr_b)
+
+    sum_aa = n_voxels * patch_sums(arr_a * arr_a)
+    sum_bb = n_voxels * patch_sums(arr_b * arr_b)
+
+    covariance = n_voxels * patch_sums(arr_a * arr_b) - sum_a * sum_b
+    variance_a = sum_aa - sum_a * sum_a
+    variance_b = sum_bb - sum_b * sum_b
+
+    # Patches which are constant (up to round-off error) have an undefined correlation
+    variance_a[variance_a <= 1e-10 * sum_aa] = 0
+    variance_b[variance_b <= 1e-10 * sum_bb] = 0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr_arr = covariance / np.sqrt(variance_a * variance_b)
+
+    corr_arr[~np.isfinite(corr_arr)] = 0
+
+    return np.clip(corr_arr, -1, 1)
+
+
 def compute_weight_map(
     target_image,
     moving_image,
@@ -85,49 +179,16 @@ def compute_weight_map(
         img_target_res = smooth_and_resample(target_image, isotropic_voxel_size_mm=voxel_size)
         img_moving_res = smooth_and_resample(moving_image, isotropic_voxel_size_mm=voxel_size)
 
-        # Convert to arrats
+        # Convert to arrays
         arr_target = sitk.GetArrayFromImage(img_target_res)
         arr_moving = sitk.GetArrayFromImage(img_moving_res)
-        # The mask will help us deal with zero data at the edges (generated by padding)
-        arr_mask = 0 * arr_target + 1
 
         # Define the patch box in image coordinates
         window_box_mm = vote_params["patch_window_mm"]
         window_box_im = [int(window_box_mm / i) for i in img_target_res.GetSpacing()[::-1]]
 
-        # Pad the arrays
-        padder = [((i - 1) // 2, (i) // 2) for i in window_box_im]  # Could pad more at other ends?
-        arr_target = np.pad(arr_target, padder)
-        arr_moving = np.pad(arr_moving, padder)
-        arr_mask = np.pad(arr_mask, padder)
-
-        # Extract the patches as views
-        view_target = view_as_windows(arr_target, window_box_im)
-        view_moving = view_as_windows(arr_moving, window_box_im)
-        view_mask = view_as_windows(arr_mask, window_box_im)
-
-        # Flatten to have a list of patches (that are also flattened)
-        new_shape = (np.product(view_target.shape[:3]), np.product(view_target.shape[3:]))
-        view_target_flat = np.reshape(view_target, new_shape)
-        view_moving_flat = np.reshape(view_moving, new_shape)
-        view_mask_flat = np.reshape(view_mask, new_shape)
-
-        # Iterate over patches
-        corr_values = []
-        for i in range(view_target_flat.shape[0]):
-
-            patch_mask = view_mask_flat[i]
-
-            patch_target = view_target_flat[i, :][np.where(patch_mask)]
-            patch_moving = view_moving_flat[i, :][np.where(patch_mask)]
-
-            # Calculate Pearson correlation coefficient
-            sr, _ = pearsonr(patch_target, patch_moving)
-            corr_values.append(sr)
-
-        # Reshape into the image
-        corr_arr = np.reshape(corr_values, img_target_res.GetSize()[::-1])
-        corr_arr[np.isnan(corr_arr)] = 0
+        # Compute the correlation coefficient in every patch in a single pass
+        corr_arr = local_correlation(arr_target, arr_moving, window_box_im)
 
         # Copy information
         corr_img = sitk.GetImageFromArray(corr_arr)
@@ -237,6 +298,24 @@ def combine_labels_staple(label_list_dict, threshold=1e-4):
 def combine_labels(atlas_set, structure_name, label="DIR", threshold=1e-4, smooth_sigma=1.0):
     """
     Combine labels using weight maps
+
+    All structures are fused in a single pass over the atlases. The weighted labels of each
+    structure are accumulated in a single float32 buffer, cropped to the bounding box of the
+    structure in all atlases (with a margin covering the smoothing kernel, so the result is the
+    same as fusing the full images). The sum of the weight maps is computed once.
+
+    Args:
+        atlas_set (dict): The atlas set, each atlas must contain a "Weight Map" as well as the
+            labels.
+        structure_name (str | list): The structure(s) to combine.
+        label (str, optional): The label to use in the atlas set. Defaults to "DIR".
+        threshold (float, optional): Probabilities below this threshold are set to zero.
+            Defaults to 1e-4.
+        smooth_sigma (float, optional): The standard deviation (in mm) of the Gaussian used to
+            smooth the combined labels. Defaults to 1.0.
+
+    Returns:
+        dict: The combined (probabilistic) label for each structure.
     """
 
     case_id_list = list(atlas_set.keys())
@@ -246,32 +325,76 @@ def combine_labels(atlas_set, structure_name, label="DIR", threshold=1e-4, smoot
     elif isinstance(structure_name, list):
         structure_name_list = structure_name
 
-    combined_label_dict = {}
+    weight_map_dict = {
+        case_id: atlas_set[case_id][label]["Weight Map"] for case_id in case_id_list
+    }
+    reference_image = weight_map_dict[case_id_list[0]]
+
+    # The sum of all the weight maps is shared by structures which are present in every case
+    weight_sum_arr = np.zeros(reference_image.GetSize()[::-1], dtype=np.float32)
+    for case_id in case_id_list:
+        weight_sum_arr += sitk.GetArrayViewFromImage(weight_map_dict[case_id])
 
+    structure_info = {}
     for s_name in structure_name_list:
         # Find the cases which have the strucure (in case some cases do not)
         valid_case_id_list = [i for i in case_id_list if s_name in atlas_set[i][label].keys()]
 
-        # Get valid weight images
-        weight_image_list = [
-            atlas_set[caseId][label]["Weight Map"] for caseId in valid_case_id_list
-        ]
+        # Crop to all the labels, with a margin larger than the (maximum) smoothing kernel radius
+        union_arr = np.zeros(weight_sum_arr.shape, dtype=bool)
+        for case_id in valid_case_id_list:
+            union_arr |= sitk.GetArrayViewFromImage(atlas_set[case_id][label][s_name]) != 0
+        crop_box = label_to_slices(union_arr, expansion=COMBINE_LABELS_CROP_MARGIN)
+
+        if crop_box is None:
+            crop_box = tuple(slice(0, n) for n in weight_sum_arr.shape)
+
+        structure_info[s_name] = {
+            "valid_case_id_list": valid_case_id_list,
+            "crop_box": crop_box,
+            "label_sum": np.zeros([b.stop - b.start for b in crop_box], dtype=np.float32),
+            "weight_sum": None,
+        }
+
+        if len(valid_case_id_list) < len(case_id_list):
+            structure_info[s_name]["weight_sum"] = np.zeros_like(
+                structure_info[s_name]["label_sum"]
+            )
 
-        # Sum the weight images
-        weight_sum_image = reduce(lambda x, y: x + y, weight_image_list)
-        weight_sum_image = sitk.Mask(
-            weight_sum_image, weight_sum_image == 0, maskingValue=1, outsideValue=1
-        )
+    # Accumulate the weighted labels of every structure, one atlas at a time
+    for case_id in case_id_list:
+        weight_arr = sitk.GetArrayViewFromImage(weight_map_dict[case_id])
 
-        # Combine weight map with each label
-        weighted_labels = [
-            atlas_set[caseId][label]["Weight Map"]
-            * sitk.Cast(atlas_set[caseId][label][s_name], sitk.sitkFloat32)
-            for caseId in valid_case_id_list
-        ]
+        for s_name, info in structure_info.items():
+            if case_id not in info["valid_case_id_list"]:
+                continue
+
+            crop_box = info["crop_box"]
+            label_arr = sitk.GetArrayViewFromImage(atlas_set[case_id][label][s_name])
+
+            info["label_sum"] += weight_arr[crop_box] * label_arr[crop_box].astype(np.float32)
+            if info["weight_sum"] is not None:
+                info["weight_sum"] += weight_arr[crop_box]
+
+    combined_label_dict = {}
+
+    for s_name, info in structure_info.items():
+        crop_box = info["crop_box"]
 
-        # Combine all the weighted labels
-        combined_label = reduce(lambda x, y: x + y, weighted_labels) / weight_sum_image
+        weight_sum_crop = info["weight_sum"]
+        if weight_sum_crop is None:
+            weight_sum_crop = weight_sum_arr[crop_box].copy()
+        weight_sum_crop[weight_sum_crop == 0] = 1
+
+        # As with SimpleITK image division, the result is double precision
+        combined_label = sitk.GetImageFromArray(
+            info["label_sum"].astype(np.float64) / weight_sum_crop
+        )
+        combined_label.SetSpacing(reference_image.GetSpacing())
+        combined_label.SetDirection(reference_image.GetDirection())
+        combined_label.SetOrigin(
+            reference_image.TransformIndexToPhysicalPoint([int(b.start) for b in crop_box[::-1]])
+        )
 
         # Smooth combined label
         combined_label = sitk.DiscreteGaussian(combined_label, smooth_sigma * smooth_sigma)
@@ -285,6 +408,14 @@ def combine_labels(atlas_set, structure_name, label="DIR", threshold=1e-4, smoot
                 combined_label, lower=threshold, upper=1, outsideValue=0.0
             )
 
+        # Paste back into the full image
+        combined_label_crop_arr = sitk.GetArrayViewFromImage(combined_label)
+        combined_label_arr = np.zeros(weight_sum_arr.shape, dtype=combined_label_crop_arr.dtype)
+        combined_label_arr[crop_box] = combined_label_crop_arr
+
+        combined_label = sitk.GetImageFromArray(combined_label_arr)
+        combined_label.CopyInformation(reference_image)
+
         combined_label_dict[s_name] = combined_label
 
     return combined_label_dict
@@ -28,9 +28,10 @@ from platipy.imaging.label.fusion import combine_labels, process_probability_ima
 
 from platipy.imaging.label.projection import (
     evaluate_distance_on_surface,
-    evaluate_distance_to_reference,
     regrid_spherical_data,
 )
+from platipy.imaging.utils.crop import label_to_slices
+from platipy.imaging.utils.parallel import parallel_map
 
 
 def median_absolute_deviation(data, axis=None):
@@ -56,6 +57,200 @@ def gaussian_curve(x, a, m, s):
     return a * scipy_norm.pdf(x, loc=m, scale=s)
 
 
+def _leave_one_out_median_sorted(sorted_values, ranks):
+    """Computes the leave-one-out median from values sorted along the first axis.
+
+    Args:
+        sorted_values (np.ndarray): The values, sorted along the first axis.
+        ranks (np.ndarray): The rank (position in sorted_values) of the value left out. Must
+            broadcast with sorted_values.
+
+    Returns:
+        np.ndarray: The median of the remaining values.
+    """
+
+    number_remaining = sorted_values.shape[0] - 1
+    ranks = np.broadcast_to(ranks, sorted_values.shape)
+
+    def select(k):
+        # The k-th smallest remaining value skips over the value left out
+        return np.take_along_axis(sorted_values, k + (ranks <= k), axis=0)
+
+    if number_remaining % 2 == 1:
+        return select(number_remaining // 2)
+
+    return (select(number_remaining // 2 - 1) + select(number_remaining // 2)) / 2
+
+
+def _sort_with_ranks(values):
+    """Sorts values along the first axis, also returning the rank of each value"""
+
+    order = np.argsort(values, axis=0, kind="stable")
+    ranks = np.empty_like(order)
+    positions = np.arange(values.shape[0]).reshape(-1, *[1] * (values.ndim - 1))
+    np.put_along_axis(ranks, order, positions, axis=0)
+
+    return np.take_along_axis(values, order, axis=0), ranks
+
+
+def leave_one_out_median(values):
+    """Computes the median along the first axis, leaving out each element in turn.
+
+    Equivalent to np.median(np.delete(values, i, axis=0), axis=0) for each i, but computed from
+    a single sort.
+
+    Args:
+        values (np.ndarray): The values, with shape (N, ...).
+
+    Returns:
+        np.ndarray: The leave-one-out medians, with the same shape as values.
+    """
+
+    values = np.asarray(values, dtype=float)
+
+    if values.shape[0] < 2:
+        return np.full(values.shape, np.nan)
+
+    sorted_values, ranks = _sort_with_ranks(values)
+
+    return _leave_one_out_median_sorted(sorted_values, ranks)
+
+
+def leave_one_out_median_absolute_deviation(values):
+    """Computes the median absolute deviation along the first axis, leaving out each element in
+    turn.
+
+    Equivalent to median_absolute_deviation(np.delete(values, i, axis=0), axis=0) for each i.
+    Each leave-one-out median takes one of (at most) three values, so the absolute deviations
+    only need to be sorted for each of these.
+
+    Args:
+        values (np.ndarray): The values, with shape (N, ...).
+
+    Returns:
+        np.ndarray: The leave-one-out median absolute deviations, with the same shape as values.
+    """
+
+    values = np.asarray(values, dtype=float)
+    number_values = values.shape[0]
+
+    if number_values < 2:
+        return np.full(values.shape, np.nan)
+
+    sorted_values, ranks = _sort_with_ranks(values)
+    median = _leave_one_out_median_sorted(sorted_values, ranks)
+
+    # Leaving out the lowest, the middle or the highest value covers every possible median
+    mad = np.full(values.shape, np.nan)
+    for left_out_rank in sorted({0, (number_values - 1) // 2, number_values - 1}):
+        candidate_median = _leave_one_out_median_sorted(
+            sorted_values, np.full((1, *values.shape[1:]), left_out_rank)
+        )[:1]
+
+        sorted_deviations, deviation_ranks = _sort_with_ranks(np.abs(values - candidate_median))
+        candidate_mad = _leave_one_out_median_sorted(sorted_deviations, deviation_ranks)
+
+        use_candidate = median == candidate_median
+        mad[use_candidate] = candidate_mad[use_candidate]
+
+    return mad
+
+
+def leave_one_out_mean_std(values):
+    """Computes the mean and standard deviation along the first axis, leaving out each element in
+    turn.
+
+    Args:
+        values (np.ndarray): The values, with shape (N, ...).
+
+    Returns:
+        tuple (np.ndarray, np.ndarray): The leave-one-out means and standard deviations, with the
+            same shape as values.
+    """
+
+    values = np.asarray(values, dtype=float)
+    number_remaining = values.shape[0] - 1
+
+    if number_remaining < 1:
+        return np.full(values.shape, np.nan), np.full(values.shape, np.nan)
+
+    # Centre the values first for numerical stability
+    centre = values.mean(axis=0)
+    centred_values = values - centre
+
+    mean = (centred_values.sum(axis=0) - centred_values) / number_remaining
+    variance = ((centred_values**2).sum(axis=0) - centred_values**2) / number_remaining - mean**2
+    std = np.sqrt(np.maximum(variance, 0))
+
+    # Rounding errors can leave a tiny standard deviation where the remaining values are equal
+    sorted_values, ranks = _sort_with_ranks(values)
+    remaining_min = np.where(ranks == 0, sorted_values[1], sorted_values[0])
+    remaining_max = np.where(ranks == number_remaining, sorted_values[-2], sorted_values[-1])
+    std[remaining_min == remaining_max] = 0
+
+    return mean + centre, std
+
+
+def compute_q_value(z_score_vals):
+    """Computes the Q-metric: the excess area of the distribution of Z-scores compared with a
+    fitted Gaussian, weighted by the squared Z-score.
+
+    Args:
+        z_score_vals (np.ndarray): The Z-scores.
+
+    Returns:
+        float: The Q-metric
+    """
+
+    bins = np.linspace(-15, 15, 501)
+    z_density, bin_edges = np.histogram(z_score_vals, bins=bins, density=True)
+    bin_centers = (bin_edges[1:] + bin_edges[:-1]) / 2.0
+
+    try:
+        popt, _ = curve_fit(  # pylint: disable=unbalanced-tuple-unpacking
+            f=gaussian_curve, xdata=bin_centers, ydata=z_density
+        )
+
+        z_ideal = gaussian_curve(bin_centers, *popt)
+        z_diff = np.abs(z_density - z_ideal)
+    except (RuntimeError, ValueError):
+        logger.debug("IAR couldnt fit curve, estimating with sampled statistics.")
+        z_ideal = gaussian_curve(bin_centers, a=1, m=z_density.mean(), s=z_density.std())
+        z_diff = np.abs(z_density - z_ideal)
+
+    # Integrate to get the q_value
+    return np.float64(np.trapz(z_diff * np.abs(bin_centers) ** 2, bin_centers))
+
+
+def _compute_test_volume(test_volume):
+    """Binarises a (possibly probabilistic) test delineation"""
+
+    # We use 0.1 to capture the outer edge of the test delineation, if it is probabilistic
+    return process_probability_image(test_volume, 0.1)
+
+
+def _compute_test_distance_map(test_volume, crop_box):
+    """Computes the (absolute) distance map of a binary test volume, cropped to crop_box"""
+
+    test_distance_map = sitk.Abs(
+        sitk.SignedMaurerDistanceMap(test_volume, squaredDistance=False, useImageSpacing=True)
+    )
+
+    return sitk.GetArrayFromImage(test_distance_map)[crop_box].astype(np.float32)
+
+
+def _compute_spherical_surface_values(test_volume, reference_distance_map, resolution):
+    """Evaluates the reference distance map on the test surface, regridded on a sphere"""
+
+    theta, phi, values = evaluate_distance_on_surface(
+        reference_distance_map, test_volume, reference_as_distance_map=True
+    )
+
+    _, _, g_vals = regrid_spherical_data(theta, phi, values, resolution=resolution)
+
+    return g_vals
+
+
 def run_iar(
     atlas_set,
     reference_structure,
@@ -69,9 +264,20 @@ def run_iar(
     single_step=False,
     project_on_sphere=False,
     label="DIR",
+    executor="serial",
+    max_workers=None,
 ):
     """
     Perform iterative atlas removal on the atlas_set
+
+    The distance map of each atlas is computed once (optionally in parallel) and re-used in every
+    iteration, only the consensus surface is recomputed after atlases are removed. The
+    leave-one-out statistics of all atlases are computed together from the stacked surface values.
+
+    Args:
+        executor (str, optional): The type of executor used to compute the per-atlas distance
+            maps, one of "serial", "thread" or "process". Defaults to "serial".
+        max_workers (int, optional): The maximum number of workers. Defaults to None.
     """
 
     if iteration == 0:
@@ -82,47 +288,70 @@ def run_iar(
         logger.info("Iterative atlas removal: ")
         logger.info("  Beginning process")
 
-    # Get remaining case identifiers to loop through
-    remaining_id_list = list(atlas_set.keys())
-
-    # Generate the surface projections
-    #   1. Set the consensus surface using the reference volume
-    probability_label = combine_labels(atlas_set, reference_structure, label=label)[
-        reference_structure
-    ]
-
-    # Modify resolution for better statistics
-    if project_on_sphere:
-        if len(remaining_id_list) < 12:
-            logger.info("  Less than 12 atlases, resolution set: 3x3 sqr deg")
-            resolution = 3
-        elif len(remaining_id_list) < 7:
-            logger.info("  Less than 7 atlases, resolution set: 6x6 sqr deg")
-            resolution = 6
-        else:
-            resolution = 1
-    else:
-        if len(remaining_id_list) < 12:
-            logger.info("  Less than 12 atlases, resample factor set: 5")
-            resample_factor = 5
-        elif len(remaining_id_list) < 7:
-            logger.info("  Less than 7 atlases, resolution set: 6x6 sqr deg")
-            resample_factor = 10
-        else:
-            resample_factor = 1
+    if z_score_statistic.lower() not in ("std", "mad"):
+        logger.error(" Error!")
+        logger.error(" z_score must be one of: MAD, STD")
+        sys.exit()
 
-    g_val_list = []
-    logger.info("  Calculating surface distance maps: ")
-    for test_id in remaining_id_list:
-        logger.info("    {0}".format(test_id))
-        #   2. Calculate the distance from the surface to the consensus surface
+    # Binarise the test delineations, and compute the distance maps once for all iterations
+    atlas_id_list = list(atlas_set.keys())
+    test_volume_list = parallel_map(
+        _compute_test_volume,
+        [atlas_set[test_id][label][reference_structure] for test_id in atlas_id_list],
+        executor=executor,
+        max_workers=max_workers,
+    )
+    test_volumes = dict(zip(atlas_id_list, test_volume_list))
 
-        test_volume = atlas_set[test_id][label][reference_structure]
+    # The consensus (reference) surface, which is thresholded well above 0.5, always lies within
+    # the bounding box of the test volumes, so the distance maps are cropped to this box
+    crop_box = label_to_slices(
+        np.any([sitk.GetArrayViewFromImage(i) for i in test_volume_list], axis=0), expansion=1
+    )
+
+    test_distance_maps = {}
+    if not project_on_sphere:
+        logger.info("  Calculating surface distance maps: ")
+        test_distance_map_list = parallel_map(
+            _compute_test_distance_map,
+            test_volume_list,
+            executor=executor,
+            max_workers=max_workers,
+            crop_box=crop_box,
+        )
+        test_distance_maps = dict(zip(atlas_id_list, test_distance_map_list))
+
+    while True:
+        # Get remaining case identifiers to loop through
+        remaining_id_list = list(atlas_set.keys())
 
-        # This next step ensures non-binary labels are treated properly
-        # We use 0.1 to capture the outer edge of the test delineation, if it is probabilistic
-        test_volume = process_probability_image(test_volume, 0.1)
+        # Generate the surface projections
+        #   1. Set the consensus surface using the reference volume
+        probability_label = combine_labels(atlas_set, reference_structure, label=label)[
+            reference_structure
+        ]
 
+        # Modify resolution for better statistics
+        if project_on_sphere:
+            if len(remaining_id_list) < 12:
+                logger.info("  Less than 12 atlases, resolution set: 3x3 sqr deg")
+                resolution = 3
+            elif len(remaining_id_list) < 7:
+                logger.info("  Less than 7 atlases, resolution set: 6x6 sqr deg")
+                resolution = 6
+            else:
+                resolution = 1
+        else:
+            if len(remaining_id_list) < 12:
+                logger.info("  Less than 12 atlases, resample factor set: 5")
+                resample_factor = 5
+            elif len(remaining_id_list) < 7:
+                logger.info("  Less than 7 atlases, resolution set: 6x6 sqr deg")
+                resample_factor = 10
+            else:
+                resample_factor = 1
+
+        #   2. Calculate the distance from the surface to the consensus surface
         if project_on_sphere:
             reference_volume = process_probability_image(probability_label, threshold=0.999)
             # note: we use a threshold slightly below 1 to ensure the consensus (reference) volume
@@ -136,13 +365,14 @@ def run_iar(
             )
 
             # Compute the distance to test surfaces, across the surface of the reference
-            theta, phi, values = evaluate_distance_on_surface(
-                reference_distance_map, test_volume, reference_as_distance_map=True
+            g_val_list = parallel_map(
+                _compute_spherical_surface_values,
+                [test_volumes[test_id] for test_id in remaining_id_list],
+                executor=executor,
+                max_workers=max_workers,
+                reference_distance_map=reference_distance_map,
+                resolution=resolution,
             )
-
-            _, _, g_vals = regrid_spherical_data(theta, phi, values, resolution=resolution)
-
-            g_val_list.append(g_vals)
         else:
             reference_volume = process_probability_image(probability_label, threshold=0.95)
             # note: we use a threshold slightly below 1 to ensure the consensus (reference) volume
@@ -151,152 +381,117 @@ def run_iar(
             # better statistics, so we prefer a lower threshold but not too low,
             # or it may include some errors
 
-            # Compute distance to reference, from the test volume
-            values = evaluate_distance_to_reference(
-                reference_volume, test_volume, resample_factor=resample_factor
-            )
-
-            g_val_list.append(values)
+            # Evaluate the distance to each test surface, on the reference surface
+            reference_surface = sitk.GetArrayFromImage(sitk.LabelContour(reference_volume)) == 1
+            reference_surface = reference_surface[crop_box]
 
-    q_results = {}
+            g_val_list = [
+                test_distance_maps[test_id][reference_surface][::resample_factor]
+                for test_id in remaining_id_list
+            ]
 
-    for i, (test_id, g_vals) in enumerate(zip(remaining_id_list, g_val_list)):
+        # Compute the statistics of the other atlases, leaving out each atlas in turn
+        g_val_array = np.stack(g_val_list)
 
-        g_val_list_test = g_val_list[:]
-        g_val_list_test.pop(i)
-
-        if project_on_sphere and smooth_distance_maps:
-            g_vals = filters.gaussian_filter(g_vals, sigma=smooth_sigma, mode="wrap")
-
-        #       b) i] Compute the Z-scores over the projected surface
         if z_score_statistic.lower() == "std":
-            g_val_mean = np.mean(g_val_list_test, axis=0)
-            g_val_std = np.std(g_val_list_test, axis=0)
-
-            if np.any(g_val_std == 0):
-                logger.info("    Std Dev zero count: {0}".format(np.sum(g_val_std == 0)))
-                g_val_std[g_val_std == 0] = g_val_std.mean()
-
-            z_score_vals_array = (g_vals - g_val_mean) / g_val_std
-
-        elif z_score_statistic.lower() == "mad":
-            g_val_median = np.median(g_val_list_test, axis=0)
-            g_val_mad = 1.4826 * median_absolute_deviation(g_val_list_test, axis=0)
-
-            if np.any(~np.isfinite(g_val_mad)):
-                logger.info("Error in MAD")
-                logger.info(g_val_mad)
-
-            if np.any(g_val_mad == 0):
-                logger.info("    MAD zero count: {0}".format(np.sum(g_val_mad == 0)))
-                g_val_mad[g_val_mad == 0] = np.median(g_val_mad)
-
-            z_score_vals_array = (g_vals - g_val_median) / g_val_mad
-
+            g_val_centre, g_val_scale = leave_one_out_mean_std(g_val_array)
+        else:
+            g_val_centre = leave_one_out_median(g_val_array)
+            g_val_scale = 1.4826 * leave_one_out_median_absolute_deviation(g_val_array)
+
+        q_results = {}
+
+        for test_id, g_vals, g_val_location, g_val_spread in zip(
+            remaining_id_list, g_val_list, g_val_centre, g_val_scale
+        ):
+
+            if project_on_sphere and smooth_distance_maps:
+                g_vals = filters.gaussian_filter(g_vals, sigma=smooth_sigma, mode="wrap")
+
+            #       b) i] Compute the Z-scores over the projected surface
+            if z_score_statistic.lower() == "std":
+                if np.any(g_val_spread == 0):
+                    logger.info("    Std Dev zero count: {0}".format(np.sum(g_val_spread == 0)))
+                    g_val_spread[g_val_spread == 0] = g_val_spread.mean()
+
+            else:
+                if np.any(~np.isfinite(g_val_spread)):
+                    logger.info("Error in MAD")
+                    logger.info(g_val_spread)
+
+                if np.any(g_val_spread == 0):
+                    logger.info("    MAD zero count: {0}".format(np.sum(g_val_spread == 0)))
+                    g_val_spread[g_val_spread == 0] = np.median(g_val_spread)
+
+            z_score_vals = np.ravel((g_vals - g_val_location) / g_val_spread)
+
+            logger.debug("      [{0}] Statistics of mZ-scores".format(test_id))
+            logger.debug("        Min(Z)    = {0:.2f}".format(z_score_vals.min()))
+            logger.debug("        Q1(Z)     = {0:.2f}".format(np.percentile(z_score_vals, 25)))
+            logger.debug("        Mean(Z)   = {0:.2f}".format(z_score_vals.mean()))
+            logger.debug("        Median(Z) = {0:.2f}".format(np.percentile(z_score_vals, 50)))
+            logger.debug("        Q3(Z)     = {0:.2f}".format(np.percentile(z_score_vals, 75)))
+            logger.debug("        Max(Z)    = {0:.2f}\n".format(z_score_vals.max()))
+
+            # Calculate excess area from Gaussian: the Q-metric
+            q_results[test_id] = compute_q_value(z_score_vals)
+
+        # Exclude (at most) the worst 3 atlases for outlier detection
+        # With a minimum number, this helps provide more robust estimates at low numbers
+        result_list = list(q_results.values())
+        result_list = [r for r in result_list if ~np.isnan(r) and np.isfinite(r)]
+        best_results = np.sort(result_list)[: max([min_best_atlases, len(result_list) - 3])]
+
+        if outlier_method.lower() == "iqr":
+            outlier_limit = np.percentile(best_results, 75, axis=0) + outlier_factor * np.subtract(
+                *np.percentile(best_results, [75, 25], axis=0)
+            )
+        elif outlier_method.lower() == "std":
+            outlier_limit = np.mean(best_results, axis=0) + outlier_factor * np.std(
+                best_results, axis=0
+            )
         else:
             logger.error(" Error!")
-            logger.error(" z_score must be one of: MAD, STD")
+            logger.error(" outlier_method must be one of: IQR, STD")
             sys.exit()
 
-        z_score_vals = np.ravel(z_score_vals_array)
+        logger.info("  Analysing results")
+        logger.info("   Outlier limit: {0:06.3f}".format(outlier_limit))
+        keep_id_list = []
 
-        logger.debug("      [{0}] Statistics of mZ-scores".format(test_id))
-        logger.debug("        Min(Z)    = {0:.2f}".format(z_score_vals.min()))
-        logger.debug("        Q1(Z)     = {0:.2f}".format(np.percentile(z_score_vals, 25)))
-        logger.debug("        Mean(Z)   = {0:.2f}".format(z_score_vals.mean()))
-        logger.debug("        Median(Z) = {0:.2f}".format(np.percentile(z_score_vals, 50)))
-        logger.debug("        Q3(Z)     = {0:.2f}".format(np.percentile(z_score_vals, 75)))
-        logger.debug("        Max(Z)    = {0:.2f}\n".format(z_score_vals.max()))
-
-        # Calculate excess area from Gaussian: the Q-metric
-        bins = np.linspace(-15, 15, 501)
-        z_density, bin_edges = np.histogram(z_score_vals, bins=bins, density=True)
-        bin_centers = (bin_edges[1:] + bin_edges[:-1]) / 2.0
-
-        try:
-            popt, _ = curve_fit(  # pylint: disable=unbalanced-tuple-unpacking
-                f=gaussian_curve, xdata=bin_centers, ydata=z_density
+        logger.info(
+            "{0},{1},{2},{3:.4g}\n".format(
+                iteration,
+                " ".join(remaining_id_list),
+                " ".join(["{0:.4g}".format(i) for i in list(q_results.values())]),
+                outlier_limit,
             )
-
-            z_ideal = gaussian_curve(bin_centers, *popt)
-            z_diff = np.abs(z_density - z_ideal)
-        except (RuntimeError, ValueError):
-            logger.debug("IAR couldnt fit curve, estimating with sampled statistics.")
-            z_ideal = gaussian_curve(bin_centers, a=1, m=z_density.mean(), s=z_density.std())
-            z_diff = np.abs(z_density - z_ideal)
-
-        # Integrate to get the q_value
-        q_value = np.trapz(z_diff * np.abs(bin_centers) ** 2, bin_centers)
-        q_results[test_id] = np.float64(q_value)
-
-    # Exclude (at most) the worst 3 atlases for outlier detection
-    # With a minimum number, this helps provide more robust estimates at low numbers
-    result_list = list(q_results.values())
-    result_list = [r for r in result_list if ~np.isnan(r) and np.isfinite(r)]
-    best_results = np.sort(result_list)[: max([min_best_atlases, len(result_list) - 3])]
-
-    if outlier_method.lower() == "iqr":
-        outlier_limit = np.percentile(best_results, 75, axis=0) + outlier_factor * np.subtract(
-            *np.percentile(best_results, [75, 25], axis=0)
-        )
-    elif outlier_method.lower() == "std":
-        outlier_limit = np.mean(best_results, axis=0) + outlier_factor * np.std(
-            best_results, axis=0
-        )
-    else:
-        logger.error(" Error!")
-        logger.error(" outlier_method must be one of: IQR, STD")
-        sys.exit()
-
-    logger.info("  Analysing results")
-    logger.info("   Outlier limit: {0:06.3f}".format(outlier_limit))
-    keep_id_list = []
-
-    logger.info(
-        "{0},{1},{2},{3:.4g}\n".format(
-            iteration,
-            " ".join(remaining_id_list),
-            " ".join(["{0:.4g}".format(i) for i in list(q_results.values())]),
-            outlier_limit,
         )
-    )
 
-    for idx, result in q_results.items():
+        for idx, result in q_results.items():
 
-        accept = result <= outlier_limit
+            accept = result <= outlier_limit
 
-        logger.info(
-            "      {0}: Q = {1:06.3f} [{2}]".format(
-                idx, result, {True: "KEEP", False: "REMOVE"}[accept]
+            logger.info(
+                "      {0}: Q = {1:06.3f} [{2}]".format(
+                    idx, result, {True: "KEEP", False: "REMOVE"}[accept]
+                )
             )
-        )
 
-        if accept:
-            keep_id_list.append(idx)
+            if accept:
+                keep_id_list.append(idx)
+
+        if len(keep_id_list) == len(remaining_id_list):
+            break
 
-    if len(keep_id_list) < len(remaining_id_list):
         logger.info("\n  Step {0} Complete".format(iteration))
         logger.info("  Num. Removed = {0} --\n".format(len(remaining_id_list) - len(keep_id_list)))
 
         iteration += 1
-        atlas_set_new = {i: atlas_set[i] for i in keep_id_list}
+        atlas_set = {i: atlas_set[i] for i in keep_id_list}
 
         if single_step:
-            return atlas_set_new
-
-        return run_iar(
-            atlas_set=atlas_set_new,
-            reference_structure=reference_structure,
-            smooth_distance_maps=smooth_distance_maps,
-            smooth_sigma=smooth_sigma,
-            z_score_statistic=z_score_statistic,
-            outlier_method=outlier_method,
-            min_best_atlases=min_best_atlases,
-            outlier_factor=outlier_factor,
-            iteration=iteration,
-            project_on_sphere=project_on_sphere,
-            label=label,
-        )
+            return atlas_set
 
     logger.info("  End point reached. Keeping:\n   {0}".format(keep_id_list))
 
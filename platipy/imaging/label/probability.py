@@ -0,0 +1,223 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from collections.abc import MutableMapping
+
+import numpy as np
+import SimpleITK as sitk
+
+from platipy.imaging.utils.crop import label_to_slices
+
+PROBABILITY_MAP_DTYPES = (np.uint8, np.uint16)
+
+
+class SparseProbabilityMap:
+    """A probability map stored compactly: cropped to the bounding box of its non-zero voxels and
+    quantised to 8 or 16 bit integers (with a stored scale).
+
+    Integer images (e.g. binary or encoded labels) are cropped but not quantised, so they are
+    stored exactly.
+
+    Args:
+        arr (np.ndarray): The (cropped, quantised) array.
+        index (tuple): The index (x, y, z) of the cropped region in the full image.
+        size (tuple): The size of the full image.
+        spacing (tuple): The spacing of the full image.
+        origin (tuple): The origin of the full image.
+        direction (tuple): The direction of the full image.
+        scale (float, optional): The probability of each quantisation step. Defaults to None, in
+            which case the array isn't quantised.
+    """
+
+    def __init__(self, arr, index, size, spacing, origin, direction, scale=None):
+
+        self.arr = arr
+        self.index = tuple(int(i) for i in index)
+        self.size = tuple(int(i) for i in size)
+        self.spacing = tuple(spacing)
+        self.origin = tuple(origin)
+        self.direction = tuple(direction)
+        self.scale = scale
+
+    @classmethod
+    def from_image(cls, image, dtype=np.uint16):
+        """Creates a sparse probability map from an image.
+
+        Args:
+            image (SimpleITK.Image): The probability map (or label).
+            dtype (np.dtype, optional): The type to quantise floating point images to, np.uint8
+                or np.uint16. Defaults to np.uint16, which keeps probabilities to within 1e-5.
+
+        Returns:
+            SparseProbabilityMap: The sparse probability map.
+        """
+
+        if dtype not in PROBABILITY_MAP_DTYPES:
+            raise ValueError(f"dtype must be one of {PROBABILITY_MAP_DTYPES}, not {dtype}")
+
+        image_arr = sitk.GetArrayViewFromImage(image)
+
+        # The bounding box of the non-zero voxels (in array order), an empty map is stored empty
+        bbox = label_to_slices(image_arr != 0)
+        if bbox is None:
+            bbox = (slice(0, 0),) * image_arr.ndim
+
+        arr = image_arr[bbox]
+        scale = None
+
+        if arr.dtype.kind == "f":
+            max_value = float(arr.max(initial=0))
+            scale = max_value / np.iinfo(dtype).max if max_value > 0 else 1.0
+            arr = np.rint(arr / scale).astype(dtype)
+        else:
+            arr = arr.copy()
+
+        return cls(
+            arr,
+            index=[b.start for b in bbox][::-1],
+            size=image.GetSize(),
+            spacing=image.GetSpacing(),
+            origin=image.GetOrigin(),
+            direction=image.GetDirection(),
+            scale=scale,
+        )
+
+    @property
+    def nbytes(self):
+        """int: The memory used by the stored array"""
+        return self.arr.nbytes
+
+    def to_image(self):
+        """Rehydrates the full probability map.
+
+        Returns:
+            SimpleITK.Image: The probability map (float32, or the original type for integer
+            images).
+        """
+
+        dtype = self.arr.dtype if self.scale is None else np.float32
+
+        full_arr = np.zeros(self.size[::-1], dtype=dtype)
+        bbox = tuple(slice(i, i + n) for i, n in zip(self.index[::-1], self.arr.shape))
+
+        if self.scale is None:
+            full_arr[bbox] = self.arr
+        else:
+            full_arr[bbox] = self.arr * np.float32(self.scale)
+
+        image = sitk.GetImageFromArray(full_arr)
+        image.SetSpacing(self.spacing)
+        image.SetOrigin(self.origin)
+        image.SetDirection(self.direction)
+
+        return image
+
+    def get_metadata(self):
+        """Gets everything but the array, for writing to disk"""
+
+        return {
+            "index": self.index,
+            "size": self.size,
+            "spacing": self.spacing,
+            "origin": self.origin,
+            "direction": self.direction,
+            "scale": self.scale,
+        }
+
+
+class ProbabilityMapDict(MutableMapping):
+    """A dict of probability maps (SimpleITK.Image), stored as SparseProbabilityMap.
+
+    Images are converted when they are set, and rehydrated to a SimpleITK.Image each time they are
+    accessed, so this can be used in place of a dict of images.
+
+    Args:
+        dtype (np.dtype, optional): The type floating point images are quantised to, np.uint8 or
+            np.uint16. Defaults to np.uint16.
+    """
+
+    def __init__(self, dtype=np.uint16):
+
+        self.dtype = dtype
+        self.sparse_maps = {}
+
+    def __getitem__(self, name):
+
+        return self.sparse_maps[name].to_image()
+
+    def __setitem__(self, name, image):
+
+        if not isinstance(image, SparseProbabilityMap):
+            image = SparseProbabilityMap.from_image(image, dtype=self.dtype)
+
+        self.sparse_maps[name] = image
+
+    def __delitem__(self, name):
+
+        del self.sparse_maps[name]
+
+    def __iter__(self):
+
+        return iter(self.sparse_maps)
+
+    def __len__(self):
+
+        return len(self.sparse_maps)
+
+    @property
+    def nbytes(self):
+        """int: The memory used by the stored arrays"""
+        return sum(sparse_map.nbytes for sparse_map in self.sparse_maps.values())
+
+    def write(self, output_path):
+        """Writes the probability maps to a single compressed (.npz) file.
+
+        Args:
+            output_path (str | pathlib.Path): The path of the file to write.
+        """
+
+        index = {}
+        arrays = {}
+        for map_number, (name, sparse_map) in enumerate(self.sparse_maps.items()):
+            key = f"map_{map_number}"
+            arrays[key] = sparse_map.arr
+            index[name] = {"key": key, **sparse_map.get_metadata()}
+
+        arrays["index"] = np.frombuffer(json.dumps(index).encode(), dtype=np.uint8)
+
+        with open(output_path, "wb") as file_obj:
+            np.savez_compressed(file_obj, **arrays)
+
+    @classmethod
+    def read(cls, input_path):
+        """Reads probability maps written with ProbabilityMapDict.write.
+
+        Args:
+            input_path (str | pathlib.Path): The path of the file.
+
+        Returns:
+            ProbabilityMapDict: The probability maps.
+        """
+
+        probability_maps = cls()
+
+        with np.load(input_path) as npz_file:
+            index = json.loads(npz_file["index"].tobytes().decode())
+
+            for name, entry in index.items():
+                arr = npz_file[entry.pop("key")]
+                probability_maps[name] = SparseProbabilityMap(arr, **entry)
+
+        return probability_maps
@@ -12,11 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+from collections.abc import Mapping
+from pathlib import Path
+
 import SimpleITK as sitk
 import numpy as np
 
 from scipy.ndimage.measurements import center_of_mass
 
+from platipy.imaging.utils.crop import label_to_slices
 from platipy.imaging.utils.math import gen_primes
 
 
@@ -88,26 +93,43 @@ def vectorised_transform_index_to_physical_point(image, point_array, rotate=True
     """
     Transforms a set of points from array indices to real-space
     """
+    direction = np.array(image.GetDirection()).reshape(image.GetDimension(), -1)
     if rotate:
         spacing = image.GetSpacing()[::-1]
         origin = image.GetOrigin()[::-1]
+        direction = direction[::-1, ::-1]
     else:
         spacing = image.GetSpacing()
         origin = image.GetOrigin()
-    return point_array * spacing + origin
+
+    point_array = point_array * spacing
+    if not np.allclose(direction, np.eye(image.GetDimension())):
+        point_array = point_array @ direction.T
+
+    return point_array + origin
 
 
 def vectorised_transform_physical_point_to_index(image, point_array, rotate=True):
     """
     Transforms a set of points from real-space to array indices
+
+    As with SimpleITK's TransformPhysicalPointToContinuousIndex, the returned indices are not
+    rounded.
     """
+    direction = np.array(image.GetDirection()).reshape(image.GetDimension(), -1)
     if rotate:
         spacing = image.GetSpacing()[::-1]
         origin = image.GetOrigin()[::-1]
+        direction = direction[::-1, ::-1]
     else:
         spacing = image.GetSpacing()
         origin = image.GetOrigin()
-    return (point_array - origin) / spacing
+
+    point_array = point_array - origin
+    if not np.allclose(direction, np.eye(image.GetDimension())):
+        point_array = point_array @ direction
+
+    return point_array / spacing
 
 
 def generate_primes():
@@ -154,23 +176,14 @@ def prime_encode_structure_list(structure_list):
         SimpleITK.Image: The prime-encoded structure
     """
 
-    # Create an image with all ones
-    img_size = structure_list[0].GetSize()
-    prime_encoded_image = sitk.GetImageFromArray(np.ones(img_size[::-1]))
-    prime_encoded_image = sitk.Cast(prime_encoded_image, sitk.sitkUInt64)
-    prime_encoded_image.CopyInformation(structure_list[0])
-
-    prime_generator = generate_primes()
+    prime_encoded_arr = np.ones(structure_list[0].GetSize()[::-1], dtype=np.uint64)
 
-    for s_img, prime in zip(structure_list, prime_generator):
-        # Cast to int
-        s_img_int = sitk.Cast(s_img > 0, sitk.sitkUInt64)
+    for s_img, prime in zip(structure_list, generate_primes()):
+        # Multiply the encoded values inside the structure by its prime
+        prime_encoded_arr[sitk.GetArrayViewFromImage(s_img) > 0] *= np.uint64(prime)
 
-        # Multiply with the encoded image
-        prime_encoded_image = (
-            sitk.MaskNegated(prime_encoded_image, s_img_int)
-            + sitk.Mask(prime_encoded_image, s_img_int) * prime * s_img_int
-        )
+    prime_encoded_image = sitk.GetImageFromArray(prime_encoded_arr)
+    prime_encoded_image.CopyInformation(structure_list[0])
 
     return prime_encoded_image
 
@@ -185,67 +198,100 @@ def prime_decode_image(prime_encoded_image):
         list [SimpleITK.Image]: A list of binary masks.
     """
 
-    prime_generator = generate_primes()
+    prime_encoded_arr = sitk.GetArrayViewFromImage(prime_encoded_image)
+
+    # Only the distinct values need to be factorised
+    values, value_index = np.unique(prime_encoded_arr, return_inverse=True)
+    values = values.astype(np.uint64)
 
     structure_list = []
-    num_nonzero_voxels = 1
 
-    for prime in prime_generator:
-        # Get the next prime
-        print(prime)
+    for prime in generate_primes():
 
         # Calculate the region originally defined with this prime
-        s_img = sitk.Equal(sitk.Modulus(prime_encoded_image, prime), 0)
+        value_in_structure = (values % np.uint64(prime)) == 0
 
-        # Check how many voxels we have
-        num_nonzero_voxels = sitk.GetArrayViewFromImage(s_img).sum()
-
-        if num_nonzero_voxels > 0:
-            structure_list.append(s_img)
-        else:
+        # Stop at the first prime which isn't present
+        if not value_in_structure.any():
             break
 
+        s_arr = value_in_structure[value_index].reshape(prime_encoded_arr.shape)
+
+        s_img = sitk.GetImageFromArray(s_arr.astype(np.uint8))
+        s_img.CopyInformation(prime_encoded_image)
+        structure_list.append(s_img)
+
     return structure_list
 
 
 def binary_encode_structure_list(structure_list):
     """Encode a list of binary labels using binary encoding
 
+    Each structure is stored in one bit of the encoded value (structure i in bit i + 1, the lowest
+    bit is not used), so that a structure can be decoded with a single bitwise AND (see
+    binary_decode_structure).
+
     Args:
         structure_list (list (SimpleITK.Image)): The list of binary label maps.
 
     Raises:
-        ValueError: A maximum of 32 structures can be encoded!
+        ValueError: A maximum of 63 structures can be encoded!
 
     Returns:
-        SimpleITK.Image: The encoded image, can be saved etc. as usual.
+        SimpleITK.Image: The encoded image, can be saved etc. as usual. This is a 32 bit image if
+        there are up to 31 structures, and a 64 bit image otherwise.
     """
 
-    if len(structure_list) > 32:
-        raise ValueError("You can only encode a maximum of 32 structures with this method!")
+    if len(structure_list) > 63:
+        raise ValueError("You can only encode a maximum of 63 structures with this method!")
+
+    dtype = np.uint32 if len(structure_list) <= 31 else np.uint64
 
     # Create an image with all zeros
     img_size = structure_list[0].GetSize()
-    binary_encoded_arr = np.zeros(img_size[::-1]).astype(int)
+    binary_encoded_arr = np.zeros(img_size[::-1], dtype=dtype)
 
     for power, s_img in enumerate(structure_list):
-        # Convert image to array
-        s_arr = sitk.GetArrayFromImage(s_img).astype(int)
-        # Bitwise-or with existing array
-        binary_encoded_arr = np.bitwise_or(
-            binary_encoded_arr, s_arr.astype(bool) * 2 ** (power + 1)
-        )
+        # Set the bit of this structure
+        s_arr = sitk.GetArrayViewFromImage(s_img) > 0
+        binary_encoded_arr |= s_arr.astype(dtype) << dtype(power + 1)
 
     binary_encoded_img = sitk.GetImageFromArray(binary_encoded_arr)
     binary_encoded_img.CopyInformation(structure_list[0])
 
-    # Image can be cast to 8,16, or 32 bit integer (depending on number of structures)
-    # Safest is just to use 32 bits
-    binary_encoded_img = sitk.Cast(binary_encoded_img, sitk.sitkUInt32)
-
     return binary_encoded_img
 
 
+def _get_binary_encoded_array(binary_encoded_img):
+    """Gets the (integer) array of a binary encoded image"""
+
+    binary_encoded_arr = sitk.GetArrayViewFromImage(binary_encoded_img)
+    if binary_encoded_arr.dtype.kind == "f":
+        binary_encoded_arr = binary_encoded_arr.astype(np.uint64)
+
+    return binary_encoded_arr
+
+
+def binary_decode_structure(binary_encoded_img, index):
+    """Decode a single structure from a binary label map.
+
+    Args:
+        binary_encoded_img (SimpleITK.Image): The encoded image.
+        index (int): The index of the structure in the list which was encoded.
+
+    Returns:
+        SimpleITK.Image: The binary mask of the structure.
+    """
+
+    binary_encoded_arr = _get_binary_encoded_array(binary_encoded_img)
+    bit = binary_encoded_arr.dtype.type(1) << binary_encoded_arr.dtype.type(index + 1)
+
+    s_img = sitk.GetImageFromArray(((binary_encoded_arr & bit) != 0).astype(np.uint8))
+    s_img.CopyInformation(binary_encoded_img)
+
+    return s_img
+
+
 def binary_decode_image(binary_encoded_img):
     """Decode a binary label map to a list of structures.
 
@@ -253,27 +299,127 @@ def binary_decode_image(binary_encoded_img):
         binary_encoded_img (SimpleITK.Image): The encoded image.
 
     Returns:
-        list (SimpleITK.Image): The list of images.
+        list (SimpleITK.Image): The list of images. Structures which are empty are not included.
     """
 
-    binary_encoded_arr = sitk.GetArrayFromImage(binary_encoded_img).astype(int)
+    binary_encoded_arr = _get_binary_encoded_array(binary_encoded_img)
 
-    structure_list = []
-    num_nonzero_voxels = 1
-
-    for power in range(32):
+    # The bits used anywhere in the image
+    bits_used = (
+        np.bitwise_or.reduce(binary_encoded_arr, axis=None) if binary_encoded_arr.size else 0
+    )
 
-        # Calculate the region originally defined with this prime
-        s_arr = np.bitwise_and(binary_encoded_arr, 2 ** (power + 1))
+    structure_list = []
 
-        # Check how many voxels we have
-        num_nonzero_voxels = s_arr.sum()
+    for power in range(binary_encoded_arr.dtype.itemsize * 8 - 1):
 
-        if num_nonzero_voxels > 0:
-            s_img = sitk.GetImageFromArray(s_arr) > 0
-            s_img.CopyInformation(binary_encoded_img)
-            structure_list.append(s_img)
-        else:
+        if not int(bits_used) & (1 << (power + 1)):
             continue
 
+        structure_list.append(binary_decode_structure(binary_encoded_img, power))
+
     return structure_list
+
+
+def write_packed_structure_set(structure_dict, output_path):
+    """Writes a set of structures to a single compressed file.
+
+    Each structure is cropped to its bounding box and stored as packed bits (one bit per voxel),
+    so any number of (possibly overlapping) structures can be stored in a fraction of the memory
+    needed for one image per structure. Structures can be read individually, see
+    read_packed_structure_set.
+
+    Args:
+        structure_dict (dict): The structures, as {name: SimpleITK.Image}. All structures must
+            share the same image space.
+        output_path (str | pathlib.Path): The path of the file to write (a .npz file).
+    """
+
+    reference_image = next(iter(structure_dict.values()))
+
+    index = {
+        "size": reference_image.GetSize(),
+        "spacing": reference_image.GetSpacing(),
+        "origin": reference_image.GetOrigin(),
+        "direction": reference_image.GetDirection(),
+        "structures": {},
+    }
+    arrays = {}
+
+    for structure_number, (name, structure) in enumerate(structure_dict.items()):
+        s_arr = sitk.GetArrayViewFromImage(structure) > 0
+
+        # The bounding box of the structure (in array order), empty structures are stored empty
+        bbox = label_to_slices(s_arr)
+        if bbox is None:
+            bbox = (slice(0, 0),) * s_arr.ndim
+
+        bbox_start = [int(s.start) for s in bbox]
+        bbox_end = [int(s.stop) for s in bbox]
+
+        key = f"structure_{structure_number}"
+        arrays[key] = np.packbits(s_arr[bbox])
+        index["structures"][name] = {"key": key, "start": bbox_start, "end": bbox_end}
+
+    arrays["index"] = np.frombuffer(json.dumps(index).encode(), dtype=np.uint8)
+
+    with open(output_path, "wb") as file_obj:
+        np.savez_compressed(file_obj, **arrays)
+
+
+def read_packed_structure_set(input_path):
+    """Reads a set of structures written with write_packed_structure_set.
+
+    Args:
+        input_path (str | pathlib.Path): The path of the file.
+
+    Returns:
+        PackedStructureSet: The structures, as a read-only dict of {name: SimpleITK.Image}. Each
+        structure is decoded when it is accessed.
+    """
+
+    return PackedStructureSet(input_path)
+
+
+class PackedStructureSet(Mapping):
+    """A set of structures written with write_packed_structure_set, as a read-only dict of
+    {name: SimpleITK.Image}. Only the structures accessed are read and decoded.
+
+    Args:
+        input_path (str | pathlib.Path): The path of the file.
+    """
+
+    def __init__(self, input_path):
+
+        self.input_path = Path(input_path)
+
+        with np.load(self.input_path) as npz_file:
+            self.index = json.loads(npz_file["index"].tobytes().decode())
+
+    def __getitem__(self, name):
+
+        entry = self.index["structures"][name]
+
+        with np.load(self.input_path) as npz_file:
+            packed_arr = npz_file[entry["key"]]
+
+        bbox_shape = [end - start for start, end in zip(entry["start"], entry["end"])]
+        bbox = tuple(slice(start, end) for start, end in zip(entry["start"], entry["end"]))
+
+        s_arr = np.zeros(self.index["size"][::-1], dtype=np.uint8)
+        s_arr[bbox] = np.unpackbits(packed_arr, count=int(np.prod(bbox_shape))).reshape(bbox_shape)
+
+        structure = sitk.GetImageFromArray(s_arr)
+        structure.SetSpacing(self.index["spacing"])
+        structure.SetOrigin(self.index["origin"])
+        structure.SetDirection(self.index["direction"])
+
+        return structure
+
+    def __iter__(self):
+
+        return iter(self.index["structures"])
+
+    def __len__(self):
+
+        return len(self.index["structures"])
@@ -19,7 +19,12 @@ import numpy as np
 
 from loguru import logger
 
-from platipy.imaging.registration.utils import apply_transform, convert_mask_to_reg_structure
+from platipy.imaging.registration.utils import (
+    ImagePyramid,
+    apply_transform,
+    apply_transform_to_labels,
+    convert_mask_to_reg_structure,
+)
 
 from platipy.imaging.registration.linear import (
     linear_registration,
@@ -29,6 +34,8 @@ from platipy.imaging.registration.deformable import (
     fast_symmetric_forces_demons_registration,
 )
 
+from platipy.imaging.registration.cache import RegistrationCache, cached_registration
+
 from platipy.imaging.label.fusion import (
     process_probability_image,
     compute_weight_map,
@@ -36,6 +43,9 @@ from platipy.imaging.label.fusion import (
 )
 from platipy.imaging.label.iar import run_iar
 
+from platipy.imaging.projects.multiatlas.library import AtlasLibrary
+from platipy.imaging.projects.multiatlas.run import quick_register_atlas
+
 from platipy.imaging.utils.vessel import vessel_spline_generation
 
 from platipy.imaging.utils.valve import (
@@ -49,9 +59,11 @@ from platipy.imaging.utils.conduction import (
 )
 
 from platipy.imaging.utils.crop import label_to_roi, crop_to_roi
+from platipy.imaging.utils.parallel import parallel_map
 
 from platipy.imaging.generation.mask import extend_mask
 
+from platipy.imaging.label.probability import ProbabilityMapDict
 from platipy.imaging.label.utils import binary_encode_structure_list, correct_volume_overlap
 
 ATLAS_PATH = "/atlas"
@@ -95,6 +107,7 @@ CARDIAC_SETTINGS_DEFAULTS = {
         "atlas_label_format": "Case_{0}/Structures/Case_{0}_{1}_CROP.nii.gz",
         "crop_atlas_to_structures": False,
         "crop_atlas_expansion_mm": (20, 20, 40),
+        "atlas_library_path": None,
         "guide_structure_name": "WHOLEHEART",
         "superior_extension": 30,
     },
@@ -253,9 +266,258 @@ CARDIAC_SETTINGS_DEFAULTS = {
     "return_atlas_guide_structure": False,
     "return_as_cropped": False,
     "return_proba_as_contours": False,
+    "parallel_settings": {
+        "executor": "serial",
+        "max_workers": None,
+    },
+    "registration_cache_settings": {
+        "cache_dir": None,
+        "max_size_mb": None,
+        "max_entries": None,
+    },
 }
 
 
+def register_cardiac_atlas_linear(
+    atlas,
+    target_image,
+    structure_list,
+    linear_registration_settings,
+    target_reg_structure=None,
+    guide_structure_name=None,
+    superior_extension=30,
+    cache=None,
+):
+    """Linearly registers a single atlas to the target image and propagates the structures
+
+    Args:
+        atlas (dict): The atlas, containing the "CT Image" and each structure.
+        target_image (sitk.Image): The (cropped) target image.
+        structure_list (list): The names of the structures to propagate.
+        linear_registration_settings (dict): Settings passed to linear_registration.
+        target_reg_structure (sitk.Image, optional): If given, the registration is guided by this
+            (target) structure, generated using convert_mask_to_reg_structure. Defaults to None.
+        guide_structure_name (str, optional): The name of the atlas guide structure, only used
+            for structure guided registration. Defaults to None.
+        superior_extension (float, optional): The superior extension (in mm) of the guide
+            structure, only used for structure guided registration. Defaults to 30.
+        cache (RegistrationCache, optional): Cache used to re-use previously computed
+            transforms. Defaults to None.
+
+    Returns:
+        dict: The registered atlas, containing the "Transform", "CT Image" and each structure.
+    """
+
+    registered_atlas = {}
+
+    if target_reg_structure is not None:
+        target_reg_image = target_reg_structure
+        atlas_reg_image = convert_mask_to_reg_structure(atlas[guide_structure_name], expansion=2)
+
+    else:
+        target_reg_image = target_image
+        atlas_reg_image = atlas["CT Image"]
+
+    initial_tfm = cached_registration(
+        linear_registration,
+        target_reg_image,
+        atlas_reg_image,
+        cache=cache,
+        **linear_registration_settings,
+    )
+
+    registered_atlas["Transform"] = initial_tfm
+
+    if target_reg_structure is not None:
+        registered_atlas["Reg Mask"] = apply_transform(
+            input_image=atlas_reg_image,
+            reference_image=target_image,
+            transform=initial_tfm,
+            default_value=0,
+            interpolator=sitk.sitkLinear,
+        )
+
+        expanded_atlas_guide_structure = extend_mask(
+            atlas[guide_structure_name],
+            direction=("ax", "sup"),
+            extension_mm=superior_extension,
+            interior_mm_shape=superior_extension / 2,
+        )
+
+        registered_atlas[guide_structure_name + "EXPANDED"] = apply_transform(
+            input_image=expanded_atlas_guide_structure,
+            reference_image=target_image,
+            transform=initial_tfm,
+            default_value=0,
+            interpolator=sitk.sitkNearestNeighbor,
+        )
+
+    registered_atlas["CT Image"] = apply_transform(
+        input_image=atlas["CT Image"],
+        reference_image=target_image,
+        transform=initial_tfm,
+        default_value=-1000,
+        interpolator=sitk.sitkLinear,
+    )
+
+    registered_atlas.update(
+        apply_transform_to_labels(
+            {struct: atlas[struct] for struct in structure_list},
+            reference_image=target_image,
+            transform=initial_tfm,
+        )
+    )
+
+    return registered_atlas
+
+
+def register_cardiac_atlas_structure_guided(
+    atlas,
+    target_image,
+    target_reg_structure,
+    structure_list,
+    guide_structure_name,
+    structure_guided_registration_settings,
+    cache=None,
+):
+    """Deformably registers the guide structure of a single (linearly registered) atlas to the
+    target guide structure and propagates the image and structures
+
+    Args:
+        atlas (dict): The linearly registered atlas, as returned by
+            register_cardiac_atlas_linear (using structure guided registration).
+        target_image (sitk.Image): The (cropped) target image.
+        target_reg_structure (sitk.Image | ImagePyramid): The target registration structure,
+            generated using convert_mask_to_reg_structure, or its pyramid (shared by all
+            atlases).
+        structure_list (list): The names of the structures to propagate.
+        guide_structure_name (str): The name of the atlas guide structure.
+        structure_guided_registration_settings (dict): Settings passed to
+            fast_symmetric_forces_demons_registration.
+        cache (RegistrationCache, optional): Cache used to re-use previously computed
+            transforms. Defaults to None.
+
+    Returns:
+        dict: The registered atlas, containing the "Reg Mask", "Transform", "CT Image", the
+            expanded guide structure and each structure.
+    """
+
+    registered_atlas = {}
+
+    struct_guided_tfm = cached_registration(
+        fast_symmetric_forces_demons_registration,
+        target_reg_structure,
+        atlas["Reg Mask"],
+        cache=cache,
+        **structure_guided_registration_settings,
+    )
+
+    registered_atlas["Reg Mask"] = apply_transform(
+        input_image=atlas["Reg Mask"],
+        transform=struct_guided_tfm,
+        default_value=0,
+        interpolator=sitk.sitkLinear,
+    )
+    registered_atlas["Transform"] = struct_guided_tfm
+
+    registered_atlas["CT Image"] = apply_transform(
+        input_image=atlas["CT Image"],
+        transform=struct_guided_tfm,
+        default_value=-1000,
+        interpolator=sitk.sitkLinear,
+    )
+
+    registered_atlas[guide_structure_name + "EXPANDED"] = apply_transform(
+        input_image=atlas[guide_structure_name + "EXPANDED"],
+        reference_image=target_image,
+        transform=struct_guided_tfm,
+        default_value=0,
+        interpolator=sitk.sitkNearestNeighbor,
+    )
+
+    registered_atlas.update(
+        apply_transform_to_labels(
+            {struct: atlas[struct] for struct in structure_list},
+            transform=struct_guided_tfm,
+        )
+    )
+
+    return registered_atlas
+
+
+def register_cardiac_atlas_deformable(
+    atlas,
+    target_image,
+    structure_list,
+    deformable_registration_settings,
+    expanded_target_mask=None,
+    guide_structure_name=None,
+    cache=None,
+):
+    """Deformably registers a single atlas to the target image and propagates the structures
+
+    Args:
+        atlas (dict): The atlas, containing the "CT Image" and each structure. These must be in
+            the same image space as the target image.
+        target_image (sitk.Image): The (cropped) target image.
+        structure_list (list): The names of the structures to propagate.
+        deformable_registration_settings (dict): Settings passed to
+            fast_symmetric_forces_demons_registration.
+        expanded_target_mask (sitk.Image, optional): If given (for structure guided
+            registration), the expanded target guide structure used to mask the registration.
+            Defaults to None.
+        guide_structure_name (str, optional): The name of the atlas guide structure, only used
+            for structure guided registration. Defaults to None.
+        cache (RegistrationCache, optional): Cache used to re-use previously computed
+            transforms. Defaults to None.
+
+    Returns:
+        dict: The registered atlas, containing the "Transform", "CT Image" and each structure.
+    """
+
+    registered_atlas = {}
+
+    atlas_reg_image = atlas["CT Image"]
+    target_reg_image = target_image
+
+    if expanded_target_mask is not None:
+        expanded_atlas_mask = atlas[guide_structure_name + "EXPANDED"]
+
+        combined_mask = sitk.Maximum(expanded_atlas_mask, expanded_target_mask)
+
+        atlas_reg_image = sitk.Mask(atlas_reg_image, combined_mask, outsideValue=-1000)
+        atlas_reg_image = sitk.Mask(atlas_reg_image, atlas_reg_image > -400, outsideValue=-1000)
+
+        target_reg_image = sitk.Mask(target_reg_image, combined_mask, outsideValue=-1000)
+        target_reg_image = sitk.Mask(target_reg_image, atlas_reg_image > -400, outsideValue=-1000)
+
+    dir_tfm = cached_registration(
+        fast_symmetric_forces_demons_registration,
+        target_reg_image,
+        atlas_reg_image,
+        cache=cache,
+        **deformable_registration_settings,
+    )
+
+    registered_atlas["Transform"] = dir_tfm
+
+    registered_atlas["CT Image"] = apply_transform(
+        input_image=atlas["CT Image"],
+        transform=dir_tfm,
+        default_value=-1000,
+        interpolator=sitk.sitkLinear,
+    )
+
+    registered_atlas.update(
+        apply_transform_to_labels(
+            {struct: atlas[struct] for struct in structure_list},
+            transform=dir_tfm,
+        )
+    )
+
+    return registered_atlas
+
+
 def run_cardiac_segmentation(img, guide_structure=None, settings=CARDIAC_SETTINGS_DEFAULTS):
     """Runs the atlas-based cardiac segmentation
 
@@ -265,11 +527,13 @@ def run_cardiac_segmentation(img, guide_structure=None, settings=CARDIAC_SETTING
                                    Defaults to default_settings.
 
     Returns:
-        dict: Dictionary containing output of segmentation
+        tuple (dict, ProbabilityMapDict): The binary segmentation of each structure, and the
+            probability map of each structure. Probability maps are stored cropped and quantised
+            (see ProbabilityMapDict), and converted to a SimpleITK.Image when accessed.
     """
 
     results = {}
-    results_prob = {}
+    results_prob = ProbabilityMapDict()
 
     return_as_cropped = settings["return_as_cropped"]
 
@@ -307,9 +571,33 @@ def run_cardiac_segmentation(img, guide_structure=None, settings=CARDIAC_SETTING
     crop_atlas_to_structures = settings["atlas_settings"]["crop_atlas_to_structures"]
     crop_atlas_expansion_mm = settings["atlas_settings"]["crop_atlas_expansion_mm"]
 
+    # Atlases are registered independently, optionally using a pool of workers
+    parallel_settings = settings.get("parallel_settings", {})
+    executor = parallel_settings.get("executor", "serial")
+    max_workers = parallel_settings.get("max_workers", None)
+
+    # Transforms are re-used when the same images are registered again with the same settings
+    cache_settings = settings.get("registration_cache_settings", {})
+    cache = None
+    if cache_settings.get("cache_dir"):
+        cache = RegistrationCache(**cache_settings)
+
+    # Atlases in a library (see build_atlas_library) are memory-mapped and only read when used
+    atlas_library = None
+    if settings["atlas_settings"].get("atlas_library_path"):
+        atlas_library = AtlasLibrary(settings["atlas_settings"]["atlas_library_path"])
+        atlas_library.check_crop_settings(crop_atlas_to_structures, crop_atlas_expansion_mm)
+
     atlas_set = {}
     for atlas_id in atlas_id_list:
         atlas_set[atlas_id] = {}
+
+        if atlas_library is not None:
+            atlas_set[atlas_id]["Original"] = atlas_library.get_atlas(
+                atlas_id, atlas_structure_list
+            )
+            continue
+
         atlas_set[atlas_id]["Original"] = {}
 
         image = sitk.ReadImage(f"{atlas_path}/{atlas_image_format.format(atlas_id)}")
@@ -366,6 +654,8 @@ def run_cardiac_segmentation(img, guide_structure=None, settings=CARDIAC_SETTING
         target_reg_structure = convert_mask_to_reg_structure(guide_structure, expansion=2)
 
     else:
+        target_reg_structure = None
+
         quick_reg_settings = {
             "reg_method": "similarity",
             "shrink_factors": [8],
@@ -378,27 +668,20 @@ def run_cardiac_segmentation(img, guide_structure=None, settings=CARDIAC_SETTING
             "optimiser": "gradient_descent_line_search",
         }
 
-        registered_crop_images = []
-
         logger.info("Running initial Translation tranform to crop image volume")
 
-        for atlas_id in atlas_id_list[: min([8, len(atlas_id_list)])]:
-
-            logger.info(f"  > atlas {atlas_id}")
-
-            # Register the atlases
-            atlas_set[atlas_id]["RIR"] = {}
-            atlas_image = atlas_set[atlas_id]["Original"]["CT Image"]
-
-            reg_image, _ = linear_registration(
-                img,
-                atlas_image,
-                **quick_reg_settings,
-            )
-
-            registered_crop_images.append(sitk.Cast(reg_image, sitk.sitkFloat32))
-
-            del reg_image
+        crop_atlas_id_list = atlas_id_list[: min([8, len(atlas_id_list)])]
+        logger.info(f"  > atlases {crop_atlas_id_list}")
+
+        registered_crop_images = parallel_map(
+            quick_register_atlas,
+            [atlas_set[atlas_id]["Original"]["CT Image"] for atlas_id in crop_atlas_id_list],
+            executor=executor,
+            max_workers=max_workers,
+            cache=cache,
+            target_image=img,
+            quick_reg_settings=quick_reg_settings,
+        )
 
         combined_image = sum(registered_crop_images) / len(registered_crop_images) > -1000
 
@@ -422,77 +705,27 @@ def run_cardiac_segmentation(img, guide_structure=None, settings=CARDIAC_SETTING
         f"Running {linear_registration_settings['reg_method']} tranform to align atlas images"
     )
 
-    for atlas_id in atlas_id_list:
-        # Register the atlases
-
-        logger.info(f"  > atlas {atlas_id}")
-
-        atlas_set[atlas_id]["RIR"] = {}
-
-        if guide_structure:
-            guide_structure_name = settings["atlas_settings"]["guide_structure_name"]
-            target_reg_image = target_reg_structure
-            atlas_reg_image = convert_mask_to_reg_structure(
-                atlas_set[atlas_id]["Original"][guide_structure_name], expansion=2
-            )
-
-        else:
-            target_reg_image = img_crop
-            atlas_reg_image = atlas_set[atlas_id]["Original"]["CT Image"]
-
-        _, initial_tfm = linear_registration(
-            target_reg_image,
-            atlas_reg_image,
-            **linear_registration_settings,
-        )
-
-        # Save in the atlas dict
-        atlas_set[atlas_id]["RIR"]["Transform"] = initial_tfm
-
-        if guide_structure:
-            atlas_set[atlas_id]["RIR"]["Reg Mask"] = apply_transform(
-                input_image=atlas_reg_image,
-                reference_image=img_crop,
-                transform=initial_tfm,
-                default_value=0,
-                interpolator=sitk.sitkLinear,
-            )
-
-            expanded_atlas_guide_structure = extend_mask(
-                atlas_set[atlas_id]["Original"][guide_structure_name],
-                direction=("ax", "sup"),
-                extension_mm=settings["atlas_settings"]["superior_extension"],
-                interior_mm_shape=settings["atlas_settings"]["superior_extension"] / 2,
-            )
-
-            atlas_set[atlas_id]["RIR"][guide_structure_name + "EXPANDED"] = apply_transform(
-                input_image=expanded_atlas_guide_structure,
-                reference_image=img_crop,
-                transform=initial_tfm,
-                default_value=0,
-                interpolator=sitk.sitkNearestNeighbor,
-            )
-
-        atlas_set[atlas_id]["RIR"]["CT Image"] = apply_transform(
-            input_image=atlas_set[atlas_id]["Original"]["CT Image"],
-            reference_image=img_crop,
-            transform=initial_tfm,
-            default_value=-1000,
-            interpolator=sitk.sitkLinear,
-        )
-
-        # sitk.WriteImage(rigid_image, f"./RR_{atlas_id}.nii.gz")
-
-        for struct in atlas_structure_list:
-            input_struct = atlas_set[atlas_id]["Original"][struct]
-            atlas_set[atlas_id]["RIR"][struct] = apply_transform(
-                input_image=input_struct,
-                reference_image=img_crop,
-                transform=initial_tfm,
-                default_value=0,
-                interpolator=sitk.sitkNearestNeighbor,
-            )
+    guide_structure_name = settings["atlas_settings"]["guide_structure_name"]
+    superior_extension = settings["atlas_settings"]["superior_extension"]
+
+    logger.info(f"  > atlases {atlas_id_list}")
+
+    registered_atlases = parallel_map(
+        register_cardiac_atlas_linear,
+        [atlas_set[atlas_id]["Original"] for atlas_id in atlas_id_list],
+        executor=executor,
+        max_workers=max_workers,
+        cache=cache,
+        target_image=img_crop,
+        structure_list=atlas_structure_list,
+        linear_registration_settings=linear_registration_settings,
+        target_reg_structure=target_reg_structure,
+        guide_structure_name=guide_structure_name,
+        superior_extension=superior_extension,
+    )
 
+    for atlas_id, registered_atlas in zip(atlas_id_list, registered_atlases):
+        atlas_set[atlas_id]["RIR"] = registered_atlas
         atlas_set[atlas_id]["Original"] = None
 
     """
@@ -504,49 +737,28 @@ def run_cardiac_segmentation(img, guide_structure=None, settings=CARDIAC_SETTING
 
         logger.info("Running structure-guided deformable registration on atlas labels")
 
-        for atlas_id in atlas_id_list:
-
-            logger.info(f"  > atlas {atlas_id}")
-
-            # Register the atlases
-            atlas_set[atlas_id]["DIR_STRUCT"] = {}
-
-            deform_image, struct_guided_tfm, _ = fast_symmetric_forces_demons_registration(
-                target_reg_structure,
-                atlas_set[atlas_id]["RIR"]["Reg Mask"],
-                **structure_guided_registration_settings,
-            )
-
-            # Save in the atlas dict
-            atlas_set[atlas_id]["DIR_STRUCT"]["Reg Mask"] = deform_image
-            atlas_set[atlas_id]["DIR_STRUCT"]["Transform"] = struct_guided_tfm
-
-            atlas_set[atlas_id]["DIR_STRUCT"]["CT Image"] = apply_transform(
-                input_image=atlas_set[atlas_id]["RIR"]["CT Image"],
-                transform=struct_guided_tfm,
-                default_value=-1000,
-                interpolator=sitk.sitkLinear,
-            )
-
-            atlas_set[atlas_id]["DIR_STRUCT"][guide_structure_name + "EXPANDED"] = apply_transform(
-                input_image=atlas_set[atlas_id]["RIR"][guide_structure_name + "EXPANDED"],
-                reference_image=img_crop,
-                transform=struct_guided_tfm,
-                default_value=0,
-                interpolator=sitk.sitkNearestNeighbor,
-            )
-
-            # sitk.WriteImage(deform_image, f"./DIR_STRUCT_{atlas_id}.nii.gz")
-
-            for struct in atlas_structure_list:
-                input_struct = atlas_set[atlas_id]["RIR"][struct]
-                atlas_set[atlas_id]["DIR_STRUCT"][struct] = apply_transform(
-                    input_image=input_struct,
-                    transform=struct_guided_tfm,
-                    default_value=0,
-                    interpolator=sitk.sitkNearestNeighbor,
-                )
+        logger.info(f"  > atlases {atlas_id_list}")
+
+        # The target pyramid is the same for every atlas, so only compute it once (before sending
+        # it to the workers)
+        target_reg_pyramid = ImagePyramid(target_reg_structure)
+        target_reg_pyramid.precompute(**structure_guided_registration_settings)
+
+        registered_atlases = parallel_map(
+            register_cardiac_atlas_structure_guided,
+            [atlas_set[atlas_id]["RIR"] for atlas_id in atlas_id_list],
+            executor=executor,
+            max_workers=max_workers,
+            cache=cache,
+            target_image=img_crop,
+            target_reg_structure=target_reg_pyramid,
+            structure_list=atlas_structure_list,
+            guide_structure_name=guide_structure_name,
+            structure_guided_registration_settings=structure_guided_registration_settings,
+        )
 
+        for atlas_id, registered_atlas in zip(atlas_id_list, registered_atlases):
+            atlas_set[atlas_id]["DIR_STRUCT"] = registered_atlas
             atlas_set[atlas_id]["RIR"] = None
 
     # Settings
@@ -554,69 +766,37 @@ def run_cardiac_segmentation(img, guide_structure=None, settings=CARDIAC_SETTING
 
     logger.info("Running DIR to refine atlas image registration")
 
-    for atlas_id in atlas_id_list:
-
-        logger.info(f"  > atlas {atlas_id}")
-
-        # Register the atlases
-        atlas_set[atlas_id]["DIR"] = {}
-
-        if guide_structure:
-            label = "DIR_STRUCT"
-        else:
-            label = "RIR"
-
-        atlas_reg_image = atlas_set[atlas_id][label]["CT Image"]
-        target_reg_image = img_crop
-
-        if guide_structure:
-            expanded_atlas_mask = atlas_set[atlas_id]["DIR_STRUCT"][
-                guide_structure_name + "EXPANDED"
-            ]
-            expanded_target_mask = extend_mask(
-                guide_structure,
-                direction=("ax", "sup"),
-                extension_mm=settings["atlas_settings"]["superior_extension"],
-                interior_mm_shape=settings["atlas_settings"]["superior_extension"] / 2,
-            )
-
-            combined_mask = sitk.Maximum(expanded_atlas_mask, expanded_target_mask)
-
-            atlas_reg_image = sitk.Mask(atlas_reg_image, combined_mask, outsideValue=-1000)
-            atlas_reg_image = sitk.Mask(
-                atlas_reg_image, atlas_reg_image > -400, outsideValue=-1000
-            )
-
-            target_reg_image = sitk.Mask(target_reg_image, combined_mask, outsideValue=-1000)
-            target_reg_image = sitk.Mask(
-                target_reg_image, atlas_reg_image > -400, outsideValue=-1000
-            )
-
-        deform_image, dir_tfm, _ = fast_symmetric_forces_demons_registration(
-            target_reg_image,
-            atlas_reg_image,
-            **deformable_registration_settings,
-        )
-
-        # Save in the atlas dict
-        atlas_set[atlas_id]["DIR"]["Transform"] = dir_tfm
-
-        atlas_set[atlas_id]["DIR"]["CT Image"] = apply_transform(
-            input_image=atlas_set[atlas_id][label]["CT Image"],
-            transform=dir_tfm,
-            default_value=-1000,
-            interpolator=sitk.sitkLinear,
+    if guide_structure:
+        label = "DIR_STRUCT"
+
+        # The target mask is the same for every atlas, so only compute it once
+        expanded_target_mask = extend_mask(
+            guide_structure,
+            direction=("ax", "sup"),
+            extension_mm=superior_extension,
+            interior_mm_shape=superior_extension / 2,
         )
+    else:
+        label = "RIR"
+        expanded_target_mask = None
+
+    logger.info(f"  > atlases {atlas_id_list}")
+
+    registered_atlases = parallel_map(
+        register_cardiac_atlas_deformable,
+        [atlas_set[atlas_id][label] for atlas_id in atlas_id_list],
+        executor=executor,
+        max_workers=max_workers,
+        cache=cache,
+        target_image=img_crop,
+        structure_list=atlas_structure_list,
+        deformable_registration_settings=deformable_registration_settings,
+        expanded_target_mask=expanded_target_mask,
+        guide_structure_name=guide_structure_name,
+    )
 
-        for struct in atlas_structure_list:
-            input_struct = atlas_set[atlas_id][label][struct]
-            atlas_set[atlas_id]["DIR"][struct] = apply_transform(
-                input_image=input_struct,
-                transform=dir_tfm,
-                default_value=0,
-                interpolator=sitk.sitkNearestNeighbor,
-            )
-
+    for atlas_id, registered_atlas in zip(atlas_id_list, registered_atlases):
+        atlas_set[atlas_id]["DIR"] = registered_atlas
         atlas_set[atlas_id][label] = None
 
     """
@@ -889,6 +1069,9 @@ def run_cardiac_segmentation(img, guide_structure=None, settings=CARDIAC_SETTING
     if return_as_cropped:
         results["CROP_IMAGE"] = img_crop
 
+    if cache is not None:
+        logger.info(f"Registration cache statistics: {cache.statistics}")
+
     logger.info("Done!")
 
     return results, results_prob
@@ -30,7 +30,9 @@ from platipy.imaging.projects.cardiac.run import (
 )
 
 
-@app.register("Cardiac Segmentation", default_settings=CARDIAC_SETTINGS_DEFAULTS)
+@app.register(
+    "Cardiac Segmentation", default_settings=CARDIAC_SETTINGS_DEFAULTS, partition="object"
+)
 def cardiac_service(data_objects, working_dir, settings):
     """
     Implements the platipy framework to provide cardiac atlas based segmentation.
@@ -87,6 +89,7 @@ def cardiac_service(data_objects, working_dir, settings):
 @app.register(
     "Cardiac Structure Guided Segmentation",
     default_settings=CARDIAC_SETTINGS_DEFAULTS,
+    partition="parent",
 )
 def cardiac_structure_guided_service(data_objects, working_dir, settings):
     """Runs the structure guided cardiac segmentation service"""
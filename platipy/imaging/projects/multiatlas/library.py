@@ -0,0 +1,344 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import json
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+
+from loguru import logger
+
+from platipy.imaging.utils.crop import label_to_roi, crop_to_roi
+from platipy.imaging.utils.parallel import parallel_map
+
+ATLAS_LIBRARY_VERSION = 1
+ATLAS_LIBRARY_INDEX = "atlas_library.json"
+
+
+def find_format_values(atlas_path, path_format, *args):
+    """Finds the values of the last placeholder of a path format which exist on disk.
+
+    For example, with the format "Case_{0}/Images/Case_{0}_CROP.nii.gz" this returns the IDs of
+    the atlases in atlas_path, and with "Case_{0}/Structures/Case_{0}_{1}_CROP.nii.gz" and an
+    atlas ID it returns the structure names of that atlas.
+
+    Args:
+        atlas_path (str | pathlib.Path): The directory containing the atlases.
+        path_format (str): The path format, relative to atlas_path.
+        args: Values for the preceding placeholders.
+
+    Returns:
+        list: The (sorted) values found.
+    """
+
+    marker = "\0"
+    path_pattern = path_format.format(*args, marker)
+
+    value_regex = re.escape(path_pattern).replace(re.escape(marker), "(?P<value>[^/]+)", 1)
+    value_regex = value_regex.replace(re.escape(marker), "(?P=value)")
+
+    values = set()
+    for path in Path(atlas_path).glob(path_pattern.replace(marker, "*")):
+        match = re.fullmatch(value_regex, path.relative_to(atlas_path).as_posix())
+        if match:
+            values.add(match.group("value"))
+
+    return sorted(values)
+
+
+def _write_array(image, path):
+    """Writes the array of an image to an (uncompressed) .npy file, returning its geometry"""
+
+    np.save(path, sitk.GetArrayViewFromImage(image))
+
+    return {
+        "file": path.name,
+        "spacing": image.GetSpacing(),
+        "origin": image.GetOrigin(),
+        "direction": image.GetDirection(),
+    }
+
+
+def _build_atlas(
+    atlas_id,
+    atlas_path,
+    library_path,
+    atlas_structure_list,
+    atlas_image_format,
+    atlas_label_format,
+    crop_atlas_expansion_mm,
+):
+    """Converts a single atlas into the library format, returning its index entry"""
+
+    image = sitk.ReadImage(str(Path(atlas_path).joinpath(atlas_image_format.format(atlas_id))))
+
+    if atlas_structure_list is None:
+        atlas_structure_list = find_format_values(atlas_path, atlas_label_format, atlas_id)
+
+    structures = {
+        struct: sitk.ReadImage(
+            str(Path(atlas_path).joinpath(atlas_label_format.format(atlas_id, struct)))
+        )
+        for struct in atlas_structure_list
+    }
+
+    crop_box = None
+    if crop_atlas_expansion_mm is not None:
+        crop_box_size, crop_box_index = label_to_roi(
+            structures.values(), expansion_mm=crop_atlas_expansion_mm
+        )
+        crop_box = {
+            "size": [int(i) for i in crop_box_size],
+            "index": [int(i) for i in crop_box_index],
+        }
+
+        image = crop_to_roi(image, size=crop_box_size, index=crop_box_index)
+        structures = {
+            struct: crop_to_roi(structure, size=crop_box_size, index=crop_box_index)
+            for struct, structure in structures.items()
+        }
+
+    atlas_directory = Path(library_path).joinpath(atlas_id)
+    atlas_directory.mkdir(parents=True, exist_ok=True)
+
+    return {
+        "crop_box": crop_box,
+        "images": {
+            "CT Image": _write_array(image, atlas_directory.joinpath("CT_Image.npy")),
+            **{
+                struct: _write_array(structure, atlas_directory.joinpath(f"{struct}.npy"))
+                for struct, structure in structures.items()
+            },
+        },
+    }
+
+
+def build_atlas_library(
+    atlas_path,
+    library_path,
+    atlas_id_list=None,
+    atlas_structure_list=None,
+    atlas_image_format="Case_{0}/Images/Case_{0}_CROP.nii.gz",
+    atlas_label_format="Case_{0}/Structures/Case_{0}_{1}_CROP.nii.gz",
+    crop_atlas_expansion_mm=None,
+    executor="serial",
+    max_workers=None,
+):
+    """Builds an atlas library from a directory of NIfTI atlases.
+
+    Each atlas image and structure is stored as an uncompressed numpy (.npy) file, which can be
+    memory-mapped when loading, alongside an index recording the image geometry. This avoids
+    decompressing every atlas for every case segmented.
+
+    Args:
+        atlas_path (str | pathlib.Path): The directory containing the atlases.
+        library_path (str | pathlib.Path): The directory to write the atlas library to.
+        atlas_id_list (list, optional): The atlas IDs to include. Defaults to None, in which case
+            all atlases matching atlas_image_format are included.
+        atlas_structure_list (list, optional): The structures to include. Defaults to None, in
+            which case all structures matching atlas_label_format are included.
+        atlas_image_format (str, optional): The path format of the atlas images, relative to
+            atlas_path. Defaults to "Case_{0}/Images/Case_{0}_CROP.nii.gz".
+        atlas_label_format (str, optional): The path format of the atlas structures, relative to
+            atlas_path. Defaults to "Case_{0}/Structures/Case_{0}_{1}_CROP.nii.gz".
+        crop_atlas_expansion_mm (tuple, optional): If given, each atlas is cropped to the bounding
+            box of its structures, expanded by this margin (in mm). Defaults to None.
+        executor (str, optional): How atlases are converted: "serial", "thread" or "process".
+            Defaults to "serial".
+        max_workers (int, optional): The maximum number of workers. Defaults to None.
+
+    Returns:
+        AtlasLibrary: The atlas library.
+    """
+
+    if atlas_id_list is None:
+        atlas_id_list = find_format_values(atlas_path, atlas_image_format)
+
+    if len(atlas_id_list) == 0:
+        raise ValueError(f"No atlases found in {atlas_path}")
+
+    logger.info(f"Building atlas library from {len(atlas_id_list)} atlases")
+
+    library_path = Path(library_path)
+    library_path.mkdir(parents=True, exist_ok=True)
+
+    atlas_entries = parallel_map(
+        _build_atlas,
+        atlas_id_list,
+        executor=executor,
+        max_workers=max_workers,
+        atlas_path=atlas_path,
+        library_path=library_path,
+        atlas_structure_list=atlas_structure_list,
+        atlas_image_format=atlas_image_format,
+        atlas_label_format=atlas_label_format,
+        crop_atlas_expansion_mm=crop_atlas_expansion_mm,
+    )
+
+    # The index is written last, so an interrupted build doesn't leave a usable library
+    library_index = {
+        "version": ATLAS_LIBRARY_VERSION,
+        "crop_atlas_expansion_mm": crop_atlas_expansion_mm,
+        "atlases": dict(zip(atlas_id_list, atlas_entries)),
+    }
+    with open(library_path.joinpath(ATLAS_LIBRARY_INDEX), "w") as file_obj:
+        json.dump(library_index, file_obj, indent=2)
+
+    return AtlasLibrary(library_path)
+
+
+class LazyAtlas(Mapping):
+    """A single atlas from an atlas library, as a read-only dict of {name: SimpleITK.Image}.
+
+    Images are only read (from their memory-mapped files) when first accessed. Pickling the atlas
+    (e.g. to send it to a worker process) doesn't include the loaded images, so each worker maps
+    the files itself and the pages are shared between processes by the operating system.
+
+    Args:
+        library_path (pathlib.Path): The directory of the atlas library.
+        image_entries (dict): The index entry of each image, as {name: entry}.
+    """
+
+    def __init__(self, library_path, image_entries):
+
+        self.library_path = Path(library_path)
+        self.image_entries = image_entries
+        self._images = {}
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state["_images"] = {}
+        return state
+
+    def __getitem__(self, name):
+
+        if name not in self._images:
+            entry = self.image_entries[name]
+            arr = np.load(self.library_path.joinpath(entry["file"]), mmap_mode="r")
+
+            image = sitk.GetImageFromArray(arr)
+            image.SetSpacing(entry["spacing"])
+            image.SetOrigin(entry["origin"])
+            image.SetDirection(entry["direction"])
+
+            self._images[name] = image
+
+        return self._images[name]
+
+    def __iter__(self):
+
+        return iter(self.image_entries)
+
+    def __len__(self):
+
+        return len(self.image_entries)
+
+
+class AtlasLibrary:
+    """An atlas library, built using build_atlas_library.
+
+    Args:
+        library_path (str | pathlib.Path): The directory of the atlas library.
+    """
+
+    def __init__(self, library_path):
+
+        self.library_path = Path(library_path)
+
+        index_path = self.library_path.joinpath(ATLAS_LIBRARY_INDEX)
+        if not index_path.exists():
+            raise FileNotFoundError(f"No atlas library found at {self.library_path}")
+
+        with open(index_path, "r") as file_obj:
+            library_index = json.load(file_obj)
+
+        if library_index["version"] != ATLAS_LIBRARY_VERSION:
+            raise ValueError(
+                f"Atlas library version {library_index['version']} is not supported, rebuild "
+                "the atlas library"
+            )
+
+        self.crop_atlas_expansion_mm = library_index["crop_atlas_expansion_mm"]
+        self.atlases = library_index["atlases"]
+
+    @property
+    def atlas_id_list(self):
+        """list: The IDs of the atlases in the library"""
+        return list(self.atlases.keys())
+
+    def check_crop_settings(self, crop_atlas_to_structures, crop_atlas_expansion_mm):
+        """Checks that the library was cropped as the atlas settings of a pipeline expect.
+
+        A library which isn't cropped can still be used (only slower) if cropping is requested,
+        but a cropped library can't give the atlases a pipeline expects without cropping, or
+        cropped with a different expansion.
+
+        Args:
+            crop_atlas_to_structures (bool): Whether the atlases should be cropped.
+            crop_atlas_expansion_mm (tuple | float): The expansion of the crop.
+
+        Raises:
+            ValueError: The library was cropped differently from the settings.
+        """
+
+        if self.crop_atlas_expansion_mm is None:
+            if crop_atlas_to_structures:
+                logger.warning("Atlas library is not cropped, crop_atlas_to_structures is ignored")
+            return
+
+        if not crop_atlas_to_structures:
+            raise ValueError(
+                f"Atlas library is cropped (expansion {self.crop_atlas_expansion_mm} mm) but "
+                "crop_atlas_to_structures isn't set, use a library which isn't cropped"
+            )
+
+        if not np.allclose(self.crop_atlas_expansion_mm, crop_atlas_expansion_mm):
+            raise ValueError(
+                f"Atlas library is cropped with an expansion of {self.crop_atlas_expansion_mm} "
+                f"mm but crop_atlas_expansion_mm is {crop_atlas_expansion_mm} mm, rebuild the "
+                "atlas library"
+            )
+
+    def get_atlas(self, atlas_id, structure_list=None):
+        """Gets an atlas from the library. Images are loaded when first accessed.
+
+        Args:
+            atlas_id (str): The atlas ID.
+            structure_list (list, optional): The structures to include. Defaults to None, in which
+                case all structures are included.
+
+        Returns:
+            LazyAtlas: The atlas, containing the "CT Image" and each structure.
+        """
+
+        if atlas_id not in self.atlases:
+            raise ValueError(f"Atlas {atlas_id} is not in the atlas library")
+
+        image_entries = self.atlases[atlas_id]["images"]
+
+        if structure_list is not None:
+            missing_structures = [s for s in structure_list if s not in image_entries]
+            if len(missing_structures) > 0:
+                raise ValueError(
+                    f"Structures {missing_structures} of atlas {atlas_id} are not in the atlas "
+                    "library"
+                )
+
+            image_entries = {name: image_entries[name] for name in ["CT Image", *structure_list]}
+
+        return LazyAtlas(self.library_path.joinpath(atlas_id), image_entries)
@@ -19,7 +19,11 @@ import numpy as np
 
 from loguru import logger
 
-from platipy.imaging.registration.utils import apply_transform
+from platipy.imaging.registration.utils import (
+    ImagePyramid,
+    apply_transform,
+    apply_transform_to_labels,
+)
 
 from platipy.imaging.registration.linear import (
     linear_registration,
@@ -29,6 +33,10 @@ from platipy.imaging.registration.deformable import (
     fast_symmetric_forces_demons_registration,
 )
 
+from platipy.imaging.registration.cache import RegistrationCache, cached_registration
+
+from platipy.imaging.projects.multiatlas.library import AtlasLibrary
+
 from platipy.imaging.label.fusion import (
     process_probability_image,
     compute_weight_map,
@@ -36,7 +44,9 @@ from platipy.imaging.label.fusion import (
 )
 
 from platipy.imaging.utils.crop import label_to_roi, crop_to_roi
+from platipy.imaging.utils.parallel import parallel_map
 
+from platipy.imaging.label.probability import ProbabilityMapDict
 from platipy.imaging.label.utils import correct_volume_overlap
 
 ATLAS_PATH = "/atlas"
@@ -56,6 +66,7 @@ MUTLIATLAS_SETTINGS_DEFAULTS = {
         "atlas_label_format": "Case_{0}/Structures/Case_{0}_{1}_CROP.nii.gz",
         "crop_atlas_to_structures": False,
         "crop_atlas_expansion_mm": (20, 20, 40),
+        "atlas_library_path": None,
     },
     "auto_crop_target_image_settings": {
         "expansion_mm": [20, 20, 40],
@@ -99,9 +110,147 @@ MUTLIATLAS_SETTINGS_DEFAULTS = {
         "structures_for_binaryfillhole": [],
         "structures_for_overlap_correction": [],
     },
+    "parallel_settings": {
+        "executor": "serial",
+        "max_workers": None,
+    },
+    "registration_cache_settings": {
+        "cache_dir": None,
+        "max_size_mb": None,
+        "max_entries": None,
+    },
 }
 
 
+def quick_register_atlas(atlas_image, target_image, quick_reg_settings, cache=None):
+    """Runs a quick linear registration of an atlas image, used to define the target crop box
+
+    Args:
+        atlas_image (sitk.Image): The atlas image.
+        target_image (sitk.Image): The target image.
+        quick_reg_settings (dict): Settings passed to linear_registration.
+        cache (RegistrationCache, optional): Cache used to re-use previously computed
+            transforms. Defaults to None.
+
+    Returns:
+        sitk.Image: The registered atlas image (as 32-bit float).
+    """
+
+    quick_tfm = cached_registration(
+        linear_registration,
+        target_image,
+        atlas_image,
+        cache=cache,
+        **quick_reg_settings,
+    )
+
+    return apply_transform(
+        input_image=sitk.Cast(atlas_image, sitk.sitkFloat32),
+        reference_image=target_image,
+        transform=quick_tfm,
+        default_value=quick_reg_settings["default_value"],
+        interpolator=quick_reg_settings["final_interp"],
+    )
+
+
+def register_atlas_linear(
+    atlas, target_image, structure_list, linear_registration_settings, cache=None
+):
+    """Linearly registers a single atlas to the target image and propagates the structures
+
+    Args:
+        atlas (dict): The atlas, containing the "CT Image" and each structure.
+        target_image (sitk.Image): The (cropped) target image.
+        structure_list (list): The names of the structures to propagate.
+        linear_registration_settings (dict): Settings passed to linear_registration.
+        cache (RegistrationCache, optional): Cache used to re-use previously computed
+            transforms. Defaults to None.
+
+    Returns:
+        dict: The registered atlas, containing the "Transform", "CT Image" and each structure.
+    """
+
+    registered_atlas = {}
+
+    initial_tfm = cached_registration(
+        linear_registration,
+        target_image,
+        atlas["CT Image"],
+        cache=cache,
+        **linear_registration_settings,
+    )
+
+    registered_atlas["Transform"] = initial_tfm
+
+    registered_atlas["CT Image"] = apply_transform(
+        input_image=atlas["CT Image"],
+        reference_image=target_image,
+        transform=initial_tfm,
+        default_value=-1000,
+        interpolator=sitk.sitkLinear,
+    )
+
+    registered_atlas.update(
+        apply_transform_to_labels(
+            {struct: atlas[struct] for struct in structure_list},
+            reference_image=target_image,
+            transform=initial_tfm,
+        )
+    )
+
+    return registered_atlas
+
+
+def register_atlas_deformable(
+    atlas, target_image, structure_list, deformable_registration_settings, cache=None
+):
+    """Deformably registers a single (linearly registered) atlas to the target image and
+    propagates the structures
+
+    Args:
+        atlas (dict): The atlas, containing the "CT Image" and each structure. These must be in
+            the same image space as the target image.
+        target_image (sitk.Image | ImagePyramid): The (cropped) target image, or its pyramid
+            (shared by all atlases).
+        structure_list (list): The names of the structures to propagate.
+        deformable_registration_settings (dict): Settings passed to
+            fast_symmetric_forces_demons_registration.
+        cache (RegistrationCache, optional): Cache used to re-use previously computed
+            transforms. Defaults to None.
+
+    Returns:
+        dict: The registered atlas, containing the "Transform", "CT Image" and each structure.
+    """
+
+    registered_atlas = {}
+
+    dir_tfm = cached_registration(
+        fast_symmetric_forces_demons_registration,
+        target_image,
+        atlas["CT Image"],
+        cache=cache,
+        **deformable_registration_settings,
+    )
+
+    registered_atlas["Transform"] = dir_tfm
+
+    registered_atlas["CT Image"] = apply_transform(
+        input_image=atlas["CT Image"],
+        transform=dir_tfm,
+        default_value=-1000,
+        interpolator=sitk.sitkLinear,
+    )
+
+    registered_atlas.update(
+        apply_transform_to_labels(
+            {struct: atlas[struct] for struct in structure_list},
+            transform=dir_tfm,
+        )
+    )
+
+    return registered_atlas
+
+
 def run_segmentation(img, settings=MUTLIATLAS_SETTINGS_DEFAULTS):
     """Runs the atlas-based segmentation algorithm
 
@@ -111,11 +260,13 @@ def run_segmentation(img, settings=MUTLIATLAS_SETTINGS_DEFAULTS):
                                    Defaults to default_settings.
 
     Returns:
-        dict: Dictionary containing output of segmentation
+        tuple (dict, ProbabilityMapDict): The binary segmentation of each structure, and the
+            probability map of each structure. Probability maps are stored cropped and quantised
+            (see ProbabilityMapDict), and converted to a SimpleITK.Image when accessed.
     """
 
     results = {}
-    results_prob = {}
+    results_prob = ProbabilityMapDict()
 
     """
     Initialisation - Read in atlases
@@ -151,9 +302,33 @@ def run_segmentation(img, settings=MUTLIATLAS_SETTINGS_DEFAULTS):
     crop_atlas_to_structures = settings["atlas_settings"]["crop_atlas_to_structures"]
     crop_atlas_expansion_mm = settings["atlas_settings"]["crop_atlas_expansion_mm"]
 
+    # Atlases are registered independently, optionally using a pool of workers
+    parallel_settings = settings.get("parallel_settings", {})
+    executor = parallel_settings.get("executor", "serial")
+    max_workers = parallel_settings.get("max_workers", None)
+
+    # Transforms are re-used when the same images are registered again with the same settings
+    cache_settings = settings.get("registration_cache_settings", {})
+    cache = None
+    if cache_settings.get("cache_dir"):
+        cache = RegistrationCache(**cache_settings)
+
+    # Atlases in a library (see build_atlas_library) are memory-mapped and only read when used
+    atlas_library = None
+    if settings["atlas_settings"].get("atlas_library_path"):
+        atlas_library = AtlasLibrary(settings["atlas_settings"]["atlas_library_path"])
+        atlas_library.check_crop_settings(crop_atlas_to_structures, crop_atlas_expansion_mm)
+
     atlas_set = {}
     for atlas_id in atlas_id_list:
         atlas_set[atlas_id] = {}
+
+        if atlas_library is not None:
+            atlas_set[atlas_id]["Original"] = atlas_library.get_atlas(
+                atlas_id, atlas_structure_list
+            )
+            continue
+
         atlas_set[atlas_id]["Original"] = {}
 
         image = sitk.ReadImage(f"{atlas_path}/{atlas_image_format.format(atlas_id)}")
@@ -213,27 +388,20 @@ def run_segmentation(img, settings=MUTLIATLAS_SETTINGS_DEFAULTS):
         "optimiser": "gradient_descent_line_search",
     }
 
-    registered_crop_images = []
-
     logger.info("Running initial Translation tranform to crop image volume")
 
-    for atlas_id in atlas_id_list[: min([8, len(atlas_id_list)])]:
-
-        logger.info(f"  > atlas {atlas_id}")
-
-        # Register the atlases
-        atlas_set[atlas_id]["RIR"] = {}
-        atlas_image = atlas_set[atlas_id]["Original"]["CT Image"]
-
-        reg_image, _ = linear_registration(
-            img,
-            atlas_image,
-            **quick_reg_settings,
-        )
-
-        registered_crop_images.append(sitk.Cast(reg_image, sitk.sitkFloat32))
-
-        del reg_image
+    crop_atlas_id_list = atlas_id_list[: min([8, len(atlas_id_list)])]
+    logger.info(f"  > atlases {crop_atlas_id_list}")
+
+    registered_crop_images = parallel_map(
+        quick_register_atlas,
+        [atlas_set[atlas_id]["Original"]["CT Image"] for atlas_id in crop_atlas_id_list],
+        executor=executor,
+        max_workers=max_workers,
+        cache=cache,
+        target_image=img,
+        quick_reg_settings=quick_reg_settings,
+    )
 
     combined_image = sum(registered_crop_images) / len(registered_crop_images) > -1000
 
@@ -257,45 +425,21 @@ def run_segmentation(img, settings=MUTLIATLAS_SETTINGS_DEFAULTS):
         f"Running {linear_registration_settings['reg_method']} tranform to align atlas images"
     )
 
-    for atlas_id in atlas_id_list:
-        # Register the atlases
-
-        logger.info(f"  > atlas {atlas_id}")
-
-        atlas_set[atlas_id]["RIR"] = {}
-
-        target_reg_image = img_crop
-        atlas_reg_image = atlas_set[atlas_id]["Original"]["CT Image"]
-
-        _, initial_tfm = linear_registration(
-            target_reg_image,
-            atlas_reg_image,
-            **linear_registration_settings,
-        )
-
-        # Save in the atlas dict
-        atlas_set[atlas_id]["RIR"]["Transform"] = initial_tfm
-
-        atlas_set[atlas_id]["RIR"]["CT Image"] = apply_transform(
-            input_image=atlas_set[atlas_id]["Original"]["CT Image"],
-            reference_image=img_crop,
-            transform=initial_tfm,
-            default_value=-1000,
-            interpolator=sitk.sitkLinear,
-        )
-
-        # sitk.WriteImage(rigid_image, f"./RR_{atlas_id}.nii.gz")
-
-        for struct in atlas_structure_list:
-            input_struct = atlas_set[atlas_id]["Original"][struct]
-            atlas_set[atlas_id]["RIR"][struct] = apply_transform(
-                input_image=input_struct,
-                reference_image=img_crop,
-                transform=initial_tfm,
-                default_value=0,
-                interpolator=sitk.sitkNearestNeighbor,
-            )
+    logger.info(f"  > atlases {atlas_id_list}")
+
+    registered_atlases = parallel_map(
+        register_atlas_linear,
+        [atlas_set[atlas_id]["Original"] for atlas_id in atlas_id_list],
+        executor=executor,
+        max_workers=max_workers,
+        cache=cache,
+        target_image=img_crop,
+        structure_list=atlas_structure_list,
+        linear_registration_settings=linear_registration_settings,
+    )
 
+    for atlas_id, registered_atlas in zip(atlas_id_list, registered_atlases):
+        atlas_set[atlas_id]["RIR"] = registered_atlas
         atlas_set[atlas_id]["Original"] = None
 
     """
@@ -308,41 +452,26 @@ def run_segmentation(img, settings=MUTLIATLAS_SETTINGS_DEFAULTS):
 
     logger.info("Running DIR to refine atlas image registration")
 
-    for atlas_id in atlas_id_list:
-
-        logger.info(f"  > atlas {atlas_id}")
-
-        # Register the atlases
-        atlas_set[atlas_id]["DIR"] = {}
-
-        atlas_reg_image = atlas_set[atlas_id]["RIR"]["CT Image"]
-        target_reg_image = img_crop
-
-        _, dir_tfm, _ = fast_symmetric_forces_demons_registration(
-            target_reg_image,
-            atlas_reg_image,
-            **deformable_registration_settings,
-        )
-
-        # Save in the atlas dict
-        atlas_set[atlas_id]["DIR"]["Transform"] = dir_tfm
-
-        atlas_set[atlas_id]["DIR"]["CT Image"] = apply_transform(
-            input_image=atlas_set[atlas_id]["RIR"]["CT Image"],
-            transform=dir_tfm,
-            default_value=-1000,
-            interpolator=sitk.sitkLinear,
-        )
-
-        for struct in atlas_structure_list:
-            input_struct = atlas_set[atlas_id]["RIR"][struct]
-            atlas_set[atlas_id]["DIR"][struct] = apply_transform(
-                input_image=input_struct,
-                transform=dir_tfm,
-                default_value=0,
-                interpolator=sitk.sitkNearestNeighbor,
-            )
+    logger.info(f"  > atlases {atlas_id_list}")
+
+    # The target image pyramid is the same for every atlas, so only compute it once (before
+    # sending it to the workers)
+    target_pyramid = ImagePyramid(img_crop)
+    target_pyramid.precompute(**deformable_registration_settings)
+
+    registered_atlases = parallel_map(
+        register_atlas_deformable,
+        [atlas_set[atlas_id]["RIR"] for atlas_id in atlas_id_list],
+        executor=executor,
+        max_workers=max_workers,
+        cache=cache,
+        target_image=target_pyramid,
+        structure_list=atlas_structure_list,
+        deformable_registration_settings=deformable_registration_settings,
+    )
 
+    for atlas_id, registered_atlas in zip(atlas_id_list, registered_atlases):
+        atlas_set[atlas_id]["DIR"] = registered_atlas
         atlas_set[atlas_id]["RIR"] = None
 
     """
@@ -435,6 +564,9 @@ def run_segmentation(img, settings=MUTLIATLAS_SETTINGS_DEFAULTS):
             for s in postprocessing_settings["structures_for_overlap_correction"]:
                 results[s] = output_overlap[s]
 
+    if cache is not None:
+        logger.info(f"Registration cache statistics: {cache.statistics}")
+
     logger.info("Done!")
 
     return results, results_prob
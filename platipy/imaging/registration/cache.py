@@ -0,0 +1,249 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import contextlib
+from pathlib import Path
+
+import SimpleITK as sitk
+
+from loguru import logger
+
+from platipy.imaging.registration.utils import compute_image_hash, get_pyramid_image
+
+
+class RegistrationCache:
+    """An on-disk cache of registration transforms (including displacement fields).
+
+    Entries are keyed by a hash of the image content and registration settings, so that
+    registering the same images with the same settings can be skipped. An SQLite index (stored in
+    the cache directory) records the size and last access time of each entry, as well as the
+    number of cache hits and misses. Since the index is shared, the cache can be used from several
+    threads or worker processes at once.
+
+    Args:
+        cache_dir (str | pathlib.Path): The directory in which the cache is stored.
+        max_size_mb (float, optional): The maximum total size of the cached transforms. The least
+            recently used entries are evicted once this is exceeded. Defaults to None (no limit).
+        max_entries (int, optional): The maximum number of cached transforms. The least recently
+            used entries are evicted once this is exceeded. Defaults to None (no limit).
+    """
+
+    def __init__(self, cache_dir, max_size_mb=None, max_entries=None):
+
+        self.cache_dir = Path(cache_dir)
+        self.max_size_mb = max_size_mb
+        self.max_entries = max_entries
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, filename TEXT, size INTEGER, last_access REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS statistics (name TEXT PRIMARY KEY, value INTEGER)"
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO statistics VALUES (?, 0)", [("hits",), ("misses",)]
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Connects to the index, committing any changes and closing the connection on exit"""
+
+        connection = sqlite3.connect(str(self.cache_dir.joinpath("index.sqlite")), timeout=60)
+
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def make_key(*images, **settings):
+        """Generates the cache key for a set of images and settings.
+
+        Args:
+            images (SimpleITK.Image | ImagePyramid): The images (e.g. fixed and moving) used for
+                registration. Image pyramids are keyed by their full resolution image.
+            settings: Any settings which change the result (e.g. the registration parameters).
+
+        Returns:
+            str: The cache key.
+        """
+
+        key_hash = hashlib.sha256()
+
+        for image in images:
+            key_hash.update(compute_image_hash(get_pyramid_image(image)).encode())
+
+        key_hash.update(json.dumps(settings, sort_keys=True, default=str).encode())
+
+        return key_hash.hexdigest()
+
+    def get(self, key):
+        """Reads a transform from the cache.
+
+        Args:
+            key (str): The cache key, see make_key.
+
+        Returns:
+            SimpleITK.Transform | None: The cached transform, or None if it is not in the cache.
+        """
+
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT filename FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is not None and not self.cache_dir.joinpath(row[0]).exists():
+                logger.warning(f"Cached transform missing, removing entry: {row[0]}")
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+
+            if row is None:
+                connection.execute("UPDATE statistics SET value = value + 1 WHERE name = 'misses'")
+                return None
+
+            connection.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            connection.execute("UPDATE statistics SET value = value + 1 WHERE name = 'hits'")
+
+        transform = sitk.ReadTransform(str(self.cache_dir.joinpath(row[0])))
+
+        return transform.Downcast()
+
+    def put(self, key, transform):
+        """Writes a transform to the cache, evicting old entries if required.
+
+        Args:
+            key (str): The cache key, see make_key.
+            transform (SimpleITK.Transform): The transform to store.
+        """
+
+        filename = f"{key}.h5"
+
+        # Write to a temporary file first, so partially written transforms are never read
+        temp_path = self.cache_dir.joinpath(f"{key}.{uuid.uuid4().hex}.tmp.h5")
+        sitk.WriteTransform(transform, str(temp_path))
+        os.replace(temp_path, self.cache_dir.joinpath(filename))
+
+        size = self.cache_dir.joinpath(filename).stat().st_size
+
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (key, filename, size, time.time()),
+            )
+
+            self._evict(connection)
+
+    def _evict(self, connection):
+        """Removes the least recently used entries until the cache is within its limits"""
+
+        if self.max_size_mb is None and self.max_entries is None:
+            return
+
+        entries = connection.execute(
+            "SELECT key, filename, size FROM entries ORDER BY last_access DESC"
+        ).fetchall()
+
+        total_size = 0
+        number_kept = 0
+        for key, filename, size in entries:
+            within_size = (
+                self.max_size_mb is None or total_size + size <= self.max_size_mb * 1024 ** 2
+            )
+            within_count = self.max_entries is None or number_kept < self.max_entries
+
+            # Always keep the most recently used entry
+            if number_kept == 0 or (within_size and within_count):
+                total_size += size
+                number_kept += 1
+                continue
+
+            logger.debug(f"Evicting cached transform: {filename}")
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.cache_dir.joinpath(filename).unlink(missing_ok=True)
+
+    def clear(self):
+        """Removes all entries from the cache and resets the statistics."""
+
+        with self._connect() as connection:
+            for (filename,) in connection.execute("SELECT filename FROM entries").fetchall():
+                self.cache_dir.joinpath(filename).unlink(missing_ok=True)
+
+            connection.execute("DELETE FROM entries")
+            connection.execute("UPDATE statistics SET value = 0")
+
+    @property
+    def statistics(self):
+        """dict: The number of cache hits, misses, entries and the total size (in MB)."""
+
+        with self._connect() as connection:
+            statistics = dict(connection.execute("SELECT name, value FROM statistics").fetchall())
+            entries, size = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+
+        statistics["entries"] = entries
+        statistics["size_mb"] = size / 1024 ** 2
+
+        return statistics
+
+
+def cached_registration(
+    registration_function, fixed_image, moving_image, cache=None, **registration_settings
+):
+    """Runs an image registration, re-using the transform from the cache if possible.
+
+    Args:
+        registration_function (callable): The registration function, e.g. linear_registration
+            or fast_symmetric_forces_demons_registration. This must be called as
+            registration_function(fixed_image, moving_image, **registration_settings) and return
+            the transform as its second output.
+        fixed_image (SimpleITK.Image | ImagePyramid): The fixed (target/primary) image.
+        moving_image (SimpleITK.Image | ImagePyramid): The moving (secondary) image.
+        cache (RegistrationCache, optional): The registration cache. Defaults to None, in which
+            case the registration is always run.
+
+    Returns:
+        SimpleITK.Transform: The registration transform.
+    """
+
+    if cache is None:
+        return registration_function(fixed_image, moving_image, **registration_settings)[1]
+
+    key = cache.make_key(
+        fixed_image,
+        moving_image,
+        registration_function=registration_function.__name__,
+        **registration_settings,
+    )
+
+    transform = cache.get(key)
+
+    if transform is None:
+        transform = registration_function(fixed_image, moving_image, **registration_settings)[1]
+        cache.put(key, transform)
+
+    return transform
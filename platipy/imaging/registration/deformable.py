@@ -16,7 +16,7 @@ import numpy as np
 import SimpleITK as sitk
 
 from platipy.imaging.registration.utils import (
-    smooth_and_resample,
+    ImagePyramid,
     apply_transform,
     registration_command_iteration,
     stage_iteration,
@@ -43,9 +43,10 @@ def multiscale_demons(
         registration_algorithm: Any registration algorithm that has an Execute(fixed_image,
                                 moving_image, displacement_field_image) method.
         fixed_image: Resulting transformation maps points from this image's spatial domain to the
-                     moving image spatial domain.
+                     moving image spatial domain. Can also be an ImagePyramid, so the smoothed and
+                     resampled images are re-used between registrations.
         moving_image: Resulting transformation maps points from the fixed_image's spatial domain to
-                      this image's spatial domain.
+                      this image's spatial domain. Can also be an ImagePyramid.
         initial_transform: Any SimpleITK transform, used to initialize the displacement field.
         initial_displacement_field: Initial displacement field, if this is provided
                                     initial_transform will be ignored
@@ -56,36 +57,18 @@ def multiscale_demons(
         SimpleITK.DisplacementFieldTransform
         [Optional] Displacemment (vector) field
     """
-    # Create image pyramid.
-    fixed_images = []
-    moving_images = []
-
-    for resolution, smoothing_sigma in reversed(list(zip(resolution_staging, smoothing_sigmas))):
-
-        isotropic_voxel_size_mm = None
-        shrink_factor = None
-
-        if isotropic_resample:
-            isotropic_voxel_size_mm = resolution
-        else:
-            shrink_factor = resolution
-
-        fixed_images.append(
-            smooth_and_resample(
-                fixed_image,
-                isotropic_voxel_size_mm=isotropic_voxel_size_mm,
-                shrink_factor=shrink_factor,
-                smoothing_sigma=smoothing_sigma,
-            )
-        )
-        moving_images.append(
-            smooth_and_resample(
-                moving_image,
-                isotropic_voxel_size_mm=isotropic_voxel_size_mm,
-                shrink_factor=shrink_factor,
-                smoothing_sigma=smoothing_sigma,
-            )
-        )
+    # Create image pyramid, re-using any levels which were already computed
+    if not isinstance(fixed_image, ImagePyramid):
+        fixed_image = ImagePyramid(fixed_image, pixel_type=fixed_image.GetPixelID())
+    if not isinstance(moving_image, ImagePyramid):
+        moving_image = ImagePyramid(moving_image, pixel_type=moving_image.GetPixelID())
+
+    fixed_images = fixed_image.precompute(
+        resolution_staging, smoothing_sigmas, isotropic_resample=isotropic_resample
+    )
+    moving_images = moving_image.precompute(
+        resolution_staging, smoothing_sigmas, isotropic_resample=isotropic_resample
+    )
 
     # Create initial displacement field at lowest resolution.
     # Currently, the pixel type is required to be sitkVectorFloat64 because of a constraint imposed
@@ -101,13 +84,13 @@ def multiscale_demons(
                 fixed_images[-1].GetDirection(),
             )
         else:
-            if len(moving_image.GetSize()) == 2:
+            if fixed_images[-1].GetDimension() == 2:
                 initial_displacement_field = sitk.Image(
                     fixed_images[-1].GetWidth(),
                     fixed_images[-1].GetHeight(),
                     sitk.sitkVectorFloat64,
                 )
-            elif len(moving_image.GetSize()) == 3:
+            elif fixed_images[-1].GetDimension() == 3:
                 initial_displacement_field = sitk.Image(
                     fixed_images[-1].GetWidth(),
                     fixed_images[-1].GetHeight(),
@@ -160,9 +143,10 @@ def fast_symmetric_forces_demons_registration(
     Deformable image propagation using Fast Symmetric-Forces Demons
 
     Args
-        fixed_image (sitk.Image)        : the fixed image
+        fixed_image (sitk.Image)        : the fixed image, or an ImagePyramid of the fixed image
+                                          (e.g. the target shared by several atlases)
         moving_image (sitk.Image)       : the moving image, to be deformable registered (must be in
-                                          the same image space)
+                                          the same image space), or an ImagePyramid of it
         resolution_staging (list[int])   : down-sampling factor for each resolution level
         iteration_staging (list[int])    : number of iterations for each resolution level
         isotropic_resample (bool)        : flag to request isotropic resampling of images, in which
@@ -185,13 +169,15 @@ def fast_symmetric_forces_demons_registration(
     """
 
     # Cast to floating point representation, if necessary
+    if not isinstance(fixed_image, ImagePyramid):
+        fixed_image = ImagePyramid(fixed_image)
+    if not isinstance(moving_image, ImagePyramid):
+        moving_image = ImagePyramid(moving_image)
 
-    moving_image_type = moving_image.GetPixelID()
+    fixed_pyramid, fixed_image = fixed_image, fixed_image.image
+    moving_pyramid, moving_image = moving_image, moving_image.image
 
-    if fixed_image.GetPixelID() != 6:
-        fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
-    if moving_image.GetPixelID() != 6:
-        moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
+    moving_image_type = moving_pyramid.original_pixel_id
 
     # Set up the appropriate image filter
     registration_method = sitk.FastSymmetricForcesDemonsRegistrationFilter()
@@ -214,8 +200,8 @@ def fast_symmetric_forces_demons_registration(
 
     output_transform, deformation_field = multiscale_demons(
         registration_algorithm=registration_method,
-        fixed_image=fixed_image,
-        moving_image=moving_image,
+        fixed_image=fixed_pyramid,
+        moving_image=moving_pyramid,
         resolution_staging=resolution_staging,
         smoothing_sigmas=smoothing_sigmas,
         iteration_staging=iteration_staging,
@@ -275,8 +261,9 @@ def bspline_registration(
     IMPORTANT - THIS IS UNDER ACTIVE DEVELOPMENT
 
     Args:
-        fixed_image ([SimpleITK.Image]): The fixed (target/primary) image.
-        moving_image ([SimpleITK.Image]): The moving (secondary) image.
+        fixed_image ([SimpleITK.Image]): The fixed (target/primary) image, or an ImagePyramid of
+                                         it (used when isotropic_resample is set).
+        moving_image ([SimpleITK.Image]): The moving (secondary) image, or an ImagePyramid of it.
         fixed_structure (bool, optional): If defined, a binary SimpleITK.Image used to mask metric
                                           evaluation for the moving image. Defaults to False.
         moving_structure (bool, optional): If defined, a binary SimpleITK.Image used to mask metric
@@ -338,10 +325,15 @@ def bspline_registration(
     """
 
     # Re-cast input images
-    fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
+    if not isinstance(fixed_image, ImagePyramid):
+        fixed_image = ImagePyramid(fixed_image)
+    if not isinstance(moving_image, ImagePyramid):
+        moving_image = ImagePyramid(moving_image)
+
+    fixed_pyramid, fixed_image = fixed_image, fixed_image.image
+    moving_pyramid, moving_image = moving_image, moving_image.image
 
-    moving_image_type = moving_image.GetPixelID()
-    moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
+    moving_image_type = moving_pyramid.original_pixel_id
 
     # (Optional) isotropic resample
     # This changes the behaviour, so care should be taken
@@ -350,17 +342,9 @@ def bspline_registration(
     if isotropic_resample:
         # First, copy the fixed image so we can resample back into this space at the end
         fixed_image_original = fixed_image
-        fixed_image_original.MakeUnique()
 
-        fixed_image = smooth_and_resample(
-            fixed_image,
-            isotropic_voxel_size_mm=initial_isotropic_size,
-        )
-
-        moving_image = smooth_and_resample(
-            moving_image,
-            isotropic_voxel_size_mm=initial_isotropic_size,
-        )
+        fixed_image = fixed_pyramid.get_level(isotropic_voxel_size_mm=initial_isotropic_size)
+        moving_image = moving_pyramid.get_level(isotropic_voxel_size_mm=initial_isotropic_size)
 
     else:
         fixed_image_original = fixed_image
@@ -12,11 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import itertools
+import threading
+
 import numpy as np
 import SimpleITK as sitk
 
 from loguru import logger
 
+from platipy.imaging.utils.crop import label_to_slices
+
 
 def registration_command_iteration(method):
     """
@@ -191,6 +197,212 @@ def apply_transform(
     return output_image
 
 
+def _encode_labels(label_list):
+    """Encodes up to 31 binary labels as the bits of a single (uint32) image, as in
+    binary_encode_structure_list"""
+
+    encoded_arr = np.zeros(label_list[0].GetSize()[::-1], dtype=np.uint32)
+
+    for power, label in enumerate(label_list):
+        encoded_arr |= (sitk.GetArrayViewFromImage(label) != 0).astype(np.uint32) << (power + 1)
+
+    encoded_image = sitk.GetImageFromArray(encoded_arr)
+    encoded_image.CopyInformation(label_list[0])
+
+    return encoded_image
+
+
+def _transform_grid_to_continuous_index(input_image, reference_image, transform=None):
+    """Maps each voxel of the reference image to a continuous index (x, y, z) of the input image,
+    evaluating the transform once for every voxel"""
+
+    dimension = reference_image.GetDimension()
+    if transform is None:
+        transform = sitk.Transform(dimension, sitk.sitkIdentity)
+
+    displacement_field = sitk.TransformToDisplacementField(
+        transform,
+        sitk.sitkVectorFloat64,
+        reference_image.GetSize(),
+        reference_image.GetOrigin(),
+        reference_image.GetSpacing(),
+        reference_image.GetDirection(),
+    )
+    points = sitk.GetArrayFromImage(displacement_field).reshape(-1, dimension)
+
+    index = np.indices(reference_image.GetSize()[::-1]).reshape(dimension, -1)[::-1].T
+    reference_direction = np.array(reference_image.GetDirection()).reshape(dimension, dimension)
+    points += (index * reference_image.GetSpacing()) @ reference_direction.T
+    points += reference_image.GetOrigin()
+
+    input_direction = np.array(input_image.GetDirection()).reshape(dimension, dimension)
+    points -= input_image.GetOrigin()
+
+    return (points @ input_direction) / input_image.GetSpacing()
+
+
+def _linear_resample_label(label_arr, continuous_index, slice_index, positions, number_of_points):
+    """Linearly interpolates a label array at continuous indices (x, y, z) with the same boundary
+    handling as ITK, only evaluating points near the label.
+
+    Args:
+        label_arr (np.ndarray): The label array.
+        continuous_index (np.ndarray): The (N, 3) continuous indices of the points inside the
+            image, sorted by slice.
+        slice_index (np.ndarray): The (sorted) slice (floor of the z index) of each point.
+        positions (np.ndarray): The position of each point in the output.
+        number_of_points (int): The number of points in the output.
+
+    Returns:
+        np.ndarray: The interpolated values.
+    """
+
+    values = np.zeros(number_of_points, dtype=np.float32)
+
+    label_box = label_to_slices(label_arr)
+    if label_box is None:
+        return values
+
+    # Points further than one voxel from the label are zero
+    lower = np.array([b.start for b in label_box[::-1]]) - 1
+    upper = np.array([b.stop for b in label_box[::-1]])
+
+    slab = slice(
+        np.searchsorted(slice_index, lower[2], side="left"),
+        np.searchsorted(slice_index, upper[2] - 1, side="right"),
+    )
+    near = np.all((continuous_index[slab] > lower) & (continuous_index[slab] < upper), axis=1)
+
+    size = np.array(label_arr.shape[::-1])
+    point_index = np.clip(continuous_index[slab][near], 0, size - 1)
+    base_index = np.floor(point_index).astype(int)
+    fraction = point_index - base_index
+
+    point_values = np.zeros(len(point_index))
+    for corner in itertools.product((0, 1), repeat=label_arr.ndim):
+        corner_index = np.minimum(base_index + corner, size - 1)
+        corner_weight = np.prod(np.where(corner, fraction, 1 - fraction), axis=1)
+        point_values += corner_weight * label_arr[tuple(corner_index.T[::-1])]
+
+    values[positions[slab][near]] = point_values
+
+    return values
+
+
+def apply_transform_to_labels(
+    label_dict,
+    reference_image=None,
+    transform=None,
+    interpolator=sitk.sitkNearestNeighbor,
+):
+    """
+    Transform several labels (structures) at once, evaluating the transform only once.
+
+    With nearest neighbour interpolation, the (binary) labels are encoded as the bits of a
+    single image (see binary_encode_structure_list), which is resampled once and then decoded.
+    The result is the same as resampling each label with apply_transform. Labels which are not
+    binary (i.e. which contain more than one non-zero value) are resampled individually.
+
+    With linear interpolation, the transform is evaluated once on the reference grid and each
+    label is interpolated (as a float32 probability) only near the label.
+
+    Args
+        label_dict (dict): The labels (SimpleITK.Image) to transform, e.g. {structure: label}.
+            All labels must share the same image space.
+        reference_image (SimpleITK.Image): The labels will be resampled into this reference
+            space. Defaults to None, in which case the label image space is used.
+        transform (SimpleITK.Transform): The transformation
+        interpolator (int, optional): The interpolation order.
+                                Available options:
+                                    - SimpleITK.sitkNearestNeighbor
+                                    - SimpleITK.sitkLinear
+                                Defaults to SimpleITK.sitkNearestNeighbor
+
+    Returns
+        (dict): The transformed labels, with the same keys as label_dict
+    """
+
+    if len(label_dict) == 0:
+        return {}
+
+    label_names = list(label_dict.keys())
+    input_image = label_dict[label_names[0]]
+
+    if reference_image is None:
+        reference_image = input_image
+
+    output_label_dict = {}
+
+    if interpolator == sitk.sitkNearestNeighbor:
+        binary_names = []
+        for label_name in label_names:
+            label_arr = sitk.GetArrayViewFromImage(label_dict[label_name])
+            label_values = label_arr[label_arr != 0]
+
+            if len(label_values) > 0 and np.any(label_values != label_values[0]):
+                output_label_dict[label_name] = apply_transform(
+                    label_dict[label_name], reference_image, transform
+                )
+            else:
+                binary_names.append(label_name)
+
+        # The encoded image has 32 bits, the lowest is not used
+        for chunk_start in range(0, len(binary_names), 31):
+            chunk_names = binary_names[chunk_start : chunk_start + 31]
+
+            encoded_image = apply_transform(
+                _encode_labels([label_dict[i] for i in chunk_names]), reference_image, transform
+            )
+            encoded_arr = sitk.GetArrayViewFromImage(encoded_image)
+
+            for power, label_name in enumerate(chunk_names):
+                label = label_dict[label_name]
+                label_arr = sitk.GetArrayViewFromImage(label)
+                label_value = label_arr.max()
+
+                decoded_arr = ((encoded_arr >> (power + 1)) & 1) * label_value
+
+                output_label = sitk.GetImageFromArray(decoded_arr.astype(label_arr.dtype))
+                output_label.CopyInformation(reference_image)
+                output_label_dict[label_name] = output_label
+
+    elif interpolator == sitk.sitkLinear:
+        continuous_index = _transform_grid_to_continuous_index(
+            input_image, reference_image, transform
+        )
+
+        # As in ITK, points within half a voxel of the image edge are inside the image
+        input_size = np.array(input_image.GetSize())
+        inside = np.all((continuous_index >= -0.5) & (continuous_index < input_size - 0.5), axis=1)
+
+        # Sort the points by slice, so the points near each label can be found quickly
+        positions = np.flatnonzero(inside)
+        slice_index = np.floor(continuous_index[positions, 2]).astype(np.int32)
+        order = np.argsort(slice_index, kind="stable")
+        positions = positions[order]
+        slice_index = slice_index[order]
+        continuous_index = continuous_index[positions]
+
+        for label_name in label_names:
+            label_arr = sitk.GetArrayViewFromImage(label_dict[label_name])
+            output_arr = _linear_resample_label(
+                label_arr, continuous_index, slice_index, positions, len(inside)
+            )
+
+            output_label = sitk.GetImageFromArray(
+                output_arr.reshape(reference_image.GetSize()[::-1])
+            )
+            output_label.CopyInformation(reference_image)
+            output_label_dict[label_name] = output_label
+
+    else:
+        raise ValueError(
+            "Labels can only be transformed with nearest neighbour or linear interpolation"
+        )
+
+    return {label_name: output_label_dict[label_name] for label_name in label_names}
+
+
 def smooth_and_resample(
     image,
     isotropic_voxel_size_mm=None,
@@ -266,6 +478,169 @@ def smooth_and_resample(
     )
 
 
+def compute_image_hash(image):
+    """Computes a hash of the image content and geometry.
+
+    Args:
+        image (SimpleITK.Image): The image to hash.
+
+    Returns:
+        str: The (hex) SHA-256 digest.
+    """
+
+    image_hash = hashlib.sha256()
+
+    image_hash.update(str(image.GetPixelIDValue()).encode())
+    for geometry in [image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection()]:
+        image_hash.update(repr(tuple(geometry)).encode())
+
+    image_hash.update(sitk.GetArrayViewFromImage(image).tobytes())
+
+    return image_hash.hexdigest()
+
+
+def _as_hashable(value):
+    """Converts lists (e.g. per-axis shrink factors or smoothing sigmas) to tuples"""
+
+    if hasattr(value, "__iter__"):
+        return tuple(value)
+
+    return value
+
+
+class ImagePyramid:
+    """A multi-resolution image pyramid, where each level is computed (using smooth_and_resample)
+    the first time it is requested and then re-used.
+
+    When registering several moving images to the same fixed image (e.g. atlases to a target),
+    the fixed image pyramid can be created once and passed to each registration. The pyramid can
+    be shared between threads. It can also be pickled to send to worker processes, along with the
+    levels computed so far: levels computed by a worker process aren't sent back, so use
+    precompute before sending the pyramid to share the levels between processes.
+
+    Args:
+        image (SimpleITK.Image): The full resolution image.
+        pixel_type (int, optional): The pixel type the image is cast to (registration runs on
+            floating point images). Defaults to sitk.sitkFloat32.
+    """
+
+    def __init__(self, image, pixel_type=sitk.sitkFloat32):
+
+        self.original_pixel_id = image.GetPixelID()
+
+        if image.GetPixelID() != pixel_type:
+            image = sitk.Cast(image, pixel_type)
+
+        self.image = image
+        self._levels = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._levels)
+
+    def get_level(self, isotropic_voxel_size_mm=None, shrink_factor=None, smoothing_sigma=None):
+        """Gets a level of the pyramid, computing it if necessary.
+
+        Args:
+            isotropic_voxel_size_mm (float | None): New voxel size in millimetres
+            shrink_factor (list | float): The shrink factor, see smooth_and_resample.
+            smoothing_sigma (list | float): The scale for Gaussian smoothing, see
+                smooth_and_resample.
+
+        Returns:
+            SimpleITK.Image: The smoothed and resampled image.
+        """
+
+        key = (
+            _as_hashable(isotropic_voxel_size_mm),
+            _as_hashable(shrink_factor),
+            _as_hashable(smoothing_sigma),
+        )
+
+        with self._lock:
+            if key not in self._levels:
+                self._levels[key] = smooth_and_resample(
+                    self.image,
+                    isotropic_voxel_size_mm=isotropic_voxel_size_mm,
+                    shrink_factor=shrink_factor,
+                    smoothing_sigma=smoothing_sigma,
+                )
+
+            return self._levels[key]
+
+    def precompute(
+        self,
+        resolution_staging=(8, 4, 1),
+        smoothing_sigmas=None,
+        smoothing_sigma_factor=1,
+        isotropic_resample=False,
+        **registration_settings,
+    ):
+        """Computes the levels used by a multi-resolution (demons) registration, see
+        multiscale_demons.
+
+        Other registration settings are ignored, so the settings passed to
+        fast_symmetric_forces_demons_registration can be passed as they are.
+
+        Args:
+            resolution_staging (list, optional): The shrink factor (or voxel size in millimetres,
+                if isotropic_resample is set) of each level. Defaults to (8, 4, 1).
+            smoothing_sigmas (list, optional): The smoothing sigma of each level. Defaults to
+                None, in which case the sigmas are the resolution_staging multiplied by the
+                smoothing_sigma_factor (as in fast_symmetric_forces_demons_registration).
+            smoothing_sigma_factor (float, optional): The relative width of the smoothing kernel.
+                Defaults to 1.
+            isotropic_resample (bool, optional): Whether the resolution_staging defines voxel
+                sizes. Defaults to False.
+            registration_settings: Other registration settings (ignored).
+
+        Returns:
+            list: The levels (SimpleITK.Image), in the reverse order of resolution_staging.
+        """
+
+        if not smoothing_sigmas:
+            smoothing_sigmas = [i * smoothing_sigma_factor for i in resolution_staging]
+
+        levels = []
+        for resolution, smoothing_sigma in reversed(
+            list(zip(resolution_staging, smoothing_sigmas))
+        ):
+            levels.append(
+                self.get_level(
+                    isotropic_voxel_size_mm=resolution if isotropic_resample else None,
+                    shrink_factor=None if isotropic_resample else resolution,
+                    smoothing_sigma=smoothing_sigma,
+                )
+            )
+
+        return levels
+
+
+def get_pyramid_image(image):
+    """Gets the full resolution image, from either an image or an ImagePyramid.
+
+    Args:
+        image (SimpleITK.Image | ImagePyramid): The image or image pyramid.
+
+    Returns:
+        SimpleITK.Image: The image.
+    """
+
+    if isinstance(image, ImagePyramid):
+        return image.image
+
+    return image
+
+
 def convert_mask_to_distance_map(mask, squared_distance=False, normalise=False):
     """
     Generate a distance map from a binary label.
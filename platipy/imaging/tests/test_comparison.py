@@ -0,0 +1,183 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import pytest
+
+import SimpleITK as sitk
+import numpy as np
+
+from platipy.imaging.label.comparison import (
+    compute_comparison_metrics,
+    compute_comparison_metrics_table,
+    compute_multi_label_volume_metrics,
+    compute_surface_metrics,
+    compute_volume_metrics,
+)
+from platipy.imaging.label.utils import binary_encode_structure_list
+
+
+def generate_sphere(center, radius, shape=(40, 60, 60)):
+
+    z, y, x = np.mgrid[: shape[0], : shape[1], : shape[2]]
+    arr = ((z - center[0]) * 2.5) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 < radius**2
+
+    label = sitk.GetImageFromArray(arr.astype(np.uint8))
+    label.SetSpacing((1, 1, 2.5))
+
+    return label
+
+
+@pytest.fixture
+def label_pair():
+
+    return generate_sphere((20, 30, 30), 18), generate_sphere((21, 32, 29), 15)
+
+
+def test_compute_comparison_metrics(label_pair):
+
+    label_a, label_b = label_pair
+
+    metrics = compute_comparison_metrics(label_a, label_b, tolerance_mm=2.0)
+
+    volume_metrics = compute_volume_metrics(label_a, label_b)
+    for metric, value in volume_metrics.items():
+        assert np.isclose(metrics[metric], value)
+
+    surface_metrics = compute_surface_metrics(label_a, label_b)
+    assert np.isclose(metrics["hausdorffDistance"], surface_metrics["hausdorffDistance"], atol=0.1)
+    assert np.isclose(metrics["meanSurfaceDistance"], surface_metrics["meanSurfaceDistance"])
+
+    assert metrics["hausdorffDistance95"] <= metrics["hausdorffDistance"]
+    assert 0 < metrics["surfaceDSC"] < 1
+
+
+def test_compute_comparison_metrics_hausdorff_hole():
+
+    # The Hausdorff distance is reached inside the hole of label_a, not on the surface of label_b
+    label_a = generate_sphere((20, 30, 30), 20) - generate_sphere((20, 30, 30), 12)
+    label_b = generate_sphere((20, 30, 30), 18)
+
+    hausdorff_distance = sitk.HausdorffDistanceImageFilter()
+    hausdorff_distance.Execute(label_a, label_b)
+
+    metrics = compute_comparison_metrics(label_a, label_b)
+    assert np.isclose(
+        metrics["hausdorffDistance"], hausdorff_distance.GetHausdorffDistance(), atol=0.1
+    )
+
+
+def test_compute_comparison_metrics_empty(label_pair):
+
+    label_a, _ = label_pair
+    label_empty = label_a * 0
+
+    metrics = compute_comparison_metrics(label_a, label_empty)
+
+    assert metrics["DSC"] == 0
+    assert np.isnan(metrics["hausdorffDistance"])
+    assert np.isnan(metrics["surfaceDSC"])
+
+
+@pytest.mark.parametrize("executor", ["serial", "thread"])
+def test_compute_comparison_metrics_table(label_pair, executor):
+
+    label_a, label_b = label_pair
+
+    label_sets = {
+        "observer_1": {"HEART": label_a, "LUNG": label_b},
+        "observer_2": {"HEART": label_b, "LUNG": label_a},
+        "observer_3": {"HEART": label_a},
+    }
+
+    df_metrics = compute_comparison_metrics_table(label_sets, executor=executor)
+
+    assert list(df_metrics.columns) == ["structure", "observer_a", "observer_b", "metric", "value"]
+
+    df_dsc = df_metrics[df_metrics.metric == "DSC"]
+    assert len(df_dsc) == 4
+    assert df_dsc[df_dsc.observer_b == "observer_3"].value.tolist() == [
+        compute_comparison_metrics(label_a, label_a)["DSC"],
+        compute_comparison_metrics(label_b, label_a)["DSC"],
+    ]
+
+
+@pytest.mark.parametrize("encoding", ["label", "binary", "prime"])
+def test_compute_multi_label_volume_metrics(encoding):
+
+    structure_list_a = [
+        generate_sphere((20, 30, 30), 18),
+        generate_sphere((10, 20, 20), 8),
+        generate_sphere((30, 40, 40), 10),
+    ]
+    structure_list_b = [
+        generate_sphere((21, 32, 29), 15),
+        generate_sphere((11, 20, 21), 9),
+        generate_sphere((30, 40, 40), 0),
+    ]
+
+    if encoding == "label":
+        # Structures can't overlap in a multi-label image
+        structure_list_a[0] = sitk.MaskNegated(structure_list_a[0], structure_list_a[1])
+        structure_list_b[0] = sitk.MaskNegated(structure_list_b[0], structure_list_b[1])
+        encode = lambda structure_list: sum(s * (i + 1) for i, s in enumerate(structure_list))
+    elif encoding == "binary":
+        encode = binary_encode_structure_list
+    else:
+
+        def encode(structure_list):
+            arr = np.ones(structure_list[0].GetSize()[::-1], dtype=np.uint64)
+            for prime, s in zip([2, 3, 5], structure_list):
+                arr[sitk.GetArrayFromImage(s) > 0] *= prime
+            prime_encoded_image = sitk.GetImageFromArray(arr)
+            prime_encoded_image.CopyInformation(structure_list[0])
+            return prime_encoded_image
+
+    df_metrics = compute_multi_label_volume_metrics(
+        encode(structure_list_a),
+        encode(structure_list_b),
+        encoding=encoding,
+        structure_names=["A", "B", "C"],
+    )
+
+    assert list(df_metrics.index) == ["A", "B", "C"]
+    for name, label_a, label_b in zip(df_metrics.index, structure_list_a, structure_list_b):
+        metrics = compute_comparison_metrics(label_a, label_b)
+        for metric, value in df_metrics.loc[name].items():
+            assert np.isclose(value, metrics[metric], equal_nan=True)
+
+    # The number of structures is found from the images
+    df_metrics = compute_multi_label_volume_metrics(
+        encode(structure_list_a), encode(structure_list_b), encoding=encoding
+    )
+    assert list(df_metrics.index) == [1, 2, 3]
+
+
+def test_compute_multi_label_volume_metrics_many_structures():
+
+    # More than 32 structures are binary encoded as a 64 bit image
+    structure_list = [
+        generate_sphere((5 + (i % 6) * 6, 10 + (i // 6) * 6, 30), 3, shape=(40, 60, 60))
+        for i in range(40)
+    ]
+    encoded = binary_encode_structure_list(structure_list)
+    assert encoded.GetPixelID() == sitk.sitkUInt64
+
+    df_metrics = compute_multi_label_volume_metrics(encoded, encoded, encoding="binary")
+
+    assert list(df_metrics.index) == list(range(1, 41))
+    assert np.allclose(df_metrics.DSC, 1)
+    for structure, volume in zip(structure_list, df_metrics.volumeA):
+        assert np.isclose(volume, sitk.GetArrayViewFromImage(structure).sum() * 2.5 / 1000)
@@ -21,7 +21,13 @@ import numpy as np
 
 from platipy.imaging.tests.data import get_hn_nifti
 
-from platipy.imaging.dose.dvh import calculate_dvh_for_labels, calculate_d_x, calculate_v_x
+from platipy.imaging.dose.dvh import (
+    calculate_dvh,
+    calculate_dvh_array,
+    calculate_dvh_for_labels,
+    calculate_d_x,
+    calculate_v_x,
+)
 
 
 @pytest.fixture
@@ -105,3 +111,43 @@ def test_compute_v_metric(nifti_data):
         ],
         atol=1e-4,
     )
+
+
+def test_calculate_dvh_array():
+
+    z, y, x = np.mgrid[:30, :40, :40]
+    dose_arr = 50 * np.exp(-((z - 15) ** 2 + (y - 20) ** 2 + (x - 20) ** 2) / 200.0)
+    # Include some doses exactly on the bin edges
+    dose_arr[0, 0, :10] = np.arange(10) * 0.1 + 0.05
+
+    dose = sitk.GetImageFromArray(dose_arr.astype(np.float32))
+    dose.SetSpacing((2, 2, 2.5))
+
+    labels = {}
+    for name, (c_z, c_y, c_x, r) in {
+        "A": (15, 20, 20, 10),
+        "B": (10, 15, 25, 6),
+        "C": (20, 30, 10, 8),
+    }.items():
+        mask = sitk.GetImageFromArray(
+            ((z - c_z) ** 2 + (y - c_y) ** 2 + (x - c_x) ** 2 < r**2).astype(np.uint8)
+        )
+        mask.CopyInformation(dose)
+        labels[name] = mask
+
+    bins, values, mean_dose, volume_cc = calculate_dvh_array(dose, labels, bin_width=0.1)
+    assert values.shape == (3, len(bins))
+
+    bin_edges = np.arange(-0.05, dose_arr.max() + 0.1, 0.1)
+    for label_index, mask in enumerate(labels.values()):
+        expected_bins, expected_values = calculate_dvh(dose, mask, bins=bin_edges)
+        mask_arr = sitk.GetArrayFromImage(mask) > 0
+
+        assert np.allclose(bins, expected_bins)
+        assert np.array_equal(values[label_index], expected_values)
+        assert np.isclose(mean_dose[label_index], dose_arr[mask_arr].astype(np.float32).mean())
+        assert np.isclose(volume_cc[label_index], mask_arr.sum() * 0.2 * 0.2 * 0.25)
+
+    dvh = calculate_dvh_for_labels(dose, labels)
+    assert list(dvh.label) == ["A", "B", "C"]
+    assert np.array_equal(dvh[bins].to_numpy(), values)
@@ -0,0 +1,168 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import warnings
+
+import pytest
+
+import SimpleITK as sitk
+import numpy as np
+
+from scipy.stats import pearsonr
+from skimage.util.shape import view_as_windows
+
+from platipy.imaging.label.fusion import combine_labels, compute_weight_map, local_correlation
+
+
+def patch_correlation_loop(arr_a, arr_b, window_shape):
+    """Reference implementation, computing the correlation one patch at a time"""
+
+    shape = arr_a.shape
+    padder = [((i - 1) // 2, (i) // 2) for i in window_shape]
+    arr_mask = np.pad(0 * arr_a + 1, padder)
+    arr_a = np.pad(arr_a, padder)
+    arr_b = np.pad(arr_b, padder)
+
+    new_shape = (-1, np.prod(window_shape))
+    view_a = np.reshape(view_as_windows(arr_a, window_shape), new_shape)
+    view_b = np.reshape(view_as_windows(arr_b, window_shape), new_shape)
+    view_mask = np.reshape(view_as_windows(arr_mask, window_shape), new_shape)
+
+    corr_values = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for i in range(view_a.shape[0]):
+            patch_mask = np.where(view_mask[i])
+            sr, _ = pearsonr(view_a[i][patch_mask], view_b[i][patch_mask])
+            corr_values.append(sr)
+
+    corr_arr = np.reshape(corr_values, shape)
+    corr_arr[np.isnan(corr_arr)] = 0
+
+    return corr_arr
+
+
+@pytest.fixture
+def image_pair():
+
+    rng = np.random.default_rng(42)
+
+    arr_a = rng.normal(loc=100, scale=20, size=(16, 20, 18))
+    arr_b = 0.5 * arr_a + rng.normal(loc=0, scale=10, size=arr_a.shape)
+
+    # Include a constant region, where the correlation is not defined
+    arr_a[:6, :6, :6] = 50
+    arr_b[:6, :6, :6] = 50
+
+    return arr_a, arr_b
+
+
+@pytest.mark.parametrize("window_shape", [(5, 5, 5), (4, 7, 6)])
+def test_local_correlation_matches_loop(image_pair, window_shape):
+
+    arr_a, arr_b = image_pair
+
+    corr_loop = patch_correlation_loop(arr_a, arr_b, window_shape)
+    corr_vectorised = local_correlation(arr_a, arr_b, window_shape)
+
+    assert corr_vectorised.shape == arr_a.shape
+    assert np.allclose(corr_loop, corr_vectorised, atol=1e-8)
+
+
+def test_patch_correlation_weight_map(image_pair):
+
+    arr_a, arr_b = image_pair
+
+    img_a = sitk.GetImageFromArray(arr_a)
+    img_b = sitk.GetImageFromArray(arr_b)
+    img_a.SetSpacing((3, 3, 3))
+    img_b.SetSpacing((3, 3, 3))
+
+    vote_params = {
+        "patch_window_mm": 15,
+        "resampled_voxel_size_mm": 3,
+        "correlation_function": lambda x: x + 1,
+    }
+
+    weight_map = compute_weight_map(
+        img_a, img_b, vote_type="patch_correlation", vote_params=vote_params
+    )
+    arr_weight = sitk.GetArrayFromImage(weight_map)
+
+    assert weight_map.GetSize() == img_a.GetSize()
+    assert arr_weight.min() >= 0
+    assert arr_weight.max() <= 2
+
+
+def combine_labels_full(atlas_set, structure_name, threshold=1e-4, smooth_sigma=1.0):
+    """Reference implementation, combining each structure using full-size images"""
+
+    valid_case_id_list = [i for i in atlas_set if structure_name in atlas_set[i]["DIR"]]
+    weight_image_list = [atlas_set[i]["DIR"]["Weight Map"] for i in valid_case_id_list]
+    weighted_labels = [
+        atlas_set[i]["DIR"]["Weight Map"]
+        * sitk.Cast(atlas_set[i]["DIR"][structure_name], sitk.sitkFloat32)
+        for i in valid_case_id_list
+    ]
+
+    weight_sum_image = sum(weight_image_list[1:], weight_image_list[0])
+    weight_sum_image = sitk.Mask(
+        weight_sum_image, weight_sum_image == 0, maskingValue=1, outsideValue=1
+    )
+
+    combined_label = sum(weighted_labels[1:], weighted_labels[0]) / weight_sum_image
+    combined_label = sitk.DiscreteGaussian(combined_label, smooth_sigma * smooth_sigma)
+    combined_label = sitk.RescaleIntensity(combined_label, 0, 1)
+
+    return sitk.Threshold(combined_label, lower=threshold, upper=1, outsideValue=0.0)
+
+
+def test_combine_labels():
+
+    rng = np.random.default_rng(42)
+    z, y, x = np.mgrid[:30, :80, :70]
+
+    atlas_set = {}
+    for atlas_index in range(4):
+        atlas = {}
+
+        # The second structure touches the edge of the image, and is missing from one atlas
+        for structure_name, center in [("A", (15, 30, 30)), ("B", (20, 70, 10))]:
+            if structure_name == "B" and atlas_index == 2:
+                continue
+
+            center = np.array(center) + rng.normal(0, 1, 3)
+            arr = ((z - center[0]) * 2) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 < 100
+            atlas[structure_name] = sitk.GetImageFromArray(arr.astype(np.uint8))
+
+        atlas["Weight Map"] = sitk.GetImageFromArray(
+            rng.uniform(0.5, 2, size=z.shape).astype(np.float32)
+        )
+
+        for image in atlas.values():
+            image.SetSpacing((0.8, 0.8, 2))
+
+        atlas_set[f"ATLAS_{atlas_index}"] = {"DIR": atlas}
+
+    combined_label_dict = combine_labels(atlas_set, ["A", "B"])
+
+    for structure_name, combined_label in combined_label_dict.items():
+        expected_label = combine_labels_full(atlas_set, structure_name)
+
+        assert combined_label.GetSpacing() == expected_label.GetSpacing()
+        assert np.allclose(
+            sitk.GetArrayFromImage(combined_label), sitk.GetArrayFromImage(expected_label)
+        )
@@ -0,0 +1,80 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import pytest
+
+import SimpleITK as sitk
+import numpy as np
+
+from platipy.imaging.label.iar import (
+    leave_one_out_mean_std,
+    leave_one_out_median,
+    leave_one_out_median_absolute_deviation,
+    median_absolute_deviation,
+    run_iar,
+)
+
+
+@pytest.mark.parametrize("number_of_atlases", [2, 5, 8])
+def test_leave_one_out_statistics(number_of_atlases):
+
+    rng = np.random.default_rng(number_of_atlases)
+
+    for values in [
+        rng.normal(size=(number_of_atlases, 200)),
+        rng.integers(0, 3, size=(number_of_atlases, 10, 20)).astype(float),
+    ]:
+        remaining_values = [np.delete(values, i, axis=0) for i in range(number_of_atlases)]
+
+        assert np.allclose(
+            leave_one_out_median(values), [np.median(v, axis=0) for v in remaining_values]
+        )
+        assert np.allclose(
+            leave_one_out_median_absolute_deviation(values),
+            [median_absolute_deviation(v, axis=0) for v in remaining_values],
+        )
+
+        mean, std = leave_one_out_mean_std(values)
+        expected_std = np.array([np.std(v, axis=0) for v in remaining_values])
+        assert np.allclose(mean, [np.mean(v, axis=0) for v in remaining_values])
+        assert np.allclose(std, expected_std)
+        assert np.array_equal(std == 0, expected_std == 0)
+
+
+@pytest.mark.parametrize("executor", ["serial", "thread"])
+def test_run_iar(executor):
+
+    rng = np.random.default_rng(42)
+    z, y, x = np.mgrid[:40, :60, :60]
+
+    atlas_set = {}
+    for atlas_index in range(12):
+        center = np.array([20, 30, 30]) + rng.normal(0, 0.5, 3)
+        radius = 20 if atlas_index == 3 else 12 + rng.normal(0, 0.3)
+
+        arr = (z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 < radius**2
+        label = sitk.GetImageFromArray(arr.astype(np.uint8))
+
+        atlas_set[f"ATLAS_{atlas_index}"] = {
+            "DIR": {"HEART": label, "Weight Map": sitk.Cast(label * 0 + 1, sitk.sitkFloat32)}
+        }
+
+    atlas_set_iar = run_iar(
+        atlas_set, "HEART", min_best_atlases=5, single_step=True, executor=executor
+    )
+
+    assert "ATLAS_3" not in atlas_set_iar
+    assert "ATLAS_0" in atlas_set_iar
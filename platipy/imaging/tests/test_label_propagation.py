@@ -0,0 +1,123 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import pytest
+
+import SimpleITK as sitk
+import numpy as np
+
+from platipy.imaging.registration.utils import apply_transform, apply_transform_to_labels
+
+
+def generate_sphere(center, radius, shape=(30, 40, 40)):
+
+    z, y, x = np.mgrid[: shape[0], : shape[1], : shape[2]]
+    arr = ((z - center[0]) * 2) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 < radius**2
+
+    label = sitk.GetImageFromArray(arr.astype(np.uint8))
+    label.SetSpacing((1, 1, 2))
+    label.SetOrigin((-20, -20, -30))
+
+    return label
+
+
+@pytest.fixture
+def label_dict():
+
+    label_dict = {
+        f"STRUCTURE_{i}": generate_sphere((15 + i % 3, 20 - i, 18 + i), 4 + i) for i in range(8)
+    }
+
+    # A label which isn't binary, and an empty label
+    label_dict["MULTI"] = label_dict["STRUCTURE_0"] * 3 + label_dict["STRUCTURE_1"]
+    label_dict["EMPTY"] = label_dict["STRUCTURE_0"] * 0
+
+    return label_dict
+
+
+def get_transforms(reference_image):
+
+    rng = np.random.default_rng(3)
+    field_arr = rng.normal(0, 1.5, reference_image.GetSize()[::-1] + (3,))
+    field = sitk.GetImageFromArray(field_arr, isVector=True)
+    field.CopyInformation(reference_image)
+    field = sitk.SmoothingRecursiveGaussian(field, 2.0)
+
+    return {
+        "none": None,
+        "euler": sitk.Euler3DTransform((0, 0, 0), 0.1, -0.05, 0.2, (1.3, -2.2, 0.7)),
+        "dvf": sitk.DisplacementFieldTransform(sitk.Cast(field, sitk.sitkVectorFloat64)),
+    }
+
+
+@pytest.mark.parametrize("transform_name", ["none", "euler", "dvf"])
+def test_apply_transform_to_labels_nearest(label_dict, transform_name):
+
+    reference_image = sitk.Image(36, 44, 24, sitk.sitkInt16)
+    reference_image.SetSpacing((1.1, 0.9, 2.5))
+    reference_image.SetOrigin((-22, -21, -31))
+
+    transform = get_transforms(label_dict["STRUCTURE_0"])[transform_name]
+    if transform_name == "dvf":
+        reference_image = None
+
+    propagated_dict = apply_transform_to_labels(
+        label_dict, reference_image=reference_image, transform=transform
+    )
+
+    assert list(propagated_dict.keys()) == list(label_dict.keys())
+    for name, label in label_dict.items():
+        expected = apply_transform(
+            label,
+            reference_image=reference_image,
+            transform=transform,
+            default_value=0,
+            interpolator=sitk.sitkNearestNeighbor,
+        )
+
+        assert propagated_dict[name].GetPixelID() == expected.GetPixelID()
+        assert propagated_dict[name].GetOrigin() == expected.GetOrigin()
+        assert np.array_equal(
+            sitk.GetArrayFromImage(propagated_dict[name]), sitk.GetArrayFromImage(expected)
+        )
+
+
+@pytest.mark.parametrize("transform_name", ["none", "euler", "dvf"])
+def test_apply_transform_to_labels_linear(label_dict, transform_name):
+
+    label_dict = {name: sitk.Cast(label, sitk.sitkFloat32) for name, label in label_dict.items()}
+    transform = get_transforms(label_dict["STRUCTURE_0"])[transform_name]
+
+    propagated_dict = apply_transform_to_labels(
+        label_dict, transform=transform, interpolator=sitk.sitkLinear
+    )
+
+    for name, label in label_dict.items():
+        expected = apply_transform(
+            label, transform=transform, default_value=0, interpolator=sitk.sitkLinear
+        )
+
+        assert np.allclose(
+            sitk.GetArrayFromImage(propagated_dict[name]),
+            sitk.GetArrayFromImage(expected),
+            atol=1e-5,
+        )
+
+
+def test_apply_transform_to_labels_interpolator(label_dict):
+
+    with pytest.raises(ValueError):
+        apply_transform_to_labels(label_dict, interpolator=sitk.sitkBSpline)
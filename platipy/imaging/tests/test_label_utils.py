@@ -0,0 +1,125 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import pytest
+
+import SimpleITK as sitk
+import numpy as np
+
+from platipy.imaging.label.utils import (
+    binary_decode_image,
+    binary_decode_structure,
+    binary_encode_structure_list,
+    correct_volume_overlap,
+    prime_decode_image,
+    prime_encode_structure_list,
+    read_packed_structure_set,
+    write_packed_structure_set,
+)
+
+
+def generate_structures(number_of_structures, shape=(20, 30, 30)):
+    """Generates overlapping spheres"""
+
+    rng = np.random.default_rng(42)
+    z, y, x = np.mgrid[: shape[0], : shape[1], : shape[2]]
+
+    structure_list = []
+    for _ in range(number_of_structures):
+        center = rng.uniform(5, np.array(shape) - 5)
+        radius = rng.uniform(2, 8)
+        arr = (z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 < radius**2
+
+        structure = sitk.GetImageFromArray(arr.astype(np.uint8))
+        structure.SetSpacing((0.8, 0.8, 2.5))
+        structure.SetOrigin((-12, 4, 30))
+        structure_list.append(structure)
+
+    return structure_list
+
+
+def assert_structures_equal(structure_list_a, structure_list_b):
+
+    assert len(structure_list_a) == len(structure_list_b)
+    for structure_a, structure_b in zip(structure_list_a, structure_list_b):
+        assert np.array_equal(
+            sitk.GetArrayViewFromImage(structure_a) > 0,
+            sitk.GetArrayViewFromImage(structure_b) > 0,
+        )
+        assert structure_a.GetSpacing() == structure_b.GetSpacing()
+        assert structure_a.GetOrigin() == structure_b.GetOrigin()
+
+
+@pytest.mark.parametrize("number_of_structures", [5, 40])
+def test_binary_encoding(number_of_structures):
+
+    structure_list = generate_structures(number_of_structures)
+
+    binary_encoded_img = binary_encode_structure_list(structure_list)
+
+    expected_pixel_type = sitk.sitkUInt32 if number_of_structures <= 31 else sitk.sitkUInt64
+    assert binary_encoded_img.GetPixelID() == expected_pixel_type
+
+    assert_structures_equal(binary_decode_image(binary_encoded_img), structure_list)
+    assert_structures_equal([binary_decode_structure(binary_encoded_img, 3)], [structure_list[3]])
+
+    with pytest.raises(ValueError):
+        binary_encode_structure_list(structure_list * 13)
+
+
+def test_prime_encoding():
+
+    structure_list = generate_structures(6)
+
+    prime_encoded_img = prime_encode_structure_list(structure_list)
+
+    expected_arr = np.ones(prime_encoded_img.GetSize()[::-1], dtype=np.uint64)
+    for prime, structure in zip([2, 3, 5, 7, 11, 13], structure_list):
+        expected_arr[sitk.GetArrayViewFromImage(structure) > 0] *= prime
+
+    assert np.array_equal(sitk.GetArrayViewFromImage(prime_encoded_img), expected_arr)
+    assert_structures_equal(prime_decode_image(prime_encoded_img), structure_list)
+
+
+def test_correct_volume_overlap():
+
+    structure_list = generate_structures(4)
+    binary_label_dict = {f"STRUCTURE_{i}": structure for i, structure in enumerate(structure_list)}
+
+    output_label_dict = correct_volume_overlap(binary_label_dict)
+
+    output_arr = np.stack([sitk.GetArrayFromImage(i) for i in output_label_dict.values()])
+    input_arr = np.stack([sitk.GetArrayFromImage(i) for i in structure_list])
+
+    # Each voxel of the input structures belongs to exactly one output structure
+    assert np.array_equal(output_arr.sum(axis=0), input_arr.max(axis=0))
+
+
+def test_packed_structure_set(tmp_path):
+
+    structure_list = generate_structures(100)
+    structure_list[7] = structure_list[7] * 0
+    structure_dict = {f"STRUCTURE_{i}": structure for i, structure in enumerate(structure_list)}
+
+    write_packed_structure_set(structure_dict, tmp_path.joinpath("structures.npz"))
+    packed_structure_set = read_packed_structure_set(tmp_path.joinpath("structures.npz"))
+
+    assert list(packed_structure_set.keys()) == list(structure_dict.keys())
+    assert_structures_equal(
+        [packed_structure_set["STRUCTURE_42"], packed_structure_set["STRUCTURE_7"]],
+        [structure_dict["STRUCTURE_42"], structure_dict["STRUCTURE_7"]],
+    )
+    assert_structures_equal(list(packed_structure_set.values()), structure_list)
@@ -0,0 +1,114 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import pytest
+
+import SimpleITK as sitk
+import numpy as np
+
+from platipy.imaging.label.comparison import compute_metric_dsc
+from platipy.imaging.label.fusion import process_probability_image
+from platipy.imaging.utils.math import compute_threshold_curve, quick_optimise_probability
+
+
+@pytest.fixture
+def contour_and_probability():
+
+    z, y, x = np.mgrid[:30, :40, :40]
+    distance = np.sqrt(((z - 15) * 2) ** 2 + (y - 20) ** 2 + (x - 20) ** 2)
+
+    manual_contour = sitk.GetImageFromArray((distance < 12).astype(np.uint8))
+    manual_contour.SetSpacing((1, 1, 2))
+
+    # A blurred (and slightly too large) probability map, with some noise
+    rng = np.random.default_rng(42)
+    probability_arr = 1 / (1 + np.exp((distance - 13) / 2)) + rng.normal(0, 0.05, distance.shape)
+    probability_image = sitk.GetImageFromArray(np.clip(probability_arr, 0, None) * 4)
+    probability_image.CopyInformation(manual_contour)
+
+    return manual_contour, probability_image
+
+
+def test_compute_threshold_curve(contour_and_probability):
+
+    manual_contour, probability_image = contour_and_probability
+
+    thresholds = [0.1, 0.25, 0.5, 0.75, 0.9, 1.5]
+    curve = compute_threshold_curve(manual_contour, probability_image, thresholds=thresholds)
+
+    normalised_image = probability_image / sitk.GetArrayFromImage(probability_image).max()
+    manual_arr = sitk.GetArrayFromImage(manual_contour) > 0
+    for index, threshold in enumerate(thresholds):
+        auto_arr = (
+            sitk.GetArrayFromImage(
+                sitk.BinaryThreshold(normalised_image, lowerThreshold=threshold)
+            )
+            > 0
+        )
+
+        true_pos = (manual_arr & auto_arr).sum()
+        true_neg = (~manual_arr & ~auto_arr).sum()
+        assert np.isclose(curve["DSC"][index], 2 * true_pos / (manual_arr.sum() + auto_arr.sum()))
+        assert np.isclose(curve["sensitivity"][index], true_pos / manual_arr.sum())
+        assert np.isclose(curve["specificity"][index], true_neg / (~manual_arr).sum())
+
+    # By default, every distinct probability value is a threshold
+    curve = compute_threshold_curve(manual_contour, probability_image)
+    assert len(curve["threshold"]) == len(np.unique(sitk.GetArrayFromImage(normalised_image)))
+
+
+def test_quick_optimise_probability(contour_and_probability):
+
+    manual_contour, probability_image = contour_and_probability
+
+    p_best, m_best = quick_optimise_probability(
+        compute_metric_dsc, manual_contour, probability_image, mode="max"
+    )
+
+    # The metric returned is found with post-processing
+    assert np.isclose(
+        m_best,
+        compute_metric_dsc(manual_contour, process_probability_image(probability_image, p_best)),
+    )
+
+    # At least as good as the parameter sweep (used for metric functions it doesn't recognise)
+    sweep_metric = lambda label_a, label_b: compute_metric_dsc(label_a, label_b)
+    sweep_metric.__name__ = "sweep_metric"
+    _, m_sweep = quick_optimise_probability(
+        sweep_metric, manual_contour, probability_image, mode="max"
+    )
+    assert m_best >= m_sweep - 1e-6
+
+
+def test_quick_optimise_probability_parallel(contour_and_probability):
+
+    manual_contour, probability_image = contour_and_probability
+
+    # Using metric_args, so the parameter sweep is used
+    results = [
+        quick_optimise_probability(
+            compute_metric_dsc,
+            manual_contour,
+            probability_image,
+            mode="max",
+            metric_args={"auto_crop": False},
+            executor=executor,
+            max_workers=2,
+        )
+        for executor in ["serial", "thread"]
+    ]
+
+    assert results[0] == results[1]
@@ -0,0 +1,179 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import copy
+import pickle
+
+import pytest
+
+import SimpleITK as sitk
+import numpy as np
+
+from platipy.imaging.projects.multiatlas.library import AtlasLibrary, build_atlas_library
+from platipy.imaging.projects.multiatlas.run import (
+    MUTLIATLAS_SETTINGS_DEFAULTS,
+    run_segmentation,
+)
+from platipy.imaging.utils.crop import label_to_roi, crop_to_roi
+
+
+def generate_case(shift):
+    """Generates a simple phantom CT with a spherical "heart" structure"""
+
+    z, y, x = np.mgrid[:40, :48, :48]
+    body = (y - 24) ** 2 + (x - 24) ** 2 < 20 ** 2
+    heart = (z - 20 - shift) ** 2 + (y - 24) ** 2 + (x - 26 + shift) ** 2 < 8 ** 2
+
+    arr_ct = np.where(body, 0, -1000).astype(np.float32) + np.where(heart, 60, 0)
+
+    ct_image = sitk.GetImageFromArray(arr_ct)
+    ct_image.SetSpacing((2, 2, 2.5))
+
+    heart_label = sitk.GetImageFromArray(heart.astype(np.uint8))
+    heart_label.CopyInformation(ct_image)
+
+    return ct_image, heart_label
+
+
+@pytest.fixture
+def atlas_path(tmp_path):
+
+    for case_id in ["00", "01", "02"]:
+        ct_image, heart_label = generate_case(int(case_id) - 1)
+
+        ct_path = tmp_path.joinpath(f"Case_{case_id}", "Images", f"Case_{case_id}_CROP.nii.gz")
+        ct_path.parent.mkdir(parents=True)
+        sitk.WriteImage(ct_image, str(ct_path))
+
+        label_path = tmp_path.joinpath(
+            f"Case_{case_id}", "Structures", f"Case_{case_id}_WHOLEHEART_CROP.nii.gz"
+        )
+        label_path.parent.mkdir(parents=True)
+        sitk.WriteImage(heart_label, str(label_path))
+
+    return tmp_path
+
+
+@pytest.fixture
+def settings(atlas_path):
+
+    settings = copy.deepcopy(MUTLIATLAS_SETTINGS_DEFAULTS)
+    settings["atlas_settings"]["atlas_id_list"] = ["00", "01", "02"]
+    settings["atlas_settings"]["atlas_path"] = str(atlas_path)
+    # The phantoms are too small for the default shrink factors (which occasionally fail)
+    settings["linear_registration_settings"]["shrink_factors"] = [4, 2]
+    settings["linear_registration_settings"]["smooth_sigmas"] = [0, 0]
+    settings["deformable_registration_settings"]["resolution_staging"] = [8, 4, 2]
+    settings["deformable_registration_settings"]["iteration_staging"] = [5, 5, 5]
+
+    return settings
+
+
+@pytest.mark.parametrize("executor", ["serial", "thread", "process"])
+def test_multiatlas_segmentation_executor(settings, executor):
+
+    settings["parallel_settings"]["executor"] = executor
+    settings["parallel_settings"]["max_workers"] = 2
+
+    target_image, target_label = generate_case(0.5)
+
+    results, results_prob = run_segmentation(target_image, settings=settings)
+
+    assert "WHOLEHEART" in results
+    assert "WHOLEHEART" in results_prob
+
+    label_overlap_filter = sitk.LabelOverlapMeasuresImageFilter()
+    auto_mask = results["WHOLEHEART"]
+    gt_mask = sitk.Cast(target_label, auto_mask.GetPixelID())
+    label_overlap_filter.Execute(auto_mask, gt_mask)
+    assert label_overlap_filter.GetDiceCoefficient() > 0.9
+
+
+@pytest.mark.parametrize("crop_atlas_expansion_mm", [None, (4, 4, 5)])
+def test_atlas_library(atlas_path, tmp_path_factory, crop_atlas_expansion_mm):
+
+    library_path = tmp_path_factory.mktemp("library")
+    atlas_library = build_atlas_library(
+        atlas_path, library_path, crop_atlas_expansion_mm=crop_atlas_expansion_mm
+    )
+    assert atlas_library.atlas_id_list == ["00", "01", "02"]
+
+    atlas = AtlasLibrary(library_path).get_atlas("01", ["WHOLEHEART"])
+    assert list(atlas.keys()) == ["CT Image", "WHOLEHEART"]
+
+    # Images are only loaded when accessed, and aren't pickled
+    assert len(atlas._images) == 0  # pylint: disable=protected-access
+    ct_image = atlas["CT Image"]
+    assert len(pickle.loads(pickle.dumps(atlas))._images) == 0  # pylint: disable=protected-access
+
+    expected_image, expected_label = generate_case(0)
+    if crop_atlas_expansion_mm is not None:
+        crop_box_size, crop_box_index = label_to_roi(
+            expected_label, expansion_mm=crop_atlas_expansion_mm
+        )
+        expected_image = crop_to_roi(expected_image, crop_box_size, crop_box_index)
+        expected_label = crop_to_roi(expected_label, crop_box_size, crop_box_index)
+
+    for image, expected in [(ct_image, expected_image), (atlas["WHOLEHEART"], expected_label)]:
+        assert image.GetPixelID() == expected.GetPixelID()
+        assert image.GetOrigin() == expected.GetOrigin()
+        assert image.GetSpacing() == expected.GetSpacing()
+        assert np.array_equal(sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(expected))
+
+    with pytest.raises(ValueError):
+        atlas_library.get_atlas("01", ["LUNG"])
+
+
+def test_multiatlas_segmentation_atlas_library(atlas_path, settings, tmp_path_factory):
+
+    library_path = tmp_path_factory.mktemp("library")
+    build_atlas_library(atlas_path, library_path)
+
+    settings["atlas_settings"]["atlas_path"] = None
+    settings["atlas_settings"]["atlas_library_path"] = str(library_path)
+    settings["parallel_settings"]["executor"] = "process"
+    settings["parallel_settings"]["max_workers"] = 2
+
+    target_image, target_label = generate_case(0.5)
+
+    results, _ = run_segmentation(target_image, settings=settings)
+
+    label_overlap_filter = sitk.LabelOverlapMeasuresImageFilter()
+    auto_mask = results["WHOLEHEART"]
+    gt_mask = sitk.Cast(target_label, auto_mask.GetPixelID())
+    label_overlap_filter.Execute(auto_mask, gt_mask)
+    assert label_overlap_filter.GetDiceCoefficient() > 0.9
+
+
+@pytest.mark.parametrize(
+    "crop_atlas_to_structures,crop_atlas_expansion_mm", [(False, (4, 4, 5)), (True, (20, 20, 40))]
+)
+def test_multiatlas_segmentation_atlas_library_crop_mismatch(
+    atlas_path, settings, tmp_path_factory, crop_atlas_to_structures, crop_atlas_expansion_mm
+):
+
+    library_path = tmp_path_factory.mktemp("library")
+    build_atlas_library(atlas_path, library_path, crop_atlas_expansion_mm=(4, 4, 5))
+
+    settings["atlas_settings"]["atlas_path"] = None
+    settings["atlas_settings"]["atlas_library_path"] = str(library_path)
+    settings["atlas_settings"]["crop_atlas_to_structures"] = crop_atlas_to_structures
+    settings["atlas_settings"]["crop_atlas_expansion_mm"] = crop_atlas_expansion_mm
+
+    target_image, _ = generate_case(0.5)
+
+    with pytest.raises(ValueError):
+        run_segmentation(target_image, settings=settings)
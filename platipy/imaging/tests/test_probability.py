@@ -0,0 +1,104 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import pytest
+
+import SimpleITK as sitk
+import numpy as np
+
+from platipy.imaging.label.probability import ProbabilityMapDict, SparseProbabilityMap
+
+
+@pytest.fixture
+def probability_map():
+
+    z, y, x = np.mgrid[:40, :80, :80]
+    distance = np.sqrt(((z - 18) * 2.5) ** 2 + (y - 30) ** 2 + (x - 45) ** 2)
+
+    arr = 1 / (1 + np.exp(distance - 15))
+    arr[arr < 1e-4] = 0
+
+    image = sitk.GetImageFromArray(arr.astype(np.float32))
+    image.SetSpacing((0.9, 0.9, 2.5))
+    image.SetOrigin((-40, -30, 12))
+
+    return image
+
+
+def assert_same_geometry(image_a, image_b):
+
+    assert image_a.GetSize() == image_b.GetSize()
+    assert np.allclose(image_a.GetSpacing(), image_b.GetSpacing())
+    assert np.allclose(image_a.GetOrigin(), image_b.GetOrigin())
+    assert np.allclose(image_a.GetDirection(), image_b.GetDirection())
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_sparse_probability_map(probability_map, dtype):
+
+    sparse_map = SparseProbabilityMap.from_image(probability_map, dtype=dtype)
+
+    # Only the bounding box of the probability map is stored
+    assert sparse_map.nbytes * 10 < sitk.GetArrayViewFromImage(probability_map).nbytes
+
+    image = sparse_map.to_image()
+    assert_same_geometry(image, probability_map)
+    assert image.GetPixelID() == sitk.sitkFloat32
+
+    error = np.abs(sitk.GetArrayViewFromImage(image) - sitk.GetArrayViewFromImage(probability_map))
+    assert error.max() <= sparse_map.scale / 2 + 1e-7
+
+    if dtype == np.uint16:
+        # The smallest probabilities (1e-4) are kept
+        assert np.array_equal(
+            sitk.GetArrayViewFromImage(image) == 0,
+            sitk.GetArrayViewFromImage(probability_map) == 0,
+        )
+
+
+def test_sparse_probability_map_integer(probability_map):
+
+    # Integer images (e.g. encoded labels) are stored exactly
+    label = sitk.Cast(probability_map > 0.5, sitk.sitkUInt32) * 6
+    image = SparseProbabilityMap.from_image(label).to_image()
+
+    assert_same_geometry(image, label)
+    assert image.GetPixelID() == sitk.sitkUInt32
+    assert np.array_equal(sitk.GetArrayViewFromImage(image), sitk.GetArrayViewFromImage(label))
+
+    empty_image = SparseProbabilityMap.from_image(probability_map * 0).to_image()
+    assert sitk.GetArrayViewFromImage(empty_image).max() == 0
+
+
+def test_probability_map_dict(probability_map, tmp_path):
+
+    probability_maps = ProbabilityMapDict()
+    probability_maps["A"] = probability_map
+    probability_maps["B"] = sitk.Cast(probability_map > 0.5, sitk.sitkUInt8)
+
+    assert list(probability_maps.keys()) == ["A", "B"]
+    assert isinstance(probability_maps["A"], sitk.Image)
+
+    probability_maps.write(tmp_path.joinpath("probability.npz"))
+    read_probability_maps = ProbabilityMapDict.read(tmp_path.joinpath("probability.npz"))
+
+    assert list(read_probability_maps.keys()) == ["A", "B"]
+    for name, image in probability_maps.items():
+        assert_same_geometry(read_probability_maps[name], image)
+        assert np.array_equal(
+            sitk.GetArrayFromImage(read_probability_maps[name]),
+            sitk.GetArrayFromImage(image),
+        )
@@ -0,0 +1,100 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import pytest
+
+import SimpleITK as sitk
+import numpy as np
+
+from platipy.imaging.registration.cache import RegistrationCache, cached_registration
+
+
+@pytest.fixture
+def image_pair():
+
+    z, y, x = np.mgrid[:20, :24, :24]
+
+    arr_fixed = 100.0 * ((z - 10) ** 2 + (y - 12) ** 2 + (x - 12) ** 2 < 6 ** 2)
+    arr_moving = 100.0 * ((z - 11) ** 2 + (y - 12) ** 2 + (x - 13) ** 2 < 6 ** 2)
+
+    fixed_image = sitk.GetImageFromArray(arr_fixed.astype(np.float32))
+    moving_image = sitk.GetImageFromArray(arr_moving.astype(np.float32))
+
+    return fixed_image, moving_image
+
+
+REGISTRATION_CALLS = []
+
+
+def counting_registration(fixed_image, moving_image, shift=1.0):
+    """A stand-in registration which returns a displacement field transform"""
+
+    REGISTRATION_CALLS.append(shift)
+
+    field = sitk.Image(fixed_image.GetSize(), sitk.sitkVectorFloat64, 3)
+    field.CopyInformation(fixed_image)
+    field = field + shift
+
+    return None, sitk.DisplacementFieldTransform(field)
+
+
+def test_cached_registration(tmp_path, image_pair):
+
+    cache = RegistrationCache(tmp_path)
+    fixed_image, moving_image = image_pair
+    REGISTRATION_CALLS.clear()
+
+    transform = cached_registration(counting_registration, fixed_image, moving_image, cache=cache)
+    cached_transform = cached_registration(
+        counting_registration, fixed_image, moving_image, cache=cache
+    )
+
+    assert len(REGISTRATION_CALLS) == 1
+    assert isinstance(cached_transform, sitk.DisplacementFieldTransform)
+    assert cached_transform.TransformPoint((1, 2, 3)) == transform.TransformPoint((1, 2, 3))
+
+    # Changing the settings or images must not re-use the transform
+    cached_registration(counting_registration, fixed_image, moving_image, cache=cache, shift=2.0)
+    cached_registration(counting_registration, moving_image, fixed_image, cache=cache)
+    assert len(REGISTRATION_CALLS) == 3
+
+    statistics = cache.statistics
+    assert statistics["hits"] == 1
+    assert statistics["misses"] == 3
+    assert statistics["entries"] == 3
+
+
+def test_cache_eviction(tmp_path, image_pair):
+
+    cache = RegistrationCache(tmp_path, max_entries=2)
+    fixed_image, moving_image = image_pair
+
+    keys = [cache.make_key(fixed_image, moving_image, shift=shift) for shift in range(3)]
+
+    for shift, key in enumerate(keys):
+        if shift == 2:
+            # Access the first entry so the second is the least recently used
+            assert cache.get(keys[0]) is not None
+        cache.put(key, counting_registration(fixed_image, moving_image, shift=shift)[1])
+
+    assert cache.statistics["entries"] == 2
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
+    assert len(list(tmp_path.glob("*.h5"))) == 2
+
+    cache.clear()
+    assert cache.statistics == {"hits": 0, "misses": 0, "entries": 0, "size_mb": 0}
@@ -0,0 +1,103 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import pickle
+
+import pytest
+
+import SimpleITK as sitk
+import numpy as np
+
+from platipy.imaging.registration.deformable import fast_symmetric_forces_demons_registration
+from platipy.imaging.registration.utils import (
+    ImagePyramid,
+    smooth_and_resample,
+)
+
+
+@pytest.fixture
+def image_pair():
+
+    z, y, x = np.mgrid[:24, :32, :32]
+
+    arr_fixed = 100.0 * ((z - 12) ** 2 + (y - 16) ** 2 + (x - 16) ** 2 < 8**2)
+    arr_moving = 100.0 * ((z - 12) ** 2 + ((y - 17) * 1.2) ** 2 + (x - 15) ** 2 < 8**2)
+
+    fixed_image = sitk.GetImageFromArray(arr_fixed.astype(np.int16))
+    moving_image = sitk.GetImageFromArray(arr_moving.astype(np.int16))
+
+    return fixed_image, moving_image
+
+
+def test_image_pyramid(image_pair):
+
+    fixed_image, _ = image_pair
+    pyramid = ImagePyramid(fixed_image)
+
+    level = pyramid.get_level(shrink_factor=[2, 2, 1], smoothing_sigma=2)
+    expected_level = smooth_and_resample(
+        sitk.Cast(fixed_image, sitk.sitkFloat32), shrink_factor=[2, 2, 1], smoothing_sigma=2
+    )
+
+    assert pyramid.original_pixel_id == sitk.sitkInt16
+    assert pyramid.get_level(shrink_factor=(2, 2, 1), smoothing_sigma=2) is level
+    assert np.array_equal(sitk.GetArrayFromImage(level), sitk.GetArrayFromImage(expected_level))
+    assert len(pyramid) == 1
+
+    # The computed levels are kept when sending the pyramid to another process
+    pickled_pyramid = pickle.loads(pickle.dumps(pyramid))
+    assert len(pickled_pyramid) == 1
+    assert pickled_pyramid.get_level(shrink_factor=2) is not None
+
+
+def test_image_pyramid_precompute(image_pair):
+
+    fixed_image, moving_image = image_pair
+    settings = {"resolution_staging": [4, 2, 1], "iteration_staging": [5, 5, 5]}
+
+    fixed_pyramid = ImagePyramid(fixed_image)
+    levels = fixed_pyramid.precompute(**settings)
+
+    assert len(fixed_pyramid) == 3
+    assert levels[0] is fixed_pyramid.get_level(shrink_factor=1, smoothing_sigma=1)
+    assert levels[-1] is fixed_pyramid.get_level(shrink_factor=4, smoothing_sigma=4)
+
+    # The precomputed levels are sent to worker processes, so no level is computed again
+    pickled_pyramid = pickle.loads(pickle.dumps(fixed_pyramid))
+    fast_symmetric_forces_demons_registration(pickled_pyramid, moving_image, **settings)
+    assert len(pickled_pyramid) == 3
+
+
+def test_demons_registration_with_pyramid(image_pair):
+
+    fixed_image, moving_image = image_pair
+    settings = {"resolution_staging": [4, 2, 1], "iteration_staging": [5, 5, 5]}
+
+    registered_image, _, field = fast_symmetric_forces_demons_registration(
+        fixed_image, moving_image, **settings
+    )
+
+    fixed_pyramid = ImagePyramid(fixed_image)
+    registered_image_pyramid, _, field_pyramid = fast_symmetric_forces_demons_registration(
+        fixed_pyramid, ImagePyramid(moving_image), **settings
+    )
+
+    assert len(fixed_pyramid) == 3
+    assert registered_image_pyramid.GetPixelID() == sitk.sitkInt16
+    assert np.array_equal(
+        sitk.GetArrayFromImage(registered_image), sitk.GetArrayFromImage(registered_image_pyramid)
+    )
+    assert np.array_equal(sitk.GetArrayFromImage(field), sitk.GetArrayFromImage(field_pyramid))
@@ -0,0 +1,107 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name,missing-function-docstring
+
+import json
+
+import pytest
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from platipy.imaging.visualisation.batch import read_qa_manifest, render_qa_batch
+
+
+def write_sphere(path, center, radius, reference_image):
+
+    z, y, x = np.mgrid[:30, :40, :40]
+    arr = ((z - center[0]) * 2) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 < radius**2
+
+    label = sitk.GetImageFromArray(arr.astype(np.uint8))
+    label.CopyInformation(reference_image)
+    sitk.WriteImage(label, str(path))
+
+
+@pytest.fixture
+def qa_manifest(tmp_path):
+
+    cases = []
+    for case_index in range(3):
+        case_dir = tmp_path.joinpath(f"case_{case_index}")
+        case_dir.joinpath("auto").mkdir(parents=True)
+        case_dir.joinpath("manual").mkdir(parents=True)
+
+        image = sitk.GetImageFromArray(np.linspace(-1000, 500, 30 * 40 * 40).reshape(30, 40, 40))
+        image.SetSpacing((1, 1, 2))
+        sitk.WriteImage(image, str(case_dir.joinpath("image.nii.gz")))
+
+        write_sphere(case_dir.joinpath("auto", "A.nii.gz"), (15, 20, 15), 8, image)
+        write_sphere(case_dir.joinpath("auto", "B.nii.gz"), (12, 15, 28), 5, image)
+        write_sphere(case_dir.joinpath("manual", "A.nii.gz"), (15, 21, 16), 7, image)
+        write_sphere(case_dir.joinpath("manual", "B.nii.gz"), (13, 15, 27), 5, image)
+
+        cases.append(
+            {
+                "id": f"case_{case_index}",
+                "image": f"case_{case_index}/image.nii.gz",
+                "contours": f"case_{case_index}/auto",
+            }
+        )
+
+    # Compare to manual contours, and override the template for one case
+    cases[1]["comparison"] = "case_1/manual"
+    cases[2]["contours"] = {"A": "case_2/auto/A.nii.gz"}
+    cases[2]["template"] = {"visualiser": {"axis": "z"}}
+
+    # A case which can't be rendered
+    cases.append({"id": "missing", "image": "missing.nii.gz", "contours": "missing"})
+
+    manifest_path = tmp_path.joinpath("manifest.json")
+    with open(manifest_path, "w") as file_obj:
+        json.dump({"cases": cases, "template": {"dpi": 50}}, file_obj)
+
+    return manifest_path
+
+
+def test_read_qa_manifest(qa_manifest):
+
+    manifest = read_qa_manifest(qa_manifest)
+
+    assert manifest["template"] == {"dpi": 50}
+    assert manifest["cases"][0]["image"] == str(qa_manifest.parent.joinpath("case_0/image.nii.gz"))
+    assert manifest["cases"][2]["contours"] == {
+        "A": str(qa_manifest.parent.joinpath("case_2/auto/A.nii.gz"))
+    }
+
+
+@pytest.mark.parametrize("executor", ["serial", "process"])
+def test_render_qa_batch(qa_manifest, tmp_path, executor):
+
+    output_dir = tmp_path.joinpath("qa")
+
+    results = render_qa_batch(qa_manifest, output_dir, executor=executor, max_workers=2)
+
+    assert list(results.keys()) == ["case_0", "case_1", "case_2", "missing"]
+    assert results["missing"] is None
+
+    for case_id in ["case_0", "case_1", "case_2"]:
+        assert results[case_id] == output_dir.joinpath(f"{case_id}.png")
+        assert results[case_id].stat().st_size > 0
+
+    # The metrics of the comparison are written alongside the figure
+    df_metrics = pd.read_csv(output_dir.joinpath("case_1.csv"))
+    assert df_metrics.STRUCTURE.tolist() == ["A", "B"]
+    assert (df_metrics.DSC > 0.7).all()
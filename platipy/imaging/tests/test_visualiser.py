@@ -20,11 +20,14 @@ import pytest
 
 import SimpleITK as sitk
 import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.contour import ContourSet
 
 from platipy.imaging.tests.data import get_lung_nifti
 
 from platipy.imaging import ImageVisualiser
 from platipy.imaging.label.utils import get_com
+from platipy.imaging.visualisation.utils import VisualiseContour, return_slice
 
 
 @pytest.fixture
@@ -96,3 +99,96 @@ def test_comparison_overlay_visualisation(nifti_data):
     img = fig.axes[0].images[0]
     print(img.get_array().data.sum())
     assert np.allclose(img.get_array().data.sum(), 177574, atol=1)
+
+
+@pytest.fixture
+def synthetic_data():
+
+    image = sitk.GetImageFromArray(np.linspace(-1000, 1000, 40 * 60 * 70).reshape(40, 60, 70))
+    image.SetSpacing((0.8, 0.8, 2.5))
+    image.SetOrigin((-20, -30, -50))
+
+    z, y, x = np.mgrid[:40, :60, :70]
+    structures = {}
+    for name, center, radius in [("A", (20, 30, 30), 12), ("B", (12, 20, 45), 8)]:
+        arr = ((z - center[0]) * 3) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 < radius**2
+        structure = sitk.GetImageFromArray(arr.astype(np.float32))
+        structure.CopyInformation(image)
+        structures[name] = structure
+
+    # A structure defined on a different grid
+    structures["C"] = sitk.Resample(
+        structures["A"],
+        [30, 40, 20],
+        sitk.Transform(),
+        sitk.sitkNearestNeighbor,
+        (-15, -25, -45),
+        (1.2, 1.2, 5.0),
+        image.GetDirection(),
+    )
+
+    return image, structures
+
+
+def get_contour_sets(ax):
+
+    return [c for c in ax.collections if isinstance(c, ContourSet)]
+
+
+def get_contour_vertices(contour_set):
+
+    return sorted({tuple(v) for p in contour_set.get_paths() for v in np.round(p.vertices, 6)})
+
+
+@pytest.mark.parametrize("axis,cut", [("z", 20), ("y", 28), ("x", 33), ("z", 2)])
+def test_contour_visualisation_slices(synthetic_data, axis, cut):
+
+    image, structures = synthetic_data
+
+    vis = ImageVisualiser(image, axis=axis, cut=cut)
+    vis.add_contour(structures)
+    fig = vis.show()
+
+    # Only the cut of each contour is extracted, but the same contours are drawn as for the
+    # whole contour resampled to the image
+    assert len(get_contour_sets(fig.axes[0])) == len(structures)
+
+    reference_fig, reference_ax = plt.subplots()
+    for contour_set, structure in zip(get_contour_sets(fig.axes[0]), structures.values()):
+        contour_slice = sitk.GetArrayFromImage(sitk.Resample(structure, image))[
+            return_slice(axis, cut)
+        ]
+        if contour_slice.sum() == 0:
+            contour_slice[0, 0] = 1
+
+        reference_set = reference_ax.contour(contour_slice, levels=[0.5], origin="lower")
+        assert get_contour_vertices(contour_set) == get_contour_vertices(reference_set)
+
+    plt.close(reference_fig)
+
+
+def test_contour_bounding_box(synthetic_data):
+
+    _, structures = synthetic_data
+
+    contour = VisualiseContour(structures["B"], "B")
+    assert contour.bounding_box == [(38, 53), (13, 28), (10, 15)]
+
+    contour = VisualiseContour(structures["B"] * 0, "empty")
+    assert contour.bounding_box is None
+
+
+def test_preview_visualisation(synthetic_data):
+
+    image, structures = synthetic_data
+
+    vis = ImageVisualiser(image, axis="z", cut=20, limits=[10, 60, 5, 55], preview_size=35)
+    vis.add_contour(structures["A"], name="A")
+    fig = vis.show()
+
+    # The image is downsampled by 2 in plane, the contour drawn on the downsampled image
+    assert fig.axes[0].images[0].get_array().shape == (30, 35)
+    assert fig.axes[0].get_xlim() == (4.75, 29.75)
+
+    vertices = np.array(get_contour_vertices(get_contour_sets(fig.axes[0])[0]))
+    assert np.allclose(vertices.mean(axis=0), (15.5, 15.5), atol=0.5)
@@ -72,6 +72,37 @@ def label_to_roi(label, expansion_mm=[0, 0, 0], return_as_list=False):
     return crop_box_size, crop_box_index
 
 
+def label_to_slices(label_arr, expansion=0):
+    """Gets the bounding box of the non-zero values of an array, as a tuple of slices which can
+    be used to index (crop) the array.
+
+    Args:
+        label_arr (np.ndarray): The label array.
+        expansion (int, optional): An optional expansion of the box (in voxels, in each direction).
+            The box is limited to the extent of the array. Defaults to 0.
+
+    Returns:
+        tuple | None: The slices for each axis, or None if the array is empty.
+    """
+
+    box = []
+    for axis in range(label_arr.ndim):
+        other_axes = tuple(a for a in range(label_arr.ndim) if a != axis)
+        nonzero = np.flatnonzero(label_arr.any(axis=other_axes))
+
+        if len(nonzero) == 0:
+            return None
+
+        box.append(
+            slice(
+                max(nonzero[0] - expansion, 0),
+                min(nonzero[-1] + 1 + expansion, label_arr.shape[axis]),
+            )
+        )
+
+    return tuple(box)
+
+
 def crop_to_roi(image, size, index):
     """Utility function for cropping images"""
     return sitk.RegionOfInterest(image, size=size, index=index)
@@ -15,9 +15,14 @@
 
 import matplotlib.pyplot as plt
 import numpy as np
+import SimpleITK as sitk
 
 from platipy.imaging.label.fusion import process_probability_image
 from platipy.imaging.utils.crop import label_to_roi, crop_to_roi
+from platipy.imaging.utils.parallel import parallel_map
+
+# The number of best thresholds (from the threshold curve) which are checked with post-processing
+THRESHOLD_CURVE_CANDIDATES = 5
 
 
 def gen_primes():
@@ -54,6 +59,88 @@ def gen_primes():
         q += 1
 
 
+def compute_threshold_curve(manual_contour, probability_image, thresholds=None):
+    """Computes the overlap between a manual contour and a thresholded probability image, for all
+    thresholds at once.
+
+    The probability image is normalised and thresholded as in process_probability_image, but
+    without the post-processing (filling holes and keeping the largest component). The counts of
+    voxels above each threshold are found from the sorted probability values, inside and outside
+    the manual contour, so the whole curve costs about as much as a single threshold.
+
+    Args:
+        manual_contour (SimpleITK.Image): The reference (manual) contour.
+        probability_image (SimpleITK.Image): The probability map. This does NOT have to be scaled
+            to [0,1].
+        thresholds (list | np.ndarray, optional): The thresholds at which to compute the overlap.
+            Defaults to None, in which case each distinct (normalised) probability value is used,
+            which covers every possible thresholded contour.
+
+    Returns:
+        dict: Arrays with the "threshold", and the "DSC", "sensitivity" and "specificity" (within
+        the extent of the images) at each threshold.
+    """
+
+    # Normalise the probability map exactly as in process_probability_image
+    probability_image = probability_image / sitk.GetArrayFromImage(probability_image).max()
+
+    probability_arr = sitk.GetArrayViewFromImage(probability_image).ravel()
+    manual_arr = sitk.GetArrayViewFromImage(manual_contour).ravel() > 0
+
+    values_all = np.sort(probability_arr)
+    values_manual = np.sort(probability_arr[manual_arr])
+
+    if thresholds is None:
+        thresholds = np.unique(values_all)
+    thresholds = np.asarray(thresholds, dtype=values_all.dtype)
+
+    # The number of voxels (in total, and in the manual contour) at or above each threshold
+    count_auto = len(values_all) - np.searchsorted(values_all, thresholds, side="left")
+    true_pos = len(values_manual) - np.searchsorted(values_manual, thresholds, side="left")
+
+    count_manual = len(values_manual)
+    false_pos = count_auto - true_pos
+    true_neg = len(values_all) - count_manual - false_pos
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "threshold": thresholds,
+            "DSC": 2 * true_pos / (count_manual + count_auto),
+            "sensitivity": true_pos / count_manual,
+            "specificity": true_neg / (true_neg + false_pos),
+        }
+
+
+def _get_threshold_curve_metric(metric_function):
+    """Gets the name of the threshold curve metric matching a metric function, or None if the
+    metric can't be read from compute_threshold_curve"""
+
+    # Imported here since platipy.imaging.label imports this module
+    from platipy.imaging.label.comparison import (  # pylint: disable=import-outside-toplevel
+        compute_metric_dsc,
+        compute_metric_sensitivity,
+    )
+
+    threshold_curve_metrics = {
+        compute_metric_dsc: "DSC",
+        compute_metric_sensitivity: "sensitivity",
+    }
+
+    return threshold_curve_metrics.get(metric_function)
+
+
+def _compute_threshold_metric(
+    threshold, metric_function, manual_contour, probability_image, metric_args
+):
+    """Computes the metric for a single threshold (after post-processing)"""
+
+    return metric_function(
+        manual_contour,
+        process_probability_image(probability_image, threshold=threshold),
+        **metric_args,
+    )
+
+
 def quick_optimise_probability(
     metric_function,
     manual_contour,
@@ -65,11 +152,18 @@ def quick_optimise_probability(
     create_figure=False,
     auto_crop=True,
     metric_args={},
+    executor="serial",
+    max_workers=None,
 ):
     """Optimise the probability threshold used to generate a binary segmentation.
     This is a simple parameter sweep, with linearly decreasing resolution. It will usually converge
     between 5 and 10 iterations.
 
+    For the DSC and sensitivity (compute_metric_dsc and compute_metric_sensitivity, without
+    metric_args) the sweep isn't needed: the metric is computed for every threshold at once (see
+    compute_threshold_curve), and the best few thresholds are then checked with the full
+    post-processing of process_probability_image.
+
     Args:
         metric_function (function to return float): The metric function, this takes in two binary
             masks (a reference, and test [SimpleITK.Image]) and returns a metric (as a float).
@@ -93,6 +187,9 @@ def quick_optimise_probability(
         metric_args (dict, optional): Additional arguments passes to the metric function. This
             could be useful if you are calculating a dose-based metric and require a dose grid to
             be passed to the metric function. Defaults to {}.
+        executor (str, optional): How the candidate thresholds of each iteration are evaluated:
+            "serial", "thread" or "process". Defaults to "serial".
+        max_workers (int, optional): The maximum number of workers. Defaults to None.
 
     Returns:
         tuple (float, float): The optimal probability, optimal metric value.
@@ -105,6 +202,29 @@ def quick_optimise_probability(
         manual_contour = crop_to_roi(manual_contour, cb_size, cb_index)
         probability_image = crop_to_roi(probability_image, cb_size, cb_index)
 
+    evaluate_thresholds = lambda thresholds: parallel_map(
+        _compute_threshold_metric,
+        thresholds,
+        executor=executor,
+        max_workers=max_workers,
+        metric_function=metric_function,
+        manual_contour=manual_contour,
+        probability_image=probability_image,
+        metric_args=metric_args,
+    )
+
+    curve_metric = _get_threshold_curve_metric(metric_function)
+    if curve_metric is not None and not metric_args:
+        return _optimise_probability_curve(
+            metric_function,
+            curve_metric,
+            manual_contour,
+            probability_image,
+            evaluate_thresholds,
+            mode=mode,
+            create_figure=create_figure,
+        )
+
     # Set up
     n_iter = 0
     p_best = p_0
@@ -135,14 +255,7 @@ def quick_optimise_probability(
             p_best + delta / 2,
             p_best + 3 * delta / 4,
         ]
-        m_new = [
-            metric_function(
-                manual_contour,
-                process_probability_image(probability_image, threshold=p),
-                **metric_args,
-            )
-            for p in p_new
-        ]
+        m_new = evaluate_thresholds(p_new)
 
         p_list = p_list + p_new
         m_list = m_list + m_new
@@ -177,3 +290,58 @@ def quick_optimise_probability(
         fig.show()
 
     return p_best, m_best
+
+
+def _optimise_probability_curve(
+    metric_function,
+    curve_metric,
+    manual_contour,
+    probability_image,
+    evaluate_thresholds,
+    mode="min",
+    create_figure=False,
+):
+    """Optimises the probability threshold using the threshold curve, see
+    quick_optimise_probability"""
+
+    curve = compute_threshold_curve(manual_contour, probability_image)
+    p_curve = curve["threshold"]
+    m_curve = curve[curve_metric]
+
+    # Thresholds above the maximum give an empty contour
+    valid = np.isfinite(m_curve) & (p_curve > 0)
+    p_curve = p_curve[valid]
+    m_curve = m_curve[valid]
+
+    # Post-processing can change the metric slightly, so the best few thresholds are checked
+    order = np.argsort(m_curve, kind="stable")
+    if mode == "max":
+        order = order[::-1]
+    p_candidates = [float(p) for p in p_curve[order[:THRESHOLD_CURVE_CANDIDATES]]]
+    m_candidates = evaluate_thresholds(p_candidates)
+
+    if mode == "min":
+        best = int(np.argmin(m_candidates))
+    elif mode == "max":
+        best = int(np.argmax(m_candidates))
+    p_best = p_candidates[best]
+    m_best = m_candidates[best]
+
+    print(f"Threshold curve | p = {p_best:.3f} | metric = {m_best:.3f}")
+
+    if create_figure:
+        fig, ax = plt.subplots(1, 1)
+        ax.plot(p_curve, m_curve, c="k", zorder=1)
+        ax.scatter(
+            (p_best), (m_best), c="r", label=f"Optimum ({p_best:.2f},{m_best:.2f})", zorder=2
+        )
+        ax.set_xlim(0, 1)
+        ax.set_xlabel("Probability Threshold")
+        ax.set_ylabel("Metric Value")
+        ax.grid()
+        ax.set_axisbelow(True)
+        ax.set_title(f"Optimiser | {metric_function.__name__}, mode = {mode}")
+        ax.legend()
+        fig.show()
+
+    return p_best, m_best
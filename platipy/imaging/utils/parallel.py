@@ -0,0 +1,84 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Utility functions for running independent tasks (e.g. per-atlas registrations) in parallel.
+"""
+
+import functools
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+EXECUTOR_TYPES = ("serial", "thread", "process")
+
+
+def get_executor(executor="serial", max_workers=None, initializer=None):
+    """Creates a pool executor of the requested type.
+
+    Args:
+        executor (str, optional): The type of executor. Available options:
+                                   - serial: tasks are run one after another in this process
+                                   - thread: a pool of threads (SimpleITK filters release the
+                                     GIL, so image processing runs concurrently)
+                                   - process: a pool of worker processes
+                                  Defaults to "serial".
+        max_workers (int, optional): The maximum number of workers. Defaults to None, in which
+            case the concurrent.futures default is used.
+        initializer (callable, optional): Called at the start of each worker. Defaults to None.
+
+    Raises:
+        ValueError: If the executor type is not recognised.
+
+    Returns:
+        concurrent.futures.Executor | None: The executor, or None if running in serial.
+    """
+
+    if executor is None or executor.lower() == "serial":
+        return None
+
+    if executor.lower() == "thread":
+        return ThreadPoolExecutor(max_workers=max_workers, initializer=initializer)
+
+    if executor.lower() == "process":
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=initializer)
+
+    raise ValueError(f"Executor must be one of {EXECUTOR_TYPES}, not {executor}")
+
+
+def parallel_map(function, items, executor="serial", max_workers=None, **kwargs):
+    """Applies a function to each item in a list, optionally using a pool of workers.
+
+    When using the process executor the function must be defined at the top level of a module,
+    and the items, keyword arguments and return values must be picklable (SimpleITK images and
+    transforms are).
+
+    Args:
+        function (callable): The function to apply, called as function(item, **kwargs).
+        items (iterable): The items to process.
+        executor (str, optional): The type of executor, see get_executor. Defaults to "serial".
+        max_workers (int, optional): The maximum number of workers. Defaults to None.
+
+    Returns:
+        list: The result for each item, in the same order as the items.
+    """
+
+    task = functools.partial(function, **kwargs)
+
+    pool = get_executor(executor=executor, max_workers=max_workers)
+
+    if pool is None:
+        return [task(item) for item in items]
+
+    with pool:
+        return list(pool.map(task, items))
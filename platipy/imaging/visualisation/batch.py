@@ -0,0 +1,280 @@
+# Copyright 2022 University of New South Wales, University of Sydney, Ingham Institute
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Renders QA figures of (auto-)contours for many cases, described by a manifest.
+"""
+
+import json
+from concurrent.futures import as_completed
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+import SimpleITK as sitk
+
+from loguru import logger
+
+from platipy.imaging.label.utils import get_com
+from platipy.imaging.utils.parallel import get_executor
+from platipy.imaging.visualisation.comparison import contour_comparison
+from platipy.imaging.visualisation.visualiser import ImageVisualiser
+
+QA_FIGURE_FORMATS = ("png", "pdf")
+
+QA_TEMPLATE_DEFAULTS = {
+    "visualiser": {},
+    "structure_for_com": None,
+    "structure_for_limits": None,
+    "limits_expansion": 20,
+    "contour_label": "Set A",
+    "comparison_label": "Set B",
+    "dpi": 100,
+}
+
+
+def read_qa_manifest(manifest_path):
+    """Reads a QA manifest from a JSON file.
+
+    The manifest is either a list of cases, or a dict with the list of "cases" and a "template"
+    of figure settings shared by all cases. Each case is a dict with:
+        - id: The name of the case, used to name the figure.
+        - image: The path of the image.
+        - contours: A dict of {name: path}, or the path of a directory of NIfTI contours (named
+          by their file name).
+        - comparison (optional): Contours to compare to, in the same format. A comparison figure
+          (with a table of metrics) is rendered if given.
+        - template (optional): Settings overriding the shared template for this case.
+
+    Relative paths are relative to the directory of the manifest.
+
+    Args:
+        manifest_path (str | pathlib.Path): The path of the manifest.
+
+    Returns:
+        dict: The manifest, with the "cases" and the "template".
+    """
+
+    manifest_path = Path(manifest_path)
+
+    with open(manifest_path, "r") as file_obj:
+        manifest = json.load(file_obj)
+
+    if isinstance(manifest, list):
+        manifest = {"cases": manifest}
+
+    def resolve(path):
+        return str(manifest_path.parent.joinpath(path))
+
+    for case in manifest["cases"]:
+        case["image"] = resolve(case["image"])
+
+        for key in ["contours", "comparison"]:
+            if isinstance(case.get(key), dict):
+                case[key] = {name: resolve(path) for name, path in case[key].items()}
+            elif case.get(key) is not None:
+                case[key] = resolve(case[key])
+
+    manifest.setdefault("template", {})
+
+    return manifest
+
+
+def read_contours(contours):
+    """Reads a set of contours given in a QA manifest.
+
+    Args:
+        contours (dict | str | pathlib.Path): A dict of {name: path}, or the path of a directory
+            of NIfTI contours (named by their file name).
+
+    Returns:
+        dict: The contours, as {name: SimpleITK.Image}.
+    """
+
+    if not isinstance(contours, dict):
+        contours = {
+            path.name.split(".nii")[0]: path
+            for path in sorted(Path(contours).iterdir())
+            if path.name.endswith((".nii", ".nii.gz"))
+        }
+
+    return {name: sitk.ReadImage(str(path)) for name, path in contours.items()}
+
+
+def _get_largest_contour_com(contours):
+    """Gets the centre of mass of the largest contour, or None if all contours are empty"""
+
+    volumes = {
+        name: sitk.GetArrayViewFromImage(contour).sum() for name, contour in contours.items()
+    }
+
+    if sum(volumes.values()) == 0:
+        return None
+
+    return get_com(contours[max(volumes, key=volumes.get)])
+
+
+def render_qa_figure(case, output_directory, file_format="png", template=None):
+    """Renders the QA figure of a single case and writes it to disk.
+
+    Args:
+        case (dict): The case, see read_qa_manifest.
+        output_directory (str | pathlib.Path): The directory to write the figure to.
+        file_format (str, optional): The format of the figure, "png" or "pdf". Defaults to "png".
+        template (dict, optional): The figure settings, see QA_TEMPLATE_DEFAULTS. Defaults to
+            None.
+
+    Returns:
+        pathlib.Path: The path of the figure.
+    """
+
+    settings = {**QA_TEMPLATE_DEFAULTS, **(template or {}), **case.get("template", {})}
+    visualiser_kw = dict(settings["visualiser"])
+
+    image = sitk.ReadImage(case["image"])
+    contours = read_contours(case["contours"])
+
+    output_path = Path(output_directory).joinpath(f"{case['id']}.{file_format}")
+
+    if case.get("comparison") is not None:
+        fig, df_metrics = contour_comparison(
+            image,
+            contours,
+            read_contours(case["comparison"]),
+            contour_label_a=settings["contour_label"],
+            contour_label_b=settings["comparison_label"],
+            structure_for_com=settings["structure_for_com"],
+            structure_for_limits=settings["structure_for_limits"],
+            title=case["id"],
+            img_vis_kw=visualiser_kw,
+        )
+        df_metrics.to_csv(output_path.with_suffix(".csv"), index=False)
+
+    else:
+        if "cut" not in visualiser_kw:
+            if settings["structure_for_com"] is not None:
+                visualiser_kw["cut"] = get_com(contours[settings["structure_for_com"]])
+            else:
+                visualiser_kw["cut"] = _get_largest_contour_com(contours)
+
+            axis = visualiser_kw.get("axis", "ortho")
+            if axis != "ortho" and visualiser_kw["cut"] is not None:
+                visualiser_kw["cut"] = visualiser_kw["cut"][{"x": 2, "y": 1, "z": 0}[axis]]
+
+        vis = ImageVisualiser(image, **visualiser_kw)
+        vis.add_contour(contours)
+
+        if settings["structure_for_limits"] is not None:
+            vis.set_limits_from_label(
+                contours[settings["structure_for_limits"]],
+                expansion=settings["limits_expansion"],
+            )
+
+        fig = vis.show()
+
+    fig.savefig(output_path, dpi=settings["dpi"])
+
+    # Figures aren't displayed, so free them as soon as they are written
+    plt.close(fig)
+
+    return output_path
+
+
+def _use_non_interactive_backend():
+    """Switches the worker to the (non-interactive) Agg backend"""
+
+    plt.switch_backend("agg")
+
+
+def render_qa_batch(
+    manifest,
+    output_directory,
+    file_format="png",
+    executor="process",
+    max_workers=None,
+):
+    """Renders the QA figures of all cases in a manifest.
+
+    Cases are rendered by a pool of workers using the (non-interactive) Agg backend. Each figure
+    is written to disk (and closed) as soon as it is rendered. A case which fails to render is
+    logged and skipped.
+
+    Args:
+        manifest (dict | str | pathlib.Path): The manifest, or the path of the manifest, see
+            read_qa_manifest.
+        output_directory (str | pathlib.Path): The directory to write the figures to.
+        file_format (str, optional): The format of the figures, "png" or "pdf". Defaults to
+            "png".
+        executor (str, optional): "serial" or "process". Matplotlib isn't thread safe, so
+            figures can't be rendered by threads. Defaults to "process".
+        max_workers (int, optional): The maximum number of workers. Defaults to None.
+
+    Returns:
+        dict: The path of the figure of each case, as {case id: path}. The path is None if the
+        case failed to render.
+    """
+
+    if file_format not in QA_FIGURE_FORMATS:
+        raise ValueError(f"file_format must be one of {QA_FIGURE_FORMATS}, not {file_format}")
+
+    if executor == "thread":
+        raise ValueError("QA figures must be rendered with the serial or process executor")
+
+    if not isinstance(manifest, dict):
+        manifest = read_qa_manifest(manifest)
+
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+
+    cases = manifest["cases"]
+    template = manifest.get("template", {})
+
+    logger.info(f"Rendering QA figures of {len(cases)} cases")
+
+    results = {case["id"]: None for case in cases}
+
+    def log_result(case_id, get_result):
+        try:
+            results[case_id] = get_result()
+            logger.debug(f"Rendered {case_id}: {results[case_id]}")
+        except Exception as exception:  # pylint: disable=broad-except
+            logger.error(f"Could not render {case_id}")
+            logger.exception(exception)
+
+    pool = get_executor(
+        executor=executor, max_workers=max_workers, initializer=_use_non_interactive_backend
+    )
+
+    if pool is None:
+        for case in cases:
+            log_result(
+                case["id"],
+                lambda case=case: render_qa_figure(case, output_directory, file_format, template),
+            )
+
+    else:
+        with pool:
+            futures = {}
+            for case in cases:
+                future = pool.submit(
+                    render_qa_figure, case, output_directory, file_format, template
+                )
+                futures[future] = case["id"]
+
+            for future in as_completed(futures):
+                log_result(futures[future], future.result)
+
+    number_rendered = len([path for path in results.values() if path is not None])
+    logger.info(f"Rendered {number_rendered} of {len(cases)} QA figures to {output_directory}")
+
+    return results
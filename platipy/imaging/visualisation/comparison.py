@@ -178,9 +178,7 @@ def contour_comparison(
         rows = s_select
 
     # Compute some metrics
-    df_metrics = pd.DataFrame(
-        columns=["STRUCTURE", "DSC", "MDA_mm", "HD_mm", "VOL_A_cm3", "VOL_B_cm3"]
-    )
+    metrics = []
     columns = ("DSC", "MDA\n[mm]", "HD\n[mm]", "Vol.\nRatio")
 
     cell_text = []
@@ -202,7 +200,7 @@ def contour_comparison(
         )
 
         # compute metrics and add to dataframe
-        df_metrics = df_metrics.append(
+        metrics.append(
             {
                 "STRUCTURE": s,
                 "DSC": dsc,
@@ -210,10 +208,13 @@ def contour_comparison(
                 "HD_mm": hd,
                 "VOL_A_cm3": vol_a,
                 "VOL_B_cm3": vol_b,
-            },
-            ignore_index=True,
+            }
         )
 
+    df_metrics = pd.DataFrame(
+        metrics, columns=["STRUCTURE", "DSC", "MDA_mm", "HD_mm", "VOL_A_cm3", "VOL_B_cm3"]
+    )
+
     # If there are no labels we can make the table bigger
     if title == "" and subsubtitle == "" and subsubtitle == "":
         v_extent = 0.88
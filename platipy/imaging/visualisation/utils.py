@@ -43,6 +43,35 @@ class VisualiseContour:
         self.color = color
         self.linewidth = linewidth
         self.linestyle = linestyle
+        self._bounding_box = False
+
+    @property
+    def bounding_box(self):
+        """list: The bounding box of the non-zero voxels of the contour, as a (start, stop) pair
+        of indices for each axis (x, y, z), or None if the contour is empty. This is computed once
+        and cached, so the image shouldn't be modified after creating the VisualiseContour."""
+
+        if self._bounding_box is False:
+            arr = sitk.GetArrayViewFromImage(self.image)
+
+            # Find the slices first, so only those are searched for the in-plane extent
+            z_index = np.flatnonzero(arr.reshape(arr.shape[0], -1).any(axis=1))
+
+            if len(z_index) == 0:
+                self._bounding_box = None
+            else:
+                z_0, z_1 = z_index[0], z_index[-1] + 1
+                in_plane = arr[z_0:z_1].any(axis=0)
+                y_index = np.flatnonzero(in_plane.any(axis=1))
+                x_index = np.flatnonzero(in_plane.any(axis=0))
+
+                self._bounding_box = [
+                    (int(x_index[0]), int(x_index[-1]) + 1),
+                    (int(y_index[0]), int(y_index[-1]) + 1),
+                    (int(z_0), int(z_1)),
+                ]
+
+        return self._bounding_box
 
 
 class VisualiseScalarOverlay:
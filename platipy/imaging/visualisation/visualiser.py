@@ -12,7 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import itertools
 import warnings
+from contextlib import contextmanager
 
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
@@ -47,9 +50,26 @@ This Python script comprises two contributions to the code base:
 """
 
 
+def _is_same_grid(image_a, image_b):
+    """Checks whether two images have the same size, spacing, origin and direction"""
+
+    return (
+        image_a.GetSize() == image_b.GetSize()
+        and np.allclose(image_a.GetSpacing(), image_b.GetSpacing())
+        and np.allclose(image_a.GetOrigin(), image_b.GetOrigin())
+        and np.allclose(image_a.GetDirection(), image_b.GetDirection())
+    )
+
+
 class ImageVisualiser:
     """Class to assist with visualising images and overlaying contours, scalars and bounding
-    boxes."""
+    boxes.
+
+    Only the displayed slices of the image and overlays are extracted when rendering. For a quick
+    preview of a large image, set *preview_size* to downsample the image (and its overlays) in
+    plane so that it is at most this many voxels across. The cut and limits are still given in
+    voxels of the original image.
+    """
 
     def __init__(
         self,
@@ -62,6 +82,7 @@ class ImageVisualiser:
         colormap=plt.cm.get_cmap("Greys_r"),
         origin="normal",
         projection=False,
+        preview_size=None,
     ):
         self.__set_image(image)
         self.__contours = []
@@ -80,6 +101,7 @@ class ImageVisualiser:
         self.__colormap = colormap
         self.__origin = origin
         self.__projection = projection
+        self.__preview_size = preview_size
         self.__image_view = None
         self.__scalar_view = None
         self.__contour_colormap = None
@@ -431,17 +453,19 @@ class ImageVisualiser:
 
     def show(self, interact=False):
         """Render the image with all overlays"""
-        if len(self.__comparison_overlays) == 0:
-            self._display_slice()
-        else:
-            self._overlay_comparison()
 
-        self._overlay_scalar_field()
-        self._overlay_vector_field()
-        self._overlay_contours()
-        self._overlay_bounding_boxes()
+        with self._preview():
+            if len(self.__comparison_overlays) == 0:
+                self._display_slice()
+            else:
+                self._overlay_comparison()
+
+            self._overlay_scalar_field()
+            self._overlay_vector_field()
+            self._overlay_contours()
+            self._overlay_bounding_boxes()
 
-        self._adjust_view()
+            self._adjust_view()
 
         if interact:
             logger.warning("Interactive mode not yet implemented")
@@ -453,11 +477,95 @@ class ImageVisualiser:
 
         return self.__figure
 
+    @contextmanager
+    def _preview(self):
+        """Temporarily downsamples the image and overlays (and converts the cut, limits and
+        bounding boxes to match) if the image is larger than the preview size"""
+
+        if self.__preview_size is None:
+            yield
+            return
+
+        factor = int(np.ceil(max(self.__image.GetSize()[:2]) / self.__preview_size))
+        if factor <= 1:
+            yield
+            return
+
+        shrink_factors = [factor, factor, 1]
+
+        def shrink_overlay(overlay):
+            overlay = copy.copy(overlay)
+            overlay.image = sitk.BinShrink(overlay.image, shrink_factors)
+            return overlay
+
+        def shrink_index(index, axis):
+            if axis == "z":
+                return index
+            return min(index // factor, shrunk_size[axis] - 1)
+
+        def shrink_limit(limit, axis):
+            if axis == "z":
+                return limit
+            return (limit - (factor - 1) / 2) / factor
+
+        original_state = (
+            self.__image,
+            self.__scalar_overlays,
+            self.__vector_overlays,
+            self.__comparison_overlays,
+            self.__bounding_boxes,
+            self.__cut,
+            self.__limits,
+        )
+
+        self.__image = sitk.BinShrink(self.__image, shrink_factors)
+        shrunk_size = dict(zip("xyz", self.__image.GetSize()))
+        self.__scalar_overlays = [shrink_overlay(s) for s in self.__scalar_overlays]
+        self.__vector_overlays = [shrink_overlay(v) for v in self.__vector_overlays]
+        self.__comparison_overlays = [shrink_overlay(c) for c in self.__comparison_overlays]
+
+        # Contours are resampled to the (downsampled) image when rendered
+        self.__bounding_boxes = []
+        for box in original_state[4]:
+            box = copy.copy(box)
+            sag_0, cor_0, ax_0, sag_d, cor_d, ax_d = box.bounding_box
+            box.bounding_box = [
+                shrink_limit(sag_0, "x"),
+                shrink_limit(cor_0, "y"),
+                ax_0,
+                sag_d / factor,
+                cor_d / factor,
+                ax_d,
+            ]
+            self.__bounding_boxes.append(box)
+
+        if hasattr(self.__cut, "__iter__"):
+            self.__cut = [shrink_index(c, a) for c, a in zip(self.__cut, "zyx")]
+        elif self.__cut is not None:
+            self.__cut = shrink_index(self.__cut, self.__axis)
+
+        if self.__limits is not None:
+            limit_axes = {"ortho": "zzyyxx", "x": "yyzz", "y": "xxzz", "z": "xxyy"}[self.__axis]
+            self.__limits = [shrink_limit(l, a) for l, a in zip(self.__limits, limit_axes)]
+
+        try:
+            yield
+        finally:
+            (
+                self.__image,
+                self.__scalar_overlays,
+                self.__vector_overlays,
+                self.__comparison_overlays,
+                self.__bounding_boxes,
+                self.__cut,
+                self.__limits,
+            ) = original_state
+
     def _display_slice(self):
         """Display the configured image slice"""
 
         image = self.__image
-        nda = sitk.GetArrayFromImage(image)
+        nda = sitk.GetArrayViewFromImage(image)
 
         (ax_size, cor_size, sag_size) = nda.shape[:3]
 
@@ -482,7 +590,7 @@ class ImageVisualiser:
                 f"Found a (z,y,x,{nda.shape[3]}) dimensional array - assuming this is an RGB"
                 "image."
             )
-            nda /= nda.max()
+            nda = nda / nda.max()
         except ValueError:
             logger.warning("Problem converting RGB image to np.ndarray.")
         except IndexError:
@@ -525,9 +633,10 @@ class ImageVisualiser:
                 s_cor = return_slice("y", self.__cut[1])
                 s_sag = return_slice("x", self.__cut[2])
 
-                ax_img = nda.__getitem__(s_ax)
-                cor_img = nda.__getitem__(s_cor)
-                sag_img = nda.__getitem__(s_sag)
+                # Copies of the slices, so the figure doesn't reference the image memory
+                ax_img = np.array(nda.__getitem__(s_ax))
+                cor_img = np.array(nda.__getitem__(s_cor))
+                sag_img = np.array(nda.__getitem__(s_sag))
 
             else:
                 ax_img_proj = project_onto_arbitrary_plane(
@@ -641,7 +750,7 @@ class ImageVisualiser:
 
             if not self.__projection:
                 s = return_slice(self.__axis, self.__cut)
-                disp_img = nda.__getitem__(s)
+                disp_img = np.array(nda.__getitem__(s))
             else:
                 disp_img_proj = project_onto_arbitrary_plane(
                     image,
@@ -681,10 +790,9 @@ class ImageVisualiser:
             comparison_overlay = self.__comparison_overlays[0]
 
         image_original = self.__image
-        nda_original = sitk.GetArrayFromImage(image_original)
+        nda_original = sitk.GetArrayViewFromImage(image_original)
 
         image_new = comparison_overlay.image
-        nda_new = sitk.GetArrayFromImage(image_new)
         color_rotation = comparison_overlay.color_rotation
 
         (ax_size, cor_size, sag_size) = nda_original.shape
@@ -737,7 +845,7 @@ class ImageVisualiser:
             s_sag = return_slice("x", self.__cut[2])
 
             nda_colormix = generate_comparison_colormix(
-                [nda_original, nda_new],
+                [image_original, image_new],
                 arr_slice=s_ax,
                 window=window,
                 color_rotation=color_rotation,
@@ -751,7 +859,7 @@ class ImageVisualiser:
             )
 
             nda_colormix = generate_comparison_colormix(
-                [nda_original, nda_new],
+                [image_original, image_new],
                 arr_slice=s_cor,
                 window=window,
                 color_rotation=color_rotation,
@@ -765,7 +873,7 @@ class ImageVisualiser:
             )
 
             nda_colormix = generate_comparison_colormix(
-                [nda_original, nda_new],
+                [image_original, image_new],
                 arr_slice=s_sag,
                 window=window,
                 color_rotation=color_rotation,
@@ -829,7 +937,10 @@ class ImageVisualiser:
             s = return_slice(self.__axis, self.__cut)
 
             nda_colormix = generate_comparison_colormix(
-                [nda_original, nda_new], arr_slice=s, window=window, color_rotation=color_rotation
+                [image_original, image_new],
+                arr_slice=s,
+                window=window,
+                color_rotation=color_rotation,
             )
 
             ax.imshow(
@@ -959,23 +1070,124 @@ class ImageVisualiser:
 
                 self.__figure.set_size_inches(fig_size_x, fig_size_y)
 
+    def _get_contour_bounding_box(self, contour):
+        """Gets the bounding box of a contour in the index space of the image, expanded by one
+        voxel so that contour lines at the edge of the box are closed.
+
+        Args:
+            contour (VisualiseContour): The contour.
+
+        Returns:
+            list: A (start, stop) pair of indices for each axis (x, y, z), or None if the contour
+            is empty or outside of the image.
+        """
+
+        bounding_box = contour.bounding_box
+
+        if bounding_box is None:
+            return None
+
+        image = self.__image
+
+        if not _is_same_grid(contour.image, image):
+            # The interpolated contour is zero from the centre of the voxels next to the box
+            corners = itertools.product(
+                *[(start - 1.0, float(stop)) for start, stop in bounding_box]
+            )
+            points = np.array(
+                [
+                    image.TransformPhysicalPointToContinuousIndex(
+                        contour.image.TransformContinuousIndexToPhysicalPoint(corner)
+                    )
+                    for corner in corners
+                ]
+            )
+            bounding_box = zip(
+                np.floor(points.min(axis=0)).astype(int) + 1,
+                np.ceil(points.max(axis=0)).astype(int),
+            )
+
+        bounding_box = [
+            (max(start - 1, 0), min(stop + 1, size))
+            for (start, stop), size in zip(bounding_box, image.GetSize())
+        ]
+
+        if any(start >= stop for start, stop in bounding_box):
+            return None
+
+        return bounding_box
+
+    def _get_contour_slice(self, contour, bounding_box, axis, index):
+        """Extracts a slice of a contour on the grid of the image, cropped to its bounding box.
+        Only this region is read (or resampled, if the contour is defined on a different grid).
+
+        Args:
+            contour (VisualiseContour): The contour.
+            bounding_box (list): The bounding box of the contour, see _get_contour_bounding_box.
+            axis (str): One of "x", "y" or "z"
+            index (int): The index of the slice
+
+        Returns:
+            tuple: The (cropped) slice and the (row, column) index of its first element in the
+            full slice, or (None, None) if the contour isn't defined on this slice.
+        """
+
+        dim = {"x": 0, "y": 1, "z": 2}[axis]
+
+        if bounding_box is None or not bounding_box[dim][0] <= index < bounding_box[dim][1]:
+            return None, None
+
+        region = [slice(start, stop) for start, stop in bounding_box]
+        region[dim] = slice(index, index + 1)
+
+        if _is_same_grid(contour.image, self.__image):
+            contour_arr = sitk.GetArrayViewFromImage(contour.image)[tuple(region[::-1])]
+        else:
+            contour_arr = sitk.GetArrayFromImage(
+                sitk.Resample(contour.image, self.__image[tuple(region)])
+            )
+
+        contour_slice = np.array(contour_arr[return_slice(axis, 0)])
+
+        if not contour_slice.any():
+            return None, None
+
+        row_dim, column_dim = {"x": (2, 1), "y": (2, 0), "z": (1, 0)}[axis]
+
+        return contour_slice, (bounding_box[row_dim][0], bounding_box[column_dim][0])
+
+    @staticmethod
+    def _draw_contour_slice(ax, contour_slice, offset=(0, 0), **kwargs):
+        """Draws the contour of a (cropped) slice, see _get_contour_slice"""
+
+        if contour_slice is None:
+            # Force a single pixel to 1 to display all contours
+            # even if they aren't defined on a particular slice
+            contour_slice = np.zeros((2, 2))
+            contour_slice[0, 0] = 1
+            offset = (0, 0)
+
+        rows, columns = contour_slice.shape
+        row_0, column_0 = offset
+
+        return ax.contour(
+            contour_slice,
+            levels=[0.5],
+            origin="lower",
+            extent=(column_0, column_0 + columns, row_0, row_0 + rows),
+            **kwargs,
+        )
+
     def _overlay_contours(self):
         """Overlay the contours on to the current figure image"""
 
         if len(self.__contours) == 0:
             return
 
-        plot_dict = {}
-        color_dict = {}
-        lw_dict = {}
-        ls_dict = {}
-
         color_gen_index = 0
+        color_dict = {}
 
         for contour in self.__contours:
-            contour_image_resampled = sitk.Resample(contour.image, self.__image)
-            plot_dict[contour.name] = contour_image_resampled
-
             if contour.color is not None:
                 color_dict[contour.name] = contour.color
             else:
@@ -984,126 +1196,84 @@ class ImageVisualiser:
                 color_dict[contour.name] = color_map[color_gen_index % 255]
                 color_gen_index += 1
 
-            lw_dict[contour.name] = contour.linewidth
-            ls_dict[contour.name] = contour.linestyle
+        def get_projection(contour, projection_axis):
+            # Projections need the whole contour on the grid of the image
+            contour_image_resampled = sitk.Resample(contour.image, self.__image)
+            contour_proj = project_onto_arbitrary_plane(
+                contour_image_resampled,
+                projection_axis=projection_axis,
+                projection_name="max",
+                default_value=0,
+            )
+            return sitk.GetArrayFromImage(contour_proj), (0, 0)
 
         # Test types of axes
         axes = self.__figure.axes[:4]
 
         if self.__axis in ["x", "y", "z"]:
             ax = axes[0]
-            s = return_slice(self.__axis, self.__cut)
 
-            for c_name in plot_dict:
+            for contour in self.__contours:
                 if not self.__projection:
-                    contour_disp = sitk.GetArrayFromImage(plot_dict[c_name]).__getitem__(s)
-
-                    # Force a single pixel to 1 to display all contours
-                    # even if they aren't defined on a particular slice
-                    if contour_disp.sum() == 0:
-                        contour_disp[0, 0] = 1
+                    contour_disp, offset = self._get_contour_slice(
+                        contour,
+                        self._get_contour_bounding_box(contour),
+                        self.__axis,
+                        self.__cut,
+                    )
 
                 else:
-                    contour_disp_proj = project_onto_arbitrary_plane(
-                        plot_dict[c_name],
-                        projection_axis={"x": 0, "y": 1, "z": 2}[self.__axis],
-                        projection_name="max",
-                        default_value=0,
+                    contour_disp, offset = get_projection(
+                        contour, {"x": 0, "y": 1, "z": 2}[self.__axis]
                     )
-                    contour_disp = sitk.GetArrayFromImage(contour_disp_proj)
 
                 try:
-                    temp = ax.contour(
+                    temp = self._draw_contour_slice(
+                        ax,
                         contour_disp,
-                        colors=[color_dict[c_name]],
-                        levels=[0.5],
+                        offset,
+                        colors=[color_dict[contour.name]],
                         # alpha=0.8,
-                        linewidths=lw_dict[c_name],
-                        linestyles=ls_dict[c_name],
-                        label=c_name,
-                        origin="lower",
+                        linewidths=contour.linewidth,
+                        linestyles=contour.linestyle,
+                        label=contour.name,
                     )
-                    temp.collections[0].set_label(c_name)
+                    temp.collections[0].set_label(contour.name)
                 except AttributeError:
                     pass
 
         elif self.__axis == "ortho":
             ax_ax, _, ax_cor, ax_sag = axes
 
-            ax = ax_ax
-
-            s_ax = return_slice("z", self.__cut[0])
-            s_cor = return_slice("y", self.__cut[1])
-            s_sag = return_slice("x", self.__cut[2])
-
-            for _, c_name in enumerate(plot_dict.keys()):
+            for contour in self.__contours:
 
                 if not self.__projection:
+                    bounding_box = self._get_contour_bounding_box(contour)
 
-                    contour_ax = sitk.GetArrayFromImage(plot_dict[c_name]).__getitem__(s_ax)
-                    contour_cor = sitk.GetArrayFromImage(plot_dict[c_name]).__getitem__(s_cor)
-                    contour_sag = sitk.GetArrayFromImage(plot_dict[c_name]).__getitem__(s_sag)
-
-                    # Force a single pixel to 1 to display all contours
-                    # even if they aren't defined on a particular slice
-                    if contour_ax.sum() == 0:
-                        contour_ax[0, 0] = 1
-                    if contour_cor.sum() == 0:
-                        contour_cor[0, 0] = 1
-                    if contour_sag.sum() == 0:
-                        contour_sag[0, 0] = 1
+                    contour_ax = self._get_contour_slice(contour, bounding_box, "z", self.__cut[0])
+                    contour_cor = self._get_contour_slice(
+                        contour, bounding_box, "y", self.__cut[1]
+                    )
+                    contour_sag = self._get_contour_slice(
+                        contour, bounding_box, "x", self.__cut[2]
+                    )
 
                 else:
-                    contour_ax_proj = project_onto_arbitrary_plane(
-                        plot_dict[c_name],
-                        projection_axis=2,
-                        projection_name="max",
-                        default_value=0,
-                    )
-                    contour_ax = sitk.GetArrayFromImage(contour_ax_proj)
+                    contour_ax = get_projection(contour, 2)
+                    contour_cor = get_projection(contour, 1)
+                    contour_sag = get_projection(contour, 0)
+
+                contour_kwargs = {
+                    "linewidths": contour.linewidth,
+                    "linestyles": contour.linestyle,
+                    "colors": [color_dict[contour.name]],
+                }
 
-                    contour_cor_proj = project_onto_arbitrary_plane(
-                        plot_dict[c_name],
-                        projection_axis=1,
-                        projection_name="max",
-                        default_value=0,
-                    )
-                    contour_cor = sitk.GetArrayFromImage(contour_cor_proj)
+                temp = self._draw_contour_slice(ax_ax, *contour_ax, **contour_kwargs)
+                temp.collections[0].set_label(contour.name)
 
-                    contour_sag_proj = project_onto_arbitrary_plane(
-                        plot_dict[c_name],
-                        projection_axis=0,
-                        projection_name="max",
-                        default_value=0,
-                    )
-                    contour_sag = sitk.GetArrayFromImage(contour_sag_proj)
-
-                temp = ax_ax.contour(
-                    contour_ax,
-                    levels=[0.5],
-                    linewidths=lw_dict[c_name],
-                    linestyles=ls_dict[c_name],
-                    colors=[color_dict[c_name]],
-                    origin="lower",
-                )
-                temp.collections[0].set_label(c_name)
-
-                ax_cor.contour(
-                    contour_cor,
-                    levels=[0.5],
-                    linewidths=lw_dict[c_name],
-                    linestyles=ls_dict[c_name],
-                    colors=[color_dict[c_name]],
-                    origin="lower",
-                )
-                ax_sag.contour(
-                    contour_sag,
-                    levels=[0.5],
-                    linewidths=lw_dict[c_name],
-                    linestyles=ls_dict[c_name],
-                    colors=[color_dict[c_name]],
-                    origin="lower",
-                )
+                self._draw_contour_slice(ax_cor, *contour_cor, **contour_kwargs)
+                self._draw_contour_slice(ax_sag, *contour_sag, **contour_kwargs)
 
         else:
             raise ValueError('Axis is must be one of "x","y","z","ortho".')
@@ -1114,7 +1284,7 @@ class ImageVisualiser:
         for scalar_index, scalar in enumerate(self.__scalar_overlays):
 
             scalar_image = scalar.image
-            nda = sitk.GetArrayFromImage(scalar_image)
+            nda = sitk.GetArrayViewFromImage(scalar_image)
 
             alpha = scalar.alpha
 
@@ -1160,9 +1330,9 @@ class ImageVisualiser:
                     s_cor = return_slice("y", self.__cut[1])
                     s_sag = return_slice("x", self.__cut[2])
 
-                    ax_img = nda.__getitem__(s_ax)
-                    cor_img = nda.__getitem__(s_cor)
-                    sag_img = nda.__getitem__(s_sag)
+                    ax_img = np.array(nda.__getitem__(s_ax))
+                    cor_img = np.array(nda.__getitem__(s_cor))
+                    sag_img = np.array(nda.__getitem__(s_sag))
 
                 else:
                     ax_img_proj = project_onto_arbitrary_plane(
@@ -1246,7 +1416,7 @@ class ImageVisualiser:
 
                 if not projection:
                     s = return_slice(self.__axis, self.__cut)
-                    disp_img = nda.__getitem__(s)
+                    disp_img = np.array(nda.__getitem__(s))
                 else:
                     disp_img_proj = project_onto_arbitrary_plane(
                         scalar_image,
@@ -1364,7 +1534,7 @@ class ImageVisualiser:
             max_value = vector.max_value
 
             inverse_vector_image = image  # sitk.InvertDisplacementField(image)
-            vector_nda = sitk.GetArrayFromImage(inverse_vector_image)
+            vector_nda = sitk.GetArrayViewFromImage(inverse_vector_image)
 
             # Test types of axes
             axes = self.__figure.axes
@@ -1378,7 +1548,7 @@ class ImageVisualiser:
                     )
 
                 slicer = subsample_vector_field(self.__axis, self.__cut, subsample)
-                vector_nda_slice = vector_nda.__getitem__(slicer)
+                vector_nda_slice = np.array(vector_nda.__getitem__(slicer))
 
                 vector_ax = vector_nda_slice[:, :, 2].T
                 vector_cor = vector_nda_slice[:, :, 1].T
@@ -1441,7 +1611,7 @@ class ImageVisualiser:
                 ):
 
                     slicer = subsample_vector_field(im_axis, im_cut, subsample)
-                    vector_nda_slice = vector_nda.__getitem__(slicer)
+                    vector_nda_slice = np.array(vector_nda.__getitem__(slicer))
 
                     vector_ax = vector_nda_slice[:, :, 2].T
                     vector_cor = vector_nda_slice[:, :, 1].T